@@ -230,6 +230,18 @@ class DirectEthernetProxy(LabradServer):
             return (src, dest, typ, data)
         return self._read(c, num, toWords)
 
+    @setting(16, 'Read Concatenated', num=['w'], returns='s')
+    def read_concatenated(self, c, num=1):
+        """Read packets and return their data concatenated into one string.
+
+        Source, destination and ether type are dropped, so all packets read
+        this way should have the same length if they are to be split apart
+        again by the caller.
+        """
+        pkts = yield c['buf'].get(num, timeout=c['timeout'])
+        returnValue(''.join(np.asarray(data).tostring()
+                            for src, dest, typ, data in pkts))
+
     @inlineCallbacks
     def _read(self, c, num, func=None):
         pkts = yield c['buf'].read(num, timeout=c['timeout'])
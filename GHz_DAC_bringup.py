@@ -126,34 +126,38 @@ def bringupBoards(fpga, boards, noisy=False):
     """Bringup a list of boards and return the Bist/FIFO and lvds success for
     each one.
     
-    TODO:
-    Put in code to keep track of retries and report this to the user
+    The server brings up all boards concurrently. Boards which fail are tried
+    again, up to NUM_TRIES times.
     """
     successes = {}
-    triesDict = {}
-    for board in boards:
+    triesDict = dict((board, 0) for board in boards)
+    remaining = list(boards)
+    while remaining:
         if noisy:
-            print 'bringing up %s' %board
-        #Temporarily set a value to False so while loop will run at least once
-        allOk = False
-        tries = 0
-        #Try to bring up the board until it succeeds or we exceed maximum
-        #number of tries.
-        while tries < NUM_TRIES and not allOk:
-            tries += 1
-            triesDict[board] = tries
-            boardType, result, successDict = bringupBoard(fpga, board,
-                                                          fullOutput=False,
-                                                          printOutput=True)
-            allOk = all(successDict.values())
-            successes[board] = successDict
+            print 'bringing up %s' %', '.join(remaining)
+        resp = fpga.bringup_all(remaining)
+        retry = []
+        for board, success, elapsed, error, results in resp:
+            triesDict[board] += 1
+            successes[board] = success
+            if error:
+                print '%s ---Bringup Error--- %s' %(board, error)
+            elif success:
+                print '%s ok (%.1f s)' %(board, elapsed['s'])
+                if not all(dict(r)['lvdsSuccess'] for r in results):
+                    print 'but LVDS warning'
+            else:
+                print '%s ---Bringup Failure---' %board
+            if not success and triesDict[board] < NUM_TRIES:
+                retry.append(board)
+        remaining = retry
     failures = []
     for board in boards:
         #Warn the user if a board took more than one try to bring up.
         if triesDict[board]>1:
             print 'WARNING: Board %s took %d tries to succeed' %(board,triesDict[board])
         #If this board failed, add it to the list of failures
-        if not all(successes[board].values()):
+        if not successes[board]:
             failures.append(board)
     if not failures:
         print 'All boards successful!'
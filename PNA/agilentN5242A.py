@@ -32,7 +32,9 @@ timeout = 30
 
 from labrad import types as T, util
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
+from labrad.gpib import GPIBManagedServer
+from gpib_transaction import GPIBTransactionWrapper
+from oscilloscope.waveform import decode_block
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from struct import unpack
@@ -46,7 +48,14 @@ Hz = units.Hz
 # the names of the measured parameters
 MEAS_PARAM = ['S11', 'S12', 'S21', 'S22']
 
-class PNAWrapper(GPIBDeviceWrapper):
+# outer parameters of a sweep series, and their data vault (label, unit)
+SERIES_PARAM = {
+    'power': ('power', 'dBm'),
+    'bias': ('bias', ''),
+    'repeat': ('repeat', ''),
+}
+
+class PNAWrapper(GPIBTransactionWrapper):
     @inlineCallbacks
     def initialize(self):
         yield self.write('FORM:DATA REAL,64')
@@ -78,9 +87,91 @@ class PNAWrapper(GPIBDeviceWrapper):
             print cmd
             yield self.write(cmd)
 
+    @inlineCallbacks
+    def sweepData(self, measurements):
+        """Wait for the sweep to finish and get the data of all measurements.
+
+        The stimulus values and the data of all measurements are fetched in
+        one request, the data with a single CALC:DATA:MSD? query. This
+        reads formatted data, so the measurements are set to polar format,
+        which has the real and imaginary part of each point.
+
+        Returns:
+            (ndarray): Stimulus values, e.g. frequencies in Hz.
+            (ndarray(complex)): Data, one row per measurement.
+        """
+        ops = [('query', '*OPC?')]
+        for meas in measurements:
+            ops.append(('write', "CALC:PAR:SEL '%s'" % _parName(meas)))
+            ops.append(('write', 'CALC:FORM POL'))
+        names = ','.join(_parName(meas) for meas in measurements)
+        ops.extend([('write', 'SENS:X?'), ('read_raw', ''),
+                    ('write', 'CALC:DATA:MSD? "%s"' % names), ('read_raw', '')])
+        resp = yield self.transaction(ops)
+        x = decode_block(resp[-3], '>f8')
+        data = _complex(decode_block(resp[-1], '>f8'))
+        returnValue((x, data.reshape(len(measurements), -1)))
+
+    @inlineCallbacks
+    def segments(self, segments=None):
+        """Get or set the segment table.
+
+        Each segment is (start, stop, points, IF bandwidth, power), with
+        frequencies in Hz and power in dBm. Setting the table turns on per
+        segment IF bandwidth and power.
+        """
+        if segments is not None:
+            ops = [('write', 'SENS:SEGM:DEL:ALL'),
+                   ('write', 'SENS:SEGM:BWID:CONT ON'),
+                   ('write', 'SENS:SEGM:POW:CONT ON')]
+            for n, (start, stop, points, bw, power) in enumerate(segments, 1):
+                seg = 'SENS:SEGM%d' % n
+                ops.extend([('write', seg + ':ADD'),
+                            ('write', seg + ':FREQ:STAR %f' % start),
+                            ('write', seg + ':FREQ:STOP %f' % stop),
+                            ('write', seg + ':SWE:POIN %u' % points),
+                            ('write', seg + ':BWID %f' % bw),
+                            ('write', seg + ':POW %f' % power),
+                            ('write', seg + ' ON')])
+            yield self.transaction(ops)
+        count = yield self.query('SENS:SEGM:COUN?')
+        ops = []
+        for n in range(1, int(count) + 1):
+            seg = 'SENS:SEGM%d' % n
+            ops.extend([('query', seg + ':FREQ:STAR?'),
+                        ('query', seg + ':FREQ:STOP?'),
+                        ('query', seg + ':SWE:POIN?'),
+                        ('query', seg + ':BWID?'),
+                        ('query', seg + ':POW?')])
+        resp = yield self.transaction(ops)
+        table = []
+        for n in range(0, len(resp), 5):
+            start, stop, points, bw, power = resp[n:n+5]
+            table.append((float(start), float(stop), long(points), float(bw),
+                          float(power)))
+        returnValue(table)
+
 def _parName(meas):
     return 'labrad_%s' % meas
 
+def _complex(data):
+    """Complex array from interleaved real and imaginary parts."""
+    return data[0::2] + 1j * data[1::2]
+
+def _sweepRows(x, sparams):
+    """Data vault rows of a sweep.
+
+    The columns are x, then the log magnitude [dB] of each S parameter,
+    then the phase [rad] of each S parameter.
+    """
+    sparams = numpy.atleast_2d(sparams)
+    return numpy.vstack((x, 20*numpy.log10(abs(sparams)),
+                         numpy.angle(sparams))).T
+
+def _sweepDependents(meas):
+    return ([(Sij, 'log mag', 'dB') for Sij in meas] +
+            [(Sij, 'phase', 'rad') for Sij in meas])
+
 class AgilentPNAServer(GPIBManagedServer):
     name = 'PNA_X'
     deviceName = ['Agilent Technologies N5242A',
@@ -175,6 +266,22 @@ class AgilentPNAServer(GPIBManagedServer):
             yield dev.write('SOUR:POW:ATT %f; STAR %f; STOP %f' %(good_atten, ps[0]['dBm'], ps[1]['dBm']))
         returnValue(ps)
 
+    @setting(18, segments=['*(v[Hz] v[Hz] w v[Hz] v[dBm])'],
+             returns=['*(v[Hz] v[Hz] w v[Hz] v[dBm])'])
+    def segments(self, c, segments=None):
+        """Get or set the segment table for segmented sweeps.
+
+        Each segment is (start, stop, points, IF bandwidth, power). Use
+        segments to measure densely near features and sparsely elsewhere.
+        """
+        dev = self.selectedDevice(c)
+        if segments is not None:
+            segments = [(start['Hz'], stop['Hz'], points, bw['Hz'], p['dBm'])
+                        for start, stop, points, bw, p in segments]
+        table = yield dev.segments(segments)
+        returnValue([(start*Hz, stop*Hz, points, bw*Hz, T.Value(p, 'dBm'))
+                     for start, stop, points, bw, p in table])
+
     @setting(16, n=['w'], returns=['w'])
     def num_points(self, c, n=None):
         """Get or set the number of points."""
@@ -288,6 +395,20 @@ class AgilentPNAServer(GPIBManagedServer):
         sparams = yield self.getSweepData(dev, c['meas'])
         returnValue((freq*units.Hz, sparams))
 
+    @setting(103, returns='*v[Hz]*2c')
+    def segment_sweep(self, c):
+        """Initiate a segmented sweep, see segments.
+
+        Returns:
+            (tuple):
+                (ValueArray[Hz]): Frequencies of all segments.
+                (ndarray(complex)): S parameters, one row per measurement
+                    (see s_parameters).
+        """
+        dev = self.selectedDevice(c)
+        freq, sparams = yield self._sweep(c, dev, 'SEGM')
+        returnValue((freq*Hz, sparams))
+
     @setting(102, returns='*v[Hz]*c')
     def get_trace(self, c, trace='S21'):
         """Get a trace.
@@ -304,7 +425,7 @@ class AgilentPNAServer(GPIBManagedServer):
         resp = yield dev.query('SENS:FREQ:STAR?; STOP?')
         f_start_Hz, f_stop_Hz = (float(f) for f in resp.split(';'))
         n_points = yield dev.query('SENS:SWE:POIN?')
-        freq = numpy.linspace(f_start_Hz, f_stop_Hz, n_points) * Hz
+        freq = numpy.linspace(f_start_Hz, f_stop_Hz, int(n_points)) * Hz
         s_params = yield self.getData(dev, trace)
         returnValue((freq, s_params))
 
@@ -399,24 +520,15 @@ class AgilentPNAServer(GPIBManagedServer):
 
         sparams = yield self.getSweepData(dev, c['meas'])
 
-        power = util.linspace(pstar, pstop, npoints)
-        power = [T.Value(p, 'dBm') for p in power]
-        for s in sparams:
-            for i, cplx in enumerate(s):
-                s[i] = T.Complex(cplx)
-
-        p = numpy.array(power)
-        s = 20*numpy.log10(abs(numpy.array(sparams)))
-        phases = numpy.angle(numpy.array(sparams))
-        data = numpy.vstack((p, s, phases)).T
-        data = data.astype('float64')
+        power = numpy.linspace(pstar, pstop, npoints)
+        data = _sweepRows(power, sparams)
 
         dv = self.client.data_vault
         freq = yield self.frequency(c)
         bw = yield self.bandwidth(c)
         
         independents = ['power [dBm]']
-        dependents = [('log mag', Sij, 'dB') for Sij in c['meas']]+[(Sij, 'phase', 'dB') for Sij in c['meas']]
+        dependents = _sweepDependents(c['meas'])
         p = dv.packet()
         p.new(name, independents, dependents)
         p.add(data)
@@ -448,24 +560,15 @@ class AgilentPNAServer(GPIBManagedServer):
 
         sparams = yield self.getSweepData(dev, c['meas'])
 
-        freq = util.linspace(fstar, fstop, npoints)
-        freq = [T.Value(f, 'Hz') for f in freq]
-        for s in sparams:
-            for i, cplx in enumerate(s):
-                s[i] = T.Complex(cplx)
-
-        f = numpy.array(freq)
-        s = 20*numpy.log10(abs(numpy.array(sparams)))
-        phases = numpy.angle(numpy.array(sparams))
-        data = numpy.vstack((f, s, phases)).T
-        data = data.astype('float64')
+        freq = numpy.linspace(fstar, fstop, npoints)
+        data = _sweepRows(freq, sparams)
 
         dv = self.client.data_vault
         power = yield self.power(c)
         bw = yield self.bandwidth(c)
         
         independents = ['frequency [Hz]']
-        dependents = [(Sij, 'log mag', 'dB') for Sij in c['meas']]+[(Sij, 'phase', 'dB') for Sij in c['meas']]
+        dependents = _sweepDependents(c['meas'])
         p = dv.packet()
         p.new(name, independents, dependents)
         p.add(data)
@@ -476,6 +579,69 @@ class AgilentPNAServer(GPIBManagedServer):
         
         returnValue(data)
 
+    @setting(112, name='s', parameter='s', values='*v', segmented='b',
+             callback='(ss)', returns='(*s s)')
+    def sweep_series(self, c, name, parameter, values, segmented=False,
+                     callback=None):
+        """Run a series of frequency sweeps, stepping an outer parameter.
+
+        All sweeps are saved to one new dataset in the data vault, in the
+        current directory for this context, with the outer parameter and
+        frequency as independents. Each sweep is saved while the next one
+        runs, so the PNA does not wait for the data vault.
+
+        Args:
+            name (str): Name of the dataset.
+            parameter (str): The outer parameter, one of
+                'power': the source power in dBm,
+                'bias': a value sent to the callback setting, e.g. a flux
+                    bias,
+                'repeat': nothing is changed, values just label the sweeps.
+            values (list[float]): Values of the outer parameter.
+            segmented (bool): Whether to run segmented sweeps (see
+                segments) instead of linear ones.
+            callback (str, str): Server and setting called with each value
+                for a bias series.
+
+        Returns:
+            (list[str], str): Path and name of the dataset.
+        """
+        if parameter not in SERIES_PARAM:
+            raise ValueError('Unknown series parameter %s, expected one of %s'
+                             % (parameter, ', '.join(sorted(SERIES_PARAM))))
+        if parameter == 'bias' and callback is None:
+            raise ValueError('A bias series needs a callback setting')
+        dev = self.selectedDevice(c)
+        dv = self.client.data_vault
+
+        independents = [SERIES_PARAM[parameter], ('frequency', 'Hz')]
+        dependents = _sweepDependents(c['meas'])
+        path, dataset = yield dv.new(name, independents, dependents,
+                                     context=c.ID)
+        bw = yield self.bandwidth(c)
+        yield dv.add_parameter('bandwidth', bw, context=c.ID)
+        if parameter != 'power':
+            power = yield self.power(c)
+            yield dv.add_parameter('power', power, context=c.ID)
+
+        sweepType = 'SEGM' if segmented else 'LIN'
+        saving = None
+        for value in values:
+            if parameter == 'power':
+                yield dev.write('SOUR:POW %f' % value)
+            elif parameter == 'bias':
+                server, callbackName = callback
+                yield self.client[server][callbackName](value)
+            freq, sparams = yield self._sweep(c, dev, sweepType)
+            if saving is not None:
+                yield saving
+            data = _sweepRows(freq, sparams)
+            data = numpy.column_stack((numpy.full(len(freq), value), data))
+            saving = dv.add(data, context=c.ID)
+        if saving is not None:
+            yield saving
+        returnValue((path, dataset))
+
     @setting(200, params=['*s'], returns=['*s'])
     def s_parameters(self, c, params=None):
         """Specify the scattering parameters to be measured.
@@ -525,25 +691,35 @@ class AgilentPNAServer(GPIBManagedServer):
     
     @inlineCallbacks
     def startSweep(self, dev, sweeptype):
-        yield dev.write('SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON')
-        resp = yield dev.query('SENS:SWE:TIME?; POIN?')
-        sweeptime, npoints = resp.split(';')
+        resp = yield dev.transaction([
+            ('write', 'SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON'),
+            ('query', 'SENS:SWE:TIME?; POIN?'),
+            ('write', 'SENS:SWE:TYPE %s' % sweeptype),
+            # ('write', 'ABORT;INIT:IMM'),
+            ('query', 'SENS:AVER:COUN?'),
+            ('write', 'ABORT;SENS:SWE:MODE GRO')])
+        sweeptime, npoints = resp[1].split(';')
         sweeptime = float(sweeptime)
         npoints = int(npoints)
-        yield dev.write('SENS:SWE:TYPE %s' % sweeptype)
-        # yield dev.write('ABORT;INIT:IMM')
-        resp = yield dev.query('SENS:AVER:COUN?')
-        sweeptime *= long(resp)
-        yield dev.write('ABORT;SENS:SWE:MODE GRO')
+        sweeptime *= long(resp[3])
         print 'sweeptime = ',sweeptime
         print 'npoints = ',npoints
         returnValue((sweeptime, npoints))
 
+    @inlineCallbacks
+    def _sweep(self, c, dev, sweeptype):
+        """Run a sweep and get its stimulus values and data."""
+        sweeptime, npoints = yield self.startSweep(dev, sweeptype)
+        if sweeptime > 1:
+            sweeptime *= self.sweepFactor(c)
+            yield util.wakeupCall(sweeptime)
+        x, sparams = yield dev.sweepData(c['meas'])
+        yield dev.write('OUTP OFF')
+        returnValue((x, sparams))
+
     @inlineCallbacks
     def getSweepData(self, dev, meas):
-        yield dev.query('*OPC?') # wait for sweep to finish
-        print 'Query Accepted'
-        sdata = yield self.getSParams(dev, meas)    
+        _, sdata = yield dev.sweepData(meas)
         yield dev.write('OUTP OFF')
         returnValue(sdata)
         
@@ -554,12 +730,6 @@ class AgilentPNAServer(GPIBManagedServer):
         yield dev.write('OUTP OFF')
         returnValue(sdata)
 
-    @inlineCallbacks
-    def getSParams(self, dev, measurements):
-        sdata = [(yield self.getData(dev, m)) for m in measurements]
-        print 'Got Params'
-        returnValue(sdata)
-        
     @inlineCallbacks
     def getPhaseData(self, dev, measurements):
         sdata = [(yield self.getFormattedData(dev, m)) for m in measurements]
@@ -584,26 +754,14 @@ class AgilentPNAServer(GPIBManagedServer):
             d bytes: binary sweep data, as pairs of 64-bit numbers
             1 byte:  <newline> (ignored)
 
-        The 64-bit numbers are unpacked using the struct.unpack
-        function from the standard library.
+        The data is read raw, so that bytes which look like whitespace are
+        not stripped, and decoded with numpy.
         """
-        yield dev.write("CALC:PAR:SEL '%s'" % _parName(meas))
-        yield dev.write("CALC:DATA? SDATA")
-        # as of pyvisa 1.6 reading a set number of bytes no longer seems to work
-        # we still put in a number here because we want to use read_raw to avoid attempted conversion of non-ascii chars
-        data = yield dev.read(99999)
-        
-        # parse header for length of data
-        headerLen = long(data[1])        
-        dataLen = long(data[2:2+headerLen])
-        # parse data
-        dataStr = data[2+headerLen:]
-        nPoints = dataLen / 16
-        
-        _parse = lambda s: complex(*unpack('>dd', s))
-        data = [_parse(dataStr[16*n:16*(n+1)]) for n in range(nPoints)]
-        
-        returnValue(data)
+        resp = yield dev.transaction([
+            ('write', "CALC:PAR:SEL '%s'" % _parName(meas)),
+            ('write', "CALC:DATA? SDATA"),
+            ('read_raw', '')])
+        returnValue(_complex(decode_block(resp[2], '>f8')))
         
     @inlineCallbacks
     def getFormattedData(self, dev, meas):
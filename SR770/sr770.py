@@ -42,7 +42,6 @@ from labrad.units import Value, Unit
 
 Hz,MHz,V,nV = [Unit(s) for s in ['Hz', 'MHz', 'V', 'nV']]
 
-from struct import unpack
 import numpy as np
 import time
 
@@ -221,6 +220,32 @@ class SR770Wrapper(GPIBDeviceWrapper):
         else:
             returnValue(False)
 
+    #Data transfer
+    @inlineCallbacks
+    def queryBinary(self, query):
+        """Send a query and read the response as raw bytes.
+
+        Responses to query have whitespace stripped, which may be part of
+        binary data.
+        """
+        p = self._packet()
+        p.write(query)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(resp.read_raw)
+
+    @inlineCallbacks
+    def spectrumBinary(self, trace):
+        """Get a trace as raw binary values, see scaleLogData."""
+        data = yield self.queryBinary('SPEB?%d\n' %trace)
+        returnValue(unpackBinary(data))
+
+    @inlineCallbacks
+    def spectrumASCII(self, trace):
+        """Get a trace in ASCII, in the displayed units."""
+        data = yield self.query('SPEC?%d\n' %trace)
+        returnValue(parseASCII(data))
+
     @inlineCallbacks
     def clearReadBuffer(self):
         raise Exception('Does not work')
@@ -572,10 +597,7 @@ class SR770Server(GPIBManagedServer):
     def get_trace(self, c, trace):
         """Get the trace."""
         dev = self.selectedDevice(c)
-        #Read from device
-        bytes = yield dev.query('SPEB?%d\n' %trace)
-        #Unpack binary data
-        numeric = unpackBinary(bytes)
+        numeric = yield dev.spectrumBinary(trace)
         returnValue(numeric)
 
     @setting(101, trace='i{trace}', returns='*2v{[freq,sqrt(psd)]}')
@@ -605,9 +627,8 @@ class SR770Server(GPIBManagedServer):
         yield dev.start()
         yield dev.waitForAveraging()
         #Read from device
-        bytes = yield dev.query('SPEB?%d\n' %trace)
-        #Convert to power spectral density
-        numeric = unpackBinary(bytes)                               #Data at this point matches screen with...
+        numeric = yield dev.spectrumBinary(trace)
+        #Convert to power spectral density                         #Data at this point matches screen with...
         dbVoltsPkPerBin = scaleLogData(numeric, inputRange)         #SPECTRUM with UNITS= dbV Pk
         voltsPkPerBin = 10**(dbVoltsPkPerBin/20.0)                  #SPECTRUM with UNITS= V Pk
         voltsPkPerRtHz = voltsPkPerBin/np.sqrt(linewidth['Hz'])     #PSD with UNITS = V Pk
@@ -637,10 +658,7 @@ class SR770Server(GPIBManagedServer):
         yield dev.start()
         yield dev.waitForAveraging()
         #Read from device
-        dataStr = yield dev.query('SPEC?%d\n' %trace)
-        #Convert to power spectral density
-        dataStr = dataStr.split(',')[0:-1]
-        voltsRmsPerRtHz = np.array([float(d) for d in dataStr])
+        voltsRmsPerRtHz = yield dev.spectrumASCII(trace)
         freqs = np.linspace(freqStart['Hz'],(span+freqStart)['Hz'],NUM_POINTS)
         data = np.vstack((freqs,voltsRmsPerRtHz)).T
         returnValue(data)
@@ -658,11 +676,16 @@ def scaleLogData(data, inputLevel):
     return corrected
 
 def unpackBinary(data):
-    print 'unpackBinary in server, data length',len(data)
-    if len(data)==800:
-        return np.array(unpack('h'*400,data))
-    elif len(data)==799:
-        return np.array(unpack('h'*399,data[0:798]))
+    """Unpack binary trace data, 16 bit little endian integers.
+
+    A trailing byte which does not make up a whole value is ignored.
+    """
+    count = min(len(data)//2, NUM_POINTS)
+    return np.frombuffer(data, dtype='<i2', count=count).astype(int)
+
+def parseASCII(data):
+    """Parse an ASCII trace, values each followed by a comma."""
+    return np.array(data.rstrip(',').split(','), dtype=float)
 
 def inverseDict(d):
     outDict = dict([(value,key) for key,value in d.items()])
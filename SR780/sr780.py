@@ -37,7 +37,6 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from struct import unpack
 import numpy as np
 
 COUPLINGS = {0: 'DC',
@@ -84,6 +83,12 @@ def inverseDict(d):
     outDict = dict([(value,key) for key,value in d.items()])
     return outDict
 
+def unpackBinary(data, length):
+    """Unpack length binary display values, 32 bit little endian floats."""
+    if len(data) < length*4:
+        raise Exception("Lengths don't match, dude! %d is less than %d" % (len(data), length*4))
+    return np.frombuffer(data, dtype='<f4', count=length).astype(float)
+
 class SR780Wrapper(GPIBDeviceWrapper):
     SETTLING_TIME = T.Value(5, 's')
     AVERAGING_TIME = T.Value(5, 's')
@@ -137,6 +142,27 @@ class SR780Wrapper(GPIBDeviceWrapper):
             yield util.wakeupCall(self.AVERAGING_TIME['s'])
             done = yield self.doneAveraging()
         returnValue(None)
+
+    @inlineCallbacks
+    def displayBinary(self, disp=0):
+        """Get the displayed data of a display as an array.
+
+        The data is read raw in one request with the number of points, as
+        responses to query have whitespace stripped, which may be part of
+        the binary data.
+        """
+        p = self._packet()
+        p.query("DSPN? %d" % disp)
+        p.write("DSPB? %d" % disp)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(unpackBinary(resp.read_raw, int(resp.query)))
+
+    @inlineCallbacks
+    def displayASCII(self, disp=0):
+        """Get the displayed data of a display as an array, in ASCII."""
+        data = yield self.query("DSPY? %d" % disp)
+        returnValue(np.array(data.split(','), dtype=float))
         
     @inlineCallbacks
     def overlapPercentage(self, ov):
@@ -495,7 +521,22 @@ class SR780Server(GPIBManagedServer):
 
     @setting(90, trace='i{trace}', returns='*2v{[freq,srqt(psd)]}')
     def power_spectral_amplitude_ASCII(self, c, trace):
-        ''' Get the trace in spectral amplitude (RMS units). '''
+        ''' Get the trace in spectral amplitude (RMS units), in ASCII. '''
+        data = yield self._powerSpectralAmplitude(c, binary=False)
+        returnValue(data)
+
+    @setting(91, trace='i{trace}', returns='*2v{[freq,srqt(psd)]}')
+    def power_spectral_amplitude(self, c, trace):
+        ''' Get the trace in spectral amplitude (RMS units).
+
+        Like power_spectral_amplitude_ASCII, but the data is transferred in
+        binary, which is faster to transfer and parse.
+        '''
+        data = yield self._powerSpectralAmplitude(c, binary=True)
+        returnValue(data)
+
+    @inlineCallbacks
+    def _powerSpectralAmplitude(self, c, binary):
         dev = self.selectedDevice(c)
         yield dev.clearStatusBytes()
         disp = yield self.display(c)
@@ -505,12 +546,11 @@ class SR780Server(GPIBManagedServer):
         freqStart = yield self.start_frequency(c)
         yield self.startsweep(c)
         yield dev.waitForAveraging()
-        n_points = yield dev.query("DSPN? 0")
-        n_points = int(n_points)
-        data = yield dev.query("DSPY? 0")
-        data = data.split(',')
-        vrms = np.array([float(d) for d in data])
-        freqs = np.linspace(freqStart['Hz'], (span+freqStart)['Hz'], n_points)
+        if binary:
+            vrms = yield dev.displayBinary(0)
+        else:
+            vrms = yield dev.displayASCII(0)
+        freqs = np.linspace(freqStart['Hz'], (span+freqStart)['Hz'], len(vrms))
         data = np.vstack((freqs,vrms)).T
         returnValue(data)
 
@@ -519,18 +559,8 @@ class SR780Server(GPIBManagedServer):
         """Initiate a frequency sweep."""
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
-        length = int(length)
-        print length
-        data = yield dev.query("DSPB? 0")
-        print len(data)
-
-        if len(data) != length*4:
-            raise Exception("Lengths don't match, dude! %d isn't equal to %d" % (len(data), length*4))
-
-        print "unpacking..."
-
-        data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
+        data = yield dev.displayBinary(0)
+        length = len(data)
         #Calculate frequencies from current span
         resp = yield dev.query('FSTR?0')
         fs = T.Value(float(resp), 'Hz')
@@ -551,19 +581,8 @@ class SR780Server(GPIBManagedServer):
         """
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
-        length = int(length)
-        print length
-        data = yield dev.query("DSPB? 0")
-        print len(data)
-
-        if len(data) != length*4:
-            raise Exception("Lengths don't match, dude! %d isn't equal to %d" % (len(data), length*4))
-
-        print "unpacking..."
-
-        data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
-        data = np.array(data)
+        data = yield dev.displayBinary(0)
+        length = len(data)
         #Calculate frequencies from current span
         resp = yield dev.query('FSTR?0')
         fs = T.Value(float(resp), 'Hz')
@@ -35,7 +35,7 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from struct import unpack
+from oscilloscope import waveform
 
 import numpy
 
@@ -45,7 +45,19 @@ HORZ_DIVISIONS = 10.0
 SCALES = []
 
 class Tektronix2014BWrapper(GPIBDeviceWrapper):
-    pass
+
+    @inlineCallbacks
+    def queryBinary(self, query):
+        """Send a query and read the response as raw bytes.
+
+        Responses to query have whitespace stripped, which may be part of
+        the curve data.
+        """
+        p = self._packet()
+        p.write(query)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(resp.read_raw)
 
 class Tektronix2014BServer(GPIBManagedServer):
     name = 'TEKTRONIX 2014B OSCILLOSCOPE'
@@ -185,13 +197,13 @@ class Tektronix2014BServer(GPIBManagedServer):
         #Transfer waveform preamble
         preamble = yield dev.query('WFMP?')
         #Transfer waveform data
-        binary = yield dev.query('CURV?')
+        binary = yield dev.queryBinary('CURV?')
         #Parse waveform preamble
         voltsPerDiv, secPerDiv = _parsePreamble(preamble)
         #Parse binary
         trace = _parseBinaryData(binary,wordLength = wordLength)
         #Convert from binary to volts
-        traceVolts = VERT_DIVISIONS*voltsPerDiv*(1.0/127)*trace
+        traceVolts = waveform.scale(trace, VERT_DIVISIONS*voltsPerDiv*(1.0/127))
         time = numpy.linspace(0,HORZ_DIVISIONS*secPerDiv*recordLength*(1.0/2500),recordLength)
 
         returnValue((time,traceVolts))
@@ -214,16 +226,11 @@ def _parsePreamble(preamble):
 
 def _parseBinaryData(data, wordLength):
     """Parse binary data packed as ASCII string
+
+    RIB data is MSB first. 2-byte samples were once unpacked in native
+    byte order, which swapped their bytes on little endian machines.
     """
-    formatChars = {'1':'b','2':'h'}
-    formatChar = formatChars[str(wordLength)]
-
-    #Get rid of header crap
-    header = data[0:6]
-    dat = data[6:]
-    #unpack binary data
-    dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    return dat
+    return waveform.decode_block(data, waveform.sample_dtype(wordLength))
 
 __server__ = Tektronix2014BServer()
 
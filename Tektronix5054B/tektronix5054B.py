@@ -37,9 +37,9 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad.types import Value
-from struct import unpack, calcsize
+from oscilloscope import waveform
 
-import numpy, re
+import numpy
 
 COUPLINGS = ['AC', 'DC', 'GND']
 TRIG_CHANNELS = ['AUX','CH1','CH2','CH3','CH4','LINE']
@@ -48,7 +48,19 @@ HORZ_DIVISIONS = 10.0
 SCALES = []
 
 class Tektronix5054BWrapper(GPIBDeviceWrapper):
-    pass
+
+    @inlineCallbacks
+    def queryBinary(self, query):
+        """Send a query and read the response as raw bytes.
+
+        Responses to query have whitespace stripped, which may be part of
+        the curve data.
+        """
+        p = self._packet()
+        p.write(query)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(resp.read_raw)
 
 class Tektronix5054BServer(GPIBManagedServer):
     name = 'TEKTRONIX 5054B OSCILLOSCOPE'
@@ -356,7 +368,7 @@ class Tektronix5054BServer(GPIBManagedServer):
         preamble = yield dev.query('WFMP?')
         position = yield dev.query('CH%d:POSITION?' %channel) # in units of divisions
         #Transfer waveform data
-        binary = yield dev.query('CURV?')
+        binary = yield dev.queryBinary('CURV?')
         #Parse waveform preamble
         voltsPerDiv, secPerDiv, voltUnits, timeUnits = _parsePreamble(preamble)
         voltUnitScaler = Value(1, voltUnits)['mV'] # converts the units out of the scope to mV
@@ -364,7 +376,9 @@ class Tektronix5054BServer(GPIBManagedServer):
         #Parse binary
         trace = _parseBinaryData(binary,wordLength = wordLength)
         #Convert from binary to volts
-        traceVolts = (trace * (1/32768.0) * VERT_DIVISIONS/2 * voltsPerDiv - float(position) * voltsPerDiv) * voltUnitScaler
+        traceVolts = waveform.scale(trace,
+                                    (1/32768.0) * VERT_DIVISIONS/2 * voltsPerDiv * voltUnitScaler,
+                                    -float(position) * voltsPerDiv * voltUnitScaler)
         time = numpy.linspace(0, HORZ_DIVISIONS * secPerDiv * timeUnitScaler,len(traceVolts))#recordLength)
 
         returnValue((time, traceVolts))
@@ -396,7 +410,7 @@ class Tektronix5054BServer(GPIBManagedServer):
         preamble = yield dev.query('WFMP?')
         position = yield dev.query('MATH%d:POSITION?' %channel) # in units of divisions
         #Transfer waveform data
-        binary = yield dev.query('CURV?')
+        binary = yield dev.queryBinary('CURV?')
         #Parse waveform preamble
         wattsPerDiv, secPerDiv, wattUnits, timeUnits = _parsePreamble(preamble)
         wattUnitScaler = Value(1, wattUnits)['mW'] # converts the units out of the scope to mW
@@ -414,12 +428,7 @@ def _parsePreamble(preamble):
     preamble = preamble.split(';')
     vertInfo = preamble[5].split(',')
     
-    def parseString(string): # use 'regular expressions' to parse the string
-        number = re.sub(r'.*?([\d\.]+).*', r'\1', string)
-        units = re.sub(r'.*?([a-zA-z]+)/.*', r'\1', string)
-        return float(number), units
-    
-    voltsPerDiv, voltUnits = parseString(vertInfo[2])
+    voltsPerDiv, voltUnits = waveform.parse_per_div(vertInfo[2])
     if voltUnits == 'VV':
         voltUnits ='W'
     if voltUnits == 'mVV':
@@ -428,28 +437,14 @@ def _parsePreamble(preamble):
         voltUnits = 'W'
     if voltUnits == 'nVV':
         voltUnits = 'W'
-    secPerDiv, timeUnits = parseString(vertInfo[3])
+    secPerDiv, timeUnits = waveform.parse_per_div(vertInfo[3])
     return (voltsPerDiv, secPerDiv, voltUnits, timeUnits)
 
 def _parseBinaryData(data, wordLength):
     """Parse binary data packed as string of RIBinary
     """
-    formatChars = {'1':'b','2':'h', '4':'f'}
-    formatChar = formatChars[str(wordLength)]
-
-    #Get rid of header crap
-    #unpack binary data
-    if wordLength == 1:
-        dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 2:
-        dat = data[(int(data[1])+2):]
-        dat = dat[-calcsize('>' + formatChar*(len(dat)/wordLength)):]
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 4:
-        dat = data[(int(data[1])+2):]
-        dat = dat[-calcsize('>' + formatChar*(len(dat)/wordLength)):]
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))      
-    return dat
+    dtype = waveform.sample_dtype(wordLength, floating=(wordLength == 4))
+    return waveform.decode_block(data, dtype)
 
 __server__ = Tektronix5054BServer()
 
@@ -37,7 +37,7 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad.types import Value
-from struct import unpack
+from oscilloscope import waveform
 from time import sleep
 import numpy, re
 
@@ -292,32 +292,15 @@ def _parsePreamble(preamble):
     preamble = preamble.split(';')
     vertInfo = preamble[-2].split(',')
     
-    def parseString(string): # use 'regular expressions' to parse the string
-        number = re.sub(r'.*?([\d\.]+).*', r'\1', string)
-        units = re.sub(r'.*?([a-zA-z]+)/.*', r'\1', string)
-        return float(number), units
-    
-    voltsPerDiv, voltUnits = parseString(vertInfo[1])
-    secPerDiv, timeUnits = parseString(vertInfo[2])
+    voltsPerDiv, voltUnits = waveform.parse_per_div(vertInfo[1])
+    secPerDiv, timeUnits = waveform.parse_per_div(vertInfo[2])
     return (voltsPerDiv, secPerDiv, voltUnits, timeUnits)
 
 def _parseBinaryData(data, wordLength):
     """Parse binary data packed as string of RIBinary
     """
-    formatChars = {'1':'b','2':'h'}
-    formatChar = formatChars[str(wordLength)]
-
-    #Get rid of header crap
-    header = data[0:7]
-    dat = data[7:]
-    #unpack binary data
-    if wordLength == 1:
-        dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 2:
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 4:
-        raise Exception("you really need to implement this")
-    return dat
+    dtype = waveform.sample_dtype(wordLength, floating=(wordLength == 4))
+    return waveform.decode_block(data, dtype)
 
 __server__ = TektronixDSA8300Server()
 
@@ -33,54 +33,112 @@ timeout = 20
 
 from labrad import types as T, errors
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
+from labrad.gpib import GPIBManagedServer
+from gpib_transaction import GPIBTransactionWrapper
 from struct import unpack
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad import util
+import numpy as np
 from numpy import array, transpose, linspace, hstack
 from time import sleep
 
-class Agilent_8720ES_Wrapper(GPIBDeviceWrapper):
+# Trace output formats, and the dtype of their values for binary formats.
+# FORM4 is ASCII, one 'real, imaginary' line per point.
+TRACE_FORMATS = {
+    'FORM2': np.dtype('>f4'),
+    'FORM3': np.dtype('>f8'),
+    'FORM4': None,
+}
+
+def parseBinaryTrace(data, dtype):
+    """Parse a binary trace, '#A', a 2 byte length, then the data.
+
+    Returns an array with one (real, imaginary) row per point.
+    """
+    if data[:2] != '#A':
+        raise ValueError('Invalid binary trace header %r' % data[:4])
+    length = unpack('>H', data[2:4])[0]
+    if len(data) < 4 + length:
+        raise ValueError('Binary trace has %d bytes, but header says %d'
+                         % (len(data) - 4, length))
+    values = np.frombuffer(data, dtype=dtype, count=length // dtype.itemsize,
+                           offset=4)
+    return values.reshape(-1, 2)
+
+def parseASCIITrace(data):
+    """Parse an ASCII trace, one 'real, imaginary' line per point."""
+    values = np.array(data.replace('\n', ',').split(','), dtype=float)
+    return values.reshape(-1, 2)
+
+class Agilent_8720ES_Wrapper(GPIBTransactionWrapper):
     @inlineCallbacks
     def initialize(self):
         yield self.write("ELED 0 NS") # Zero electrical delay
 
+    @inlineCallbacks
+    def trace(self, form='FORM3'):
+        """Get the current trace and its frequencies in one request.
+
+        The trace is read in the given output format, see TRACE_FORMATS.
+        Binary formats are read raw, as the bus server strips whitespace
+        from query responses, which may be part of the data.
+
+        Returns (freqs, data), the frequencies in Hz and an array with one
+        (real, imaginary) row per point.
+        """
+        if form not in TRACE_FORMATS:
+            raise ValueError('Unknown trace format %s' % form)
+        dtype = TRACE_FORMATS[form]
+        ops = [('write', form), ('write', 'SMIC')]
+        if dtype is None:
+            ops.append(('query', 'OUTPFORM'))
+        else:
+            ops.extend([('write', 'OUTPFORM'), ('read_raw', '')])
+        ops.extend([('query', 'STAR?'), ('query', 'STOP?'), ('query', 'POIN?')])
+        resp = yield self.transaction(ops)
+        if dtype is None:
+            data = parseASCIITrace(resp[2])
+        else:
+            data = parseBinaryTrace(resp[3], dtype)
+        start, stop, points = resp[-3:]
+        freqs = linspace(float(start), float(stop), int(float(points)))
+        returnValue((freqs, data))
+
 class Agilent_8720ES_Server(GPIBManagedServer):
     name = 'Agilent 8720ES Server'
     deviceName = 'HEWLETT PACKARD 8720ES'
     deviceWrapper = Agilent_8720ES_Wrapper
     
     @setting(345, 'Get Trace', measured=['b'])
-    def get_trace(self, c, measured=False):    
-        def parseData(data):
-            data = data.split('\n')
-            for i in range(len(data)):
-                stuff = data[i].split(',')
-                num1 = float(stuff[0])
-                num2 = float(stuff[1])
-                #num = (num1**2 + num2**2)
-                #num = 10*np.log10(num)
-                # num1 is real, num2 is imaginary
-                # units is U (dimensionless... Vout/Vin)
-                data[i] = [num1, num2]
-            return data
+    def get_trace(self, c, measured=False):
+        """Get the trace, taking a single sweep first unless measured is True.
+
+        Returns rows of frequency [Hz], real and imaginary part. The trace is
+        transferred in the format set with Trace Format.
+        """
         dev = self.selectedDevice(c)
         if not measured:
             time = yield dev.query('SWET?').addCallback(float)        
-            yield dev.write('FORM4') # Set the output format 
             yield dev.write('SING') # Perform a single sweep
             sleep(2*time) # avoid timeout error
-        yield dev.write('SMIC')
-        result = yield dev.query('OUTPFORM') # Get the data
-        data = parseData(result)
-        data = array(data)
-        start_freq = yield self.start_frequency(c)
-        stop_freq = yield self.stop_frequency(c)
-        num_point = yield self.num_points(c)
-        freqs = linspace(start_freq, stop_freq, num_point)
+        freqs, data = yield dev.trace(c.get('traceFormat', 'FORM3'))
         data = hstack((transpose([freqs]),data))
         
         returnValue(data)
+
+    @setting(350, 'Trace Format', form=['s'], returns=['s'])
+    def trace_format(self, c, form=None):
+        """Get or set the format traces are transferred in, in this context.
+
+        FORM3 (the default) and FORM2 are binary, 64 and 32 bit floats.
+        FORM4 is ASCII, which is slower to transfer and parse.
+        """
+        if form is not None:
+            form = form.upper()
+            if form not in TRACE_FORMATS:
+                raise Exception("Invalid trace format")
+            c['traceFormat'] = form
+        return c.get('traceFormat', 'FORM3')
     
     @setting(346, 'Start Frequency', f=['v[MHz]'], returns=['v[MHz]'])
     def start_frequency(self, c, f=None):
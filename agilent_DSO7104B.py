@@ -37,11 +37,10 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad.types import Value
-from struct import unpack
 from labrad.units import mV,ns
+from oscilloscope import waveform
 
 import time
-import numpy, re
 
 COUPLINGS = ['AC', 'DC']
 TRIG_CHANNELS = ['EXT','CHAN1','CHAN2','CHAN3','CHAN4','LINE']
@@ -50,7 +49,19 @@ HORZ_DIVISIONS = 10.0
 SCALES = []
 
 class Agilent7104BWrapper(GPIBDeviceWrapper):
-    pass
+
+    @inlineCallbacks
+    def queryBinary(self, query):
+        """Send a query and read the response as raw bytes.
+
+        Responses to query have whitespace stripped, which may be part of
+        the curve data.
+        """
+        p = self._packet()
+        p.write(query)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(resp.read_raw)
 
 class Agilent7104BServer(GPIBManagedServer):
     name = 'Agilent 7104B Oscilloscope'
@@ -377,7 +388,7 @@ class Agilent7104BServer(GPIBManagedServer):
         #run:
         yield dev.write(':SING')
         #Transfer waveform data      
-        binary = yield dev.query(':WAV:DATA?')
+        binary = yield dev.queryBinary(':WAV:DATA?')
         #Parse waveform preamble
         points,xincrement,xorigin,xreference,yincrement,yorigin,yreference,vsteps = _parsePreamble(preamble)
         
@@ -390,8 +401,8 @@ class Agilent7104BServer(GPIBManagedServer):
         trace = trace[-points:]
 
         #Convert from binary to volts
-        traceVolts = (trace - yreference) * yincrement * voltUnitScaler
-        timeAxis = (numpy.arange(points)*xincrement + xorigin) * timeUnitScaler
+        traceVolts = waveform.scale(trace, yincrement, y_reference=yreference) * voltUnitScaler
+        timeAxis = waveform.time_axis(points, xincrement, xorigin) * timeUnitScaler
         returnValue((timeAxis, traceVolts))
         
     @setting(210)
@@ -440,30 +451,21 @@ def _parsePreamble(preamble):
                      <yorigin 32-bit floating point NR3>,
                      <yreference 32-bit NR1>    
     '''
-    #fields=unpack( '>IILLddLffL' ,  preamble)
-    fields=preamble.split(',')
-    points=int(fields[2])
-    xincrement=float(fields[4])
-    xorigin=float(fields[5])
-    xreference=int(fields[6])    
-    yincrement=float(fields[7])
-    yorigin=float(fields[8])
-    yreference=int(fields[9])  
-    vsteps=65536.0    
+    fields=waveform.parse_preamble(preamble)
+    points=fields['num_points']
+    xincrement=fields['x_step']
+    xorigin=fields['x_origin']
+    xreference=int(fields['x_reference'])
+    yincrement=fields['y_step']
+    yorigin=fields['y_origin']
+    yreference=int(fields['y_reference'])
+    vsteps=65536.0
     return (points,xincrement,xorigin,xreference,yincrement,yorigin,yreference,vsteps)
 
 def _parseBinaryData(data, wordLength):
     """Parse binary data packed as string of RIBinary
     """
-    formatChars = {'1':'B','2':'H'}
-    formatChar = formatChars[str(wordLength)]
-    dat = data
-    #unpack binary data
-    if wordLength == 1:
-        dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 2:
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))
-    return dat
+    return waveform.decode_block(data, waveform.sample_dtype(wordLength, signed=False))
 
 __server__ = Agilent7104BServer()
 
@@ -36,8 +36,7 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 import labrad.units as U
-import struct
-import numpy as np
+from oscilloscope import waveform
 
 COUPLINGS = ['AC', 'DC', 'GND']
 TRIG_CHANNELS = ['AUX', 'CH1', 'CH2', 'CH3', 'CH4', 'LINE']
@@ -317,15 +316,14 @@ class AgilentDSO91304AServer(GPIBManagedServer):
 
         y_step = float(preamble_dict['yStep'])
         origin = float(preamble_dict['yOrigin'])
-        trace_volts = (trace * y_step) + origin
+        trace_volts = waveform.scale(trace, y_step, origin, unit=U.V)
 
         num_points = int(preamble_dict['numPoints'])
         x_step = float(preamble_dict['xStep'])
         first = float(preamble_dict['xFirst'])
-        time_s = np.linspace(first, first + (num_points-1) * x_step, num_points)
-
-        time_ns = time_s * 1e9
-        returnValue((time_ns * U.ns, trace_volts * U.V))
+        time_ns = waveform.time_axis(num_points, x_step * 1e9, first * 1e9,
+                                     unit=U.ns)
+        returnValue((time_ns, trace_volts))
 
 
 def _check_channel(channel, accept_channels=[1, 2, 3, 4]):
@@ -339,11 +337,11 @@ def _check_channel(channel, accept_channels=[1, 2, 3, 4]):
 
 
 def _parsePreamble(preamble):
-    preamble_vals = preamble.split(',')
-    preamble_dict = {}
-    for (key, included), val in zip(PREAMBLE_KEYS, preamble_vals):
-        if included:
-            preamble_dict[key] = val
+    preamble_dict = waveform.parse_preamble(
+        preamble, [(key, str) for key, _ in PREAMBLE_KEYS])
+    for key, included in PREAMBLE_KEYS:
+        if not included:
+            preamble_dict.pop(key, None)
 
     def unit_type(num):
         if num == '1':
@@ -363,23 +361,8 @@ def _parseBinaryData(data, word_length):
     Data format discussed here:
     http://www.keysight.com/upload/cmc_upload/All/9000_series_prog_ref.pdf?&cc=US&lc=eng#page=1091
     """
-    format_chars = {1: 'b', 2: 'h', 4: 'f'}
-    format_char = format_chars[word_length]
-
-    if data[0] != '#':
-        raise Exception("Invalid wave data. Expected '#' "
-                        "at start but got {}".format(data[0]))
-    len_header = int(data[1])
-    wave_offset = 2 + len_header
-    len_wave = int(data[2:wave_offset])
-    expected_len = 1 + 1 + len_header + len_wave + 1
-    if len(data) != expected_len:
-        raise Exception("Invalid wave data. Expected {} bytes "
-                        "but got {}.".format(expected_len, len(data)))
-    wave_data = data[wave_offset:wave_offset + len_wave]
-    num_words = len_wave // word_length
-    words = struct.unpack('>' + format_char * num_words, wave_data)
-    return np.array(words)
+    dtype = waveform.sample_dtype(word_length, floating=(word_length == 4))
+    return waveform.decode_block(data, dtype)
 
 __server__ = AgilentDSO91304AServer()
 
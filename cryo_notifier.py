@@ -18,7 +18,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Cryo Notifier
-version = 2.2
+version = 2.4
 description = Send reminders to fill cryos
 
 [startup]
@@ -34,14 +34,20 @@ timeout = 5
 from labrad        import util, types as T
 from labrad.server import LabradServer, setting
 from labrad.units  import Unit, mV, ns, deg, MHz, V, GHz, rad, s
-import datetime, time
+import datetime, os, time
 from twisted.python import log
 from twisted.internet import defer, reactor
 from twisted.internet.task import LoopingCall
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from cryolog.events import (ALERT, EXCURSION, FILL, RESET, EventLog,
+                            import_registry)
+
 DEBUG = False
 
+# message ID of registry change notifications
+REGISTRY_CHANGED = 98765
+
 def td_to_seconds(td):
     '''
     Takes a timedelta object and returns the time interval in seconds
@@ -58,7 +64,14 @@ Registry keys:
     name1_reset = timestamp
     notify_users = ["user1, "user2"]
     timers_enabled = True
+    event_log = "path of the event log"
+
+Events are recorded in an EventLog (see cryolog/events.py), by default
+~/.labrad/cryo_events.sqlite. Versions before 2.4 kept a log of timer
+resets in the registry, in [..., "log"], which is moved to the event log
+at startup.
 '''
+
 @inlineCallbacks
 def start_server(cxn, node_name, server_name):
     """Start an external server
@@ -74,18 +87,43 @@ def start_server(cxn, node_name, server_name):
         returnValue(True)
     raise RuntimeError("Unable to start server %s" % server_name)
 
+class Snapshot(object):
+    """Last known state of the cryos.
+
+    Alerts are checked against the snapshot, and status requests are
+    answered from it without asking other servers. Timers and counters are
+    read from the registry at startup and whenever it signals a change, and
+    temperatures every time alerts are checked.
+    """
+    def __init__(self):
+        self.timers = {} # name -> (interval, time of last reset)
+        self.counters = {}
+        self.diodes = []
+        self.ruox = [] # (name, temperature)
+        self.temperatures = {} # 'node:name' -> temperature
+        self.cold = False
+        self.updated = None # when temperatures were read
+
+    def remaining(self, now):
+        """[(timer name, time remaining)] at datetime now."""
+        return [(name, interval - td_to_seconds(now - reset) * s)
+                for name, (interval, reset) in self.timers.iteritems()]
+
 class CryoNotifier(LabradServer):
     """Mass email when someone forgets to fill cryos
     
     Todo: subclass DeviceServer and allow multiple notifyer devices per server.
-    This is a real problem. There are several places in this server at which we
-    make LabRAD calls to device servers without explicitly stating which device
-    we'd like to talk to. For example, we ask the lakeshore diode controller
-    for temperature data after a selectDevice() call with no arguments. This
-    means we get whatever the first lakeshare diode box on our LabRAD network
+    The thermometry servers are asked about the device whose node matches
+    the registry directory found by matchNode, or else the first device they
+    have, which is whatever the first lakeshore box on our LabRAD network
     happens to be.
     """
     name = 'Cryo Notifier'
+    clock = reactor
+
+    def __init__(self, events=None):
+        LabradServer.__init__(self)
+        self.events = events
     
     def temperatureCheckFunc(self, channel, temp):
         try:
@@ -138,16 +176,22 @@ class CryoNotifier(LabradServer):
         else:
             print "Found node: %s" % matches[0]
             yield self.reg.cd(matches[0])
+            self.fridge = matches[0]
             self.path.append(matches[0])
             returnValue(self.path)
     
     @inlineCallbacks
     def initServer(self):
         self.sent_notifications = set()
-        self.cold = False
+        self.snapshot = Snapshot()
+        self.fridge = None
+        self.reloading = False
         self.reg = self.client.registry
         self.ruox = self.client.lakeshore_ruox
         self.diodes = self.client.lakeshore_diodes
+        # packets reading the thermometers, made once a device is chosen
+        self.ruoxPacket = None
+        self.diodePacket = None
         #type of parameter -> {'data'->data, 'func'->func to check if notification needed}
         self.thingsToCheck = {"timers":
                                  {"data": None,
@@ -167,8 +211,46 @@ class CryoNotifier(LabradServer):
             self.node = 'node_'+self.path[0]
         print self.path
         yield start_server(self.client, self.node, 'Telecomm Server')
+        yield self.loadRegistryInfo()
+        yield self.update_timers()
+        if self.events is None:
+            p = self.reg.packet()
+            p.get('event_log', True, os.path.expanduser('~/.labrad/cryo_events.sqlite'))
+            ans = yield p.send()
+            self.events = EventLog(ans['get'])
+        moved = yield import_registry(self.reg, self.path + ['log'], self.events)
+        if moved:
+            print "Moved %d log entries from the registry to %s" % (moved, self.events.path)
+        yield self.watchRegistry()
         self.cb = LoopingCall(self.checkForAndSendAlerts)
+        self.cb.clock = self.clock
         self.cb.start(interval=10.0, now=True)
+
+    @inlineCallbacks
+    def watchRegistry(self):
+        """Reload the settings and timers when the registry changes."""
+        ctx = self.client.context()
+        self.reg.addListener(self.registryChanged, ID=REGISTRY_CHANGED,
+                             context=ctx)
+        p = self.reg.packet(context=ctx)
+        p.cd(self.path)
+        p.notify_on_change(REGISTRY_CHANGED, True)
+        yield p.send()
+
+    def registryChanged(self, c, data):
+        # the keys set by one packet cause one reload
+        if not self.reloading:
+            self.reloading = True
+            self.clock.callLater(0, self.reloadRegistryInfo)
+
+    @inlineCallbacks
+    def reloadRegistryInfo(self):
+        self.reloading = False
+        try:
+            yield self.loadRegistryInfo()
+            yield self.update_timers()
+        except Exception:
+            log.err()
         
     @setting(5, returns='*(sv[s])') 
     def query_timers(self, c):
@@ -178,60 +260,115 @@ class CryoNotifier(LabradServer):
         disabled all timers will list zero.
         '''
         if self.enabled:
-            yield self.loadRegistryInfo()
-            yield self.update_timers()
-            rv = self.thingsToCheck["timers"]["data"]
+            return self.snapshot.remaining(datetime.datetime.now())
         else:
-            rv = [(t, 0) for t in self.timers]
-        returnValue(rv)
+            return [(t, 0*s) for t in self.snapshot.timers]
         
-    @setting(6, returns='*(sv[s])')
+    @setting(6, returns='*(sv[K])')
     def query_temperatures(self, c):
         '''
         Returns the list of temperatures and their current values.
         '''
-        rv = self.thingsToCheck['temperatures']['data']
-        returnValue(rv)
+        return sorted(self.snapshot.temperatures.items())
+
+    @setting(7, returns='*v[K]')
+    def diode_temperatures(self, c):
+        '''
+        Returns the temperatures of all channels of the diode thermometers,
+        as last read.
+        '''
+        return self.snapshot.diodes
+
+    @setting(8, returns='*(sv[K])')
+    def ruox_temperatures(self, c):
+        '''
+        Returns the names and temperatures of the RuOx thermometers, as
+        last read.
+        '''
+        return self.snapshot.ruox
     
     @setting(10, timer_name='s', message='s', returns='v[s]')
     def reset_timer(self, c, timer_name, message=''):
-        if timer_name not in self.timers:
-            raise KeyError("Timer %s unknown" % name)
+        if timer_name not in self.snapshot.timers:
+            raise KeyError("Timer %s unknown" % timer_name)
         else:
             dt = datetime.datetime.now()
             p = self.reg.packet()
             p.set("%s_reset" % timer_name, dt)
             p.get("%s_count" % timer_name, False, -1)
-            p.cd('log')
-            p.set(dt.isoformat(), (timer_name, message))
-            p.cd(self.path)
             rv = yield p.send()
+            self.events.append(RESET, timer_name, message,
+                               t=time.mktime(dt.timetuple()) + dt.microsecond*1e-6)
+            interval = self.snapshot.timers[timer_name][0]
+            self.snapshot.timers[timer_name] = (interval, dt)
             counter_val = rv['get']
             if counter_val > -1:
                 print('Incrementing counter %s to %d' % (timer_name, counter_val+1))
                 p = self.reg.packet()
                 p.set('%s_count' % timer_name, rv['get'] + 1)
                 yield p.send()
-            returnValue(self.timers[timer_name][0])
+                self.snapshot.counters[timer_name] = counter_val + 1
+            returnValue(interval)
     
     @setting(11, name='s', val='w', returns='w')
     def counter(self, c, name, val=None):
-        if name not in self.timers:
+        if name not in self.snapshot.timers:
             raise KeyError("Counter %s unknown" % name)
         p = self.reg.packet()
         if val is not None:
             p.set('%s_count' % name, val)
         p.get('%s_count' % name, False, 0)
         rv = yield p.send()
+        self.snapshot.counters[name] = rv['get']
         returnValue(rv['get'])
     
     @setting(12, returns='*(s,w)')
     def query_counters(self, c):
-        if self.enabled:
-            yield self.loadRegistryInfo()
-            yield self.update_timers()
-        rv = self.counters.items()
-        returnValue(rv)
+        return self.snapshot.counters.items()
+
+    @setting(13, count='w', name='s', returns='*(sss)')
+    def log_entries(self, c, count=25, name=''):
+        '''
+        Returns the most recent timer resets and fills, newest first, as
+        (timestamp, timer name, message). Only timers whose names contain
+        name are included.
+        '''
+        events = self.events.query(count, kinds=[RESET, FILL], name=name)
+        return [(datetime.datetime.fromtimestamp(e.time).isoformat(),
+                 e.name, e.message) for e in events]
+
+    @setting(14, count='w', name='s', kinds='*s', cursor='(vw)', newer='b',
+             returns='*(wvsssv)')
+    def query_events(self, c, count=25, name='', kinds=None, cursor=None,
+                     newer=False):
+        '''
+        Returns a page of events, newest first, as (id, time, kind, name,
+        message, value). Times are in seconds since the epoch, and the value
+        is NaN for events without one. Only events with names containing
+        name, of the given kinds if any, are included.
+
+        With a cursor, the (time, id) of an event, the page is the events
+        just before it, or just after it if newer is set.
+        '''
+        if cursor is None:
+            events = self.events.query(count, kinds=kinds, name=name)
+        elif newer:
+            events = self.events.query(count, after=cursor, kinds=kinds,
+                                       name=name)
+        else:
+            events = self.events.query(count, before=cursor, kinds=kinds,
+                                       name=name)
+        return [(e.id, e.time, e.kind, e.name, e.message,
+                 float('nan') if e.value is None else e.value)
+                for e in events]
+
+    @setting(16, kind='s', name='s', message='s', value='v', returns='w')
+    def log_event(self, c, kind, name, message='', value=None):
+        '''
+        Records an event, such as a fill, in the event log, and returns its
+        id. The kind is one of excursion, reset, fill or alert.
+        '''
+        return self.events.append(kind, name, message, value).id
         
     @setting(15, username='s', returns='b')
     def validate_user(self, c, username):
@@ -240,7 +377,7 @@ class CryoNotifier(LabradServer):
         If not, but they are known by SMS server, add them
         to list of users.
         '''
-        if not self.cold: # Allow anyone when fridge is warm
+        if not self.snapshot.cold: # Allow anyone when fridge is warm
             return True
         if self.enabled and (username.lower() in [x.lower() for x in self.users]):
             return True
@@ -282,35 +419,79 @@ class CryoNotifier(LabradServer):
         self.timerSettings = dict(ans['timers'])
         self.temperatureBounds = dict(ans['temperatures'])
     
+    @inlineCallbacks
+    def chooseDevice(self, server):
+        """Name of the device of a thermometry server to read.
+
+        Device names start with the node of the device, so we take the one
+        on the fridge found by matchNode, if any, or else the first.
+        """
+        p = server.packet()
+        p.list_devices()
+        ans = yield p.send()
+        names = [name for _, name in ans['list_devices']]
+        if not names:
+            raise Exception("No devices on %s" % server.name)
+        for name in names:
+            if self.fridge and name.split(' ')[0].lower() == self.fridge.lower():
+                returnValue(name)
+        print "No %s device on fridge %s. Using %s" % (server.name, self.fridge, names[0])
+        returnValue(names[0])
+
+    @inlineCallbacks
+    def thermometerPacket(self, server, setting):
+        """(device, packet) reading the chosen device of a thermometry
+        server with a setting."""
+        device = yield self.chooseDevice(server)
+        p = server.packet()
+        p.select_device(device)
+        getattr(p, setting)(key='temps')
+        returnValue((device, p))
+
     @inlineCallbacks
     def update_temperatures(self):
+        """Read the thermometers into the snapshot.
+
+        The packets are made when a device is first chosen and sent again
+        every time. If reading fails, a device is chosen again next time.
+        """
+        snapshot = self.snapshot
         data = {}
         #Check to see if we're still cold
         try:
-            p = self.client.lakeshore_diodes.packet()
-            p.select_device()
-            p.temperatures()
-            ans = yield p.send()
+            if self.diodePacket is None:
+                self.diodePacket = yield self.thermometerPacket(self.diodes, 'temperatures')
+            ans = yield self.diodePacket[1].send()
+            snapshot.diodes = ans['temps']
             # only keep the ones we're interested in
             names = ["4Kin", "4Kout", "77K",]# "Ret", "Mix", "Xchg", "Still", "Pot"]
-            data.update(dict(zip(names, ans['tempetratures'])))
-            self.cold = ans['temperatures'][1]['K'] < 10.0
+            data.update(dict(zip(names, snapshot.diodes)))
+            snapshot.cold = snapshot.diodes[1]['K'] < 10.0
         except Exception:
             #Assume we are cold if we can't reach the lakeshore server
-            self.cold = True
-        p = self.ruox.packet()
-        p.select_device(key='device') #This is BAD. We should actually pick a device
+            self.diodePacket = None
+            snapshot.cold = True
         try:
-            p.named_temperatures(key='temps')
+            if self.ruoxPacket is None:
+                try:
+                    self.ruoxNamed = True
+                    self.ruoxPacket = yield self.thermometerPacket(self.ruox, 'named_temperatures')
+                except AttributeError:
+                    self.ruoxNamed = False
+                    self.ruoxPacket = yield self.thermometerPacket(self.ruox, 'temperatures')
+            device, p = self.ruoxPacket
             resp = yield p.send()
-            data.update(dict([(x[0],x[1][0]) for x in resp['temps']]))
-        except AttributeError:
-            p.temperatures(key='temps')
-            resp = yield p.send()
-            data.update(dict(zip(['Mix1', 'Mix2', 'Still', 'Pot', 'Xchg'],
-                            [x[0] for x in resp['temps']])))
+        except Exception:
+            self.ruoxPacket = None
+            raise
+        if self.ruoxNamed:
+            snapshot.ruox = [(x[0], x[1][0]) for x in resp['temps']]
+        else:
+            snapshot.ruox = zip(['Mix1', 'Mix2', 'Still', 'Pot', 'Xchg'],
+                                [x[0] for x in resp['temps']])
+        data.update(dict(snapshot.ruox))
 
-        nodeName = resp['device'].split(' ')[0]
+        nodeName = device.split(' ')[0]
         #Now we do something really ugly. We need to be able to handle the fact
         #that the temperature bound data in the registry comes with cryostat
         #names attached, eg Vince:Mix1. However the named temperatures from the
@@ -320,15 +501,15 @@ class CryoNotifier(LabradServer):
         #The next person to service this server (heh) can take up where I left
         #off. Upgrade the temperature checking facilities to more rationally
         #sort the data.
-        data = dict([(nodeName+':'+k,v) for k,v in data.items()])
-        self.thingsToCheck['temperatures']['data'] = data
+        snapshot.temperatures = dict([(nodeName+':'+k,v) for k,v in data.items()])
+        snapshot.updated = self.clock.seconds()
     
     @inlineCallbacks
     def update_timers(self):
         """Helper function to read timers.
         
-        Sets self.currentData["temperatures"] to a dict mapping timer names ->
-        remaining time. Remaining times are Values with time units.
+        Sets the timers of the snapshot to a dict mapping timer names ->
+        (interval, time of the last reset), and the counters.
         """
         now = datetime.datetime.now()
         p = self.reg.packet()
@@ -337,30 +518,35 @@ class CryoNotifier(LabradServer):
             p.get('%s_count' % timer_name, False, -1, key=timer_name+"-count")
         ans = yield p.send()
         
-        self.timers = {}
-        self.counters = {}
+        timers = {}
+        counters = {}
         for timer_name in self.timerSettings:
-            self.timers[timer_name] = \
+            timers[timer_name] = \
                 (self.timerSettings[timer_name].inUnitsOf('s'),
                  ans[timer_name])
-            self.counters[timer_name] = ans[timer_name+"-count"]
-        remaining_time = [(name, (x[0] - td_to_seconds(now-x[1])*s )) \
-                              for name, x in self.timers.iteritems()]
-        self.thingsToCheck['timers']['data'] = remaining_time
-        rt_sleepy = [(name + ' Overnight', x) for name, x in remaining_time]
-        self.thingsToCheck['sleepyTimers']['data'] = rt_sleepy
+            counters[timer_name] = ans[timer_name+"-count"]
+        self.snapshot.timers = timers
+        self.snapshot.counters = counters
     
     @inlineCallbacks
     def checkForAndSendAlerts(self):
         '''
-        Timed callback to check timers and send notifications.
+        Timed callback to read the temperatures, then check the snapshot
+        and send notifications.
         '''
-        yield self.loadRegistryInfo()
-        yield self.update_timers()
-        yield self.update_temperatures()
+        try:
+            yield self.update_temperatures()
+        except Exception:
+            log.err(None, "Reading temperatures failed")
         
-        if not (self.enabled and self.cold):
+        if not (self.enabled and self.snapshot.cold):
             return
+
+        remaining_time = self.snapshot.remaining(datetime.datetime.now())
+        self.thingsToCheck['timers']['data'] = remaining_time
+        rt_sleepy = [(name + ' Overnight', x) for name, x in remaining_time]
+        self.thingsToCheck['sleepyTimers']['data'] = rt_sleepy
+        self.thingsToCheck['temperatures']['data'] = self.snapshot.temperatures
         
         alerts = []
         for thingToCheck in self.thingsToCheck:
@@ -371,11 +557,16 @@ class CryoNotifier(LabradServer):
                     if t not in self.sent_notifications:
                         self.sent_notifications.add(t)
                         alerts.append(t)
+                        if thingToCheck == 'temperatures':
+                            msg = "%s above %s" % (data[t], self.temperatureBounds[t])
+                            self.events.append(EXCURSION, t, msg, data[t]['K'])
                     else:
                         pass
                 else:
                     self.sent_notifications.discard(t)
         if alerts:
+            for t in alerts:
+                self.events.append(ALERT, t, "Notified %s" % ', '.join(self.users))
             print "Alerts exist on: ", alerts
             print "Notifying the following users: ", self.users
             #SMS notifications
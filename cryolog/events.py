@@ -0,0 +1,225 @@
+"""Append-only log of cryo events, kept in SQLite.
+
+The Cryo Notifier records what happens to the cryos as typed events:
+
+    reset       a timer was reset, usually after a fill, with a comment
+    fill        a fill, recorded by a client without resetting a timer
+    excursion   a thermometer went above its bound, with the temperature
+    alert       users were notified about a timer or thermometer
+
+Each event has a time in seconds since the epoch, a kind, a name (of the
+timer or thermometer), a message and, for excursions, a value. Events are
+only ever appended. The table is indexed by time, so a page of events
+before or after a position in the log is found without reading the rest,
+however long the log is:
+
+    events = EventLog('cryo_events.sqlite')
+    page = events.query(25)
+    older = events.query(25, before=page[-1].cursor)
+
+Before this log, the notifier kept its log in the registry, one key per
+entry (or a block of entries per key, in version 2.3). import_registry
+moves such a log into an EventLog.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import datetime
+import os
+import re
+import sqlite3
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+EXCURSION, RESET, FILL, ALERT = KINDS = ('excursion', 'reset', 'fill', 'alert')
+
+# registry keys deleted at once by import_registry
+IMPORT_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    message TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time, id);
+CREATE INDEX IF NOT EXISTS events_kind ON events (kind, time, id);
+CREATE TABLE IF NOT EXISTS imported (
+    source TEXT PRIMARY KEY
+);
+"""
+
+BLOCK_KEY = re.compile(r'block\d{6}$')
+
+
+class Event(collections.namedtuple(
+        'Event', ['id', 'time', 'kind', 'name', 'message', 'value'])):
+
+    @property
+    def cursor(self):
+        """Position of the event in the log, for paging."""
+        return self.time, self.id
+
+
+class EventLog(object):
+    """Cryo events in an SQLite database.
+
+    Args:
+        path (str): Database file, made if there is none, or ':memory:'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def append(self, kind, name, message='', value=None, t=None):
+        """Record an event, now or at time t.
+
+        Returns:
+            Event: The event recorded.
+        """
+        if kind not in KINDS:
+            raise ValueError('Unknown event kind {!r}'.format(kind))
+        if t is None:
+            t = time.time()
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO events (time, kind, name, message, value) '
+                'VALUES (?, ?, ?, ?, ?)', (t, kind, name, message, value))
+        return Event(cursor.lastrowid, t, kind, name, message, value)
+
+    def query(self, count, before=None, after=None, kinds=None, name=''):
+        """A page of events, newest first.
+
+        Args:
+            count (int): Most events to return.
+            before, after ((float, int)): Cursors of events. With before,
+                the events just before it are returned, and with after,
+                those just after it.
+            kinds (list of str): Kinds of events to include, or all.
+            name (str): Only events with names containing this, in any
+                case.
+
+        Returns:
+            list of Event
+        """
+        where = []
+        args = []
+        if before is not None:
+            where.append('(time < ? OR (time = ? AND id < ?))')
+            args.extend([before[0], before[0], before[1]])
+        if after is not None:
+            where.append('(time > ? OR (time = ? AND id > ?))')
+            args.extend([after[0], after[0], after[1]])
+        if kinds:
+            where.append('kind IN ({})'.format(', '.join('?' * len(kinds))))
+            args.extend(kinds)
+        if name:
+            where.append("name LIKE ? ESCAPE '\\'")
+            args.append('%{}%'.format(re.sub(r'([%_\\])', r'\\\1', name)))
+        order = 'ASC' if after is not None and before is None else 'DESC'
+        sql = 'SELECT id, time, kind, name, message, value FROM events'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time {0}, id {0} LIMIT ?'.format(order)
+        args.append(count)
+        events = [Event(*row) for row in self.db.execute(sql, args)]
+        if order == 'ASC':
+            events.reverse()
+        return events
+
+    def extend(self, events, sources=()):
+        """Add (time, kind, name, message, value) events in one transaction,
+        noting the sources they were imported from."""
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO events (time, kind, name, message, value) '
+                'VALUES (?, ?, ?, ?, ?)', events)
+            self.db.executemany('INSERT INTO imported (source) VALUES (?)',
+                                [(s,) for s in sources])
+
+    def imported(self, source):
+        """Whether a source has been imported."""
+        return self.db.execute('SELECT 1 FROM imported WHERE source = ?',
+                               (source,)).fetchone() is not None
+
+
+def parse_timestamp(timestamp):
+    """Seconds since the epoch of an ISO timestamp in local time, as made by
+    datetime.isoformat."""
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%dT%H:%M:%S'
+    t = datetime.datetime.strptime(timestamp, fmt)
+    return time.mktime(t.timetuple()) + t.microsecond * 1e-6
+
+
+@inlineCallbacks
+def import_registry(reg, path, events, keep=False, batch=IMPORT_BATCH):
+    """Move the notifier's log from the registry into an event log.
+
+    The entries are timer resets, as keys named by their ISO timestamp
+    holding (timer name, message), or blocks of (timestamp, timer name,
+    message). They are read with one request, and added in one transaction.
+    Each key is noted in the event log, so that it is imported only once,
+    and then deleted, unless keep is set. Keys left by an import which was
+    cut short are deleted without being imported again.
+
+    Args:
+        reg: Registry client, such as cxn.registry.
+        path (list of str): Directory of the log. Nothing is done if there
+            is none.
+        events (EventLog): Where to add the entries.
+
+    Returns:
+        int: The number of events added.
+    """
+    ctx = reg.context()
+    p = reg.packet(context=ctx)
+    p.cd(path[:-1])
+    p.dir()
+    ans = yield p.send()
+    if path[-1] not in ans['dir'][0]:
+        returnValue(0)
+    p = reg.packet(context=ctx)
+    p.cd(path)
+    p.dir()
+    ans = yield p.send()
+    source = '/'.join(path) + ':'
+    found = ans['dir'][1]
+    keys = [k for k in found if not events.imported(source + k)]
+    p = reg.packet(context=ctx)
+    for k in keys:
+        p.get(k, key=k)
+    ans = yield p.send()
+    added = []
+    for k in keys:
+        if BLOCK_KEY.match(k):
+            entries = [tuple(entry) for entry in ans[k]]
+        else:
+            entries = [(k,) + tuple(ans[k])]
+        for timestamp, name, message in entries:
+            added.append((parse_timestamp(timestamp), RESET, name, message,
+                          None))
+    added.sort()
+    events.extend(added, [source + k for k in keys])
+    if not keep:
+        for i in range(0, len(found), batch):
+            p = reg.packet(context=ctx)
+            for k in found[i:i + batch]:
+                p.del_(k)
+            yield p.send()
+    returnValue(len(added))
@@ -430,6 +430,39 @@ class Dataset(object):
     def getData(self, limit, start, transpose=False, simpleOnly=False):
         return self.data.getData(limit, start, transpose, simpleOnly)
 
+    def findRow(self, value, side='left'):
+        """Find a row by the value of the first column, which must be sorted.
+
+        Returns the index of the first row whose first column is at least
+        value (side='left') or greater than value (side='right').  This is a
+        binary search reading one row at a time, so it is fast for long
+        datasets, such as logs with time as the first column.
+        """
+        def before(pos):
+            data, _ = self.data.getData(1, pos, False, False)
+            if side == 'left':
+                return data[0][0] < value
+            return data[0][0] <= value
+
+        # count the rows by doubling, then bisecting
+        lo, hi = 0, 1
+        while self.data.hasMore(hi - 1):
+            lo, hi = hi, 2 * hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.data.hasMore(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        lo = 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if before(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
     def keepStreaming(self, context, pos):
         # keepStreaming does something a bit odd and has a confusing name (ERJ)
         #
@@ -305,6 +305,24 @@ class DataVault(LabradServer):
         dataset.keepStreaming(key, c['filepos'])
         return data
 
+    @setting(22, 'get range', start='v', end='v', limit='w', returns='*2v')
+    def get_range(self, c, start, end, limit=None):
+        """Get the rows of the current dataset in a range of its first column.
+
+        Returns the rows whose first independent variable is between start
+        and end, inclusive, up to limit rows.  The first independent must
+        be sorted, as for a log with time as the first independent, since
+        the rows are found by binary search.  A following get continues
+        after the rows returned.
+        """
+        dataset = self.getDataset(c)
+        lo = dataset.findRow(start)
+        hi = dataset.findRow(end, 'right')
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        data, c['filepos'] = dataset.getData(hi - lo, lo, simpleOnly=True)
+        return data
+
     @setting(1021, limit='w', startOver='b', returns='?')
     def get_ex(self, c, limit=None, startOver=False):
         """Get data from the current dataset in the extended format.
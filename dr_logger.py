@@ -33,7 +33,10 @@ timeout = 20
 """
 
 import time
+import traceback
 
+import numpy as np
+from twisted.internet import defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
@@ -41,11 +44,23 @@ from labrad import types as T
 from labrad.server import setting
 from labrad.gpib import DeviceWrapper, DeviceServer
 from labrad.errors import NoSuchDeviceError, Error
-from labrad.units import Unit, Value
+from labrad.units import Value, WithUnit
 
 CONFIG_PATH = ['', 'Servers', 'DR Logger']
 DIODE_LIST = ["4Kin", "4Kout", "77K", "Ret", "Mix", "Xchg", "Still", "Pot"]
 
+# seconds to wait for a watched server before recording its values as NaN
+DEFAULT_TIMEOUT = 5.0
+# number of points sent to the data vault at once
+DEFAULT_BATCH_SIZE = 10
+# points kept while the data vault is unavailable
+MAX_BUFFER = 100000
+# dependent variable with a bit mask of the watchers that failed for a point
+ERROR_VARIABLE = 'Errors (Watchers) []'
+# registry keys of a DR that configure logging rather than a watched server
+LOGGER_SETTINGS = ['dvPath', 'datasetName', 'timeInterval', 'timeout',
+                   'batchSize', 'run']
+
 
 class NoMKSDataError(Error):
     pass
@@ -55,6 +70,63 @@ class ServerNotFoundError(Error):
     pass
 
 
+def seconds(t):
+    """Time in seconds, from a number or a Value."""
+    if isinstance(t, WithUnit):
+        return t['s']
+    return float(t)
+
+
+def strip_units(x):
+    if isinstance(x, WithUnit):
+        return x[x.unit]
+    return x
+
+
+def with_timeout(d, timeout, clock=reactor):
+    """Fire with the result of d, or fail with TimeoutError after timeout.
+
+    Unlike Deferred.addTimeout, d is not cancelled, so a watcher can tell
+    when a slow request is finally answered.
+    """
+    result = defer.Deferred()
+    call = clock.callLater(timeout, result.errback, defer.TimeoutError(
+        'no answer in {} s'.format(timeout)))
+
+    def done(r):
+        if call.active():
+            call.cancel()
+            result.callback(r)
+    d.addBoth(done)
+    return result
+
+
+def variable_name(variable):
+    """Dependent variable string from a data vault (label, legend, units)."""
+    label, legend, units = variable
+    if legend:
+        return '{} ({}) [{}]'.format(label, legend, units)
+    return '{} [{}]'.format(label, units)
+
+
+@inlineCallbacks
+def find_dataset(dv, title, context):
+    """Name of the latest dataset with the given title in the current
+    directory, or None if there is none."""
+    _, names = yield dv.dir(context=context)
+    found = None
+    for name in names:
+        if name.split(' - ', 1)[-1] == title:
+            found = name
+    returnValue(found)
+
+
+def error_message(failure):
+    if isinstance(failure.value, T.Error):
+        return failure.value.msg
+    return str(failure.value) or failure.value.__class__.__name__
+
+
 class WatchedServer(object):
     """Proxy for another server from which we pull data
 
@@ -75,6 +147,7 @@ class WatchedServer(object):
         self.options = dict(options)
         self.server = None
         self.active = False
+        self.pending = False
 
     def get_variables(self):
         """ Get the variables (for the data vault) logged by this server.
@@ -139,6 +212,30 @@ class WatchedServer(object):
             else:
                 raise err
 
+    def poll(self, timeout, clock=reactor):
+        """Take a single data point, giving up after timeout seconds.
+
+        A 'timeout' option overrides the timeout given here. No request is
+        made while an earlier one is still unanswered.
+
+        Returns:
+            Deferred firing with (values, None) if a point was taken, or
+            (None, error message) if not. It never fails.
+        """
+        if self.pending:
+            return defer.succeed((None, 'previous request still unanswered'))
+        self.pending = True
+
+        def finished(result):
+            self.pending = False
+            return result
+        d = defer.maybeDeferred(self.take_point).addBoth(finished)
+        d = with_timeout(d, seconds(self.options.get('timeout', timeout)),
+                         clock)
+        d.addCallbacks(lambda values: (list(values), None),
+                       lambda failure: (None, error_message(failure)))
+        return d
+
 
 # noinspection PyAttributeOutsideInit
 class MKS(WatchedServer):
@@ -240,13 +337,30 @@ print "Found these watchers: ", WATCHERS
 
 # noinspection PyAttributeOutsideInit
 class DRLogger(DeviceWrapper):
-    """
+    """Logs points from the watched servers of one DR to the data vault.
+
+    Each point polls all watchers at once, so the time to take a point is
+    that of the slowest watcher, up to its timeout. A watcher that fails or
+    times out gives NaN for its variables, and sets bit i (for the i-th
+    watcher) of the errors variable. Points are buffered and sent to the
+    data vault in batches.
+
+    Without a run, there is a dataset for each day. With a run, such as
+    a cooldown, all points go into a single dataset for the run, which is
+    reopened and extended when the logger restarts. Its rows can be read
+    by time with the data vault's 'get range'.
 
     Attributes:
         name (str): Name of this DR setup. Assigned by pylabrad's device server
             code.
         watchers (list of WatchedServer): Server proxies we watch.
+        run (str): Name of the current run, or '' for daily datasets.
+        buffer (list of (float, list)): Points not yet sent to the data vault,
+            as a time and the values from each watcher (None if it failed).
+        clock: Provider of callLater, used for logging and timeouts.
     """
+    clock = reactor
+
     @inlineCallbacks
     def connect(self, *args, **kwargs):
         """Connect to a DR device
@@ -264,12 +378,18 @@ class DRLogger(DeviceWrapper):
         self.watchers = []
         self.data_vault = None
         self.errors = []
+        self.buffer = []
+        self.writeLock = defer.DeferredLock()
+        self.widths = []
         self.dvPath = kwargs.pop('dvPath', ['', 'DR', self.name])
         self.datasetName = kwargs.pop('datasetName', '%s log - [t]' % self.name)
         self.timeInterval = kwargs.pop('timeInterval', 1.0)
-        self.currentDay = ''
+        self.timeout = seconds(kwargs.pop('timeout', DEFAULT_TIMEOUT))
+        self.batchSize = int(kwargs.pop('batchSize', DEFAULT_BATCH_SIZE))
+        self.run = kwargs.pop('run', '')
+        self.currentSegment = None
         # now make our watchers
-        for k, v in kwargs.iteritems():
+        for k, v in sorted(kwargs.iteritems()):
             server_name = v[0]
             nodeName = v[1]
             if len(v) > 2:
@@ -296,6 +416,7 @@ class DRLogger(DeviceWrapper):
             # start the loop
             self.isLogging = True
             self.loop = LoopingCall(self.take_point)
+            self.loop.clock = self.clock
             self.loopDone = self.loop.start(self.timeInterval, now=True)
             print 'loop started'
         elif self.isLogging and not start:
@@ -307,72 +428,172 @@ class DRLogger(DeviceWrapper):
                 pass
             print 'loop stopped'
             self.isLogging = False
+            yield self.flush()
 
     @inlineCallbacks
     def shutdown(self):
         yield self.logging(False)
 
+    @inlineCallbacks
     def new_dataset(self):
+        """Save buffered points, and start a new dataset for the next ones."""
+        yield self.flush()
+        self.data_vault = None
+
+    @inlineCallbacks
+    def set_run(self, run):
+        """Save buffered points, and log the next ones to the given run."""
+        yield self.flush()
+        self.run = run
         self.data_vault = None
 
+    @staticmethod
+    def day(t):
+        return time.strftime("%Y-%m-%d", time.localtime(t))
+
+    def segment(self, t):
+        """Points with the same segment go into the same dataset."""
+        return self.run or self.day(t)
+
+    def run_title(self):
+        return '{} run {}'.format(self.name, self.run)
+
     @inlineCallbacks
-    def make_dataset(self):
-        self.data_vault = self.cxn['data_vault']
-        self.data_vault.cd(self.dvPath, True, context=self.ctx)
-        name = self.datasetName.replace('[t]', time.strftime("%Y-%m-%d %H:%M"))
-        self.currentDay = time.strftime("%d")
+    def make_dataset(self, t=None):
+        """Make a dataset for points starting at time t (default now)."""
+        if t is None:
+            t = time.time()
+        self.data_vault = None
+        dv = self.cxn['data_vault']
+        yield dv.cd(self.dvPath, True, context=self.ctx)
         indeps = ['time [s]']
         deps = []
+        widths = []
         for w in self.watchers:
-            r = yield w.get_variables()
+            r = yield with_timeout(defer.maybeDeferred(w.get_variables),
+                                   self.timeout, self.clock)
             deps.extend(r)
+            widths.append(len(r))
+        deps.append(ERROR_VARIABLE)
         print "Indep vars: %s" % str(indeps)
         print "Dependent vars: %s" % str(deps)
 
-        yield self.data_vault.new(name, indeps, deps, context=self.ctx)
+        reopened = False
+        if self.run:
+            name = self.run_title()
+            reopened = yield self.reopen_dataset(dv, name, deps)
+        else:
+            name = self.datasetName.replace(
+                '[t]', time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
+        if not reopened:
+            yield dv.new(name, indeps, deps, context=self.ctx)
+            # the order of watchers gives the bits of the errors variable
+            yield dv.add_parameter('watchers',
+                                   [w.server_name for w in self.watchers],
+                                   context=self.ctx)
+        self.widths = widths
+        self.currentSegment = self.segment(t)
+        self.data_vault = dv
+
+    @inlineCallbacks
+    def reopen_dataset(self, dv, title, deps):
+        """Open the latest dataset with this title for appending.
+
+        Returns:
+            bool: Whether it was opened. It is not if there is none, or if
+                its variables differ from deps, as when watchers changed.
+        """
+        name = yield find_dataset(dv, title, self.ctx)
+        if name is None:
+            returnValue(False)
+        yield dv.open(name, True, context=self.ctx)
+        _, variables = yield dv.variables(context=self.ctx)
+        if [variable_name(v) for v in variables] != deps:
+            print "Variables of %s changed, making a new dataset" % name
+            returnValue(False)
+        # as for a dataset made by dr_logger_migrate
+        params = yield dv.parameters(context=self.ctx)
+        if 'watchers' not in params:
+            yield dv.add_parameter('watchers',
+                                   [w.server_name for w in self.watchers],
+                                   context=self.ctx)
+        print "Appending to %s" % name
+        returnValue(True)
+
+    def row(self, t, results):
+        """Data vault row for a point, with NaN for missing values."""
+        row = [t]
+        errors = 0
+        for i, (values, width) in enumerate(zip(results, self.widths)):
+            if values is None or len(values) != width:
+                row.extend([np.nan] * width)
+                errors |= 1 << i
+            else:
+                row.extend(strip_units(x) for x in values)
+        row.append(errors)
+        return row
 
     @inlineCallbacks
     def take_point(self):
+        """Take a point from all watchers at once, and buffer it.
+
+        The buffer is sent to the data vault when it holds batchSize
+        points, or when the day rolls over if there is no run.
+        """
         try:
-            # gather data
-            data = [time.time() * Unit('s')]
-            errors = []
-            for w in self.watchers:
-                try:
-                    r = yield w.take_point()
-                    data.extend(r)
-                except T.Error as err:
-                    errors.append((w.server_name, err.msg))
-            if errors:
-                self.errors = errors
-                returnValue(None)
-            # strip units
-            data = [x[x.unit] for x in data]
-            # did the day roll over?
-            if self.currentDay != time.strftime("%d"):
-                self.new_dataset()
-            try:
-                # make dataset if first time
-                if self.data_vault is None:
-                    print("Making new dataset")
-                    yield self.make_dataset()
-                # add data
-                yield self.data_vault.add(data, context=self.ctx)
-            except T.Error as err:
-                print("Error when writing data to data vault: {}".format(err))
-                if 'NoDatasetError' in err.msg:
-                    try:
-                        yield self.make_dataset()
-                        yield self.data_vault.add(data, context=self.ctx)
-                    except T.Error as err:
-                        errors.append(("Data Vault", str(err)))
-                else:
-                    errors.append(("General", str(err)))
-            self.errors = errors
-        except Exception as e:
-            import traceback
+            t = time.time()
+            results = yield defer.gatherResults(
+                [w.poll(self.timeout, self.clock) for w in self.watchers])
+            self.errors = [(w.server_name, err)
+                           for w, (_, err) in zip(self.watchers, results)
+                           if err is not None]
+            self.buffer.append((t, [values for values, _ in results]))
+            if (len(self.buffer) >= self.batchSize or
+                    self.segment(t) != self.currentSegment):
+                yield self.flush()
+        except Exception:
             traceback.print_exc()
 
+    @inlineCallbacks
+    def flush(self):
+        """Send buffered points to the data vault.
+
+        Without a run, points go into the dataset of the day they were
+        taken, so those taken before a rollover are saved before the new
+        dataset is made.
+        Points that could not be saved stay buffered for the next flush.
+        """
+        yield self.writeLock.acquire()
+        try:
+            if len(self.buffer) > MAX_BUFFER:
+                dropped = len(self.buffer) - MAX_BUFFER
+                del self.buffer[:dropped]
+                self.errors.append(("Data Vault", "buffer full, dropped "
+                                    "{} points".format(dropped)))
+            while self.buffer:
+                segment = self.segment(self.buffer[0][0])
+                if self.data_vault is None or segment != self.currentSegment:
+                    print("Making new dataset")
+                    yield self.make_dataset(self.buffer[0][0])
+                count = len(self.buffer)
+                for i, (t, _) in enumerate(self.buffer):
+                    if self.segment(t) != segment:
+                        count = i
+                        break
+                rows = [self.row(t, results)
+                        for t, results in self.buffer[:count]]
+                yield self.data_vault.add(rows, context=self.ctx)
+                # points may have been added to the buffer while we waited
+                del self.buffer[:count]
+        except Exception as err:
+            msg = err.msg if isinstance(err, T.Error) else str(err)
+            print("Error when writing data to data vault: {}".format(msg))
+            if 'NoDatasetError' in msg:
+                self.data_vault = None
+            self.errors.append(("Data Vault", msg))
+        finally:
+            self.writeLock.release()
+
 
 class DRLoggerServer(DeviceServer):
     """Log DR temperatures and pressures
@@ -386,7 +607,14 @@ class DRLoggerServer(DeviceServer):
                     'lakeshore_diodes'.
                 <node> (s): Name of node running <server>.
                 <options> ((s, ?),...): Tuple of (key, value) tuples. Provides
-                    additional data to configure measurements.
+                    additional data to configure measurements, such as a
+                    'timeout' for this server.
+            Optional logging settings, each a key of its own:
+                dvPath (*s), datasetName (s), timeInterval (v),
+                timeout (v[s]): Default time to wait for a watched server.
+                batchSize (w): Points sent to the data vault at once.
+                run (s): Log to one dataset for this run, instead of one
+                    per day.
     """
     name = 'DR Logger'
     deviceName = 'DR'
@@ -422,6 +650,9 @@ class DRLoggerServer(DeviceServer):
             for dev in devs:
                 config = yield reg.get(dev)
                 print("config: {}".format(config))
+                if dev in LOGGER_SETTINGS:
+                    serverDict[dev] = config
+                    continue
                 # config is a tuple of (server name, node name) or
                 #                      (server name, node name, options)
                 serverDict[dev] = config
@@ -438,12 +669,30 @@ class DRLoggerServer(DeviceServer):
     @setting(10, "Take Point")
     def take_point(self, c):
         """ Take a single data point. """
-        self.selectedDevice(c).take_point()
+        return self.selectedDevice(c).take_point()
 
     @setting(11, "New Dataset")
     def new_dataset(self, c):
-        """ Start a new dataset. """
-        self.selectedDevice(c).new_dataset()
+        """ Start a new dataset, after saving buffered points. """
+        return self.selectedDevice(c).new_dataset()
+
+    @setting(16, "Flush")
+    def flush(self, c):
+        """ Send buffered points to the data vault now. """
+        return self.selectedDevice(c).flush()
+
+    @setting(17, 'Run', name='s', returns='s')
+    def run(self, c, name=None):
+        """ Get/set the run logged to a single dataset.
+
+        Setting a run saves buffered points, then logs to the dataset of
+        the run, which is extended if it exists. An empty name goes back to
+        a dataset per day.
+        """
+        dev = self.selectedDevice(c)
+        if name is not None:
+            yield dev.set_run(name)
+        returnValue(dev.run)
 
     @setting(12, 'Logging', start='b', returns='b')
     def logging(self, c, start=None):
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+"""Migrate the daily datasets of the DR Logger into one dataset for a run.
+
+Without a run, the DR Logger writes a dataset per day, so reading a
+cooldown means opening and stitching many datasets. This copies such
+datasets, in order, into the single dataset the logger extends for a run,
+
+    <DR name> run <run>
+
+in the same directory. The run dataset has the variables of all the
+copied datasets, newest first, with NaN where a dataset lacked one. The
+errors variable of the logger comes last, as the logger writes it, also
+when the copied datasets predate it. Rows already in the run dataset are
+skipped, so an interrupted migration can be run again. Since rows of the
+run dataset must stay in time order to be read by time, migrate before
+switching the logger to the run.
+
+The logger appends to the run dataset only if its variables are those of
+its watchers, so the logger should watch the same servers as when the
+newest copied dataset was written. Otherwise it starts another dataset
+for the run.
+
+Usage:
+    python dr_logger_migrate.py <DR name> <run> [<dataset>...]
+
+With no datasets given, all '<DR name> log' datasets in the logger's
+directory are copied.
+"""
+
+import argparse
+
+import numpy as np
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import labrad.wrappers
+
+from dr_logger import ERROR_VARIABLE, find_dataset, variable_name
+
+# rows read and written at once
+BATCH = 10000
+
+
+@inlineCallbacks
+def read_variables(dv, name, context):
+    yield dv.open(name, context=context)
+    indeps, deps = yield dv.variables(context=context)
+    returnValue(([variable_name((i[0], '', i[1])) for i in indeps],
+                 [variable_name(d) for d in deps]))
+
+
+@inlineCallbacks
+def migrate(dv, path, sources, title, read=(0, 1), write=(0, 2),
+            batch=BATCH):
+    """Copy datasets into the latest dataset with the given title.
+
+    Args:
+        dv: Data vault client, such as cxn.data_vault.
+        path (list of str): Directory of the datasets.
+        sources (list of str): Names of the datasets to copy, oldest first.
+            Rows are copied in order of their first column, time.
+        title (str): Title of the dataset to copy into. It is made if there
+            is none, and otherwise must have the variables of all sources.
+        read, write: Contexts for reading the sources and writing.
+
+    Returns:
+        (str, int): Name of the dataset copied into, and the number of rows
+            copied.
+    """
+    yield dv.cd(path, context=read)
+    yield dv.cd(path, context=write)
+    indeps = None
+    columns = {}
+    for name in sources:
+        i, d = yield read_variables(dv, name, read)
+        if indeps is None:
+            indeps = i
+        elif i != indeps:
+            raise ValueError('{} has independents {}, not {}'.format(
+                name, i, indeps))
+        columns[name] = d
+    # newest variables first, then those that were dropped
+    deps = []
+    for name in reversed(sources):
+        deps.extend(d for d in columns[name] if d not in deps)
+    # last, as in the datasets of the logger, which datasets written before
+    # it had errors lack
+    if ERROR_VARIABLE in deps:
+        deps.remove(ERROR_VARIABLE)
+    deps.append(ERROR_VARIABLE)
+
+    target = yield find_dataset(dv, title, write)
+    if target is None:
+        _, target = yield dv.new(title, indeps, deps, context=write)
+    else:
+        yield dv.open(target, True, context=write)
+        _, existing = yield dv.variables(context=write)
+        existing = [variable_name(d) for d in existing]
+        missing = [d for d in deps if d not in existing]
+        if missing:
+            raise ValueError('{} lacks variables {}'.format(target, missing))
+        deps = existing
+
+    copied = 0
+    for name in sources:
+        start = copied
+        yield dv.open(name, context=read)
+        index = [deps.index(d) for d in columns[name]]
+        while True:
+            data = yield dv.get(batch, False, context=read)
+            data = np.asarray(data, dtype=float)
+            if not data.size:
+                break
+            # skip rows copied by an earlier migration
+            done = yield dv.get_range(data[0, 0], data[-1, 0], context=write)
+            done = np.asarray(done, dtype=float)
+            if done.size:
+                data = data[data[:, 0] > done[:, 0].max()]
+                if not len(data):
+                    continue
+            rows = np.full((len(data), len(indeps) + len(deps)), np.nan)
+            rows[:, :len(indeps)] = data[:, :len(indeps)]
+            rows[:, [len(indeps) + i for i in index]] = data[:, len(indeps):]
+            yield dv.add(rows, context=write)
+            copied += len(rows)
+        print 'Copied {} rows from {}'.format(copied - start, name)
+    returnValue((target, copied))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Copy daily DR Logger datasets into one run dataset.')
+    parser.add_argument('dr', help='name of the DR, as in the registry')
+    parser.add_argument('run', help='name of the run')
+    parser.add_argument('datasets', nargs='*',
+                        help='datasets to copy (default all daily ones)')
+    parser.add_argument('--path', nargs='+',
+                        help='data vault directory (default DR/<DR name>)')
+    args = parser.parse_args()
+
+    @inlineCallbacks
+    def run():
+        try:
+            cxn = yield labrad.wrappers.connectAsync(
+                name='DR Logger migration')
+            path = [''] + (args.path or ['DR', args.dr])
+            sources = args.datasets
+            if not sources:
+                yield cxn.data_vault.cd(path)
+                _, names = yield cxn.data_vault.dir()
+                prefix = '{} log - '.format(args.dr)
+                sources = [n for n in names
+                           if n.split(' - ', 1)[-1].startswith(prefix)]
+            title = '{} run {}'.format(args.dr, args.run)
+            name, copied = yield migrate(cxn.data_vault, path, sources, title,
+                                         cxn.context(), cxn.context())
+            print 'Copied {} rows to {}'.format(copied, name)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
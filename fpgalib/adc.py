@@ -11,7 +11,7 @@ from labrad.devices import DeviceWrapper
 from labrad import types as T
 import labrad.support
 
-from fpgalib.util import littleEndian, TimedLock
+from fpgalib.util import littleEndian, packetArray, TimedLock
 
 import fpgalib.mondict as mondict
 
@@ -245,10 +245,12 @@ class ADC_Branch1(ADC):
     
     @staticmethod
     def extractAverage(packets):
-        """Extract Average waveform from a list of packets (byte strings)."""
-        
-        data = ''.join(packets)
-        Is, Qs = np.fromstring(data, dtype='<i2').reshape(-1, 2).astype(int).T
+        """Extract Average waveform from a list of packets (byte strings).
+
+        packets may also be a packet array, see util.packetArray.
+        """
+        data = packetArray(packets).view('<i2')
+        Is, Qs = data.reshape(-1, 2).astype(int).T
         return (Is, Qs)
 
 
@@ -331,7 +333,12 @@ class AdcRunner_Build1(AdcRunner):
             self.dev.discard(self.nPackets)
     
     def extract(self, packets):
-        """Extract data coming back from a readPacket."""
+        """Extract data coming back from a readPacket.
+
+        packets is either a list of packet payloads or, if the data was read
+        with Read Concatenated, a single string of all payloads.
+        """
+        packets = packetArray(packets, self.nPackets)
         if self.runMode == 'average':
             return self.dev.extractAverage(packets)
         elif self.runMode == 'demodulate':
@@ -502,13 +509,14 @@ class ADC_Build1(ADC_Branch1):
     
     @staticmethod
     def extractDemod(packets, nDemod):
-        """Extract Demodulation data from a list of packets (byte strings)."""
-        #stick all data strings in packets together, chopping out last 4 bytes
-        #from each string
-        data = ''.join(data[:44] for data in packets)
-        #Convert string of bytes into numpy array of 16bit integers. <i2 means
-        #little endian 2 byte
-        vals = np.fromstring(data, dtype='<i2')
+        """Extract Demodulation data from a list of packets (byte strings).
+
+        packets may also be a packet array, see util.packetArray.
+        """
+        pkts = packetArray(packets)
+        #stick all data in packets together, chopping out last 4 bytes
+        #from each packet, and convert to little endian 2 byte integers
+        vals = np.ascontiguousarray(pkts[:, :44]).view('<i2')
         #Is,Qs are numpy arrays with the following format
         #[I0,I1,...,I_numChannels,    I0,I1,...,I_numChannels]
         #           1st data run                2nd data run    
@@ -518,17 +526,11 @@ class ADC_Build1(ADC_Branch1):
         data = (Is, Qs)
         #data = [(Is[i::nDemod], Qs[i::nDemod]) for i in xrange(nDemod)]
         #data_saved = data
-        # compute overall max and min for I and Q
-        def getRange(pkt):
-            Irng, Qrng = [ord(i) for i in pkt[46:48]]
-            twosComp = lambda i: int(i if i < 0x8 else i - 0x10)
-            Imax = twosComp((Irng >> 4) & 0xF) # << 12
-            Imin = twosComp((Irng >> 0) & 0xF) # << 12
-            Qmax = twosComp((Qrng >> 4) & 0xF) # << 12
-            Qmin = twosComp((Qrng >> 0) & 0xF) # << 12
-            return Imax, Imin, Qmax, Qmin
-        
-        ranges = np.array([getRange(pkt) for pkt in packets]).T
+        # compute overall max and min for I and Q from the 4 bit two's
+        # complement range nibbles in bytes 46 (I) and 47 (Q) of each packet
+        Irng, Qrng = pkts[:, 46:48].astype(int).T
+        nibbles = np.array([Irng >> 4, Irng & 0xF, Qrng >> 4, Qrng & 0xF])
+        ranges = np.where(nibbles < 0x8, nibbles, nibbles - 0x10)
         Imax = int(max(ranges[0]))
         Imin = int(min(ranges[1]))
         Qmax = int(max(ranges[2]))
@@ -655,7 +657,12 @@ class AdcRunner_Build7(AdcRunner_Build2):
         return regs    
     
     def extract(self, packets):
-        """Extract data coming back from a readPacket."""
+        """Extract data coming back from a readPacket.
+
+        packets is either a list of packet payloads or, if the data was read
+        with Read Concatenated, a single string of all payloads.
+        """
+        packets = packetArray(packets, self.nPackets)
         if self.runMode == 'average':
             return self.dev.extractAverage(packets)
         elif self.runMode == 'demodulate':
@@ -820,10 +827,12 @@ class ADC_Branch2(ADC):
     
     @staticmethod
     def extractAverage(packets):
-        """Extract Average waveform from a list of packets (byte strings)."""
-        
-        data = ''.join(packets)
-        Is, Qs = np.fromstring(data, dtype='<i2').reshape(-1, 2).astype(int).T
+        """Extract Average waveform from a list of packets (byte strings).
+
+        packets may also be a packet array, see util.packetArray.
+        """
+        data = packetArray(packets).view('<i2')
+        Is, Qs = data.reshape(-1, 2).astype(int).T
         return (Is, Qs)
 
 class ADC_Build7(ADC_Branch2):
@@ -1062,6 +1071,8 @@ class ADC_Build7(ADC_Branch2):
     def extractDemod(cls, packets, triggerTable, mode):
         """
         Extract Demodulation data from a list of packets (byte strings).
+
+        packets may also be a packet array, see util.packetArray.
         
         Returns a tuple of (demodData, packet counters, readback counters)
         
@@ -1119,8 +1130,7 @@ class ADC_Build7(ADC_Branch2):
         d(47)	spare [7..0]		
         
         """
-        #stick all data strings in packets together, chopping out last 4 bytes
-        #from each string
+        pkts = packetArray(packets)
         rchans = [trig[3] for trig in triggerTable]
         nTrigger = [trig[0] for trig in triggerTable]
              
@@ -1135,68 +1145,49 @@ class ADC_Build7(ADC_Branch2):
             rchan = rchans[0]
         
         totalTriggers = np.sum(nTrigger)
-        # pkt_per_stat = int(np.ceil((totalTriggers * rchan * 2.0)/cls.DEMOD_CHANNELS_PER_PACKET))
         pkt_per_stat = int(np.ceil((totalTriggers * rchan)/float(cls.DEMOD_CHANNELS_PER_PACKET)))
-        # print 'totalTriggers: %s, rchan: %s, DEMOD_CHANNELS_PER_PACKET: %s' % (totalTriggers, rchan, cls.DEMOD_CHANNELS_PER_PACKET)
-        reps = len(packets)//pkt_per_stat
-        if len(packets) % pkt_per_stat:
-            raise RuntimeError("wrong number of packets: %d not a multiple of pkt_per_stat: %d" % (len(packets), pkt_per_stat))
-
-        
-        # Puke all over the console output.
-        #print "extract demod packets.  Total triggers: %d, rchan: %d" % (totalTriggers, rchan)
-        #for p in packets:
-        #    print "len: %d" % (len(p),)
-        #    print labrad.support.hexdump(p)
-        # print "total packets: %s, packets_per_stat: %s, reps: %s" % (len(packets), pkt_per_stat, reps)
-        
-        stat_pkt_list = [packets[idx*pkt_per_stat:pkt_per_stat*(idx+1)] for idx in range(reps)]
-        # print "len of stat_pkt_list: %d, len stat_packet 0: %d" % (len(stat_pkt_list),len(stat_pkt_list[0]))
-        all_data = []
-        for stat_packet in stat_pkt_list:
-            data = np.fromstring(''.join(data[:44] for data in stat_packet), dtype='<u1')
-            pktCounters = [ord(pkt[46]) for pkt in stat_packet]
-            readbackCounters = [ ord(pkt[44]) + ord(pkt[45])<<8 for pkt in stat_packet ]
-            #print "packet counters: %s, readback counters: %s" % (pktCounters, readbackCounters)
-            if mode=='iq':
-                # Convert to 16-bit int array and chop garbage from last packet
-                vals = np.fromstring(data, dtype='<i2')[:2*rchan*totalTriggers] 
-                # Slowest varying index: time step, next slowest index : demodulator, fastest index: I vs Q
-                #  Transpose first two indices to make demodulator first index 
-                # Iq0[t=0], Qq0[t=0], Iq1[t=0], Qq1[t=0], Iq0[t=1], Qq0[t=1], Iq1[t=1], Qq1[t=1]
-                #    
-                #     goes to:
-                # data[qubit][time_step][(I=0 | Q=1)]       
-                #print "flat values: ", vals
-                reshapedData = vals.reshape(totalTriggers , rchan, 2).astype(int)
-                #print "reshaped data: ", reshapedData
-                transposedData = reshapedData.transpose((1, 0, 2))
-                #print "transposed data: ", transposedData
-                all_data.append(transposedData)
-            else:
-                '''
-                In bit readout mode, use rchan[7..0]=0.  Readout is only the sign bit of channels 0 to 7; one byte readout is designed for compactness to minimize number of Ethernet packets.  The bit is 0 if real quadrature of the channel is positive.  Bit is flipped with XOR mask bitflip[7..0] defined in register write.  Order of bits in output byte is [ch7..ch0].
-
-                l(0)	length[15..8]		set to 0
-                l(1)	length[7..0]		set to 48
-
-                d(0)	bits1[7..0]		1st bitstring
-                d(1)	bits2[7..0]		2nd bitstring
-                ...	
-                d(43)	bits44[7..0]		44th bitstring
-
-                d(44)	countrb[7..0]		Running count of triggers since last start
-                d(45)	countrb[15..8]		   1st readback has countrb=1
-                d(46)	countpack[7..0]	Packet counter for retriggering, reset when countrb incr
-                d(47)	spare [7..0]		   
-                '''
-                raise RuntimeError('Operation mode %s not implemented / available' % (mode,))
-        #print "all data length: %d, element 0 size: %s" % (len(all_data), all_data[0].shape)
-        # This makes stat the first index, giving us: data[stat][qubit][time_step][(I=0 | Q=1)]
-        all_data = np.array(all_data)
-        # data[stat][qubit][time_step][(I=0 | Q=1)] --> data[qubit][stat][time_step][(I=0 | Q=1)]
-        all_data = all_data.transpose([1, 0, 2, 3])
-        #print "all_data shape: ", all_data.shape
-        return (all_data, pktCounters, readbackCounters)  # Only returning the packet counters of the last stat.  FIXME if you care about these
+        reps = len(pkts)//pkt_per_stat
+        if len(pkts) % pkt_per_stat:
+            raise RuntimeError("wrong number of packets: %d not a multiple of pkt_per_stat: %d" % (len(pkts), pkt_per_stat))
+
+        if mode != 'iq':
+            '''
+            In bit readout mode, use rchan[7..0]=0.  Readout is only the sign bit of channels 0 to 7; one byte readout is designed for compactness to minimize number of Ethernet packets.  The bit is 0 if real quadrature of the channel is positive.  Bit is flipped with XOR mask bitflip[7..0] defined in register write.  Order of bits in output byte is [ch7..ch0].
+
+            l(0)	length[15..8]		set to 0
+            l(1)	length[7..0]		set to 48
+
+            d(0)	bits1[7..0]		1st bitstring
+            d(1)	bits2[7..0]		2nd bitstring
+            ...	
+            d(43)	bits44[7..0]		44th bitstring
+
+            d(44)	countrb[7..0]		Running count of triggers since last start
+            d(45)	countrb[15..8]		   1st readback has countrb=1
+            d(46)	countpack[7..0]	Packet counter for retriggering, reset when countrb incr
+            d(47)	spare [7..0]		   
+            '''
+            raise RuntimeError('Operation mode %s not implemented / available' % (mode,))
+
+        # Chop the 4 counter bytes off the end of each packet, join the
+        # packets of each stat and convert to 16-bit ints, then chop garbage
+        # from the last packet of each stat.
+        payload = np.ascontiguousarray(pkts[:, :44]).reshape(reps, -1)
+        vals = payload.view('<i2')[:, :2*rchan*totalTriggers]
+        # Slowest varying index: stat, then time step, then demodulator,
+        # fastest index: I vs Q
+        # Iq0[t=0], Qq0[t=0], Iq1[t=0], Qq1[t=0], Iq0[t=1], Qq0[t=1], Iq1[t=1], Qq1[t=1]
+        #
+        #     goes to:
+        # data[qubit][stat][time_step][(I=0 | Q=1)]
+        all_data = vals.reshape(reps, totalTriggers, rchan, 2).astype(int)
+        all_data = all_data.transpose([2, 0, 1, 3])
+
+        # Only returning the counters of the last stat.  FIXME if you care
+        # about these
+        last_stat = pkts[len(pkts)-pkt_per_stat:].astype(int)
+        pktCounters = last_stat[:, 46].tolist()
+        readbackCounters = (last_stat[:, 44] + (last_stat[:, 45] << 8)).tolist()
+        return (all_data, pktCounters, readbackCounters)
 
 fpga.REGISTRY[('ADC', 7)] = ADC_Build7
@@ -25,7 +25,7 @@ import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad import types as T
 
-from fpgalib.util import littleEndian
+from fpgalib.util import littleEndian, packetArray
 import fpgalib.fpga as fpga
 import fpgalib.jump_table as jump_table
 
@@ -345,16 +345,10 @@ class DAC(fpga.FPGA):
         appropriate page.
         """
 
-        def shiftAddr(cmd):
-            opcode, address = MemorySequence.getOpcode(cmd), \
-                              MemorySequence.getAddress(cmd)
-            if opcode in [0x8, 0xA]:
-                address += page * cls.SRAM_PAGE_LEN
-                return (opcode << 20) + address
-            else:
-                return cmd
-
-        return [shiftAddr(cmd) for cmd in cmds]
+        cmds = MemorySequence.asArray(cmds)
+        opcodes = MemorySequence.getOpcode(cmds)
+        sramAddrs = (opcodes == 0x8) | (opcodes == 0xA)
+        return np.where(sramAddrs, cmds + page * cls.SRAM_PAGE_LEN, cmds)
 
     @staticmethod
     def getCommand(cmds, chan):
@@ -499,9 +493,13 @@ class DacRunner_Build7(DacRunner):
             self.dev.discard(self.nPackets)
 
     def extract(self, packets):
-        """Extract timing data coming back from a readPacket."""
-        data = ''.join(data[3:63] for data in packets)
-        return np.fromstring(data, dtype='<u2').astype('u4')
+        """Extract timing data coming back from a readPacket.
+
+        packets is either a list of packet payloads or, if the data was read
+        with Read Concatenated, a single string of all payloads.
+        """
+        timers = packetArray(packets, self.nPackets)[:, 3:63]
+        return np.ascontiguousarray(timers).view('<u2').ravel().astype('u4')
 
 
 class DAC_Build7(DAC):
@@ -1563,27 +1561,32 @@ class DAC_Build15(DAC_Build8):
                              .format(len(jt_entries), cls.JUMP_TABLE_COUNT))
 
         # no two opcodes executed within JT_MIN_CLK_CYCLES_BETWEEN_OPCODES
-        for k, jt_entry in enumerate(jt_entries):
-            # first pass we check all increment cases
-            if isinstance(jt_entry.operation, cls.increment_ops):
-                sram_idx = jt_entry.from_addr
-                next_jt_idx = k + 1
-                next_from_addr = jt_entries[next_jt_idx].from_addr
-                if ((next_from_addr - sram_idx) <
-                        cls.JT_MIN_CLK_CYCLES_BETWEEN_OPCODES):
-                    raise ValueError("Entry {} and entry it increments to "
-                                     "executed too closely in time"
-                                     .format(jt_entry))
-            # second pass we check all jump cases
-            if isinstance(jt_entry.operation, cls.jump_ops):
-                sram_idx = jt_entry.to_addr
-                # take off 1 as first entry is always NOP (self.toString)
-                next_jt_idx = jt_entry.operation.jump_index - 1
-                next_from_addr = jt_entries[next_jt_idx].from_addr
-                if ((next_from_addr - sram_idx) <
-                        cls.JT_MIN_CLK_CYCLES_BETWEEN_OPCODES):
-                    raise ValueError("Entry {} and entry it jumps to executed "
-                                     "too closely in time".format(jt_entry))
+        from_addrs = np.array([e.from_addr for e in jt_entries], dtype=int)
+        to_addrs = np.array([e.to_addr for e in jt_entries], dtype=int)
+        ops = [e.operation for e in jt_entries]
+        # first we check all increment cases
+        incs = np.flatnonzero(
+            [isinstance(op, cls.increment_ops) for op in ops])
+        inc_gaps = from_addrs[incs + 1] - from_addrs[incs]
+        # then all jump cases
+        jumps = np.flatnonzero([isinstance(op, cls.jump_ops) for op in ops])
+        # take off 1 as first entry is always NOP (self.toString)
+        next_jt_idxs = np.array([ops[k].jump_index - 1 for k in jumps],
+                                dtype=int)
+        jump_gaps = from_addrs[next_jt_idxs] - to_addrs[jumps]
+        # report the first offending entry, increments before jumps
+        min_gap = cls.JT_MIN_CLK_CYCLES_BETWEEN_OPCODES
+        bad_incs = incs[inc_gaps < min_gap]
+        bad_jumps = jumps[jump_gaps < min_gap]
+        if len(bad_incs) and (not len(bad_jumps) or
+                              bad_incs[0] <= bad_jumps[0]):
+            raise ValueError("Entry {} and entry it increments to "
+                             "executed too closely in time"
+                             .format(jt_entries[bad_incs[0]]))
+        if len(bad_jumps):
+            raise ValueError("Entry {} and entry it jumps to executed "
+                             "too closely in time"
+                             .format(jt_entries[bad_jumps[0]]))
 
         return jump_table.JumpTable(
             start_addr=cls.convert_to_address(start_address_ns),
@@ -1724,15 +1727,25 @@ def maxSRAM(cmds):
     This is used to determine whether a given memory sequence is pageable,
     since only half of the available SRAM can be used when paging.
     """
+    cmds = MemorySequence.asArray(cmds)
+    opcodes = MemorySequence.getOpcode(cmds)
+    addrs = np.where((opcodes == 0x8) | (opcodes == 0xA),
+                     MemorySequence.getAddress(cmds), 0)
+    return int(addrs.max())
 
-    def addr(cmd):
-        return MemorySequence.getAddress(cmd) if \
-            MemorySequence.getOpcode(cmd) in [0x8, 0xA] else 0
 
-    return max(addr(cmd) for cmd in cmds)
+#Memory sequence functions
 
+# Cycles taken by each memory opcode, see MemorySequence.cmdTime_cycles.
+# noOp, fiber 0 out, fiber 1 out, start/stop timer, sram start addr and sram
+# end addr take one cycle, branch to start takes two. Delays (0x3) depend on
+# the address. SRAM calls (0xC) are assumed to take the maximum SRAM length of
+# 12us, with 25 cycles per us.
+# TODO: Incorporate SRAMoffset when calculating sequence time.
+#       This gives a max of up to 12 + 255 us
+_OPCODE_CYCLES = np.array([1, 1, 1, 0, 1, -1, -1, -1,
+                           1, -1, 1, -1, 25*12, -1, -1, 2], dtype=np.int64)
 
-#Memory sequence functions
 
 class MemorySequence(list):
     @staticmethod
@@ -1811,6 +1824,15 @@ class MemorySequence(list):
         self.append(0xf00000)
         return self
 
+    @staticmethod
+    def asArray(cmds):
+        """Memory commands as a uint32 array.
+
+        All of the sequence helpers below work on whole arrays of commands
+        at once, so that long sequences do not pay for a python loop.
+        """
+        return np.asarray(cmds, dtype='<u4')
+
     @staticmethod
     def addMasterDelay(cmds, delay_us=MASTER_SRAM_DELAY_US):
         """Add delays to master board before SRAM calls.
@@ -1822,15 +1844,12 @@ class MemorySequence(list):
         
         TODO: check for repeated delay calls to make sure delays actually happen
         """
-        newCmds = []
         delayCycles = int(delay_us * 25)  #memory clock speed is 25MHz
         assert delayCycles < 0xFFFFF
         delayCmd = 0x300000 + delayCycles
-        for cmd in cmds:
-            if MemorySequence.getOpcode(cmd) == 0xC:  # call SRAM
-                newCmds.append(delayCmd)  # add delay
-            newCmds.append(cmd)
-        return newCmds
+        cmds = MemorySequence.asArray(cmds)
+        sramCalls = np.flatnonzero(MemorySequence.getOpcode(cmds) == 0xC)
+        return np.insert(cmds, sramCalls, delayCmd)
 
     @staticmethod
     def cmdTime_cycles(cmd):
@@ -1838,24 +1857,27 @@ class MemorySequence(list):
         
         SRAM calls are assumed to take 12us. This is an upper bound.
         """
-        opcode = MemorySequence.getOpcode(cmd)
-        # noOp, fiber 0 out, fiber 1 out, start/stop timer, sram start addr,
-        # sram end addr
-        if opcode in [0x0, 0x1, 0x2, 0x4, 0x8, 0xA]:
-            return 1
-        #branch to start
-        elif opcode == 0xF:
-            return 2
+        return int(MemorySequence.cycles([cmd])[0])
+
+    @staticmethod
+    def cycles(cmds):
+        """Array of conservative cycle counts, one per memory command.
+
+        See cmdTime_cycles. Unknown opcodes raise an Exception naming the
+        first offending command.
+        """
+        cmds = MemorySequence.asArray(cmds)
+        opcodes = MemorySequence.getOpcode(cmds)
+        cycles = _OPCODE_CYCLES[opcodes]
         #delay
-        elif opcode == 0x3:
-            return MemorySequence.getAddress(cmd) + 1
-        #run sram
-        elif opcode == 0xC:
-            # TODO: Incorporate SRAMoffset when calculating sequence time.
-            #       This gives a max of up to 12 + 255 us
-            return 25*12  # maximum SRAM length is 12us, with 25 cycles per us
-        else:
-            raise Exception("Unknown opcode: %s address: %s" % (opcode, MemorySequence.getAddress(cmd)))
+        delays = opcodes == 0x3
+        cycles[delays] = MemorySequence.getAddress(cmds[delays]) + 1
+        unknown = np.flatnonzero(cycles < 0)
+        if len(unknown):
+            cmd = cmds[unknown[0]]
+            raise Exception("Unknown opcode: %s address: %s" % (
+                MemorySequence.getOpcode(cmd), MemorySequence.getAddress(cmd)))
+        return cycles
     
     @staticmethod
     def sequenceTime_sec(cmds):
@@ -1863,7 +1885,7 @@ class MemorySequence(list):
         
         cmds - list of numbers: memory commands for GHz DAC
         """
-        cycles = sum(MemorySequence.cmdTime_cycles(c) for c in cmds)
+        cycles = int(MemorySequence.cycles(cmds).sum())
         return cycles * 40e-9  # assume 25 MHz clock -> 40 ns per cycle
 
     @staticmethod
@@ -1904,25 +1926,19 @@ class MemorySequence(list):
         delayBlocks = sram[2]
         if not isinstance(sram, tuple):
             return mem
-        numSramCalls = sum(MemorySequence.getOpcode(cmd) == 0xC for cmd in mem)
-        if numSramCalls > 1:
+        mem = MemorySequence.asArray(mem)
+        opcodes = MemorySequence.getOpcode(mem)
+        if np.count_nonzero(opcodes == 0xC) > 1:
             raise Exception('Only one SRAM call allowed in multi-block sequences.')
 
-        def fixAddr(cmd):
-            opcode, address = MemorySequence.getOpcode(cmd), MemorySequence.getAddress(cmd)
-            if opcode == 0x8:
-                # SRAM start address
-                address = device.SRAM_BLOCK0_LEN - block0Len_words
-                return (opcode << 20) + address
-            elif opcode == 0xA:
-                # SRAM end address
-                address = device.SRAM_BLOCK0_LEN + block1Len_words \
-                          + device.SRAM_DELAY_LEN * delayBlocks - 1
-                return (opcode << 20) + address
-            else:
-                return cmd
-
-        return [fixAddr(cmd) for cmd in mem]
+        mem = mem.copy()
+        # SRAM start address
+        mem[opcodes == 0x8] = (0x8 << 20) + \
+            device.SRAM_BLOCK0_LEN - block0Len_words
+        # SRAM end address
+        mem[opcodes == 0xA] = (0xA << 20) + device.SRAM_BLOCK0_LEN + \
+            block1Len_words + device.SRAM_DELAY_LEN * delayBlocks - 1
+        return mem
 
     @staticmethod
     def timerCount(cmds):
@@ -1935,5 +1951,4 @@ class MemorySequence(list):
         user's responsibility at this point (if using the qubit server,
         these things are automatically checked).
         """
-        return int(sum(np.asarray(cmds) == 0x400001))  # numpy version
-        #return cmds.count(0x400001) # python list version
+        return int(np.count_nonzero(MemorySequence.asArray(cmds) == 0x400001))
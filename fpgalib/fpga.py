@@ -3,9 +3,9 @@ import os
 
 # Named functions
 from labrad.devices import DeviceWrapper
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import DeferredLock, inlineCallbacks, returnValue
 from labrad.units import Value
-from fpgalib.util import LoggingPacket
+from fpgalib.util import BoardHealth, LoggingPacket
 
 # A registry of FPGA board classes. The class for each build must be added to
 # this registry so that the fpga server knows what type of object to construct
@@ -132,8 +132,17 @@ class FPGA(DeviceWrapper):
     def read(self, nPackets):
         """
         Create a direct ethernet server request to read data for this FPGA.
+
+        The data is stored in the response under the key 'read'. If the
+        direct ethernet server has the Read Concatenated setting (see
+        BoardGroup.init) this is a single string of concatenated packet
+        payloads, otherwise it is a list of (src, dest, eth, data) clusters.
+        See util.packetArray, which handles both.
         """
-        return self.makePacket().read(nPackets)
+        p = self.makePacket()
+        if self.boardGroup.readConcatenated:
+            return p.read_concatenated(nPackets, key='read')
+        return p.read(nPackets, key='read')
     
     def discard(self, nPackets):
         """
@@ -227,11 +236,27 @@ class FPGA(DeviceWrapper):
         """Interpret byte string returned by register readback"""
         raise NotImplementedError()
     
+    @property
+    def testLock(self):
+        """Lock serializing test mode operations on this board."""
+        if not hasattr(self, '_testLock'):
+            self._testLock = DeferredLock()
+        return self._testLock
+
+    @property
+    def health(self):
+        """BoardHealth counters for this board."""
+        if not hasattr(self, '_health'):
+            self._health = BoardHealth()
+        return self._health
+
     def testMode(self, func, *a, **kw):
         """
         Run a func in test mode on our board group.
         
         Test mode acquires locks so that other operations on the board group,
         eg. data taking, are halted until the test operation completes.
+        Test mode operations on this board run one at a time, while those on
+        other boards of the group may run concurrently.
         """
-        return self.boardGroup.testMode(func, *a, **kw)
+        return self.testLock.run(self.boardGroup.testMode, func, *a, **kw)
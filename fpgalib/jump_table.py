@@ -50,11 +50,35 @@ class JumpEntry(object):
         :return: ndarray(dtype='u1') of bytes for this entry.
         :rtype: np.ndarray
         """
-        data = np.zeros(8, dtype='u1')
-        data[0:3] = littleEndian(self.from_addr, 3)
-        data[3:6] = littleEndian(self.to_addr, 3)
-        data[6:8] = self.operation.as_bytes()
+        return entryArray([self]).view('u1')
+
+
+# Packed layout of one entry as written to the board: 3 byte from address,
+# 3 byte to address and 2 byte op code, all little endian.
+ENTRY_DTYPE = np.dtype([('from_addr', 'u1', 3),
+                        ('to_addr', 'u1', 3),
+                        ('op', '<u2')])
+
+
+def _addressBytes(addrs):
+    addrs = np.asarray(addrs, dtype=np.int64)
+    return (addrs[:, np.newaxis] >> np.array([0, 8, 16])) & 0xFF
+
+
+def entryArray(entries):
+    """Pack a list of JumpEntry into an ENTRY_DTYPE array.
+
+    All entries are serialized in one go, so building long tables does not
+    cost one small array per entry.
+    """
+    data = np.zeros(len(entries), dtype=ENTRY_DTYPE)
+    if not len(entries):
         return data
+    data['from_addr'] = _addressBytes([e.from_addr for e in entries])
+    data['to_addr'] = _addressBytes([e.to_addr for e in entries])
+    data['op'] = np.array([e.operation.value() for e in entries],
+                          dtype=np.int64) & 0xFFFF
+    return data
 
 
 # Operations (ie op codes)
@@ -75,6 +99,10 @@ class Operation(object):
         Returns:
             2 element ndarray with dtype 'u1' in little endian order.
         """
+        return littleEndian(self.value(), 2)
+
+    def value(self):
+        """Get the 16 bit op code word for this operation."""
         raise NotImplementedError()
 
 
@@ -92,8 +120,8 @@ class IDLE(Operation):
     def __str__(self):
         return "%s %d cycles" % (self.NAME, self.cycles)
 
-    def as_bytes(self):
-        """Get bytes for an IDLE.
+    def value(self):
+        """Op code word for an IDLE.
 
         The op code is
             dddddddd ddddddd0
@@ -105,7 +133,7 @@ class IDLE(Operation):
                     IDLE_NUM_BITS
                 )
             )
-        return littleEndian(self.cycles << 1, 2)
+        return self.cycles << 1
 
 
 class CHECK(Operation):
@@ -133,8 +161,8 @@ class CHECK(Operation):
     def __str__(self):
         raise NotImplementedError()
 
-    def as_bytes(self):
-        """Get bytes for a CHECK
+    def value(self):
+        """Op code word for a CHECK
 
         The op code is
             xxjjjjjj iiiin001
@@ -147,8 +175,7 @@ class CHECK(Operation):
         which_daisy_bit = self.which_daisy_bit << 4
         bit_state = int(self.bit_state) << 3
         op = 1
-        val = jump_idx + which_daisy_bit + bit_state + op
-        return littleEndian(val, 2)
+        return jump_idx + which_daisy_bit + bit_state + op
 
 
 class JUMP(Operation):
@@ -167,8 +194,8 @@ class JUMP(Operation):
     def __str__(self):
         return '\n'.join([self.NAME, "Next jump index: %d" % self.jump_index])
 
-    def as_bytes(self):
-        """Get bytes for a JUMP
+    def value(self):
+        """Op code word for a JUMP
 
         The op code is
             xxjjjjjj xxxx1101
@@ -176,8 +203,7 @@ class JUMP(Operation):
             jjjjjj is the jump index to set after the jump.
         """
         # binary 1101 = decimal 13
-        val = (self.jump_index << 8) + 13
-        return littleEndian(val, 2)
+        return (self.jump_index << 8) + 13
 
 
 class NOP(Operation):
@@ -187,12 +213,12 @@ class NOP(Operation):
     def __str__(self):
         return self.NAME
 
-    def as_bytes(self):
-        """Get bytes for a NOP.
+    def value(self):
+        """Op code word for a NOP.
 
         The op code is xxxxxxxx xxxx0101
         """
-        return littleEndian(5, 2)
+        return 5
 
 
 class CYCLE(Operation):
@@ -220,8 +246,8 @@ class CYCLE(Operation):
             self.NAME, self.counter, self.jump_index
         )
 
-    def as_bytes(self):
-        """Get bytes for a CYCLE.
+    def value(self):
+        """Op code word for a CYCLE.
 
         The op code is
             xxjjjjjj xxccx011
@@ -232,7 +258,7 @@ class CYCLE(Operation):
         jump_index = self.jump_index << 8
         counter = self.counter << 4
         op = 3
-        return littleEndian(jump_index + counter + op, 2)
+        return jump_index + counter + op
 
 
 class END(Operation):
@@ -241,13 +267,13 @@ class END(Operation):
     def __str__(self):
         return self.NAME
 
-    def as_bytes(self):
-        """Get bytes for an END.
+    def value(self):
+        """Op code word for an END.
 
         The op code is
             xxxxxxxx xxxxx111
         """
-        return littleEndian(7, 2)
+        return 7
 
 
 class JumpTable(object):
@@ -332,9 +358,8 @@ class JumpTable(object):
         # Start op code
         data[22] = 5
         data[23] = 0
-        for i, jump in enumerate(self.jumps):
-            ofs = 24 + i * 8
-            data[ofs:ofs+8] = jump.as_bytes()
+        jumps = entryArray(self.jumps).view('u1')
+        data[24:24 + len(jumps)] = jumps
         return data.tostring()
 
     def pretty_string(self):
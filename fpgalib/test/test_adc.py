@@ -0,0 +1,88 @@
+"""This is intended to test fpgalib/adc.py"""
+
+import numpy as np
+import pytest
+import fpgalib.adc as adc
+from fpgalib.util import packetArray
+
+
+def make_packets(n, length, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, length).astype('u1').tostring()
+            for _ in range(n)]
+
+
+def test_packet_array():
+    packets = make_packets(5, 48)
+    from_list = packetArray(packets)
+    from_string = packetArray(''.join(packets), 5)
+    assert from_list.shape == (5, 48)
+    assert np.array_equal(from_list, from_string)
+    assert packetArray(from_list) is from_list
+    with pytest.raises(ValueError):
+        packetArray(''.join(packets), 7)
+    with pytest.raises(ValueError):
+        packetArray(''.join(packets))
+
+
+def test_extract_average():
+    packets = make_packets(adc.ADC_Build7.AVERAGE_PACKETS, 1024)
+    Is, Qs = adc.ADC_Build7.extractAverage(packets)
+    vals = np.fromstring(''.join(packets), dtype='<i2')
+    assert np.array_equal(Is, vals[0::2])
+    assert np.array_equal(Qs, vals[1::2])
+
+
+def test_extract_demod_build1():
+    packets = make_packets(3, 48)
+    (Is, Qs), ranges = adc.ADC_Build1.extractDemod(packets, 11)
+    vals = np.fromstring(''.join(p[:44] for p in packets), dtype='<i2')
+    assert np.array_equal(Is, vals[0::2])
+    assert np.array_equal(Qs, vals[1::2])
+    signed = lambda n: n if n < 8 else n - 16
+    Irng = [ord(p[46]) for p in packets]
+    Qrng = [ord(p[47]) for p in packets]
+    assert ranges == (max(signed(i >> 4) for i in Irng),
+                      min(signed(i & 0xF) for i in Irng),
+                      max(signed(q >> 4) for q in Qrng),
+                      min(signed(q & 0xF) for q in Qrng))
+
+
+class TestDemodBuild7(object):
+    trigger_table = [(3, 0, 10, 4), (2, 0, 10, 4)]  # 20 IQ pairs per stat
+    stats = 6
+
+    def make_runner(self):
+        dev = adc.ADC_Build7(0, 'adc_name')
+        dev.devName = 'adc_name'
+        info = {'triggerTable': self.trigger_table, 'mode': 'iq'}
+        return adc.AdcRunner_Build7(dev, self.stats, 'demodulate', 0, [], info)
+
+    def test_extract(self):
+        runner = self.make_runner()
+        packets = make_packets(runner.nPackets, 48)
+        data, pktCounters, rbCounters = runner.extract(packets)
+        assert data.shape == (4, self.stats, 5, 2)
+        # check one stat by hand
+        per_stat = runner.nPackets // self.stats
+        stat = 2
+        raw = ''.join(p[:44] for p in
+                      packets[stat * per_stat:(stat + 1) * per_stat])
+        vals = np.fromstring(raw, dtype='<i2')[:2 * 20].reshape(5, 4, 2)
+        assert np.array_equal(data[:, stat], vals.transpose(1, 0, 2))
+        last = packets[-per_stat:]
+        assert pktCounters == [ord(p[46]) for p in last]
+        assert rbCounters == [ord(p[44]) + (ord(p[45]) << 8) for p in last]
+
+    def test_extract_concatenated(self):
+        runner = self.make_runner()
+        packets = make_packets(runner.nPackets, 48)
+        data, _, _ = runner.extract(packets)
+        concatenated, _, _ = runner.extract(''.join(packets))
+        assert np.array_equal(data, concatenated)
+
+    def test_wrong_packet_count(self):
+        runner = self.make_runner()
+        packets = make_packets(runner.nPackets + 1, 48)
+        with pytest.raises(RuntimeError):
+            runner.extract(packets)
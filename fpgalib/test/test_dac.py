@@ -20,6 +20,37 @@ def test_dacify():
     assert actual == expected
 
 
+class TestMemorySequence(object):
+    mem = (dac.MemorySequence().noOp().delayCycles(100)
+           .sramStartAddress(16).sramEndAddress(200).startTimer().runSram()
+           .stopTimer().branchToStart())
+
+    def test_sequence_time(self):
+        cycles = [dac.MemorySequence.cmdTime_cycles(c) for c in self.mem]
+        assert cycles == [1, 101, 1, 1, 1, 300, 1, 2]
+        assert np.array_equal(dac.MemorySequence.cycles(self.mem), cycles)
+        assert dac.MemorySequence.sequenceTime_sec(self.mem) == \
+            sum(cycles) * 40e-9
+
+    def test_unknown_opcode(self):
+        with pytest.raises(Exception):
+            dac.MemorySequence.sequenceTime_sec(self.mem + [0x500000])
+
+    def test_add_master_delay(self):
+        mem = dac.MemorySequence.addMasterDelay(self.mem, delay_us=2)
+        assert list(mem) == self.mem[:5] + [0x300000 + 50] + self.mem[5:]
+
+    def test_sram_addresses(self):
+        assert dac.maxSRAM(self.mem) == 200
+        shifted = dac.DAC_Build8.shiftSRAM(self.mem, 1)
+        page_len = dac.DAC_Build8.SRAM_PAGE_LEN
+        assert list(shifted[2:4]) == [0x800000 + 16 + page_len,
+                                      0xA00000 + 200 + page_len]
+        assert list(shifted[:2]) == self.mem[:2]
+        assert list(shifted[4:]) == self.mem[4:]
+        assert dac.MemorySequence.timerCount(shifted) == 1
+
+
 class TestDAC15(object):
     @classmethod
     def setup_class(cls):
@@ -21,10 +21,12 @@ being sent to the boards.
 import mock
 import numpy as np
 import pytest
+from twisted.internet import defer
 
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
 import fpgalib.jump_table as jump_table
+from fpgalib.util import BoardHealth
 import ghz_fpga_server
 from labrad.units import Value
 
@@ -213,5 +215,239 @@ class TestFPGAServer(object):
             ))
             is_master = False
 
+
+def _fired(d):
+    """Return a list which gets the result of d once it fires."""
+    results = []
+    d.addCallback(results.append)
+    return results
+
+
+def test_concurrent_test_mode():
+    group = ghz_fpga_server.BoardGroup(None, mock.MagicMock(), 0)
+    waits = [defer.Deferred(), defer.Deferred()]
+    devs = [dac.DAC_Build15(i, 'Test DAC {}'.format(i)) for i in (1, 2)]
+    for dev in devs:
+        dev.boardGroup = group
+    results = [_fired(dev.testMode(lambda d=d: d))
+               for dev, d in zip(devs, waits)]
+    # Both boards are in test mode at once, holding the whole pipeline.
+    assert group.testModeUsers == 2
+    assert group.pipeSemaphore.tokens == 0
+    waits[0].callback('first')
+    assert results[0] == ['first']
+    assert group.pipeSemaphore.tokens == 0
+    waits[1].callback('second')
+    assert results[1] == ['second']
+    assert group.pipeSemaphore.tokens == ghz_fpga_server.NUM_PAGES
+
+
+def test_test_mode_serialized_per_board():
+    group = ghz_fpga_server.BoardGroup(None, mock.MagicMock(), 0)
+    dev = dac.DAC_Build15(1, 'Test DAC 1')
+    dev.boardGroup = group
+    first = defer.Deferred()
+    calls = []
+    dev.testMode(lambda: first)
+    dev.testMode(lambda: calls.append('second'))
+    assert calls == []
+    first.callback(None)
+    assert calls == ['second']
+
+
+def test_bringup_all():
+    server = ghz_fpga_server.FPGAServer()
+    server.initServer()
+    waits = {}
+    for i in (1, 2):
+        dev = dac.DAC_Build15(i, 'Test DAC {}'.format(i))
+        dev.devName = dev.name
+        server.devices[dev.name] = dev
+        waits[dev.name] = defer.Deferred()
+    ok = [(('dac', 'A'), ('fifoSuccess', True), ('bistSuccess', True))]
+    bad = [(('dac', 'A'), ('fifoSuccess', True), ('bistSuccess', False))]
+
+    def fake_bringup(dev, *args):
+        return waits[dev.name]
+    server._dacBringup = fake_bringup
+    result = _fired(server.bringup_all(None, ['Test DAC 1', 'Test DAC 2']))
+    # Both boards are running; the second finishes first.
+    waits['Test DAC 2'].callback(bad)
+    assert result == []
+    waits['Test DAC 1'].callback(ok)
+    (name1, success1, _, error1, r1), (name2, success2, _, _, _) = result[0]
+    assert (name1, success1, error1, r1) == ('Test DAC 1', True, '', ok)
+    assert (name2, success2) == ('Test DAC 2', False)
+
+
+class FakeBoard(object):
+    """Board whose pings are answered by hand, for timeout recovery."""
+    def __init__(self, name):
+        self.devName = self.name = name
+        self.health = BoardHealth()
+        self.pings = []
+        self.triggers = []
+
+    def clear(self, triggerCtx=None):
+        if triggerCtx is not None:
+            self.triggers.append(triggerCtx)
+        p = mock.MagicMock()
+        p.send.return_value = defer.succeed(None)
+        return p
+
+    def regPingPacket(self):
+        p = mock.MagicMock()
+        d = defer.Deferred()
+        self.pings.append(d)
+        p.timeout.return_value = p
+        p.send.return_value = d
+        return p
+
+    def processReadback(self, resp):
+        return {'executionCounter': resp, 'badPackets': 2}
+
+
+def test_recover_from_timeout():
+    server = mock.MagicMock(quarantineThreshold=2)
+    group = ghz_fpga_server.BoardGroup(server, mock.MagicMock(), 0)
+    group.ctx = 'run context'
+    boards = [FakeBoard('Test DAC 1'), FakeBoard('Test DAC 2')]
+    runners = [mock.Mock(dev=board, reps=30) for board in boards]
+    results = [(True, None), (False, None)]
+    for attempt in range(2):
+        for board, (success, _) in zip(boards, results):
+            board.health.recordRun(success)
+        done = _fired(group.recoverFromTimeout(runners, results))
+        # both boards are pinged at once
+        assert [len(b.pings) for b in boards] == [attempt + 1] * 2
+        boards[1].pings[-1].callback(mock.Mock(read=[(0, 0, 0, 12)]))
+        assert done == []
+        boards[0].pings[-1].callback(mock.Mock(read=[(0, 0, 0, 30)]))
+        assert done == [None]
+    assert runners[1].executionCount == 12
+    assert boards[0].triggers == []
+    assert boards[1].triggers == ['run context'] * 2
+    healthy, failing = [b.health for b in boards]
+    assert (healthy.runs, healthy.timeouts, healthy.executionMismatches) == \
+        (2, 0, 0)
+    assert (failing.timeouts, failing.executionMismatches,
+            failing.badPackets) == (2, 2, 2)
+    assert not healthy.quarantined
+    assert failing.quarantined
+    failing.reset()
+    assert not failing.quarantined and failing.timeouts == 0
+
+
+def test_board_health_setting():
+    server = ghz_fpga_server.FPGAServer()
+    server.initServer()
+    ctx = server.newContext(11)
+    server.initContext(ctx)
+    for i in (1, 2):
+        board = FakeBoard('Test DAC {}'.format(i))
+        board.accessibleFrom = lambda ID: True
+        server.devices[board.name] = board
+    board.health.recordRun(False)
+    board.health.quarantined = True
+    health = server.board_health(ctx)
+    assert [h[0] for h in health] == ['Test DAC 1', 'Test DAC 2']
+    assert health[1][1:] == (1, 1, 1, 0, 0, 0, True)
+    with pytest.raises(Exception):
+        server._checkQuarantine([board])
+    server.reset_board_health(ctx, ['Test DAC 2'])
+    assert server.board_health(ctx, ['Test DAC 2'])[0][-1] is False
+    server._checkQuarantine([board])
+
+
+
+class FakePacket(dict):
+    """Direct ethernet or setup packet whose sends are logged."""
+    def __init__(self, name, log, result=None):
+        dict.__init__(self)
+        self.name = name
+        self.log = log
+        self.result = result
+        self._packet = [name]
+        self.pending = None
+
+    def send(self):
+        self.log.append(self.name)
+        if self.pending is not None:
+            return self.pending
+        return defer.succeed(self.result)
+
+
+class TestSetupPackets(object):
+
+    def make_group(self):
+        self.log = []
+        group = ghz_fpga_server.BoardGroup(mock.MagicMock(), mock.MagicMock(), 0)
+        group.ctx = 'ctx'
+        self.board = FakeBoard('Test DAC 1')
+        self.runner = mock.Mock(dev=self.board, reps=30)
+        self.runner.pageable.return_value = True
+        self.collect = FakePacket('collect', self.log)
+        trig = {'nTriggers': {'s': 0}}
+        self.wait = FakePacket('wait', self.log, trig)
+        group.makePackets = lambda *args: (
+            [], [], (self.wait, FakePacket('run', self.log),
+                     FakePacket('both', self.log, trig)),
+            [self.collect], [])
+        return group
+
+    def run(self, group, setup):
+        pkts = [(server, state, [FakePacket(server + state, self.log)])
+                for server, state in setup]
+        states = set('{}={}'.format(server, state) for server, state in setup)
+        return group.run([self.runner], 30, pkts, states, 249, False, [])
+
+    def test_only_changed_servers_are_sent(self):
+        group = self.make_group()
+        self.run(group, [('mw', 'a'), ('dc', 'x')])
+        # nothing else is running, so everything is sent before the run lock
+        assert self.log == ['mwa', 'dcx', 'both', 'collect']
+        del self.log[:]
+        self.run(group, [('mw', 'b'), ('dc', 'x')])
+        assert self.log == ['mwb', 'both', 'collect']
+        del self.log[:]
+        self.run(group, [('mw', 'b'), ('dc', 'x')])
+        assert self.log == ['both', 'collect']
+
+    def test_prefetch_unclaimed_servers(self):
+        group = self.make_group()
+        self.run(group, [('mw', 'a')])
+        # the first sequence is still collecting, and depends on 'mw'
+        collecting = self.collect.pending = defer.Deferred()
+        self.run(group, [('mw', 'a')])
+        del self.log[:]
+        self.collect.pending = None
+        self.wait.pending = defer.Deferred()
+        self.run(group, [('mw', 'b'), ('new', 'c')])
+        # 'new' is sent right away, 'mw' only once the first sequence is done
+        assert self.log == ['newc', 'wait']
+        self.wait.pending.callback({'nTriggers': {'s': 0}})
+        assert self.log == ['newc', 'wait', 'mwb', 'run']
+        assert group.setupClaims == {'mw': 2, 'new': 1}
+        collecting.callback(None)
+        assert group.setupClaims == {}
+
+
+def test_process_setup_packets():
+    cxn = mock.MagicMock()
+    pkts = [((1, 2), 'mw', (('Frequency', Value(5, 'GHz')),)),
+            ((1, 3), 'mw', (('Output', True),)),
+            ((1, 2), 'dc', (('Init',),))]
+    reqs = ghz_fpga_server._process_setup_packets(cxn, pkts)
+    assert [(server, len(p)) for server, state, p in reqs] == \
+        [('mw', 2), ('dc', 1)]
+    again = ghz_fpga_server._process_setup_packets(cxn, pkts)
+    assert [state for _, state, _ in reqs] == [state for _, state, _ in again]
+    pkts[0] = ((1, 2), 'mw', (('Frequency', Value(6, 'GHz')),))
+    changed = ghz_fpga_server._process_setup_packets(cxn, pkts)
+    assert changed[0][1] != reqs[0][1]
+    assert changed[1][1] == reqs[1][1]
+
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
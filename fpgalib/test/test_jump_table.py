@@ -71,5 +71,22 @@ def test_table():
     assert np.array_equal(data[32:40], end.as_bytes())
 
 
+def test_table_entries():
+    jumps = [jump_table.JumpEntry(64 + 8 * i, 2 * i, jump_table.CYCLE(i % 4, i))
+             for i in range(60)]
+    jumps.append(jump_table.JumpEntry(1000, 0, jump_table.IDLE(300)))
+    jumps.append(jump_table.JumpEntry(70000, 0, jump_table.END()))
+    jt = jump_table.JumpTable(0, jumps)
+    data = np.fromstring(jt.toString(), dtype='u1')
+    assert len(data) == 528
+    expected = np.hstack([j.as_bytes() for j in jumps])
+    assert np.array_equal(data[24:24 + len(expected)], expected)
+    assert not data[24 + len(expected):].any()
+    with pytest.raises(ValueError):
+        jump_table.JumpTable(0, [jump_table.JumpEntry(
+            64, 0, jump_table.IDLE(2 ** 15))]).toString()
+
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
\ No newline at end of file
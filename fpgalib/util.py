@@ -1,5 +1,6 @@
 import time
 import os
+import numpy as np
 from twisted.internet import defer
 
 DUMP_NUM = 0
@@ -28,6 +29,7 @@ TEMP = {
     'reject_length' : 121 ,
     'timeout' : 30 ,
     'read_as_words' : 51 ,
+    'read_concatenated' : 53 ,
     'discard' : 52 ,
     'adapters' : 1 ,
     'reject_source_mac' : 101 ,
@@ -41,6 +43,35 @@ def littleEndian(data, bytes=4):
     return [(data >> ofs) & 0xFF for ofs in (0, 8, 16, 24)[:bytes]]
 
 
+def packetArray(packets, nPackets=None):
+    """Get ethernet packet payloads as a 2D uint8 array, one row per packet.
+
+    packets is one of
+        - a single string of nPackets concatenated payloads of equal length,
+          as returned by the direct ethernet Read Concatenated setting.
+        - a list of payload strings of equal length.
+        - an array already returned by this function, which is passed
+          through unchanged.
+
+    The returned array shares memory with the packet data where possible, so
+    it must be treated as read-only.
+    """
+    if isinstance(packets, np.ndarray):
+        return packets
+    if isinstance(packets, str):
+        if nPackets is None:
+            raise ValueError('nPackets is required for concatenated packets')
+        data = packets
+        if nPackets and len(data) % nPackets:
+            raise ValueError('%d bytes can not be split into %d packets'
+                             % (len(data), nPackets))
+    else:
+        data = ''.join(packets)
+        nPackets = len(packets)
+    stride = len(data) // nPackets if nPackets else 0
+    return np.frombuffer(data, dtype='<u1').reshape(nPackets, stride)
+
+
 class TimedLock(object):
     """
     A lock that times how long it takes to acquire.
@@ -102,6 +133,50 @@ class TimedLock(object):
             d.callback(dt)
 
 
+class BoardHealth(object):
+    """
+    Running counts of how reliably a board has been executing sequences.
+
+    These live in memory only and are cleared by reset(), which also lifts
+    quarantine.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.runs = 0
+        self.timeouts = 0
+        self.consecutiveTimeouts = 0
+        self.executionMismatches = 0
+        self.pingFailures = 0
+        self.badPackets = 0
+        self.quarantined = False
+
+    def recordRun(self, success):
+        """Record the outcome of collecting data from one sequence."""
+        self.runs += 1
+        if success:
+            self.consecutiveTimeouts = 0
+        else:
+            self.timeouts += 1
+            self.consecutiveTimeouts += 1
+
+    def recordReadback(self, regs, expectedExecutions):
+        """Record a register readback taken while recovering from a timeout.
+
+        regs is the dict returned by the board's processReadback.
+        """
+        if regs.get('executionCounter', None) != expectedExecutions:
+            self.executionMismatches += 1
+        if 'badPackets' in regs:
+            # The board keeps its own running count.
+            self.badPackets = int(regs['badPackets'])
+
+    def recordPingFailure(self):
+        self.pingFailures += 1
+
+
 # class LoggingPacketWrapper(object):
     # def __init__(self, packet, outFile=None):
         # self._packet = packet
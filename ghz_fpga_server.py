@@ -200,7 +200,7 @@ import time
 
 import numpy as np
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad import types as T, units as U
@@ -212,7 +212,7 @@ import labrad.util
 import fpgalib.adc as adc
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
-from fpgalib.util import TimedLock, LoggingPacket
+from fpgalib.util import TimedLock, LoggingPacket, packetArray
 
 
 # The logging level is set at the bottom of the file where the server starts.
@@ -230,8 +230,31 @@ def timeString():
 LOGGING_PACKET = False
 
 
+# Sequence timeouts are appended to this file, see FPGAServer.run_sequence.
+TIMEOUT_LOG_PATH = os.path.join(os.path.expanduser('~'), 'dac_timeout_log.txt')
+
+
+def appendTimeoutLog(lines):
+    """Append lines to the timeout log in a thread, off the reactor."""
+    def write():
+        with open(TIMEOUT_LOG_PATH, 'a') as logfile:
+            logfile.write(''.join(line + '\n' for line in lines))
+    d = threads.deferToThread(write)
+    d.addErrback(lambda f: logging.error(
+        'Could not write timeout log: {}'.format(f.getErrorMessage())))
+    return d
+
+
 NUM_PAGES = 2
 
+# Time window, in seconds, in which boards must answer detection pings. All
+# board groups share one window, see FPGAServer.findDevices.
+DETECTION_TIMEOUT = 1.0
+# Minimum time a board group listens for detection responses, in case it
+# had to wait for a running sequence to release its locks and missed the
+# shared window.
+MIN_DETECTION_TIME = 0.2
+
 I2C_RB = 0x100
 I2C_ACK = 0x200
 I2C_RB_ACK = I2C_RB | I2C_ACK
@@ -255,6 +278,11 @@ I2C_END = 0x400
 #       badly to slow down pipelining
 
 
+# LabRAD type of the results of DAC Bringup.
+DAC_BRINGUP_TYPE = ('*((ss)(sb)(si)(si)(sw)(s(*w*b*b))(sw)(sb)(sb)(si)(sw)'
+                    '(sw)(sb)(s(ww))(s(ww))(s(ww)))')
+
+
 class TimeoutError(Exception):
     """Error raised when boards timeout."""
 
@@ -275,18 +303,30 @@ class BoardGroup(object):
         self.directEthernetServer = directEthernetServer
         self.port = port
         self.ctx = None
+        # Whether the direct ethernet server can return the payloads of many
+        # packets as one string, with Read Concatenated. The deployed server
+        # (DirectEthernet v1.2.3) can't, so this is checked in init.
+        self.readConcatenated = False
         self.pipeSemaphore = defer.DeferredSemaphore(NUM_PAGES)
         self.pageNums = itertools.cycle(range(NUM_PAGES))
         self.pageLocks = [TimedLock() for _ in range(NUM_PAGES)]
         self.runLock = TimedLock()
         self.readLock = TimedLock()
         self.setupState = set()
+        # Setup state per server (or ADC board) as last sent, and the number
+        # of sequences in the pipeline that depend on each server's state.
+        self.serverStates = {}
+        self.setupClaims = {}
         self.runWaitTimes = []
         self.prevTriggers = 0
+        self.testModeLock = defer.DeferredLock()
+        self.testModeUsers = 0
 
     @inlineCallbacks
     def init(self):
         """Set up the direct ethernet server in our own context."""
+        self.readConcatenated = \
+            'read_concatenated' in self.directEthernetServer.settings
         self.ctx = self.directEthernetServer.context()
         p = self.directEthernetServer.packet(context=self.ctx)
         p.connect(self.port)
@@ -311,11 +351,15 @@ class BoardGroup(object):
         self.boardDelays = [delay for (boardName, delay) in boards]
 
     @inlineCallbacks
-    def detectBoards(self):
+    def detectBoards(self, deadline=None):
         """Detect boards on the ethernet adapter managed by this board group.
 
         The autodetect operation is guarded by board group locks so that it
         will not conflict with sequences running on this board group.
+
+        Responses are collected until deadline, a time.time() value, so that
+        several board groups can be detected concurrently in one shared
+        window. If deadline is None we listen for DETECTION_TIMEOUT.
         """
         try:
             # Acquire all locks so we can ping boards without interfering with
@@ -327,8 +371,12 @@ class BoardGroup(object):
             yield self.runLock.acquire()
             yield self.readLock.acquire()
 
+            if deadline is None:
+                deadline = time.time() + DETECTION_TIMEOUT
+            deadline = max(deadline, time.time() + MIN_DETECTION_TIME)
+
             # Detect each board type in its own context.
-            detections = [self.detectDACs(), self.detectADCs()]
+            detections = [self.detectDACs(deadline), self.detectADCs(deadline)]
             answer = yield defer.DeferredList(detections, consumeErrors=True)
             found = []
             for success, result in answer:
@@ -355,7 +403,7 @@ class BoardGroup(object):
             self.runLock.release()
             self.readLock.release()
 
-    def detectDACs(self, timeout=1.0):
+    def detectDACs(self, deadline):
         """Try to detect DAC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -366,9 +414,9 @@ class BoardGroup(object):
             return (devName, args)
         macs = [dac.DAC.macFor(board) for board in range(256)]
         return self._doDetection(macs, dac.DAC.regPing(),
-                                 dac.DAC.READBACK_LEN, callback)
+                                 dac.DAC.READBACK_LEN, callback, deadline)
 
-    def detectADCs(self, timeout=1.0):
+    def detectADCs(self, deadline):
         """Try to detect ADC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -379,14 +427,14 @@ class BoardGroup(object):
             return (devName, args)
         macs = [adc.ADC.macFor(board) for board in range(256)]
         return self._doDetection(macs, adc.ADC.regPing(),
-                                 adc.ADC.READBACK_LEN, callback)
+                                 adc.ADC.READBACK_LEN, callback, deadline)
 
     @inlineCallbacks
-    def _doDetection(self, macs, packet, respLength, callback, timeout=1.0):
+    def _doDetection(self, macs, packet, respLength, callback, deadline):
         """
         Try to detect a boards at the specified mac addresses.
 
-        For each response of the correct length received within the timeout
+        For each response of the correct length received before the deadline
         from one of the given mac addresses, the callback function will be
         called and should return data to be added to the list of found
         devices.
@@ -398,24 +446,29 @@ class BoardGroup(object):
             p = self.directEthernetServer.packet()
             p.connect(self.port)
             p.require_length(respLength)
-            p.timeout(T.Value(timeout, 's'))
             p.listen()
             for mac in macs:
                 p.destination_mac(mac)
                 p.write(packet.tostring())
             yield p.send(context=ctx)
-            # Listen for responses.
-            start = time.time()
+            # Listen for responses. Each read may only wait for the time left
+            # in the detection window.
             found = []
-            while (len(found) < len(macs)) and (time.time() - start < timeout):
+            while len(found) < len(macs):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
                 try:
-                    ans = yield self.directEthernetServer.read(1, context=ctx)
-                    src, dst, eth, data = ans[0]
+                    p = self.directEthernetServer.packet(context=ctx)
+                    p.timeout(T.Value(remaining, 's'))
+                    p.read(1, key='read')
+                    ans = yield p.send()
+                    src, dst, eth, data = ans['read'][0]
                     if src in macs:
                         devInfo = callback(src, data)
                         found.append(devInfo)
                 except T.Error as e:
-                    logging.error('timeout exception: {}'.format(e))
+                    logging.info('detection read timeout: {}'.format(e))
                     break  # Read timeout.
             returnValue(found)
         finally:
@@ -440,13 +493,33 @@ class BoardGroup(object):
         are finished by acquiring the pipe semaphore for all pages,
         then runs the function, and finally releases the semaphore
         to allow the pipeline to continue.
+
+        Several test mode functions, eg. bringup of different boards, may run
+        at once. The pipe semaphore is acquired by the first of them and
+        released when the last one finishes. Functions for the same board
+        are serialized by the board itself, see fpga.FPGA.testMode.
         """
-        for i in xrange(NUM_PAGES):
-            yield self.pipeSemaphore.acquire()
+        yield self._enterTestMode()
         try:
             ans = yield func(*a, **kw)
             returnValue(ans)
         finally:
+            self._exitTestMode()
+
+    @inlineCallbacks
+    def _enterTestMode(self):
+        yield self.testModeLock.acquire()
+        try:
+            if not self.testModeUsers:
+                for i in xrange(NUM_PAGES):
+                    yield self.pipeSemaphore.acquire()
+            self.testModeUsers += 1
+        finally:
+            self.testModeLock.release()
+
+    def _exitTestMode(self):
+        self.testModeUsers -= 1
+        if not self.testModeUsers:
             for i in xrange(NUM_PAGES):
                 self.pipeSemaphore.release()
 
@@ -481,7 +554,7 @@ class BoardGroup(object):
 
 
         loadPkts: list of packets, one for each board
-        setupPkts: list of (packet, setup state). Only for ADC
+        setupPkts: list of (board, packet, setup state). Only for ADC
         runPkts: wait, run, both. These packets are sent in the master
                  context, and are placed carefully in order so that the
                  master board runs last.
@@ -510,14 +583,14 @@ class BoardGroup(object):
                     loadPkts.append(p)
 
         # Setup board state (not pipelined).
-        # Build a list of (setupPacket, setupState).
+        # Build a list of (board, setupPacket, setupState).
         setupPkts = []
         for board in self.boardOrder:
             if board in runnerInfo:
                 runner = runnerInfo[board]
                 p = runner.setupPacket()
                 if p is not None:
-                    setupPkts.append(p)
+                    setupPkts.append((board,) + p)
         # Run all boards (master last).
         # Set the first board which is both in the boardOrder and also in the
         # list of runners for this sequence as the master. Any subsequent boards
@@ -594,7 +667,16 @@ class BoardGroup(object):
     @inlineCallbacks
     def run(self, runners, reps, setupPkts, setupState, sync, getTimingData,
             timingOrder):
-        """Run a sequence on this board group."""
+        """Run a sequence on this board group.
+
+        setupPkts is a list of (server, state, packets) as returned by
+        _process_setup_packets, and setupState a set of strings describing
+        the whole setup. If setupState is not covered by the current setup
+        state, only the servers whose state differs from what was last sent
+        to them get their packets. Packets for servers that no other
+        sequence in the pipeline depends on are sent before the run lock is
+        acquired, the rest once the previous sequence has collected.
+        """
 
         # Check whether this sequence will fit in just one page.
         if all(runner.pageable() for runner in runners):
@@ -615,12 +697,25 @@ class BoardGroup(object):
         # Add setup packets from boards (ADCs) to that provided in the args:
         # setupPkts is a list.
         # setupState is a set.
-        setupPkts.extend(pkt for pkt, state in boardSetupPkts)
-        setupState.update(state for pkt, state in boardSetupPkts)
+        setupPkts = setupPkts + [(board, state, [pkt])
+                                 for board, pkt, state in boardSetupPkts]
+        setupState = setupState | set(state for board, pkt, state
+                                      in boardSetupPkts)
+        setupKeys = set(key for key, state, pkts in setupPkts)
 
         try:
             yield self.pipeSemaphore.acquire()
             logging.info('pipe semaphore acquired')
+            # Board setup changes the boards themselves, so is never sent
+            # while another sequence may be running.
+            boards = set(board for board, pkt, state in boardSetupPkts)
+            prefetch = [(key, state, pkts) for key, state, pkts
+                        in self._staleSetup(setupPkts, setupState)
+                        if key not in boards and not self.setupClaims.get(key)]
+            prefetched = set(key for key, state, pkts in prefetch)
+            for key in setupKeys:
+                self.setupClaims[key] = self.setupClaims.get(key, 0) + 1
+            setupDone = self._sendSetup(prefetch)
             try:
                 # Stage 1: load.
                 for pageLock in pageLocks:  # Lock pages to be written.
@@ -651,14 +746,15 @@ class BoardGroup(object):
                     # store the number of triggers for the next run
                     self.prevTriggers = len(runners)
                     logging.info('num runners: {}'.format(len(runners)))
-                    # If the passed in setup state setupState, or the current
-                    # actual setup state, self.setupState are empty, we need
-                    # to set things up. Also if the desired setup state isn't
-                    # a subset of the actual one, we need to set up.
+                    # If the desired setup state isn't a subset of the actual
+                    # one, we need to set up the servers whose state changed
+                    # and which were not set up early. See _staleSetup.
                     # XXX Check what setup state means for ADC. Should this
                     # include the trigger/demodulator tables or not?
-                    needSetup = ((not setupState) or (not self.setupState) or
-                                    (not (setupState <= self.setupState)))
+                    stale = [(key, state, pkts) for key, state, pkts
+                             in self._staleSetup(setupPkts, setupState)
+                             if key not in prefetched]
+                    needSetup = bool(stale)
                     if needSetup:
                         logging.info('needSetup = True')
                         # we require changes to the setup state so first, wait
@@ -670,13 +766,13 @@ class BoardGroup(object):
                         try:
                             # Then set up
                             logging.info('sending setupPkts...')
-                            yield self.sendAll(setupPkts, 'Setup')
+                            yield self._sendSetup(stale)
+                            yield setupDone
                             logging.info('...setupPkts sent')
                             self.setupState = setupState
                         except Exception as e:
                             # if there was an error, clear setup state
                             logging.info('catching setupPkts exception')
-                            self.setupState = set()
                             logging.error(
                                     'Exception in setupPkts: {}'.format(e))
                             raise e
@@ -687,6 +783,8 @@ class BoardGroup(object):
                     else:
                         # if this fails, something BAD happened!
                         logging.info('need setup = false')
+                        yield setupDone
+                        self.setupState = setupState
                         r = yield bothPkt.send()
 
                     # Keep track of how long the packet waited before being
@@ -735,9 +833,22 @@ class BoardGroup(object):
                 results = yield collectAll
                 logging.info('results collected')
             finally:
+                # If we got here by an exception before waiting for the
+                # prefetched setup, its failure must still be consumed.
+                # Otherwise the setup has been waited for and this is a no-op.
+                setupDone.addErrback(lambda failure: logging.error(
+                        'Exception in prefetched setupPkts: {}'.format(
+                                failure.getErrorMessage())))
                 for pageLock in pageLocks:
                     pageLock.release()
                 logging.info('page lock released')
+                for key in setupKeys:
+                    self.setupClaims[key] -= 1
+                    if not self.setupClaims[key]:
+                        del self.setupClaims[key]
+
+            for runner, (success, result) in zip(runners, results):
+                runner.dev.health.recordRun(success)
 
             # check for a timeout and recover if necessary
             if not all(success for success, result in results):
@@ -753,9 +864,10 @@ class BoardGroup(object):
             boardOrder = [runner.dev.devName for runner in runners]
             readAll = self.sendAll(readPkts, 'Read', boardOrder)
             self.readLock.release()
-            # This line scales really badly with incrasing stats
-            # At 9600 stats the next line takes 10s out of 20s per
-            # sequence.
+            # With Read Concatenated each board's data comes back as a
+            # single string. Reading a list of (src, dest, eth, data)
+            # clusters instead scales really badly with increasing stats: at
+            # 9600 stats the next line took 10s out of 20s per sequence.
             results = yield readAll  # wait for read to complete
 
             if getTimingData:
@@ -787,8 +899,9 @@ class BoardGroup(object):
                         # relevant part to the list of returned data
                         idx = boardOrder.index(boardName)
                         runner = runners[idx]
-                        result = [data for src, dest, eth, data in
-                                  results[idx]['read']]
+                        result = results[idx]['read']
+                        if not isinstance(result, str):
+                            result = [data for src, dest, eth, data in result]
                         # Array of all timing results (DAC)
                         extracted = runner.extract(result)
                         extractedData[boardName] = extracted
@@ -804,6 +917,40 @@ class BoardGroup(object):
         finally:
             self.pipeSemaphore.release()
 
+    def _staleSetup(self, setupPkts, setupState):
+        """Get the setup packets needed to reach the given setup state.
+
+        Nothing is needed if setupState is covered by the current setup
+        state. An empty setupState means always set up. Otherwise we need
+        the packets for servers whose state differs from what was last sent
+        to them.
+        """
+        if setupState and self.setupState and setupState <= self.setupState:
+            return []
+        if not setupState:
+            return list(setupPkts)
+        return [(key, state, pkts) for key, state, pkts in setupPkts
+                if self.serverStates.get(key) != state]
+
+    def _sendSetup(self, setupPkts):
+        """Send setup packets for all servers concurrently.
+
+        The servers' new states are recorded right away, so that sequences
+        queued behind this one do not send them again. If anything fails,
+        they are forgotten so that the next sequence sets everything up.
+        """
+        for key, state, pkts in setupPkts:
+            self.serverStates[key] = state
+        d = self.sendAll([p for key, state, pkts in setupPkts for p in pkts],
+                         'Setup')
+
+        def failed(failure):
+            self.setupState = set()
+            for key, state, pkts in setupPkts:
+                self.serverStates.pop(key, None)
+            return failure
+        return d.addErrback(failed)
+
     @inlineCallbacks
     def sendAll(self, packets, info, infoList=None):
         """Send a list of packets and wrap them up in a deferred list."""
@@ -826,10 +973,14 @@ class BoardGroup(object):
                     msg += '{} : {}\n\n'.format(i, m)
             raise Exception(msg)
 
-    def extractTiming(self, packets):
-        """Extract timing data coming back from a readPacket."""
-        data = ''.join(data[3:63] for data in packets)
-        return np.fromstring(data, dtype='<u2').astype('u4')
+    def extractTiming(self, packets, nPackets=None):
+        """Extract timing data coming back from a readPacket.
+
+        packets is a list of packet payloads, or a string of nPackets
+        concatenated payloads.
+        """
+        timers = packetArray(packets, nPackets)[:, 3:63]
+        return np.ascontiguousarray(timers).view('<u2').ravel().astype('u4')
 
     @inlineCallbacks
     def recoverFromTimeout(self, runners, results):
@@ -840,36 +991,59 @@ class BoardGroup(object):
         (1) Get execution counts. For each board we clear the packet buffer and
         ping the board to see how many times it executed its SRAM sequence (or
         demod sequence for ADC boards). This count is stored in the runner
-        object for the board for later reporting to the user.
+        object for the board for later reporting to the user, and recorded in
+        the board's health counters.
 
         (2) Send triggers. After all boards have been pinged, we again clear
         the packet buffers for all boards and then send a trigger to the board
         group run context from each failed board. We must do this to unlock the
         run context since the trigger would not have been sent yet if packet
         collection failed.
+
+        Each step talks to all boards at once, so recovery costs about one
+        ping timeout however many boards are in the sequence. Boards that
+        have timed out quarantineThreshold times in a row (if set on the
+        server) are quarantined until their health is reset.
         """
         print 'RECOVERING FROM TIMEOUT'
 
         # Get execution counts.
-        for runner, (success, result) in zip(runners, results):
-            yield runner.dev.clear().send()
-            try:
-                # NOTE: in the current implementation of regPing for DAC boards
-                # (build 15) the start field is set to master, which means when
-                # we ping these boards they will emit daisy chain signals.
-                p = runner.dev.regPingPacket()
-                p.timeout(U.Value(1.0, 's')).read(1)
-                resp = yield p.send()
-                regs = runner.dev.processReadback(resp.read[0][3])
-                runner.executionCount = regs.get('executionCounter', None)
-            except Exception:
-                logging.error('Exception in recoverFromTimeout', exc_info=True)
+        yield defer.DeferredList([self._pingAfterTimeout(runner)
+                                  for runner in runners])
 
         # Send triggers.
-        for runner, (success, result) in zip(runners, results):
+        yield defer.DeferredList(
+            [runner.dev.clear(None if success else self.ctx).send()
+             for runner, (success, result) in zip(runners, results)],
+            consumeErrors=True)
+
+        threshold = getattr(self.fpgaServer, 'quarantineThreshold', 0)
+        for runner in runners:
+            health = runner.dev.health
+            if threshold and health.consecutiveTimeouts >= threshold:
+                if not health.quarantined:
+                    logging.error('Quarantining {} after {} timeouts in a '
+                                  'row'.format(runner.dev.devName,
+                                               health.consecutiveTimeouts))
+                health.quarantined = True
+
+    @inlineCallbacks
+    def _pingAfterTimeout(self, runner):
+        """Clear a board's packet buffer and read its execution count."""
+        try:
             yield runner.dev.clear().send()
-            if not success:
-                yield runner.dev.trigger(self.ctx).send()
+            # NOTE: in the current implementation of regPing for DAC boards
+            # (build 15) the start field is set to master, which means when
+            # we ping these boards they will emit daisy chain signals.
+            p = runner.dev.regPingPacket()
+            p.timeout(U.Value(1.0, 's')).read(1)
+            resp = yield p.send()
+            regs = runner.dev.processReadback(resp.read[0][3])
+            runner.executionCount = regs.get('executionCounter', None)
+            runner.dev.health.recordReadback(regs, runner.reps)
+        except Exception:
+            runner.dev.health.recordPingFailure()
+            logging.error('Exception in recoverFromTimeout', exc_info=True)
 
     def timeoutReport(self, runners, results):
         """Create a nice error message explaining which boards timed out."""
@@ -890,6 +1064,8 @@ class FPGAServer(DeviceServer):
     """
     name = 'GHz FPGAs'
     retries = 5
+    # Consecutive timeouts after which a board is quarantined; 0 disables.
+    quarantineThreshold = 0
 
     @inlineCallbacks
     def initServer(self):
@@ -959,20 +1135,20 @@ class FPGAServer(DeviceServer):
         removals = existing - configured
         keepers = existing - removals
 
-        # Check each addition to see whether the desired server/port exists.
-        for key in set(additions):
+        # Check whether the server/port of each addition and keeper exists.
+        toCheck = list(additions | keepers)
+        checks = yield defer.DeferredList(
+                [self.adapterExists(server, port) for server, port in toCheck],
+                fireOnOneErrback=True, consumeErrors=True)
+        for key, (_, exists) in zip(toCheck, checks):
+            if exists:
+                continue
             server, port = key
-            exists = yield self.adapterExists(server, port)
-            if not exists:
+            if key in additions:
                 print ('Adapter "{}" (port {}) does not exist. Group will not '
                        'be added.'.format(server, port))
                 additions.remove(key)
-
-        # Check each keeper to see whether the server/port still exists.
-        for key in set(keepers):
-            server, port = key
-            exists = yield self.adapterExists(server, port)
-            if not exists:
+            else:
                 print ('Adapter "{}" (port {}) does not exist. Group will be '
                        'removed.'.format(server, port))
                 keepers.remove(key)
@@ -1001,13 +1177,18 @@ class FPGAServer(DeviceServer):
             self.boardGroups[server, port] = boardGroup
 
         # Update configuration of all board groups and detect devices.
+        # Detection runs concurrently on all board groups, which share one
+        # detection window.
+        groups = self.boardGroups.items()
+        yield defer.DeferredList([bg.init() for _, bg in groups],
+                                 fireOnOneErrback=True, consumeErrors=True)
+        deadline = time.time() + DETECTION_TIMEOUT
         detections = []
         groupNames = []
-        for (server, port), boardGroup in self.boardGroups.items():
-            yield boardGroup.init()  # Gets context with direct ethernet.
+        for (server, port), boardGroup in groups:
             name, boards = config[server, port]
             boardGroup.configure(name, boards)
-            detections.append(boardGroup.detectBoards())  # Board detection.
+            detections.append(boardGroup.detectBoards(deadline))
             groupNames.append(name)
         answer = yield defer.DeferredList(detections, consumeErrors=True)
         found = []
@@ -1470,6 +1651,7 @@ class FPGAServer(DeviceServer):
             raise Exception('Can only run multiboard sequence if all boards '
                             'are in the same board group!')
         bg = devs[0].boardGroup
+        self._checkQuarantine(devs)
 
         # build a list of runners which have necessary sequence information
         # for each board
@@ -1500,21 +1682,26 @@ class FPGAServer(DeviceServer):
                 returnValue(ans)
             except TimeoutError as err:
                 # log attempt to stdout and file
-                userpath = os.path.expanduser('~')
-                logpath = os.path.join(userpath, 'dac_timeout_log.txt')
-                with open(logpath, 'a') as logfile:
-                    t = timeString()
-                    msg = '{}: attempt {} - error: {}'.format(t, attempt, err)
-                    print(msg)
-                    logfile.write(msg+'\n')
-                    if attempt == retries:
-                        logfile.write('FAIL\n')
-                        # TODO: notify users via SMS.
-                        raise
-                    else:
-                        print('retrying...')
-                        logfile.write('retrying...')
-                        attempt += 1
+                msg = '{}: attempt {} - error: {}'.format(timeString(),
+                                                          attempt, err)
+                print(msg)
+                quarantined = any(dev.health.quarantined for dev in devs)
+                if attempt == retries or quarantined:
+                    # TODO: notify users via SMS.
+                    appendTimeoutLog([msg, 'FAIL'])
+                    raise
+                else:
+                    print('retrying...')
+                    appendTimeoutLog([msg, 'retrying...'])
+                    attempt += 1
+
+    def _checkQuarantine(self, devs):
+        """Refuse to run a sequence involving quarantined boards."""
+        names = [dev.devName for dev in devs if dev.health.quarantined]
+        if names:
+            raise Exception('Boards quarantined after repeated timeouts: {}. '
+                            'Use "Reset Board Health" once they are fixed.'
+                            .format(', '.join(names)))
 
     @setting(52, 'Daisy Chain', boards='*s', returns='*s')
     def sequence_boards(self, c, boards=None):
@@ -1589,6 +1776,52 @@ class FPGAServer(DeviceServer):
             c['master_sync'] = sync
         return sync
 
+    @setting(56, 'Board Health', boards='*s',
+             returns='*(swwwwwwb)')
+    def board_health(self, c, boards=None):
+        """Get health counters for boards.
+
+        For each board (all boards if none are given) this returns
+        (name, runs, timeouts, consecutive timeouts, execution count
+        mismatches, failed pings, bad packets, quarantined). Runs and timeouts
+        count sequence executions on the board. Execution count mismatches and
+        failed pings are recorded when pinging boards after a timeout, as is
+        the board's own bad packet count (ADC build 7 and up).
+        """
+        if boards is None:
+            boards = self._healthBoardNames()
+        ans = []
+        for name in boards:
+            h = self.getDevice(c, name).health
+            ans.append((name, h.runs, h.timeouts, h.consecutiveTimeouts,
+                        h.executionMismatches, h.pingFailures, h.badPackets,
+                        h.quarantined))
+        return ans
+
+    @setting(57, 'Reset Board Health', boards='*s', returns='')
+    def reset_board_health(self, c, boards=None):
+        """Clear health counters and lift quarantine for boards (default all).
+        """
+        if boards is None:
+            boards = self._healthBoardNames()
+        for name in boards:
+            self.getDevice(c, name).health.reset()
+
+    @setting(58, 'Quarantine Threshold', n='w', returns='w')
+    def quarantine_threshold(self, c, n=None):
+        """Set or get the number of consecutive timeouts that quarantines a
+        board.
+
+        Sequences involving a quarantined board fail immediately until the
+        board's health is reset. 0, the default, disables quarantine.
+        """
+        if n is not None:
+            self.quarantineThreshold = n
+        return self.quarantineThreshold
+
+    def _healthBoardNames(self):
+        return sorted(set(dev.name for dev in self.devices.values()))
+
     @setting(59, 'Performance Data', returns='*((sw)(*v, *v, *v, *v, *v))')
     def sequence_performance_data(self, c):
         """Get data about the pipeline performance.
@@ -2028,8 +2261,7 @@ class FPGAServer(DeviceServer):
              lvdsSD='w',
              signed='b',
              targetFifo='w',
-             returns=('*((ss)(sb)(si)(si)(sw)(s(*w*b*b))(sw)(sb)(sb)(si)(sw)'
-                      '(sw)(sb)(s(ww))(s(ww))(s(ww)))'))
+             returns=DAC_BRINGUP_TYPE)
     def dac_bringup(self, c, lvdsOptimize=False, lvdsSD=None, signed=True,
                     targetFifo=None):
         """
@@ -2041,9 +2273,17 @@ class FPGAServer(DeviceServer):
         (string, data) with all the calibration parameters.
         """
         dev = self.selectedDAC(c)
+        ans = yield self._dacBringup(dev, lvdsOptimize, lvdsSD, signed,
+                                     targetFifo)
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _dacBringup(self, dev, lvdsOptimize=False, lvdsSD=None, signed=True,
+                    targetFifo=None):
+        """Run the DAC bringup procedure on one board. See dac_bringup."""
         ans = []
         yield dev.initPLL()
-        time.sleep(0.100)
+        yield labrad.util.wakeupCall(0.100)
         yield dev.resetPLL()
         for dac in ['A', 'B']:
             ansDAC = [('dac', dac)]
@@ -2071,6 +2311,61 @@ class FPGAServer(DeviceServer):
             ans.append(tuple(ansDAC))
         returnValue(ans)
 
+    @setting(1301, 'Bringup All',
+             boards='*s',
+             lvdsOptimize='b',
+             lvdsSD='w',
+             signed='b',
+             targetFifo='w',
+             returns='*(sbv[s]s' + DAC_BRINGUP_TYPE + ')')
+    def bringup_all(self, c, boards=None, lvdsOptimize=False, lvdsSD=None,
+                    signed=True, targetFifo=None):
+        """Run the bringup procedure on many boards at once.
+
+        Bringup runs concurrently on all boards, so the total time is that of
+        the slowest board rather than the sum over boards. The steps for each
+        single board still run in order.
+
+        Args:
+            boards: Names of the boards to bring up. If not given or empty,
+                all detected boards are brought up.
+            lvdsOptimize, lvdsSD, signed, targetFifo: As for DAC Bringup.
+                Ignored for ADC boards.
+
+        Returns:
+            A list with one entry per board of (name, success, elapsed time,
+            error, results). success is True if no error occurred and, for
+            DACs, the FIFO and BIST checks passed on both channels. error is
+            the error message, or '' if bringup completed. results are as
+            returned by DAC Bringup, and empty for ADCs.
+        """
+        if not boards:
+            IDs, boards = self.deviceLists()
+        devs = [self.devices[name] for name in boards]
+
+        @inlineCallbacks
+        def bringup(dev):
+            start = time.time()
+            success, error, results = False, '', []
+            try:
+                if isinstance(dev, dac.DAC):
+                    results = yield self._dacBringup(
+                            dev, lvdsOptimize, lvdsSD, signed, targetFifo)
+                    success = all(dict(r)['fifoSuccess'] and
+                                  dict(r)['bistSuccess'] for r in results)
+                else:
+                    yield dev.initPLL()
+                    success = True
+            except Exception as e:
+                logging.error('Bringup failed for {}'.format(dev.devName),
+                              exc_info=True)
+                error = str(e)
+            elapsed = T.Value(time.time() - start, 's')
+            returnValue((dev.devName, success, elapsed, error, results))
+
+        ans = yield defer.gatherResults([bringup(dev) for dev in devs])
+        returnValue(ans)
+
     @setting(1313, 'DAC Serial', cmd='w', pkts='*w', returns='?')
     def dac_serial(self, c, cmd, pkts):
         dev = self.selectedDAC(c)
@@ -2189,12 +2484,29 @@ def _assert_has_jump_table(dev):
   assert dev.HAS_JUMP_TABLE, 'device is not a jump table board: {}'.format(dev)
 
 
+def _setup_record_state(ctxt, settings):
+    """Comparable description of what a setup packet sets up."""
+    state = [tuple(ctxt)]
+    for rec in settings:
+        try:
+            flat = T.flatten(rec)
+            state.append((flat.bytes, str(flat.tag)))
+        except Exception:
+            state.append(repr(rec))
+    return tuple(state)
+
+
 def _process_setup_packets(cxn, setupPkts):
     """
     Process packets sent in flattened form into actual labrad packets on the
     given connection.
+
+    Returns a list of (server, state, packets), one per server, where state
+    describes the content of all packets for that server. BoardGroup.run
+    compares these states to skip servers that are already set up.
     """
-    pkts = []
+    servers = []
+    byServer = {}
     for ctxt, server, settings in setupPkts:
         if ctxt[0] == 0:
             print ('Using a context with high ID = 0 for packet requests might '
@@ -2210,8 +2522,14 @@ def _process_setup_packets(cxn, setupPkts):
             else:
                 raise Exception('Malformed setup packet: ctx={}, server={}, '
                                 'settings={}'.format(ctxt, server, settings))
+        if server not in byServer:
+            servers.append(server)
+            byServer[server] = ([], [])
+        states, pkts = byServer[server]
+        states.append(_setup_record_state(ctxt, settings))
         pkts.append(p)
-    return pkts
+    return [(server, tuple(byServer[server][0]), byServer[server][1])
+            for server in servers]
 
 __server__ = FPGAServer()
 
@@ -36,9 +36,13 @@
 # were made here and in the next few revisions are hacks to make socket
 # connections work, and should be improved.
 
+import time
+
 from labrad.server import LabradServer, setting
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor, threads
+from twisted.internet.defer import DeferredLock, inlineCallbacks, returnValue
 from twisted.internet.reactor import callLater
+from twisted.python.threadpool import ThreadPool
 from labrad.errors import DeviceNotSelectedError
 import labrad.units as units
 import visa
@@ -65,6 +69,94 @@ timeout = 20
 
 KNOWN_DEVICE_TYPES = ('GPIB', 'TCPIP', 'USB')
 
+# Threads available for VISA calls. Each address uses at most one at a time.
+VISA_THREADS = 32
+
+
+class AddressWorker(object):
+    """Runs blocking VISA calls for one instrument in a worker thread.
+
+    Calls to the same address run one at a time, in the order they were
+    made, while calls to different addresses overlap. We also keep track of
+    how many calls are waiting and how long they take, including the time
+    spent waiting for earlier calls.
+    """
+
+    def __init__(self, instr, pool):
+        self.instr = instr
+        self.pool = pool
+        self.lock = DeferredLock()
+        self.depth = 0
+        self.calls = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+
+    @inlineCallbacks
+    def run(self, func, *args):
+        """Call func(instr, *args) in a thread and return its result."""
+        self.depth += 1
+        start = time.time()
+        try:
+            ans = yield self.lock.run(threads.deferToThreadPool, reactor,
+                                      self.pool, func, self.instr, *args)
+        finally:
+            elapsed = time.time() - start
+            self.depth -= 1
+            self.calls += 1
+            self.totalTime += elapsed
+            self.maxTime = max(self.maxTime, elapsed)
+        returnValue(ans)
+
+    def stats(self):
+        mean = self.totalTime / self.calls if self.calls else 0.0
+        return self.depth, self.calls, mean, self.maxTime
+
+
+def _openInstrument(rm, addr):
+    instr = rm.get_instrument(addr)
+    instr.write_termination = ''
+    instr.clear()
+    if addr.endswith('SOCKET'):
+        instr.write_termination = '\n'
+    return instr
+
+
+def _write(instr, data):
+    instr.write(data)
+
+
+def _writeRaw(instr, data):
+    instr.write_raw(data)
+
+
+def _readRaw(instr, n_bytes=None):
+    if n_bytes is None:
+        return instr.read_raw()
+    return instr.read_raw(n_bytes)
+
+
+def _query(instr, data):
+    instr.write(data)
+    return instr.read_raw()
+
+
+def _readBytes(arg):
+    return int(arg) if arg else None
+
+
+# Operations allowed in a transaction, as functions of (instr, arg).
+TRANSACTION_OPS = {
+    'write': lambda instr, arg: _write(instr, arg) or '',
+    'write_raw': lambda instr, arg: _writeRaw(instr, arg) or '',
+    'read': lambda instr, arg: str(_readRaw(instr, _readBytes(arg))).strip(),
+    'read_raw': lambda instr, arg: bytes(_readRaw(instr, _readBytes(arg))),
+    'query': lambda instr, arg: str(_query(instr, arg)).strip(),
+}
+
+
+def _transaction(instr, ops):
+    return [TRANSACTION_OPS[op](instr, arg) for op, arg in ops]
+
 
 class GPIBBusServer(LabradServer):
     """Provides direct access to GPIB-enabled devices."""
@@ -75,6 +167,8 @@ class GPIBBusServer(LabradServer):
 
     def initServer(self):
         self.devices = {}
+        self.pool = ThreadPool(maxthreads=VISA_THREADS, name='VISA')
+        self.pool.start()
         # start refreshing only after we have started serving
         # this ensures that we are added to the list of available
         # servers before we start sending messages
@@ -97,27 +191,27 @@ class GPIBBusServer(LabradServer):
         if hasattr(self, 'refresher'):
             self.refresher.stop()
             yield self.refresherDone
+        self.pool.stop()
 
+    @inlineCallbacks
     def refreshDevices(self):
         """Refresh the list of known devices on this bus.
 
-        Currently supported are GPIB devices and GPIB over USB.
+        Currently supported are GPIB devices and GPIB over USB. Talking to
+        VISA happens in threads, so that I/O to other devices carries on.
         """
         try:
-            rm = visa.ResourceManager()
-            addresses = [str(x) for x in rm.list_resources()]
+            rm = yield self.inThread(visa.ResourceManager)
+            resources = yield self.inThread(rm.list_resources)
+            addresses = [str(x) for x in resources]
             additions = set(addresses) - set(self.devices.keys())
             deletions = set(self.devices.keys()) - set(addresses)
             for addr in additions:
                 try:
                     if not addr.startswith(KNOWN_DEVICE_TYPES):
                         continue
-                    instr = rm.get_instrument(addr)
-                    instr.write_termination = ''
-                    instr.clear()
-                    if addr.endswith('SOCKET'):
-                        instr.write_termination = '\n'
-                    self.devices[addr] = instr
+                    instr = yield self.inThread(_openInstrument, rm, addr)
+                    self.devices[addr] = AddressWorker(instr, self.pool)
                     self.sendDeviceMessage('GPIB Device Connect', addr)
                 except Exception, e:
                     print 'Failed to add ' + addr + ':' + str(e)
@@ -127,6 +221,9 @@ class GPIBBusServer(LabradServer):
         except Exception, e:
             print 'Problem while refreshing devices:', str(e)
 
+    def inThread(self, func, *args):
+        return threads.deferToThreadPool(reactor, self.pool, func, *args)
+
     def sendDeviceMessage(self, msg, addr):
         print msg + ': ' + addr
         self.client.manager.send_named_message(msg, (self.name, addr))
@@ -134,13 +231,15 @@ class GPIBBusServer(LabradServer):
     def initContext(self, c):
         c['timeout'] = self.defaultTimeout
 
-    def getDevice(self, c):
+    def getWorker(self, c):
         if 'addr' not in c:
             raise DeviceNotSelectedError("No GPIB address selected")
         if c['addr'] not in self.devices:
             raise Exception('Could not find device ' + c['addr'])
-        instr = self.devices[c['addr']]
-        return instr
+        return self.devices[c['addr']]
+
+    def getDevice(self, c):
+        return self.getWorker(c).instr
 
     @setting(0, addr='s', returns='s')
     def address(self, c, addr=None):
@@ -163,12 +262,12 @@ class GPIBBusServer(LabradServer):
     @setting(3, data='s', returns='')
     def write(self, c, data):
         """Write a string to the GPIB bus."""
-        self.getDevice(c).write(data)
+        return self.getWorker(c).run(_write, data)
 
     @setting(8, data='y', returns='')
     def write_raw(self, c, data):
         """Write a string to the GPIB bus."""
-        self.getDevice(c).write_raw(data)
+        return self.getWorker(c).run(_writeRaw, data)
 
     @setting(4, n_bytes='w', returns='s')
     def read(self, c, n_bytes=None):
@@ -179,12 +278,8 @@ class GPIBBusServer(LabradServer):
         binary data. If specified, reads only the given number
         of bytes. Otherwise, reads until the device stops sending.
         """
-        instr = self.getDevice(c)
-        if n_bytes is None:
-            ans = instr.read_raw()
-        else:
-            ans = instr.read_raw(n_bytes)
-        return str(ans).strip()
+        ans = yield self.getWorker(c).run(_readRaw, n_bytes)
+        returnValue(str(ans).strip())
 
     @setting(5, data='s', returns='s')
     def query(self, c, data):
@@ -193,10 +288,8 @@ class GPIBBusServer(LabradServer):
         This query is atomic.  No other communication to the
         device will occur while the query is in progress.
         """
-        instr = self.getDevice(c)
-        instr.write(data)
-        ans = instr.read_raw()
-        return str(ans).strip()
+        ans = yield self.getWorker(c).run(_query, data)
+        returnValue(str(ans).strip())
 
     @setting(7, n_bytes='w', returns='y')
     def read_raw(self, c, n_bytes=None):
@@ -206,12 +299,29 @@ class GPIBBusServer(LabradServer):
         If n_bytes is specified, reads only that many bytes.
         Otherwise, reads until the device stops sending.
         """
-        instr = self.getDevice(c)
-        if n_bytes is None:
-            ans = instr.read_raw()
-        else:
-            ans = instr.read_raw(n_bytes)
-        return bytes(ans)
+        ans = yield self.getWorker(c).run(_readRaw, n_bytes)
+        returnValue(bytes(ans))
+
+    @setting(9, ops='*(ss)', returns='*s')
+    def transaction(self, c, ops):
+        """Run a list of operations on the device in one request.
+
+        ops is a list of (operation, argument). Operations are write,
+        write_raw and query, whose argument is the string to send, and read
+        and read_raw, whose argument is the number of bytes to read, or ''
+        to read until the device stops sending. Returns one response per
+        operation, '' for writes. Reads and queries are stripped of
+        termination characters as in the read and query settings, read_raw
+        is not.
+
+        Like query, the whole transaction is atomic.
+        """
+        for op, arg in ops:
+            if op not in TRANSACTION_OPS:
+                raise ValueError('Unknown transaction operation {}. Allowed '
+                                 'operations: {}'.format(
+                                     op, ', '.join(sorted(TRANSACTION_OPS))))
+        return self.getWorker(c).run(_transaction, ops)
 
     @setting(20, returns='*s')
     def list_devices(self, c):
@@ -221,7 +331,21 @@ class GPIBBusServer(LabradServer):
     @setting(21)
     def refresh_devices(self, c):
         """ manually refresh devices """
-        self.refreshDevices()
+        return self.refreshDevices()
+
+    @setting(22, returns='*(swwv[s]v[s])')
+    def queue_stats(self, c):
+        """Get I/O statistics for each device on this bus.
+
+        Returns a list of (address, calls waiting or running, calls completed,
+        mean latency, max latency). Latencies include time spent waiting for
+        earlier calls to the same device.
+        """
+        ans = []
+        for addr, worker in sorted(self.devices.items()):
+            depth, calls, mean, worst = worker.stats()
+            ans.append((addr, depth, calls, mean * units.s, worst * units.s))
+        return ans
 
 
 __server__ = GPIBBusServer()
@@ -0,0 +1,89 @@
+"""
+Device wrapper for GPIB devices which can batch commands.
+
+GPIB bus servers have a Transaction setting which runs an ordered list of
+write, query and read operations on one device in a single request.
+GPIBTransactionWrapper.transaction uses it so that a driver can set up a
+device with many small commands in one LabRAD round trip instead of one per
+command. Bus servers without the setting are sent the operations one at a
+time.
+
+Example:
+    resp = yield dev.transaction([
+        ('write', 'SENS:SWE:TYPE LIN'),
+        ('query', 'SENS:SWE:POIN?'),
+        ('query', 'SENS:SWE:TIME?')])
+    npoints, sweeptime = int(resp[1]), float(resp[2])
+"""
+
+from labrad.gpib import GPIBDeviceWrapper
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+class GPIBTransactionWrapper(GPIBDeviceWrapper):
+    """A GPIB device wrapper which can run batches of operations."""
+
+    @inlineCallbacks
+    def transaction(self, ops, timeout=None):
+        """Run operations on this device in one request.
+
+        :param list[(str, str)] ops: (operation, argument) pairs. See the
+            Transaction setting of the GPIB bus server.
+        :param timeout: timeout for the transaction, if different from the
+            device timeout.
+        :return: list of responses, one per operation ('' for writes).
+        """
+        p = self._packet()
+        if timeout is not None:
+            p.timeout(timeout)
+        try:
+            p.transaction([(op, str(arg)) for op, arg in ops])
+        except AttributeError:
+            # This bus server does not know about transactions.
+            resp = yield self._runSeparately(ops, timeout)
+            returnValue(resp)
+        if timeout is not None:
+            p.timeout(self._timeout)
+        resp = yield p.send()
+        returnValue(list(resp.transaction))
+
+    @inlineCallbacks
+    def _runSeparately(self, ops, timeout):
+        ans = []
+        for op, arg in ops:
+            if op == 'write':
+                yield self.write(arg, timeout=timeout)
+                ans.append('')
+            elif op == 'query':
+                resp = yield self.query(arg, timeout=timeout)
+                ans.append(resp)
+            elif op == 'read':
+                resp = yield self.read(int(arg) if arg else None,
+                                       timeout=timeout)
+                ans.append(resp)
+            elif op == 'write_raw':
+                yield self._raw('write_raw', arg, timeout)
+                ans.append('')
+            elif op == 'read_raw':
+                resp = yield self._raw('read_raw', int(arg) if arg else None,
+                                       timeout)
+                ans.append(resp)
+            else:
+                raise ValueError('Operation {} needs a GPIB bus server with '
+                                 'transactions'.format(op))
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _raw(self, op, arg, timeout):
+        p = self._packet()
+        if timeout is not None:
+            p.timeout(timeout)
+        getattr(p, op)(arg)
+        if timeout is not None:
+            p.timeout(self._timeout)
+        resp = yield p.send()
+        returnValue(getattr(resp, op))
+
+    def queries(self, *queries):
+        """Send several queries in one request and return their responses."""
+        return self.transaction([('query', q) for q in queries])
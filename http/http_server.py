@@ -5,10 +5,12 @@ from twisted.web.server import Site, NOT_DONE_YET
 from twisted.internet import reactor
 from twisted.web.resource import Resource, IResource, NoResource
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.task import LoopingCall
 from twisted.web.template import flattenString, renderer
 from labrad.server import LabradServer, setting
 import functools
 import inspect
+import json
 import labrad
 from zope.interface import implements
 
@@ -78,8 +80,11 @@ class RootStatusResource(Resource):
         # 
         # if name=="" we should instead return a dictionary of all known modules
         try:
-            page_factory = __import__("modules.%s"%name, globals=globals(), fromlist=['page_factory']).page_factory
-            child = StatusResource(page_factory, self.cxn)
+            module = __import__("modules.%s"%name, globals=globals(), fromlist=['page_factory'])
+            child = StatusResource(module.page_factory, self.cxn)
+            feed_factory = getattr(module, 'feed_factory', None)
+            if feed_factory is not None:
+                child.putChild('events', EventStreamResource(StatusFeed(feed_factory, self.cxn)))
             self.putChild(name, child)
             print "successfully registered resource %s" % name
             return child
@@ -94,11 +99,17 @@ class StatusResource(Resource):
     Generic class for a LabRAD based status page.  It takes a twisted template 'Element' subclass
     and the labrad client connection and uses them to generate a response page.  twisted templates
     can return deferreds, so they work well with LabRAD calls.
+
+    Paths below the page also render it, except for children added with putChild, such as
+    the events stream of the page.
     '''
-    isLeaf=True
+    isLeaf=False
     def __init__(self, page_factory, cxn=None):
+        Resource.__init__(self)
         self.factory = page_factory
         self.cxn = cxn
+    def getChild(self, name, request):
+        return self
     def _delayedRender(self, request, data):
         request.write(data)
         request.finish()
@@ -111,6 +122,106 @@ class StatusResource(Resource):
         d.addCallback(lambda data: self._delayedRender(request, data))
         return NOT_DONE_YET
 
+class StatusFeed(object):
+    '''
+    Status from LabRAD servers, polled once for any number of viewers.
+
+    poll(cxn) returns (a deferred giving) a dict of JSON values.  While anyone
+    is watching, the feed polls every interval seconds and tells the watchers
+    which keys changed, so that the servers are asked the same amount however
+    many pages are open.  Polling stops an interval after the last watcher
+    leaves, which lets long-polling clients come back in between.  A failed
+    poll keeps the last status, with the error in the 'error' key.
+    '''
+    clock = reactor
+    def __init__(self, poll, cxn, interval=10):
+        self.poll = poll
+        self.cxn = cxn
+        self.interval = interval
+        self.status = None
+        self.version = 0
+        self.watchers = []
+        self.loop = None
+
+    def watch(self, callback):
+        '''
+        callback(version, status, full) is called with the whole status, if
+        it is known, and then with the keys which change, with None for keys
+        that are gone.
+        '''
+        self.watchers.append(callback)
+        if self.status is not None:
+            callback(self.version, self.status, True)
+        if callback in self.watchers and self.loop is None:
+            self.loop = LoopingCall(self.update)
+            self.loop.clock = self.clock
+            self.loop.start(self.interval)
+
+    def unwatch(self, callback):
+        if callback in self.watchers:
+            self.watchers.remove(callback)
+
+    @inlineCallbacks
+    def update(self):
+        if not self.watchers:
+            self.loop.stop()
+            self.loop = None
+            self.status = None # not kept up to date without watchers
+            return
+        old = self.status or {}
+        try:
+            status = yield self.poll(self.cxn)
+        except Exception as e:
+            status = dict(old, error=str(e))
+        delta = dict((k, v) for k, v in status.items() if k not in old or old[k] != v)
+        delta.update((k, None) for k in old if k not in status)
+        full = self.status is None
+        self.status = status
+        if delta:
+            self.version += 1
+            for callback in list(self.watchers):
+                callback(self.version, status if full else delta, full)
+
+class EventStreamResource(Resource):
+    '''
+    Pushes the changes of a StatusFeed to a page as server-sent events.  The
+    first event, 'status', is the whole status, and each 'delta' after it
+    has the keys which changed, with null for keys that are gone.
+
+    Clients which can't use event streams can long-poll instead, with
+    ?since=<version>.  The response is {"version": ..., "full": ...,
+    "status": ...}, with the whole status at once unless the client is at the
+    latest version, in which case it waits for the next change.
+    '''
+    isLeaf=True
+    def __init__(self, feed):
+        Resource.__init__(self)
+        self.feed = feed
+    def render_GET(self, request):
+        if 'since' in request.args:
+            return self.long_poll(request, int(request.args['since'][-1]))
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.write('retry: %d\n\n' % (self.feed.interval * 1000))
+        def send(version, status, full):
+            event = 'status' if full else 'delta'
+            request.write('id: %d\nevent: %s\ndata: %s\n\n' % (version, event, json.dumps(status)))
+        request.notifyFinish().addBoth(lambda _: self.feed.unwatch(send))
+        self.feed.watch(send)
+        return NOT_DONE_YET
+    def long_poll(self, request, since):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        def send(version, status, full):
+            if full and version == since:
+                return
+            self.feed.unwatch(send)
+            request.write(json.dumps({'version': version, 'full': full, 'status': status}))
+            request.finish()
+        request.notifyFinish().addErrback(lambda _: self.feed.unwatch(send))
+        self.feed.watch(send)
+        return NOT_DONE_YET
+
 class HTTPServer(LabradServer):
     """
     HTTP server to provide cryo status information
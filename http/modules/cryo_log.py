@@ -3,6 +3,8 @@
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.web.template import flattenString, Element, renderer, XMLFile, tags
 import datetime
+import json
+import urllib
 
 from http_server import render_safe
 
@@ -12,6 +14,55 @@ from http_server import render_safe
 # and assign it to the module global "page_factory".  Then drop it in the
 # labrad/servers/http/modules directory and it will automatically be served up.   
 #
+# To have changes pushed to open pages, also assign a function polling the labrad
+# connection for a dict of JSON values to "feed_factory".  It is polled once for all
+# viewers, and its changes are served as server-sent events at <page>/events.
+#
+
+def timer_str(t):
+    '''
+    Time left on a timer as HH:MM:SS, and whether it is running out.
+    '''
+    t = int(t['s'])
+    hours = t//3600
+    minutes = (t - hours*3600)//60
+    seconds = (t - hours*3600 - minutes*60)
+    return "%02d:%02d:%02d" % (hours, minutes, seconds), hours < 1
+
+def temperature_str(temp):
+    val = temp['K']
+    if val<1:
+        return "%.3f mK" % (val*1000,)
+    else:
+        return "%.3f K" % (val,)
+
+@inlineCallbacks
+def cryo_feed(cxn, count=25):
+    '''
+    The cryo notifier's snapshot as it is shown on the page, for pushing to
+    open pages: rows of the timers (with whether they are running out), of
+    the temperatures and of the newest events.  Events end with their
+    time and id, by which pages tell which of them they do not show yet.
+    '''
+    p = cxn.cryo_notifier.packet()
+    p.query_timers()
+    p.diode_temperatures()
+    p.ruox_temperatures()
+    p.query_events(count)
+    result = yield p.send()
+    timers = []
+    for (name, t) in result['query_timers']:
+        time_str, warning = timer_str(t)
+        timers.append([name, time_str, warning])
+    returnValue({
+        'timers': timers,
+        'RuOx': [["%s: " % (name,), temperature_str(temp)]
+                 for name, temp in result['ruox_temperatures']],
+        'Diode': [["%d: " % (idx+1,), temperature_str(temp)]
+                  for idx, temp in enumerate(result['diode_temperatures'])],
+        'events': [[datetime.datetime.fromtimestamp(t).ctime(), kind, name, message, t, id]
+                   for id, t, kind, name, message, value in result['query_events']],
+    })
 
 class CryoStatusPage(Element):
     loader = XMLFile('cryo_log.xml')
@@ -20,27 +71,56 @@ class CryoStatusPage(Element):
         self._cxn = cxn
         self.cryo_name = request.args.get('cryo', [''])[-1]
         self.max_entries = int(request.args.get('maxentries', ['25'])[-1])
-        self.log_path = ['', 'Servers', 'Cryo Notifier', 'Log' ]
+        self.feed_url = request.path.rstrip('/') + '/events'
+        self.cursor = None
+        self.newer = False
+        for arg in ['before', 'after']:
+            if arg in request.args:
+                t, id = request.args[arg][-1].split('_')
+                self.cursor = (float(t), int(id))
+                self.newer = arg == 'after'
+        self._status = None
+        self.older_page = None
+        self.newer_page = None
 
     @inlineCallbacks
-    def get_log(self):
-        p = self._cxn.registry.packet()
-        p.cd(self.log_path)
-        p.dir()
-        p.cd([''])
-        rv = yield p.send()
-        subdirs, keys = rv['dir']
-        keys = sorted(keys, reverse=True)[:self.max_entries]
-        p = self._cxn.registry.packet()
-        p.cd(self.log_path)
-        for k in keys:
-            p.get(k, key=k)
-        p.cd([''])
-        values = yield p.send()
-        result = []
-        for k in keys:
-            result.append((k,) + values[k])
-        returnValue(result)
+    def status(self):
+        '''
+        The cryo notifier's snapshot of timers, temperatures and a page of
+        the event log, asked for with one request for the whole page.  The
+        parts of the page are rendered one after another, so the first one
+        asks.  One more event than is shown is asked for, to tell whether
+        there is a further page.
+        '''
+        if self._status is None:
+            p = self._cxn.cryo_notifier.packet()
+            p.query_timers()
+            p.diode_temperatures()
+            p.ruox_temperatures()
+            if self.cursor is None:
+                p.query_events(self.max_entries + 1, self.cryo_name)
+            else:
+                p.query_events(self.max_entries + 1, self.cryo_name, [],
+                               self.cursor, self.newer)
+            self._status = yield p.send()
+            events = list(self._status['query_events'])
+            more = len(events) > self.max_entries
+            if self.newer:
+                events = events[-self.max_entries:] if self.max_entries else []
+            else:
+                events = events[:self.max_entries]
+            self.events = events
+            if events:
+                if more or (self.cursor is not None and self.newer):
+                    self.older_page = events[-1][1], events[-1][0]
+                if (more and self.newer) or (self.cursor is not None and not self.newer):
+                    self.newer_page = events[0][1], events[0][0]
+        returnValue(self._status)
+
+    def page_link(self, arg, cursor):
+        args = {'cryo': self.cryo_name, 'maxentries': self.max_entries,
+                arg: '%r_%d' % cursor}
+        return '?' + urllib.urlencode(sorted(args.items()))
 
     @render_safe
     def maxentries(self, request, tag):
@@ -60,63 +140,36 @@ class CryoStatusPage(Element):
     @inlineCallbacks
     def Diode(self, request, tag):
         '''
-        This function has to be different than RuOx because lakeshore_dioes and lakeshore_ruox
-        return data in different formats.  ruox returns a timestamp along with the temperature,
-        diodes does not.
+        This function has to be different than RuOx because the cryo notifier numbers
+        the diode channels, while the ruox channels come with names.
         '''
-        server = self._cxn.lakeshore_diodes 
-        p  = server.packet()
-        p.select_device()
-        p.temperatures()
-        result = yield p.send()
+        result = yield self.status()
         rv = []
-        for idx, temp in enumerate(result['temperatures']):
-            val = temp['K']
-            if val<1:
-                val = val*1000
-                unit_str = 'mK'
-            else:
-                unit_str = 'K'
-            rv.append(tag.clone().fillSlots(channel="%d: " % (idx+1,), temp="%.3f %s" % (val, unit_str)))
+        for idx, temp in enumerate(result['diode_temperatures']):
+            rv.append(tag.clone().fillSlots(channel="%d: " % (idx+1,), temp=temperature_str(temp)))
         returnValue(rv)
        
 
     @render_safe
     @inlineCallbacks
     def RuOx(self, request, tag):
-        server = self._cxn.lakeshore_ruox
-        p  = server.packet()
-        p.select_device()
-        p.named_temperatures()
-        result = yield p.send()
+        result = yield self.status()
         rv = []
-        for idx, (name, (temp, dt)) in enumerate(result['named_temperatures']):
-            val = temp['K']
-            if val<1:
-                val = val*1000
-                unit_str = 'mK'
-            else:
-                unit_str = 'K'
-            rv.append(tag.clone().fillSlots(channel="%s: " % (name,), temp="%.3f %s" % (val, unit_str)))
+        for idx, (name, temp) in enumerate(result['ruox_temperatures']):
+            rv.append(tag.clone().fillSlots(channel="%s: " % (name,), temp=temperature_str(temp)))
         returnValue(rv)
 
     @render_safe
     @inlineCallbacks
     def timeouts(self, request, tag):
-        p = self._cxn.cryo_notifier.packet()
-        p.query_timers()
-        result = yield p.send()
+        result = yield self.status()
         rv = []
         for (name, t) in result['query_timers']:
             if self.cryo_name.lower() not in name.lower():
                 continue
 
-            t = int(t['s'])
-            hours = t//3600
-            minutes = (t - hours*3600)//60
-            seconds = (t - hours*3600 - minutes*60)
-            time_str = "%02d:%02d:%02d" % (hours, minutes, seconds)
-            if hours < 1:
+            time_str, warning = timer_str(t)
+            if warning:
                 time_str = tags.font(time_str, color="#FF0000")
             rv.append(tag.clone().fillSlots(name=name, time=time_str))
         returnValue(rv)
@@ -136,23 +189,41 @@ class CryoStatusPage(Element):
     @render_safe
     @inlineCallbacks
     def logentries(self, request, tag):
-        logdata = yield self.get_log()
-        logdata = sorted(logdata, reverse=True)
+        yield self.status()
         rv = [tag.clone().fillSlots(
-                timestamp=tags.b("Fill Time"), 
-                cryo_name=tags.b("Cryo"), 
+                timestamp=tags.b("Time"), 
+                kind=tags.b("Event"), 
+                cryo_name=tags.b("Name"), 
                 comments=tags.b("Comments"))]
-        for entry in logdata:
-            timestamp = entry[0]
-            cryo_name = entry[1]
-            if self.cryo_name.lower() not in cryo_name.lower():
-                continue
-            comments = entry[2]
-            try: # convert to human readable date
-                timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f').ctime()
-            except ValueError:
-                pass
-            rv.append(tag.clone().fillSlots(timestamp=timestamp, cryo_name=cryo_name, comments=tags.pre(comments)))
+        for id, t, kind, name, message, value in self.events:
+            timestamp = datetime.datetime.fromtimestamp(t).ctime()
+            rv.append(tag.clone().fillSlots(timestamp=timestamp, kind=kind, cryo_name=name, comments=tags.pre(message)))
         returnValue(rv)
 
+    @render_safe
+    @inlineCallbacks
+    def feed(self, request, tag):
+        '''
+        Starts the script which keeps the page up to date with the changes
+        pushed from the events stream next to it.  Only the first page of
+        the log has new events added, those newer than the newest it shows.
+        '''
+        yield self.status()
+        entries = self.max_entries if self.cursor is None else 0
+        newest = list(self.events[0][1::-1]) if self.events else None
+        returnValue(tag("watchStatus(%s, %s, %d, %s);" % (
+            json.dumps(self.feed_url), json.dumps(self.cryo_name), entries,
+            json.dumps(newest))))
+
+    @render_safe
+    @inlineCallbacks
+    def pages(self, request, tag):
+        yield self.status()
+        if self.newer_page is not None:
+            tag(tags.a("Newer", href=self.page_link('after', self.newer_page)), " ")
+        if self.older_page is not None:
+            tag(tags.a("Older", href=self.page_link('before', self.older_page)))
+        returnValue(tag)
+
 page_factory = CryoStatusPage
+feed_factory = cryo_feed
@@ -0,0 +1,401 @@
+"""Resistance to temperature calibrations of RuOx thermometers.
+
+The calibrations of a Lakeshore 370 are stored in the registry (see
+lakeshore370.py) as an interpolation table, a variable-range hopping model,
+or a python expression. They are compiled here once, when loaded, into
+objects which convert whole arrays of resistances at a time:
+
+    cal = compile_calibration([INTERPOLATION, resistances, temperatures])
+    cal.temperature(np.array([1500.0, 2000.0]))  # in K
+
+Interpolation tables are kept as logs, sorted by resistance, so a
+conversion is a single np.interp. Expressions are parsed and checked
+against a whitelist of names and operations, so that a registry string can
+only compute a number from r (or t, for the inverse). Calls to math
+functions are made with their numpy counterparts, so that they act on
+arrays.
+
+The inverse of each calibration, from temperature to resistance, is a
+lookup table made when it is compiled: the log resistances of the table
+against the log temperatures, which rise monotonically. For interpolations
+this is the table itself, and for the others it is the calibration
+evaluated on a fine grid of resistances. Temperatures beyond the table have
+no resistance.
+
+Conversions give 0 K (or 0 Ohm) where the calibration gives no finite
+result, as for a reading of 0 Ohm before the first measurement. A
+calibration which does not compile is kept as Invalid, which gives 0 K
+(and 0 Ohm) for everything.
+"""
+
+from __future__ import absolute_import
+
+import ast
+
+import numpy as np
+
+DEFAULT, FUNCTION, INTERPOLATION, VRHOPPING = range(4)
+
+# numpy counterparts of the math functions allowed in expressions
+FUNCTIONS = {
+    'log': np.log, 'log10': np.log10, 'exp': np.exp, 'sqrt': np.sqrt,
+    'pow': np.power, 'fabs': np.abs, 'abs': np.abs,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan,
+    'floor': np.floor, 'ceil': np.ceil,
+}
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+# modules through which functions and constants may be named, as math.log
+MODULES = ['math', 'np', 'numpy']
+
+# resistances in Ohm at which calibrations are evaluated for their inverse
+# tables; the spacing gives relative errors of about 1e-6
+LOOKUP_RESISTANCES = np.logspace(1, 8, 7001)
+
+NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name,
+         ast.Attribute, ast.Num, ast.Load,
+         ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+         ast.USub, ast.UAdd)
+
+
+class Namespace(object):
+    """Functions and constants, looked up as attributes of a module name."""
+
+    def __init__(self, names):
+        self.__dict__.update(names)
+
+
+def compile_expression(source, variable):
+    """Compile a calibration expression in one variable.
+
+    Args:
+        source (str): Python expression, such as
+            '((math.log(r) - 6.02) / 1.76) ** (-1/.345)'.
+        variable (str): Name of the variable in the expression.
+
+    Returns:
+        A function of an array of values of the variable.
+
+    Raises:
+        ValueError: If the expression does anything other than arithmetic
+            on the variable and constants, and calls of the math functions.
+    """
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Invalid expression {!r}: {}'.format(source, e))
+    names = dict(FUNCTIONS, **CONSTANTS)
+    for node in ast.walk(tree):
+        if not isinstance(node, NODES):
+            raise ValueError('{} not allowed in expression {!r}'.format(
+                node.__class__.__name__, source))
+        if isinstance(node, ast.Attribute):
+            if (not isinstance(node.value, ast.Name) or
+                    node.value.id not in MODULES or node.attr not in names):
+                raise ValueError('Unknown function or constant in {!r}'
+                                 .format(source))
+        elif isinstance(node, ast.Name):
+            if node.id not in names and node.id not in MODULES + [variable]:
+                raise ValueError('Unknown name {} in expression {!r}'.format(
+                    node.id, source))
+        elif isinstance(node, ast.Call):
+            if node.keywords or node.starargs or node.kwargs:
+                raise ValueError('Only positional arguments allowed in {!r}'
+                                 .format(source))
+    # like eval of the source in lakeshore370, without inheriting its
+    # __future__ imports
+    code = compile(tree, '<calibration>', 'eval', dont_inherit=True)
+    namespace = dict(names)
+    module = Namespace(names)
+    for name in MODULES:
+        namespace[name] = module
+
+    def evaluate(x):
+        scope = dict(namespace)
+        scope[variable] = np.asarray(x, dtype=float)
+        return eval(code, {'__builtins__': {}}, scope)
+    return evaluate
+
+
+def finite(values):
+    """Array of values, with 0 where they are not finite."""
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isfinite(values), values, 0.0)
+
+
+class Lookup(object):
+    """Monotonic table of log resistance against log temperature.
+
+    Args:
+        resistances, temperatures (array of float): Points of a calibration,
+            in Ohm and K. Those which are not positive and finite are
+            dropped, as are all but the longest run of points over which
+            the temperature falls strictly as the resistance rises.
+    """
+
+    def __init__(self, resistances, temperatures):
+        r = np.asarray(resistances, dtype=float)
+        t = np.asarray(temperatures, dtype=float)
+        order = np.argsort(r)
+        r, t = r[order], t[order]
+        with np.errstate(all='ignore'):
+            ok = np.isfinite(r) & np.isfinite(t) & (r > 0) & (t > 0)
+            logR, logT = np.log(r[ok]), np.log(t[ok])
+        lo, hi = longest_run(np.diff(logT) < 0)
+        # in order of rising temperature
+        self.logT = logT[lo:hi + 1][::-1]
+        self.logR = logR[lo:hi + 1][::-1]
+
+    @property
+    def range(self):
+        """Lowest and highest temperatures in the table, in K."""
+        if not len(self.logT):
+            return 0.0, 0.0
+        return float(np.exp(self.logT[0])), float(np.exp(self.logT[-1]))
+
+    def __call__(self, t):
+        if len(self.logT) < 2:
+            return np.zeros(np.shape(t))
+        logT = np.log(t)
+        inside = (logT >= self.logT[0]) & (logT <= self.logT[-1])
+        return np.where(inside, np.exp(np.interp(logT, self.logT, self.logR)),
+                        0.0)
+
+
+def longest_run(mask):
+    """First and last points of the longest run of True in a mask of the
+    steps between points, or (0, -1) if there is none."""
+    best = (0, -1)
+    start = None
+    for i, m in enumerate(np.append(mask, False)):
+        if m and start is None:
+            start = i
+        elif not m and start is not None:
+            if i - start > best[1] - best[0]:
+                best = (start, i)
+            start = None
+    return best
+
+
+class Calibration(object):
+    """Conversion between resistance in Ohm and temperature in K.
+
+    Both directions take and return float arrays (or scalars). The inverse
+    is a Lookup of the calibration on LOOKUP_RESISTANCES, made by
+    subclasses with makeLookup once they are set up.
+    """
+    kind = DEFAULT
+
+    def makeLookup(self):
+        with np.errstate(all='ignore'):
+            temperatures = self._temperature(LOOKUP_RESISTANCES)
+        self.lookup = Lookup(LOOKUP_RESISTANCES, temperatures)
+
+    def temperature(self, r):
+        with np.errstate(all='ignore'):
+            return finite(self._temperature(np.asarray(r, dtype=float)))
+
+    def resistance(self, t):
+        with np.errstate(all='ignore'):
+            return finite(self.lookup(np.asarray(t, dtype=float)))
+
+    def _temperature(self, r):
+        raise NotImplementedError()
+
+
+class Interpolation(Calibration):
+    """Log-log interpolation of a table of resistances and temperatures."""
+    kind = INTERPOLATION
+
+    def __init__(self, resistances, temperatures):
+        order = np.argsort(resistances)
+        self.resistances = np.asarray(resistances, dtype=float)[order]
+        self.temperatures = np.asarray(temperatures, dtype=float)[order]
+        self.logR = np.log(self.resistances)
+        self.logT = np.log(self.temperatures)
+        self.lookup = Lookup(self.resistances, self.temperatures)
+
+    def _temperature(self, r):
+        return np.exp(np.interp(np.log(r), self.logR, self.logT))
+
+    def __str__(self):
+        return 'INTERPOLATION --  Resistances: %s -- Temperatures: %s' % (
+            self.resistances, self.temperatures)
+
+
+class VRHopping(Calibration):
+    """Variable-range hopping model, R = R0 exp((T0 / T)**(1/4))."""
+    kind = VRHOPPING
+
+    def __init__(self, r0, t0):
+        self.r0 = r0
+        self.t0 = t0
+        self.makeLookup()
+
+    def _temperature(self, r):
+        return self.t0 / np.log(self.r0 / r) ** 4
+
+    def __str__(self):
+        return 'Variable-range hopping model: r0: %s Ohm, t0: %s K' % (
+            self.r0, self.t0)
+
+
+class Function(Calibration):
+    """Expression in r for the temperature.
+
+    The inverse expression, in t, is checked but not used, since the
+    lookup table of the function is its exact inverse.
+    """
+    kind = FUNCTION
+
+    def __init__(self, function, inverse):
+        self.function = function
+        self.inverse = inverse
+        self._temperature = compile_expression(function, 'r')
+        compile_expression(inverse, 't')
+        self.makeLookup()
+
+    def __str__(self):
+        return 'FUNCTION: %s -- Inverse: %s' % (self.function, self.inverse)
+
+
+class Default(Function):
+    """The calibration used when there is none in the registry."""
+    kind = DEFAULT
+
+    def __init__(self):
+        Function.__init__(self, '((math.log(r) - 6.02) / 1.76) ** (-1/.345)',
+                          'math.exp(1.76*(t**(-0.345)) + 6.02)')
+
+    def __str__(self):
+        return 'DEFAULT'
+
+
+class Invalid(Calibration):
+    """A calibration from the registry which does not compile.
+
+    It converts every resistance to 0 K, and no temperature has a
+    resistance, so that its readings are obviously invalid and it cannot
+    be regulated on.
+    """
+
+    def __init__(self, calibration, error):
+        self.kind = calibration[0]
+        self.calibration = calibration
+        self.error = error
+        self.lookup = Lookup([], [])
+
+    def _temperature(self, r):
+        return np.zeros(np.shape(r))
+
+    def __str__(self):
+        return 'INVALID: %s' % self.error
+
+
+def compile_calibration(calibration):
+    """Compile a calibration loaded from the registry.
+
+    Args:
+        calibration (list): [DEFAULT], [INTERPOLATION, resistances,
+            temperatures], [VRHOPPING, R0, T0] or [FUNCTION, function,
+            inverse], as loaded by RuOxWrapper.loadSingleCalibration.
+
+    Returns:
+        Calibration, or None for DEFAULT.
+    """
+    kind = calibration[0]
+    if kind == INTERPOLATION:
+        return Interpolation(calibration[1], calibration[2])
+    if kind == VRHOPPING:
+        r0, t0 = calibration[1:3]
+        return VRHopping(r0['Ohm'] if hasattr(r0, 'unit') else float(r0),
+                         t0['K'] if hasattr(t0, 'unit') else float(t0))
+    if kind == FUNCTION:
+        return Function(calibration[1], calibration[2])
+    return None
+
+
+class Calibrations(object):
+    """Calibrations of the channels of a device.
+
+    A channel without a calibration of its own uses the device calibration,
+    and if there is none of those either, the Default calibration.
+
+    To convert the readings of all channels in one call, the log tables of
+    all interpolations are joined into one table, each shifted along the
+    log resistance axis so that they do not overlap. A reading is clipped
+    to the range of its channel's table, which is what np.interp does at
+    the ends of a table anyway, and shifted by the same amount.
+
+    Args:
+        device (Calibration or None): Calibration of the device.
+        channels (list of Calibration or None): Calibrations of channels
+            1 to N.
+    """
+
+    def __init__(self, device, channels):
+        self.device = device or Default()
+        # by channel, with the device calibration at 0
+        self.table = [self.device] + [c or self.device for c in channels]
+        n = len(self.table)
+        self.interpolated = np.zeros(n, bool)
+        self.lo, self.hi, self.offset = np.zeros((3, n))
+        self.group = np.zeros(n, int)
+        self.groups = []
+        xs, ys = [], []
+        shifted = {}
+        end = 0.0
+        for i, calibration in enumerate(self.table):
+            key = id(calibration)
+            if isinstance(calibration, Interpolation):
+                if key not in shifted:
+                    offset = end + 1.0 - calibration.logR[0]
+                    xs.append(calibration.logR + offset)
+                    ys.append(calibration.logT)
+                    end = xs[-1][-1]
+                    shifted[key] = offset
+                self.interpolated[i] = True
+                self.lo[i] = calibration.logR[0]
+                self.hi[i] = calibration.logR[-1]
+                self.offset[i] = shifted[key]
+            else:
+                if calibration not in self.groups:
+                    self.groups.append(calibration)
+                self.group[i] = self.groups.index(calibration)
+        self.x = np.concatenate(xs) if xs else np.zeros(0)
+        self.y = np.concatenate(ys) if ys else np.zeros(0)
+
+    def __getitem__(self, channel):
+        if 0 < channel < len(self.table):
+            return self.table[channel]
+        return self.device
+
+    def temperatures(self, channels, resistances):
+        """Convert the resistances read on several channels at once.
+
+        Args:
+            channels (array of int): Channel of each resistance.
+            resistances (array of float): Resistances in Ohm.
+
+        Returns:
+            (array of float): Temperatures in K.
+        """
+        index = np.asarray(channels, dtype=int)
+        index = np.where((index > 0) & (index < len(self.table)), index, 0)
+        r = np.asarray(resistances, dtype=float)
+        temperatures = np.zeros(len(r))
+        with np.errstate(all='ignore'):
+            interpolated = self.interpolated[index]
+            if interpolated.any():
+                i = index[interpolated]
+                logR = np.clip(np.log(r[interpolated]), self.lo[i], self.hi[i])
+                temperatures[interpolated] = np.exp(
+                    np.interp(logR + self.offset[i], self.x, self.y))
+            others = ~interpolated
+            if others.any():
+                group = self.group[index]
+                for g in np.unique(group[others]):
+                    mask = others & (group == g)
+                    temperatures[mask] = self.groups[g]._temperature(r[mask])
+        return finite(temperatures)
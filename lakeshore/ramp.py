@@ -0,0 +1,83 @@
+"""Temperature ramps and steps for regulation with a Lakeshore 370.
+
+A Ramp is a plan of setpoint temperatures over time, piecewise linear
+between points, which the server follows by sending a new setpoint every
+interval seconds. This replaces a client calling 'Regulate Temperature'
+once per step, so the setpoints go out on time, without a round trip
+each.
+
+    ramp = Ramp.linear(0.05, 0.2, rate=0.01 / 60, interval=10)  # 10 mK/min
+    ramp.setpoint(120.0)  # 0.07 K
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class Ramp(object):
+    """Setpoint temperatures over time.
+
+    Args:
+        times (list of float): Seconds from the start of the ramp, rising.
+        temperatures (list of float): Setpoints in K at those times. The
+            setpoint is interpolated linearly between them.
+        interval (float): Seconds between setpoint updates.
+    """
+
+    def __init__(self, times, temperatures, interval):
+        if len(times) != len(temperatures) or not len(times):
+            raise ValueError('Need a temperature for each time')
+        if np.any(np.diff(times) < 0):
+            raise ValueError('Ramp times must not decrease')
+        if interval <= 0:
+            raise ValueError('Ramp interval must be positive')
+        self.times = np.asarray(times, dtype=float)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.interval = float(interval)
+
+    @classmethod
+    def linear(cls, start, end, rate, interval):
+        """Ramp from start to end K at rate K/s."""
+        if rate <= 0:
+            raise ValueError('Ramp rate must be positive')
+        return cls([0.0, abs(end - start) / rate], [start, end], interval)
+
+    @classmethod
+    def steps(cls, temperatures, dwell, interval=None):
+        """Step through temperatures, holding each one for dwell seconds.
+
+        The setpoint is updated at each step, or every interval seconds if
+        given.
+        """
+        times = []
+        temps = []
+        for i, t in enumerate(temperatures):
+            times.extend([i * dwell, (i + 1) * dwell])
+            temps.extend([t, t])
+        return cls(times[:-1], temps[:-1], interval or dwell)
+
+    @property
+    def duration(self):
+        return float(self.times[-1])
+
+    @property
+    def target(self):
+        return float(self.temperatures[-1])
+
+    def setpoint(self, elapsed):
+        """Setpoint in K at elapsed seconds from the start."""
+        # the last point at or before elapsed, for steps
+        i = np.searchsorted(self.times, elapsed, 'right') - 1
+        if i < 0:
+            return float(self.temperatures[0])
+        if i >= len(self.times) - 1:
+            return self.target
+        t0, t1 = self.times[i], self.times[i + 1]
+        T0, T1 = self.temperatures[i], self.temperatures[i + 1]
+        return float(T0 + (T1 - T0) * (elapsed - t0) / (t1 - t0))
+
+    def schedule(self):
+        """Times of the setpoint updates, from 0 to the end of the ramp."""
+        times = np.arange(0.0, self.duration, self.interval)
+        return np.union1d(times, [self.duration])
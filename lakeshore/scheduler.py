@@ -0,0 +1,114 @@
+"""Choosing which channel of a Lakeshore 370 to read next.
+
+The 370 has a single measurement channel, which is switched between the
+thermometers by a scanner, and each switch must be followed by a settle
+time before the reading is good. With many channels, reading them in a
+fixed order leaves each one stale for a long time, including the channel
+being regulated on.
+
+The Scheduler instead reads the most urgent channel next. The urgency of a
+channel is the time since it was last read, as it will be when a reading
+taken now is done, in units of its target refresh interval. It is increased
+for the regulated channel and for channels whose resistance is changing
+fast:
+
+    urgency = (staleness + settle) / interval * weight * (1 + rate / fastRate)
+
+where weight is regulatedWeight for the regulated channel and 1 otherwise,
+and rate is the fractional change of the resistance per second between the
+last two readings. Channels never read are the most urgent of all.
+
+Without configured intervals, the interval of a channel is that given by
+the read order: a channel appearing k times in a read order that takes T
+seconds to go through has an interval of T / k. With nothing else going
+on, channels are then read about as often as before. These intervals fill
+all the time there is, so shorter intervals for some channels make the
+others be read less often than their intervals. Intervals are targets:
+channels are read continuously, so if the intervals leave time to spare,
+all channels are read more often, in proportion.
+"""
+
+from __future__ import absolute_import
+
+import math
+
+# urgency of the regulated channel relative to the others
+REGULATED_WEIGHT = 4.0
+# fractional change of resistance per second which doubles the urgency
+FAST_RATE = 1e-3
+
+
+class Scheduler(object):
+    """Priorities of the channels of one Lakeshore 370.
+
+    Args:
+        readOrder (list of int): Channels to read. A channel appearing more
+            often gets a shorter default interval.
+        settleTime (float): Default settle time in seconds.
+        intervals (dict): Maps channels to target refresh intervals in
+            seconds, instead of those from the read order.
+        settleTimes (dict): Maps channels to their settle times in seconds.
+
+    Attributes:
+        regulated (int): Channel being regulated on, or 0 for none.
+    """
+
+    def __init__(self, readOrder, settleTime, intervals=None, settleTimes=None,
+                 regulatedWeight=REGULATED_WEIGHT, fastRate=FAST_RATE):
+        self.readOrder = list(readOrder)
+        self.channels = sorted(set(self.readOrder))
+        self.settleTime = float(settleTime)
+        self.intervals = dict(intervals or {})
+        self.settleTimes = dict(settleTimes or {})
+        self.regulatedWeight = regulatedWeight
+        self.fastRate = fastRate
+        self.regulated = 0
+        # time of the last reading and rate of change, by channel
+        self.last = {}
+        self.values = {}
+        self.rates = {}
+
+    def settle(self, channel):
+        """Settle time of a channel in seconds."""
+        return self.settleTimes.get(channel, self.settleTime)
+
+    def interval(self, channel):
+        """Target refresh interval of a channel in seconds."""
+        if channel in self.intervals:
+            return self.intervals[channel]
+        cycle = sum(self.settle(ch) for ch in self.readOrder)
+        return cycle / max(self.readOrder.count(channel), 1)
+
+    def urgency(self, channel, now):
+        if channel not in self.last:
+            return float('inf')
+        weight = self.regulatedWeight if channel == self.regulated else 1.0
+        weight *= 1.0 + self.rates.get(channel, 0.0) / self.fastRate
+        staleness = now + self.settle(channel) - self.last[channel]
+        return staleness / self.interval(channel) * weight
+
+    def next(self, now):
+        """The channel to read next, or None if there are none."""
+        if not self.channels:
+            return None
+        # ties go to the channel read longest ago, then the lowest
+        return max(self.channels,
+                   key=lambda ch: (self.urgency(ch, now),
+                                   -self.last.get(ch, -float('inf')), -ch))
+
+    def record(self, channel, resistance, now):
+        """Note a reading of a channel, in Ohm, taken at time now."""
+        previous = self.values.get(channel)
+        if (previous is not None and previous > 0 and resistance > 0 and
+                now > self.last[channel]):
+            self.rates[channel] = (abs(math.log(resistance / previous)) /
+                                   (now - self.last[channel]))
+        self.last[channel] = now
+        self.values[channel] = resistance
+
+    def staleness(self, now):
+        """Maps each channel to the seconds since it was last read, or inf
+        if it has not been read."""
+        return dict((ch, now - self.last[ch] if ch in self.last
+                     else float('inf'))
+                    for ch in self.channels)
@@ -60,7 +60,10 @@
 #       '((math.log(r) - 6.02) / 1.76) ** (-1/.345)'
 #        The Inverse code is used for temperature regulation. (Note that for
 #       interpolation calibrations the server can simply reverse the arguments
-#       of the interpolation to convert a temp to a res).
+#       of the interpolation to convert a temp to a res). Functions may only
+#       do arithmetic on r (or t) and call math functions; they are compiled
+#       to act on arrays when the calibrations are loaded (see
+#       lakeshore/calibration.py).
 #
 # The best way to understand these is by example. Look in >> Servers >>
 # Lakeshore 370 >> Jules for an example of a function, and >> Servers >>
@@ -77,6 +80,21 @@
 
 # Also note that the read order for a given device now can be stored in the
 # registry as well. If not, it defaults to [1, 2, 1, 3, 1, 4, 1, 5]
+#
+# Channels are not read in the read order itself, but by priority (see
+# lakeshore/scheduler.py): the channel which is most overdue for a reading
+# is read next, with the regulated channel and channels changing fast read
+# more often. By default a channel's target refresh interval is the one it
+# would have had with the read order. Two optional keys change this:
+#   "Refresh Intervals", a list of (channel, interval [s]) giving target
+#       refresh intervals for some channels, and
+#   "Settle Times", a list of (channel, time [s]) giving settle times for
+#       some channels, instead of the "Settle Time" of the device.
+#
+# Once "Regulate Temperature" has set up regulation, the server can change
+# the setpoint over time by itself, with "Ramp Temperature" or "Ramp Steps"
+# (see lakeshore/ramp.py). It sends the "ramp progress" signal at each new
+# setpoint.
 
 """
 ### BEGIN NODE INFO
@@ -96,44 +114,42 @@ timeout = 20
 """
 
 from datetime import datetime
-import math
 
 from twisted.python import log
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall, deferLater
 
 from labrad import types as T, util, units as U
-from labrad.server import setting
+from labrad.server import setting, Signal
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 import labrad.units as units
 import numpy as np
 
+from lakeshore.calibration import (DEFAULT, FUNCTION, INTERPOLATION, VRHOPPING,
+                                   Calibrations, Invalid, compile_calibration)
+from lakeshore.ramp import Ramp
+from lakeshore.scheduler import Scheduler
+
 Ohm, K, s = [U.Unit(s) for s in ['Ohm', 'K', 's']]
 
 READ_ORDER = [1, 2, 1, 3, 1, 4, 1, 5]
 #N_CHANNELS = 5
 DEFAULT_SETTLE_TIME = 8*s
-DEFAULT, FUNCTION, INTERPOLATION, VRHOPPING = range(4)
-
-# These functions suck.
-def res2temp(r):
-    try:
-        return units.K * ((math.log(r) - 6.02) / 1.76) ** (-1/.345)
-    except Exception:
-        return units.K*0.0
-
-def temp2res(t):
-    try:
-        return units.Ohm * math.exp(1.76*(t**(-0.345)) + 6.02)
-    except Exception:
-        return units.Ohm * 0.0
 
 class RuOxWrapper(GPIBDeviceWrapper):
+    # provider of seconds and callLater, for the read loop
+    clock = reactor
     
     @inlineCallbacks
     def initialize(self):
         """Set up initial state for this wrapper"""
         self.alive = False
         self.onlyChannel = 0
+        self.scannedChannel = 0
+        self.regulatedChannel = 0
+        self.setpoint = None
+        self.ramp = None
         print "Initializing %s" % self.name
         yield self.loadDeviceInformation()
         # also we should set the box settings here
@@ -149,6 +165,7 @@ class RuOxWrapper(GPIBDeviceWrapper):
         yield self.reloadCalibrations(path)
         yield self.reloadChannelNames(path)
         yield self.reloadSettleTime(path)
+        yield self.reloadSchedule(path)
     
     def getRegistryPath(self):
         """Get a registry path suitable for registry.cd"""
@@ -179,6 +196,28 @@ class RuOxWrapper(GPIBDeviceWrapper):
         except Exception as e:
             print e
             self.settleTime = DEFAULT_SETTLE_TIME
+
+    @inlineCallbacks
+    def reloadSchedule(self, path):
+        """Make the scheduler for the read order, with the refresh intervals
+        and settle times of channels in the registry."""
+        reg = self.gpib._cxn.registry
+        options = {}
+        for key, name in [('intervals', 'Refresh Intervals'),
+                          ('settleTimes', 'Settle Times')]:
+            try:
+                p = reg.packet()
+                p.cd(path)
+                p.get(name, key=key)
+                ans = yield p.send()
+                options[key] = dict((ch, t['s']) for ch, t in ans[key])
+            except Exception:
+                options[key] = {}
+        previous = getattr(self, 'scheduler', None)
+        self.scheduler = Scheduler(self.readOrder, self.settleTime['s'],
+                                   **options)
+        if previous is not None:
+            self.scheduler.regulated = previous.regulated
         
     @inlineCallbacks
     def loadSingleCalibration(self, reg, path):
@@ -261,6 +300,9 @@ class RuOxWrapper(GPIBDeviceWrapper):
         self.calibrations[0] = device default calibration,
         self.calibrations[1-N] for channels 1-N. See docstring for
         loadSingleCalibration
+
+        The calibrations are then compiled into self.compiled, which
+        converts the readings of any channel.
         """
         self.calibrations = []
         self.readOrder = []
@@ -309,13 +351,32 @@ class RuOxWrapper(GPIBDeviceWrapper):
                 print "%s -- found FUNCTION calibration for channel %d." % (self.addr, i+1)
             else:
                 raise Exception("Calibration loader messed up. This shouldn't have happened.")
+        self.compileCalibrations()
+
+    def compileCalibrations(self):
+        """Compile self.calibrations into self.compiled.
+
+        A calibration which does not compile, such as a function with an
+        expression that is not allowed, is kept as Invalid. Its channels
+        read 0 K and cannot be regulated.
+        """
+        compiled = []
+        for i, calib in enumerate(self.calibrations):
+            try:
+                compiled.append(compile_calibration(calib))
+            except Exception as e:
+                print "WARNING: %s -- invalid calibration %d: %s" % (self.addr, i, e)
+                compiled.append(Invalid(calib, e))
+        self.compiled = Calibrations(compiled[0], compiled[1:])
     
     def shutdown(self):
         self.alive = False
+        self.stopRamp()
     
     @inlineCallbacks
     def selectChannel(self, channel):
         yield self.write('SCAN %d,0' % channel)
+        self.scannedChannel = channel
     
     @inlineCallbacks
     def getHeaterOutput(self):
@@ -346,92 +407,67 @@ class RuOxWrapper(GPIBDeviceWrapper):
     def setPID(self, P, I, D):
         yield self.write('PID %f, %f, %f' % (P, I, D))
     
+    def sleep(self, seconds):
+        return deferLater(self.clock, seconds, lambda: None)
+
+    def now(self):
+        return datetime.fromtimestamp(self.clock.seconds())
+
     @inlineCallbacks
-    def readLoop(self, idx=0):
+    def readLoop(self):
         while self.alive:
             # read only one specific channel
             if self.onlyChannel > 0:
                 chan = self.onlyChannel
-                yield util.wakeupCall(self.settleTime['s'])
-                r = yield self.query('RDGR? %d' % chan)
-                self.readings[chan] = float(r)*Ohm, datetime.now()
-            # scan over channels
+            # read the most urgent channel
             else:
-                if len(self.readOrder) > 0:
-                    chan = self.readOrder[idx]
-                else:
-                    yield util.wakeupCall(self.settleTime['s'])
+                chan = self.scheduler.next(self.clock.seconds())
+                if chan is None:
+                    yield self.sleep(self.settleTime['s'])
                     continue
+            if chan != self.scannedChannel:
+                # also sends SCAN again if selecting the channel failed
                 yield self.selectChannel(chan)
-                yield util.wakeupCall(self.settleTime['s'])
-                r = yield self.query('RDGR? %d' % chan)
-                self.readings[chan] = float(r)*Ohm, datetime.now()
-                idx = (idx + 1) % len(self.readOrder)
-    
-    def getSingleTemp(self, channel, calIndex=-1):
+            yield self.sleep(self.scheduler.settle(chan))
+            if chan != self.scannedChannel:
+                # another channel was selected while we waited
+                continue
+            r = yield self.query('RDGR? %d' % chan)
+            self.readings[chan] = float(r)*Ohm, self.now()
+            self.scheduler.record(chan, float(r), self.clock.seconds())
+
+    def getStaleness(self):
+        """Seconds since each channel was last read, by channel."""
+        staleness = self.scheduler.staleness(self.clock.seconds())
+        return sorted(staleness.items())
+
+    def getSingleTemp(self, channel):
         """Get a single temperature for a given channel
-        
-        Use that channel's calibration, or if it's default, the device
-        calibration (and if that's zero, the default function) the first
-        argument is the channel the second argument is the channel to use for
-        the calibration, where 0 means use device default calibration if we
-        don't find a calibration on the given channel, we try again with 0 if
-        that doesn't work, we use the old-fashioned res2temp.
+
+        Use that channel's calibration, or if it has none, the device
+        calibration, and if there is none of those either, the default
+        calibration.
         """
-        if calIndex == -1:
-            calIndex = channel
-        try:
-            #print("lakeshore370: Computing temperature for channel %d"%channel)
-            #print("Resistance is %s"%str(self.readings[channel][0]))
-            #print("Calibration type %s" % (self.calibrations[calIndex][0],))
-            #print self.calibrations[calIndex]
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # log-log interpolation
-                return (np.exp(np.interp(np.log(self.readings[channel][0]['Ohm']),
-                              np.log(np.array(self.calibrations[calIndex][1])),
-                              np.log(np.array(self.calibrations[calIndex][2]))
-                              ))) * K
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                T0 = self.calibrations[calIndex][2]
-                R0 = self.calibrations[calIndex][1]
-                res = self.readings[channel][0]
-                T = T0 / (np.log(R0/res)**4)
-                return T
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # hack alert--using eval is bad:
-                # (1) This depends on the function string being good python
-                #     code.
-                # (2) It also depends on it having "r" as the variable for 
-                #     resistance, in ohms.
-                # (3) very unsafe if anyone ever hacks the registry. of course,
-                #     then we have bigger problems
-                r = self.readings[channel][0][units.Ohm]
-                return eval(self.calibrations[calIndex][1]) * units.K
-            elif self.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    # use calibration 0--the device calibration
-                    return self.getSingleTemp(channel, 0) 
-                else:
-                    #If there is no calibration at all use res2temp
-                    return res2temp(self.readings[channel][0])
-        except Exception as e:
-            print "Exception getting temperature: ", e
-            return 0.0*K
-    
+        r = self.readings[channel][0]['Ohm']
+        return float(self.compiled[channel].temperature(r)) * K
+
+    def convertResistances(self, channel, resistances):
+        """Convert an array of resistances in Ohm read on a channel to K."""
+        return self.compiled[channel].temperature(resistances)
+
     def getTemperatures(self):
-        # we now do this channel by channel. oh yeah.
-        result = []
-        for channel in sorted(self.readings.keys()):
-            result.append((self.getSingleTemp(channel), self.readings[channel][1]))
-        return result
-    
+        """Temperatures of all channels, converted at once."""
+        channels = sorted(self.readings.keys())
+        temps = self.compiled.temperatures(
+            channels, [self.readings[ch][0]['Ohm'] for ch in channels])
+        return [(U.Value(float(t), K), self.readings[ch][1])
+                for ch, t in zip(channels, temps)]
+
     def getNamedTemperatures(self):
-        # we now do this channel by channel. oh yeah.
-        result = []
-        for channel in sorted(self.readings.keys()):
-            result.append((self.channelNames[channel-1],(self.getSingleTemp(channel), self.readings[channel][1])))
-        return result
-    
+        channels = sorted(self.readings.keys())
+        return [(self.channelNames[ch-1], reading)
+                for ch, reading in zip(channels, self.getTemperatures())]
+
     def getResistances(self):
         result = []
         for channel in sorted(self.readings.keys()):
@@ -444,41 +480,74 @@ class RuOxWrapper(GPIBDeviceWrapper):
             result.append((self.channelNames[channel-1],self.readings[channel]))
         return result
     
-    def singleTempToRes (self, temp, channel, calIndex=-1):
+    def startRamp(self, ramp, progress=None):
+        """Follow a ramp of setpoints on the regulated channel.
+
+        Args:
+            ramp (Ramp): Setpoints from now on.
+            progress (callable): Called with (channel, setpoint, target,
+                fraction done) at each new setpoint.
+        """
+        channel = self.regulatedChannel
+        if not channel:
+            raise Exception('Use Regulate Temperature before ramping')
+        for t in ramp.temperatures:
+            if self.singleTempToRes(t, channel) == 0.0:
+                raise Exception('Temperature %g K is beyond the calibration '
+                                'of channel %d' % (t, channel))
+        self.stopRamp()
+        self.ramp = ramp
+        self.rampStart = self.clock.seconds()
+        self.rampDone = 0.0
+        self.rampProgress = progress
+        self.rampLoop = LoopingCall(self.rampStep, channel)
+        self.rampLoop.clock = self.clock
+        self.rampLoop.start(ramp.interval, now=True).addErrback(log.err)
+
+    @inlineCallbacks
+    def rampStep(self, channel):
+        ramp = self.ramp
+        elapsed = min(self.clock.seconds() - self.rampStart, ramp.duration)
+        temperature = ramp.setpoint(elapsed)
+        done = elapsed >= ramp.duration
+        if done:
+            self.stopRamp()
+        yield self.write('SETP %f' % self.singleTempToRes(temperature, channel))
+        self.setpoint = temperature
+        self.rampDone = elapsed / ramp.duration if ramp.duration else 1.0
+        if self.rampProgress is not None:
+            self.rampProgress(channel, temperature, ramp.target, self.rampDone)
+
+    def stopRamp(self):
+        """Stop following the ramp, leaving the last setpoint."""
+        if self.ramp is not None and self.rampLoop.running:
+            self.rampLoop.stop()
+
+    def rampStatus(self):
+        """(running, setpoint, target, fraction done) of the ramp."""
+        setpoint = self.setpoint or 0.0
+        if self.ramp is None:
+            return False, setpoint, setpoint, 1.0
+        return (self.rampLoop.running, setpoint, self.ramp.target,
+                self.rampDone)
+
+    def singleTempToRes(self, temp, channel):
         """Get the resistance that corresponds to a temperature
         
         You need to provide the channel because different channels can have
         different calibrations this function is essentially the inverse of
-        getSingleTemp.
+        getSingleTemp, through the lookup table of the calibration. Returns
+        0.0 if there is no such resistance.
         """
-        if calIndex == -1:
-            calIndex = channel
-        try:
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # do the log-log interpolation in reverse
-                return (np.exp(np.interp(np.log(temp),
-                                            np.log(np.array(self.calibrations[calIndex][2][::-1])),
-                                            np.log(np.array(self.calibrations[calIndex][1][::-1]))
-                                            )))
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                return self.calibrations[calIndex][1]['K'] * np.exp((self.calibrations[calIndex][2]['K']/temp)**.25)
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # same as getSingleTemp, but use inverse instead of function
-                t = temp
-                return eval(self.calibrations[calIndex][2])
-            elif eslf.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    return self.singleTempToRes(temp, channel, 0) # use calibration 0
-                else:
-                    return temp2res(temp) # if no calibration for the device either, use old-fashioned temp2res
-        except Exception as e:
-            print "Exception converting temp to res: %s" % e.__str__()
-            return 0.0
-            
+        return float(self.compiled[channel].resistance(temp))
+
 class LakeshoreRuOxServer(GPIBManagedServer):
     name = 'Lakeshore RuOx'
     deviceName = 'LSCI MODEL370'
     deviceWrapper = RuOxWrapper
+
+    onRampProgress = Signal(543370, 'signal: ramp progress',
+                            '(w, v[K], v[K], v)')
     
     @setting(111, "r", returns='v[Ohm]')
     def r(self, c):
@@ -528,8 +597,8 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         dev = self.selectedDevice(c)
         dev.onlyChannel = channel
         if channel > 0:
-            dev.selectChannel(channel)
-        return channel
+            yield dev.selectChannel(channel)
+        returnValue(channel)
     
     @setting(9, 'Settle Time', time='v[s]', returns='v[s]')
     def settleTime(self, c, time=None):
@@ -541,7 +610,45 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         dev = self.selectedDevice(c)
         if time != None:
             dev.settleTime = time
+            dev.scheduler.settleTime = time['s']
         return dev.settleTime
+
+    @setting(25, 'Channel Settle Time', channel='w', time='v[s]',
+             returns='v[s]')
+    def channel_settle_time(self, c, channel, time=None):
+        """Get/set the settle time of a channel.
+
+        Channels without a settle time of their own use the device's
+        Settle Time.
+        """
+        dev = self.selectedDevice(c)
+        if time is not None:
+            dev.scheduler.settleTimes[channel] = time['s']
+        return dev.scheduler.settle(channel) * s
+
+    @setting(26, 'Refresh Interval', channel='w', interval='v[s]',
+             returns='v[s]')
+    def refresh_interval(self, c, channel, interval=None):
+        """Get/set the target refresh interval of a channel.
+
+        Channels are read when they are most overdue relative to their
+        interval, so this sets how often a channel is read relative to the
+        others. By default, it is the interval given by the read order.
+        """
+        dev = self.selectedDevice(c)
+        if interval is not None:
+            dev.scheduler.intervals[channel] = interval['s']
+        return dev.scheduler.interval(channel) * s
+
+    @setting(27, 'Staleness', returns='*(w, v[s])')
+    def staleness(self, c):
+        """Time since each channel was last read.
+
+        Returns (channel, time) for each channel read, with an infinite time
+        for channels not read yet.
+        """
+        dev = self.selectedDevice(c)
+        return [(ch, t * s) for ch, t in dev.getStaleness()]
     
     @setting(21, "Single Temperature", channel='w', returns='(v[K], t)')
     def single_temperature(self, c, channel):
@@ -559,13 +666,26 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         This includes:
         * Calibration curves/interpolation tables for all channels and the
           device default
-        * Channel read order
+        * Channel read order, refresh intervals and settle times
         Call this after you change something in the registry and want to reload
         it.
         """
         dev = self.selectedDevice(c)
-        dev.reloadCalibrations()
+        yield dev.reloadCalibrations(dev.getRegistryPath())
+        yield dev.reloadSchedule(dev.getRegistryPath())
     
+    @setting(24, 'Convert Resistances', channel='w', resistances='*v[Ohm]',
+             returns='*v[K]')
+    def convert_resistances(self, c, channel, resistances):
+        """Convert resistances to temperatures with a channel's calibration.
+
+        This converts many resistances at once, such as those logged over a
+        cooldown.
+        """
+        dev = self.selectedDevice(c)
+        temps = dev.convertResistances(channel, np.asarray(resistances['Ohm']))
+        return U.ValueArray(temps, 'K')
+
     @setting(23, 'Print Settings', returns='s')
     def print_settings(self, c):
         """Prints the settings loaded from the registry for this device."""
@@ -581,9 +701,12 @@ class LakeshoreRuOxServer(GPIBManagedServer):
     
     @setting(50, 'Regulate Temperature', channel='w', temperature='v[K]',
                  loadresistor='v[Ohm]', returns='v[Ohm]: Target resistance')
-    def regulate(self, c, channel, temperature, loadresistor=30000):
+    def regulate(self, c, channel, temperature, loadresistor=30000*Ohm):
         """Initializes temperature regulation
 
+        This reads only the regulated channel. After "Select channel" 0,
+        all channels are read again, with the regulated one more often.
+
         NOTE:
         Use "Heater Range" to turn on heater and start regulation."""
         dev = self.selectedDevice(c)
@@ -591,17 +714,67 @@ class LakeshoreRuOxServer(GPIBManagedServer):
             raise Exception('Channel needs to be between 1 and 16')
         #res = temp2res(float(temperature))
         # we now do it intelligently
-        res = dev.singleTempToRes(float(temperature), channel)
+        res = dev.singleTempToRes(temperature['K'], channel)
         if res == 0.0:
             raise Exception('Invalid temperature')
-        loadresistor = float(loadresistor)
+        loadresistor = loadresistor['Ohm']
         if (loadresistor < 1) or (loadresistor > 100000):
             msg = 'Load resistor value must be between 1 Ohm and 100kOhm'
             raise Exception(msg)
+        dev.stopRamp()
         dev.onlyChannel = channel
-        dev.selectChannel(channel)
+        dev.scheduler.regulated = channel
+        yield dev.selectChannel(channel)
         yield dev.controlTemperature(channel, res, loadresistor)
+        dev.regulatedChannel = channel
+        dev.setpoint = temperature['K']
         returnValue(res)
+
+    def rampProgress(self, channel, setpoint, target, fraction):
+        self.onRampProgress((channel, setpoint * K, target * K, fraction))
+
+    @setting(60, 'Ramp Temperature', target='v[K]', rate='v[K/s]',
+             interval='v[s]', returns='v[s]: Duration of the ramp')
+    def ramp_temperature(self, c, target, rate, interval=10*s):
+        """Ramp the setpoint linearly to a target temperature.
+
+        The ramp starts from the current setpoint, on the channel set up by
+        Regulate Temperature, and the setpoint is updated every interval.
+        """
+        dev = self.selectedDevice(c)
+        if dev.setpoint is None:
+            raise Exception('Use Regulate Temperature before ramping')
+        ramp = Ramp.linear(dev.setpoint, target['K'], rate['K/s'],
+                           interval['s'])
+        dev.startRamp(ramp, self.rampProgress)
+        return ramp.duration * s
+
+    @setting(61, 'Ramp Steps', temperatures='*v[K]', dwell='v[s]',
+             returns='v[s]: Duration of the steps')
+    def ramp_steps(self, c, temperatures, dwell):
+        """Step the setpoint through temperatures, dwell apart.
+
+        The steps are taken on the channel set up by Regulate Temperature.
+        """
+        dev = self.selectedDevice(c)
+        ramp = Ramp.steps(list(temperatures['K']), dwell['s'])
+        dev.startRamp(ramp, self.rampProgress)
+        return ramp.duration * s
+
+    @setting(62, 'Stop Ramp', returns='v[K]: Setpoint')
+    def stop_ramp(self, c):
+        """Stop a ramp, holding the current setpoint."""
+        dev = self.selectedDevice(c)
+        dev.stopRamp()
+        return (dev.setpoint or 0.0) * K
+
+    @setting(63, 'Ramp Status', returns='(b, v[K], v[K], v)')
+    def ramp_status(self, c):
+        """Whether a ramp is running, the setpoint, the target, and the
+        fraction of the ramp done."""
+        dev = self.selectedDevice(c)
+        running, setpoint, target, fraction = dev.rampStatus()
+        return running, setpoint * K, target * K, fraction
     
     @setting(52, 'PID', P='v', I='v[s]', D='v[s]')
     def setPID(self, c, P, I, D=0):
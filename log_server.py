@@ -17,8 +17,8 @@
 ### BEGIN NODE INFO
 [info]
 name = Logger
-version = 1.0
-description = Manages log files with the data vault and registry.
+version = 2.0
+description = Stores logs of timestamped values from many channels.
 
 [startup]
 cmdline = %PYTHON% %FILE%
@@ -30,61 +30,144 @@ timeout = 5
 ### END NODE INFO
 """
 
-from labrad.server import LabradServer, setting, inlineCallbacks, returnValue
-from labrad.units import degC, K, psi, torr, min as minutes, A
-
+import os
+import time
 from datetime import datetime
 
-# registry (metadata about logs and nonnumeric logs)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
+import numpy as np
+from twisted.internet.task import LoopingCall
+
+from labrad import units as U
+from labrad import util
+from labrad.server import (LabradServer, Signal, setting, inlineCallbacks,
+                           returnValue)
+
+from logstore.rollup import points
+from logstore.store import LogStore
+
+# Logs are kept in a LogStore (see logstore/store.py) under the directory set
+# in the registry, in ['', 'Servers', 'Logger', 'Repository'], either for
+# this node or as '__default__'.
+
+# seconds between updates of the rollups of open logs
+ROLLUP_INTERVAL = 60
+
+
+def toSeconds(t):
+    """Convert a datetime in local time to seconds since the epoch."""
+    return time.mktime(t.timetuple()) + t.microsecond * 1e-6
+
+
+def toDatetime(seconds):
+    return datetime.fromtimestamp(seconds)
 
-# data vault (for logging of numerical data)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
 
-class Log(object):
-    def __new__(self):
-        pass
+def withUnit(channel, values):
+    """Numeric values of a channel, with the channel's units if it has any."""
+    if channel.unit is not None:
+        return U.ValueArray(values, channel.unit)
+    return values.tolist()
 
-    def __getitem__(self, key):
-        """Get or create a variable with the specified key."""
 
-class Channel(object):
-    def __new__(self):
-        pass
-    
-    def __init__(self):
-        pass
+def entries(channel, times, values):
+    """List of (time, value) entries, as returned by get."""
+    if not channel.binary:
+        values = withUnit(channel, values)
+    return [(toDatetime(t), v) for t, v in zip(times, values)]
+
+
+def buckets(rollup, start, end, limit):
+    """Rollup records over [start, end], evenly downsampled to the limit."""
+    records = rollup.query(start, end)
+    return records[rollup.channel.select(0, len(records), limit)]
 
-    def addEntry(self, time, value):
-        """Add an entry for this channel."""
 
 class Logger(LabradServer):
     name = 'Logger'
 
-    @inlineCallbacks
-    def initServer(self):
-        pass
-
     onNewLog = Signal(654321, 'signal: new log', '*s')
     onNewVar = Signal(654322, 'signal: new channel', 'ss')
     onNewData = Signal(654323, 'signal: new data', '')
 
+    def __init__(self, store=None):
+        LabradServer.__init__(self)
+        self.store = store
+
+    @inlineCallbacks
+    def initServer(self):
+        if self.store is None:
+            root = yield self.loadRepository()
+            self.store = LogStore(root)
+        self.rollupLoop = LoopingCall(self.store.updateRollups)
+        self.rollupLoop.start(ROLLUP_INTERVAL, now=False)
+
+    @inlineCallbacks
+    def loadRepository(self):
+        reg = self.client.registry
+        yield reg.cd(['', 'Servers', self.name, 'Repository'], True)
+        dirs, keys = yield reg.dir()
+        nodename = util.getNodeName()
+        if nodename in keys:
+            root = yield reg.get(nodename)
+        elif '__default__' in keys:
+            root = yield reg.get('__default__')
+        else:
+            root = os.path.expanduser('~/.labrad/logs')
+            yield reg.set('__default__', root)
+        returnValue(root)
+
+    def stopServer(self):
+        if getattr(self, 'rollupLoop', None) is not None:
+            self.rollupLoop.stop()
+        if self.store is not None:
+            self.store.close()
+
+    def initContext(self, c):
+        # open gets, by channel: (start, index of the next entry to send)
+        c['cursors'] = {}
+
+    def expireContext(self, c):
+        if 'log' in c:
+            c['log'].listeners.discard(c.ID)
+
     def getLog(self, c):
         if 'log' not in c:
             raise Exception('No log opened in this context.')
         return c['log']
 
-    @setting(1, 'list', filters=['s', '*s'])
-    def get_log_list(self, c, filters):
+    def describeLog(self, log):
+        last = log.last if log.last is not None else log.created
+        # a channel may have no entries, if the server stopped as it was made
+        channels = [(name, ch.tag,
+                     toDatetime(ch.first if ch.first is not None else log.created),
+                     toDatetime(ch.last if ch.last is not None else log.created))
+                    for name, ch in sorted(log.channels.items())]
+        return toDatetime(log.created), toDatetime(last), channels
+
+    def logPath(self, logPath):
+        if isinstance(logPath, str):
+            return logPath.split('/')
+        return list(logPath)
+
+    @setting(1, 'list', filters=['s', '*s'], returns='*s')
+    def get_log_list(self, c, filters=None):
         """Get a list of available logs matching the given filters.
+
+        Filters are glob patterns, such as 'fridge/*', matched against the
+        log path joined with '/'. Logs are returned as paths joined with '/'.
         """
+        if isinstance(filters, str):
+            filters = [filters]
+        return ['/'.join(path) for path in self.store.list(filters)]
 
     @setting(2, 'describe', logPath=['s', '*s'],
-             returns='t{start} t{last} *(s{name} s{type} t{start} t{last}')
+             returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
     def describe(self, c, logPath):
         """Get information about the specified log.
         """
-    
+        log, _ = self.store.open(self.logPath(logPath))
+        return self.describeLog(log)
+
     @setting(100, 'open', logPath=['s', '*s'], create='b',
              returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
     def open_log(self, c, logPath, create=False):
@@ -96,6 +179,14 @@ class Logger(LabradServer):
         Returns the start time of the log, as well as a list
         with the name and type tag of each channel in the log.
         """
+        log, created = self.store.open(self.logPath(logPath), create)
+        if 'log' in c:
+            c['log'].listeners.discard(c.ID)
+        c['log'] = log
+        c['cursors'] = {}
+        if created:
+            self.onNewLog(log.path)
+        return self.describeLog(log)
 
     @setting(300, 'log', data='?: ((s?)(s?)...)', returns='')
     def log_data(self, c, data):
@@ -110,9 +201,13 @@ class Logger(LabradServer):
         name must have the same type.
         """
         log = self.getLog(c)
-        t = datetime.now()
-        for key, value in data:
-            log[key].addEntry(t, value)
+        # entries are kept in time order even if the clock goes back
+        t = max(time.time(), log.last or 0)
+        for name in log.add(t, list(data)):
+            self.onNewVar(('/'.join(log.path), name))
+        if log.listeners:
+            self.onNewData(None, log.listeners)
+            log.listeners = set()
 
     @setting(400, 'get',
              channels=['s', '*s'], range=['t', 'tt'], limit='w',
@@ -131,19 +226,107 @@ class Logger(LabradServer):
         of new messages, sign up for the 'new data' signal.
 
         Limit specifies the maximum number of entries to allow in any
-        given list.  If there is more data available beyond the limit,
-        a 'new data' message will be fired to listeners signed up for
-        the message.  This is the same 'streaming' protocol used by
-        clients of the data vault.
+        given list.  For a finite range with more entries than this, the
+        entries of numeric channels are replaced by their means over 1
+        minute, 1 hour or 1 day, whichever is the finest that fits in the
+        limit, with the start time of each interval.  Other channels, or
+        ranges too long even for 1 day intervals, are downsampled evenly
+        over the range.  For an
+        open range, the first entries are returned, and the next get with
+        the same start continues where this one stopped.  If there is more
+        data available beyond the limit, a 'new data' message will be
+        fired to listeners signed up for the message.  This is the same
+        'streaming' protocol used by clients of the data vault.
+        """
+        log = self.getLog(c)
+        if isinstance(channels, str):
+            channels = [channels]
+        limit = int(limit)
+        streaming = isinstance(range, datetime)
+        if streaming:
+            start = toSeconds(range)
+        else:
+            start, end = toSeconds(range[0]), toSeconds(range[1])
+        more = False
+        result = []
+        for name in channels:
+            channel = log[name]
+            if streaming:
+                cursor = c['cursors'].get(name)
+                if cursor is not None and cursor[0] == start:
+                    lo = cursor[1]
+                else:
+                    lo = channel.index(start)
+                hi = min(len(channel), lo + limit)
+                more = more or hi < len(channel)
+                c['cursors'][name] = (start, hi)
+                times, values = channel.take(np.arange(lo, hi))
+            else:
+                lo, hi = channel.index(start), channel.index(end, 'right')
+                rollup = None
+                if hi - lo > limit:
+                    rollup = channel.rollup(start, end, limit)
+                if rollup is None:
+                    times, values = channel.take(channel.select(lo, hi, limit))
+                else:
+                    records = buckets(rollup, start, end, limit)
+                    times = records['t']
+                    values = records['sum'] / records['n']
+            result.append(entries(channel, times, values))
+        if streaming:
+            if more:
+                log.listeners.discard(c.ID)
+                self.onNewData(None, [c.ID])
+            else:
+                log.listeners.add(c.ID)
+        return tuple(result)
+
+    @setting(401, 'get rollup',
+             channels=['s', '*s'], range='tt', limit='w',
+             returns='?: ((v[s]*(tivvv))(v[s]*(tivvv))...)')
+    def get_rollup(self, c, channels, range, limit=1000):
+        """Get the min, mean and max of channels over a range of time.
+
+        For each channel, returns the length of the intervals the range is
+        divided into, and for each interval its start time, the number of
+        entries, and their min, mean and max.  The intervals are 1 minute,
+        1 hour or 1 day long, whichever is the finest that fits in the
+        limit.  If the entries in the range fit in the limit, they are
+        returned as they are, as intervals of length 0 with one entry each.
+        Only real valued channels are summarized this way.
         """
-        
+        log = self.getLog(c)
+        if isinstance(channels, str):
+            channels = [channels]
+        start, end = toSeconds(range[0]), toSeconds(range[1])
+        limit = int(limit)
+        result = []
+        for name in channels:
+            channel = log[name]
+            if not channel.rollups:
+                raise ValueError("Channel '{0}' of type {1} has no "
+                                 "rollups".format(name, channel.tag))
+            lo, hi = channel.index(start), channel.index(end, 'right')
+            if hi - lo <= limit:
+                resolution = 0
+                records = points(*channel.take(np.arange(lo, hi)))
+            else:
+                rollup = channel.rollup(start, end, limit)
+                resolution = rollup.resolution
+                records = buckets(rollup, start, end, limit)
+            columns = [withUnit(channel, records['min']),
+                       withUnit(channel, records['sum'] / records['n']),
+                       withUnit(channel, records['max'])]
+            result.append((U.Value(resolution, 's'),
+                           [(toDatetime(t), int(n), low, mean, high)
+                            for t, n, low, mean, high in zip(
+                                records['t'], records['n'], *columns)]))
+        return tuple(result)
+
 #####
 # Create a server instance and run it
 
 __server__ = Logger()
 
 if __name__ == '__main__':
-    from labrad import util
     util.runServer(__server__)
-
-
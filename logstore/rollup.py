@@ -0,0 +1,147 @@
+"""Min, max and mean of log channels over fixed intervals of time.
+
+A Rollup summarizes the entries of a numeric channel in buckets of one
+resolution, such as one minute. Each bucket is a record with the start time
+of the bucket, the number of entries, and their min, max and sum. Records
+of finished buckets are appended to a file in the channel's directory,
+
+    <channel>.channel/rollup.<resolution>
+
+and the bucket of the latest entries is kept in memory until an entry
+beyond it arrives. Since the number of entries in each record is stored,
+the number of entries already summarized is the sum of these, and a
+rollup picks up where it left off when the channel is loaded.
+
+Rollups are brought up to date by update, which reads the entries added
+since the last update. Queries update the rollup first, so they are always
+current, and updating in the background keeps this quick.
+"""
+
+from __future__ import absolute_import
+
+import os
+
+import numpy as np
+
+RECORD = np.dtype([('t', '<f8'), ('n', '<i8'), ('min', '<f8'),
+                   ('max', '<f8'), ('sum', '<f8')])
+
+# 1 minute, 1 hour and 1 day
+RESOLUTIONS = [60, 60 * 60, 24 * 60 * 60]
+
+# entries read at once when updating
+CHUNK = 10 ** 6
+
+
+def points(times, values):
+    """Records for single entries."""
+    records = np.zeros(len(times), RECORD)
+    records['t'] = times
+    records['n'] = 1
+    records['min'] = records['max'] = records['sum'] = values
+    return records
+
+
+def aggregate(records, resolution):
+    """Combine time ordered records into buckets of the given resolution."""
+    starts = records['t'] // resolution * resolution
+    splits = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1))
+    buckets = np.zeros(len(splits), RECORD)
+    buckets['t'] = starts[splits]
+    buckets['n'] = np.add.reduceat(records['n'], splits)
+    buckets['min'] = np.minimum.reduceat(records['min'], splits)
+    buckets['max'] = np.maximum.reduceat(records['max'], splits)
+    buckets['sum'] = np.add.reduceat(records['sum'], splits)
+    return buckets
+
+
+class Rollup(object):
+    """Buckets of one resolution, summarizing the entries of a channel.
+
+    Args:
+        channel (Channel): A numeric channel.
+        resolution (int): Length of a bucket, in seconds.
+    """
+
+    def __init__(self, channel, resolution):
+        self.channel = channel
+        self.resolution = resolution
+        self.filename = os.path.join(channel.directory,
+                                     'rollup.{0}'.format(resolution))
+        self.count = 0
+        if os.path.exists(self.filename):
+            size = os.path.getsize(self.filename)
+            self.count = size // RECORD.itemsize
+            if size > self.count * RECORD.itemsize:
+                with open(self.filename, 'r+b') as f:
+                    f.truncate(self.count * RECORD.itemsize)
+        # number of entries summarized in the file, and in the open bucket
+        self.position = int(self.records()['n'].sum())
+        self.open = None
+        self._file = None
+
+    def records(self):
+        """Records of finished buckets."""
+        if self.count == 0:
+            return np.zeros(0, RECORD)
+        return np.memmap(self.filename, RECORD, 'r', shape=(self.count,))
+
+    def update(self):
+        """Summarize the entries added to the channel since the last update."""
+        end = len(self.channel)
+        while self.position < end:
+            hi = min(end, self.position + CHUNK)
+            times, values = self.channel.take(np.arange(self.position, hi))
+            records = points(times, values)
+            if self.open is not None:
+                records = np.concatenate((self.open[None], records))
+            buckets = aggregate(records, self.resolution)
+            self._write(buckets[:-1])
+            self.open = buckets[-1].copy()
+            self.position = hi
+
+    def _write(self, buckets):
+        if not len(buckets):
+            return
+        if self._file is None:
+            self._file = open(self.filename, 'ab')
+        self._file.write(buckets.tostring())
+        self._file.flush()
+        self.count += len(buckets)
+
+    def _range(self, start, end):
+        """Indices of the finished buckets overlapping [start, end]."""
+        t = self.records()['t']
+        first = start // self.resolution * self.resolution
+        return (int(np.searchsorted(t, first, 'left')),
+                int(np.searchsorted(t, end, 'right')))
+
+    def _openInRange(self, start, end):
+        return (self.open is not None and
+                start // self.resolution * self.resolution <= self.open['t']
+                <= end)
+
+    def size(self, start, end):
+        """Number of buckets overlapping [start, end]."""
+        self.update()
+        lo, hi = self._range(start, end)
+        return hi - lo + int(self._openInRange(start, end))
+
+    def query(self, start, end):
+        """Buckets overlapping [start, end], including the open one.
+
+        Returns:
+            (ndarray): Records with fields t, n, min, max and sum, where t is
+                the start of the bucket.
+        """
+        self.update()
+        lo, hi = self._range(start, end)
+        records = np.array(self.records()[lo:hi])
+        if self._openInRange(start, end):
+            records = np.concatenate((records, self.open[None]))
+        return records
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
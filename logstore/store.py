@@ -0,0 +1,548 @@
+"""Append-only time-series storage for the Logger server.
+
+A store is a directory tree with one directory per log, named by the log
+path. Each channel of a log has its own directory, and its entries are kept
+in blocks of time, with a set of files per block:
+
+    <log path>/<channel>.channel/<block start>.t    timestamps, <f8
+    <log path>/<channel>.channel/<block start>.v    values
+    <log path>/<channel>.channel/<block start>.o    value end offsets, <i8
+
+Timestamps are seconds since the epoch and never decrease within a channel,
+so a time is found by bisecting the list of blocks and then binary searching
+the timestamps of one block, which are memory mapped rather than read.
+Entries are only ever appended, so files are never rewritten.
+
+Numeric channels (types v, c, i, w and b) store their values as a fixed
+width column in the channel's units. Values of any other type are stored in
+LabRAD's flattened form, and only these channels have .o files, giving the
+end of each value in the .v file. Real valued channels also keep rollups
+(see rollup.py), which summarize long ranges of time.
+
+Values are written before timestamps, so an entry whose timestamp has been
+written is complete. A write cut short by a crash is truncated away when the
+channel is next loaded. A channel directory is made under a temporary name
+and renamed once it has its description, so it is never found half made,
+though it may have no entries.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import fnmatch
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from labrad import types as T
+from labrad import units as U
+
+from datavault import filename_decode, filename_encode
+
+from .rollup import RESOLUTIONS, Rollup
+
+# length of a block of entries, in seconds
+BLOCK = 24 * 60 * 60
+
+# column types of numeric channels, by LabRAD type
+NUMERIC = {'v': '<f8', 'c': '<c16', 'i': '<i4', 'w': '<u4', 'b': '?'}
+
+# types of channels with rollups
+ROLLUP_TYPES = 'viwb'
+
+LOG_FILE = 'log.json'
+CHANNEL_FILE = 'channel.json'
+CHANNEL_EXT = '.channel'
+
+
+class LogNotFoundError(T.Error):
+    code = 1
+
+    def __init__(self, path):
+        self.msg = "Log '{0}' not found!".format('/'.join(path))
+
+
+class ChannelNotFoundError(T.Error):
+    code = 2
+
+    def __init__(self, name):
+        self.msg = "Channel '{0}' not found!".format(name)
+
+
+class ChannelTypeError(T.Error):
+    code = 3
+
+    def __init__(self, name, tag, value):
+        self.msg = "Channel '{0}' has type {1}, cannot log {2!r}.".format(
+            name, tag, value)
+
+
+def type_tag(value):
+    """Type tag of a value, without empty units, e.g. 'v[K]', 'v' or '*s'."""
+    return str(T.getType(value)).replace('[]', '')
+
+
+def _tag(tag):
+    return str(T.parseTypeTag(tag)).replace('[]', '')
+
+
+def _fileSize(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _truncate(filename, size):
+    if _fileSize(filename) > size:
+        with open(filename, 'r+b') as f:
+            f.truncate(size)
+
+
+def _memmap(filename, dtype, count):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
+
+
+class Channel(object):
+    """Entries of one channel of a log.
+
+    Args:
+        directory (str): Directory of the channel.
+        name (str): Channel name.
+        tag (str): LabRAD type tag of the values.
+        block (int): Length of a block of entries, in seconds.
+    """
+
+    def __init__(self, directory, name, tag, block=BLOCK):
+        self.directory = directory
+        self.name = name
+        self.tag = _tag(tag)
+        self.block = block
+        kind = self.tag[0]
+        self.dtype = np.dtype(NUMERIC[kind]) if kind in NUMERIC else None
+        self.unit = getattr(T.parseTypeTag(self.tag), 'unit', None) or None
+        self.starts = []   # start time of each block
+        self.offsets = []  # index of the first entry of each block
+        self.counts = []   # number of entries in each block
+        self.first = None
+        self.last = None
+        self._files = None
+        self._end = 0      # size of the .v file of the last block
+        self.rollups = []
+        if kind in ROLLUP_TYPES:
+            self.rollups = [Rollup(self, r) for r in RESOLUTIONS]
+
+    @classmethod
+    def create(cls, directory, name, tag, block=BLOCK):
+        channel = cls(directory, name, tag, block)
+        channel.save()
+        return channel
+
+    def save(self):
+        """Make the directory of a new channel, with its description."""
+        partial = self.directory + '.new'
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+        with open(os.path.join(partial, CHANNEL_FILE), 'w') as f:
+            json.dump({'name': self.name, 'type': self.tag,
+                       'block': self.block}, f)
+        os.rename(partial, self.directory)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, CHANNEL_FILE)) as f:
+            info = json.load(f)
+        channel = cls(directory, str(info['name']), str(info['type']),
+                      info['block'])
+        starts = sorted(int(fn[:-2]) for fn in os.listdir(directory)
+                        if fn.endswith('.t'))
+        for start in starts:
+            count = channel._repair(start)
+            if count:
+                channel.starts.append(start)
+                channel.offsets.append(len(channel))
+                channel.counts.append(count)
+        if channel.starts:
+            channel.first = float(channel._times(0)[0])
+            channel.last = float(channel._times(-1)[-1])
+            if channel.dtype is None:
+                channel._end = int(channel._ends(-1)[-1])
+        return channel
+
+    @property
+    def binary(self):
+        """Whether values are stored in flattened form."""
+        return self.dtype is None
+
+    def __len__(self):
+        if not self.counts:
+            return 0
+        return self.offsets[-1] + self.counts[-1]
+
+    def _file(self, start, ext):
+        return os.path.join(self.directory, '{0}.{1}'.format(start, ext))
+
+    def _repair(self, start):
+        """Truncate an incomplete last entry, returning the entry count."""
+        times = self._file(start, 't')
+        values = self._file(start, 'v')
+        count = _fileSize(times) // 8
+        if self.binary:
+            ends = self._file(start, 'o')
+            count = min(count, _fileSize(ends) // 8)
+            size = _fileSize(values)
+            count = int(np.searchsorted(_memmap(ends, '<i8', count), size,
+                                        'right'))
+            _truncate(ends, 8 * count)
+            _truncate(values,
+                      int(_memmap(ends, '<i8', count)[-1]) if count else 0)
+        else:
+            count = min(count, _fileSize(values) // self.dtype.itemsize)
+            _truncate(values, self.dtype.itemsize * count)
+        _truncate(times, 8 * count)
+        return count
+
+    def _times(self, i):
+        return _memmap(self._file(self.starts[i], 't'), '<f8', self.counts[i])
+
+    def _values(self, i):
+        return _memmap(self._file(self.starts[i], 'v'), self.dtype,
+                       self.counts[i])
+
+    def _ends(self, i):
+        return _memmap(self._file(self.starts[i], 'o'), '<i8', self.counts[i])
+
+    def encode(self, values):
+        """Convert values to the form they are stored in.
+
+        Numeric values are converted to the units of the channel. Values
+        which do not have the type of the channel raise ChannelTypeError.
+        """
+        if self.binary:
+            data = []
+            for value in values:
+                try:
+                    flat = T.flatten(value, self.tag)
+                except T.FlatteningError:
+                    raise ChannelTypeError(self.name, self.tag, value)
+                if _tag(flat.tag) != self.tag:
+                    raise ChannelTypeError(self.name, self.tag, value)
+                data.append(flat.bytes)
+            return data
+        try:
+            if isinstance(values, U.ValueArray):
+                data = np.asarray(values[self.unit or ''])
+            else:
+                data = np.asarray([v[self.unit or '']
+                                   if isinstance(v, U.WithUnit) else v
+                                   for v in values])
+        except (TypeError, ValueError):
+            raise ChannelTypeError(self.name, self.tag, values)
+        if not len(data):
+            return data.astype(self.dtype)
+        if self.dtype.kind in 'iu':
+            # integers of either sign fit if they are in range, which is
+            # checked as astype would wrap them
+            info = np.iinfo(self.dtype)
+            if data.dtype.kind not in 'biu' or data.min() < info.min or \
+                    data.max() > info.max:
+                raise ChannelTypeError(self.name, self.tag, values)
+        elif not np.can_cast(data.dtype, self.dtype, 'same_kind'):
+            raise ChannelTypeError(self.name, self.tag, values)
+        return data.astype(self.dtype)
+
+    def append(self, times, values):
+        """Add entries, given their times in seconds since the epoch."""
+        self.write(times, self.encode(values))
+
+    def write(self, times, data):
+        """Add entries whose values have already been encoded."""
+        times = np.asarray(times, dtype='<f8')
+        if len(times) != len(data):
+            raise ValueError('Got {0} times for {1} values'.format(
+                len(times), len(data)))
+        if not len(times):
+            return
+        if np.any(np.diff(times) < 0) or (self.last is not None and
+                                          times[0] < self.last):
+            raise ValueError("Entries of channel '{0}' must be added in time "
+                             "order".format(self.name))
+        starts = (times // self.block).astype(np.int64) * self.block
+        splits = list(np.flatnonzero(np.diff(starts)) + 1)
+        for lo, hi in zip([0] + splits, splits + [len(times)]):
+            self._writeBlock(int(starts[lo]), times[lo:hi], data[lo:hi])
+        if self.first is None:
+            self.first = float(times[0])
+        self.last = float(times[-1])
+
+    def _writeBlock(self, start, times, data):
+        if not self.starts or self.starts[-1] != start:
+            self.close()
+            self.starts.append(start)
+            self.offsets.append(len(self))
+            self.counts.append(0)
+            self._end = 0
+        if self._files is None:
+            exts = ['v', 'o', 't'] if self.binary else ['v', 't']
+            self._files = [open(self._file(start, ext), 'ab') for ext in exts]
+        if self.binary:
+            ends = self._end + np.cumsum([len(d) for d in data])
+            self._files[0].write(''.join(data))
+            self._files[1].write(ends.astype('<i8').tostring())
+            self._end = int(ends[-1])
+        else:
+            self._files[0].write(data.tostring())
+        self._files[-1].write(times.tostring())
+        for f in self._files:
+            f.flush()
+        self.counts[-1] += len(times)
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+        for rollup in self.rollups:
+            rollup.close()
+
+    def updateRollups(self):
+        for rollup in self.rollups:
+            rollup.update()
+
+    def rollup(self, start, end, limit):
+        """Finest rollup with at most limit buckets over [start, end].
+
+        Returns the coarsest rollup if none has few enough buckets, or None
+        if the channel has no rollups.
+        """
+        for rollup in self.rollups:
+            if rollup.size(start, end) <= limit:
+                return rollup
+        return self.rollups[-1] if self.rollups else None
+
+    def index(self, t, side='left'):
+        """Index of the first entry at (left) or after (right) time t."""
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0:
+            return 0
+        return self.offsets[i] + int(np.searchsorted(self._times(i), t, side))
+
+    def select(self, lo, hi, limit):
+        """Indices of at most limit entries, evenly spread over [lo, hi).
+
+        The first and last entries of the range are always included.
+        """
+        if hi - lo <= limit:
+            return np.arange(lo, hi)
+        if limit == 1:
+            return np.array([lo])
+        return np.round(np.linspace(lo, hi - 1, limit)).astype(np.int64)
+
+    def take(self, indices):
+        """Times and values of the entries with the given sorted indices.
+
+        Returns:
+            (ndarray, ndarray or list): Times, and the values, which are an
+                array in the channel's units for numeric channels.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        blocks = np.searchsorted(self.offsets, indices, 'right') - 1
+        splits = list(np.flatnonzero(np.diff(blocks)) + 1)
+        times = []
+        values = []
+        for lo, hi in zip([0] + splits, splits + [len(indices)]):
+            if lo == hi:
+                continue
+            i = int(blocks[lo])
+            local = indices[lo:hi] - self.offsets[i]
+            times.append(self._times(i)[local])
+            if self.binary:
+                values.extend(self._unflatten(i, local))
+            else:
+                values.append(self._values(i)[local])
+        times = np.hstack(times) if times else np.zeros(0)
+        if not self.binary:
+            values = np.hstack(values) if values else np.zeros(0, self.dtype)
+        return times, values
+
+    def _unflatten(self, i, local):
+        ends = self._ends(i)
+        data = _memmap(self._file(self.starts[i], 'v'), np.uint8, self._size(i))
+        values = []
+        for j in local:
+            start = int(ends[j - 1]) if j else 0
+            values.append(T.unflatten(data[start:ends[j]].tostring(),
+                                      self.tag))
+        return values
+
+    def _size(self, i):
+        if i == len(self.starts) - 1 or i == -1:
+            return self._end
+        return int(self._ends(i)[-1])
+
+
+class Log(object):
+    """A set of channels stored in one directory.
+
+    Args:
+        directory (str): Directory of the log.
+        path (list[str]): Log path.
+        block (int): Block length of new channels, in seconds.
+    """
+
+    def __init__(self, directory, path, block=BLOCK):
+        self.directory = directory
+        self.path = path
+        self.block = block
+        with open(os.path.join(directory, LOG_FILE)) as f:
+            self.created = json.load(f)['created']
+        self.channels = {}
+        for fn in sorted(os.listdir(directory)):
+            if fn.endswith(CHANNEL_EXT):
+                channel = Channel.load(os.path.join(directory, fn))
+                self.channels[channel.name] = channel
+        # contexts to notify when entries are added
+        self.listeners = set()
+
+    @classmethod
+    def create(cls, directory, path, block=BLOCK):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, LOG_FILE), 'w') as f:
+            json.dump({'path': path, 'created': time.time()}, f)
+        return cls(directory, path, block)
+
+    def __getitem__(self, name):
+        """Get the channel with the specified name."""
+        if name not in self.channels:
+            raise ChannelNotFoundError(name)
+        return self.channels[name]
+
+    @property
+    def last(self):
+        """Time of the last entry of any channel."""
+        lasts = [ch.last for ch in self.channels.values()
+                 if ch.last is not None]
+        return max(lasts) if lasts else None
+
+    def _newChannel(self, name, tag):
+        directory = os.path.join(self.directory,
+                                 filename_encode(name) + CHANNEL_EXT)
+        return Channel(directory, name, tag, self.block)
+
+    def addChannel(self, name, tag):
+        channel = self._newChannel(name, tag)
+        channel.save()
+        self.channels[name] = channel
+        return channel
+
+    def add(self, t, entries):
+        """Log one entry on each of several channels, at time t.
+
+        Channels that do not exist are created, with the type of the value
+        logged. No entries are added, and no channels created, if any value
+        has the wrong type.
+
+        Args:
+            t (float): Time of the entries, in seconds since the epoch.
+            entries (list[(str, value)]): Channel names and values.
+
+        Returns:
+            (list[str]): Names of the channels that were created.
+        """
+        new = [name for name, value in entries if name not in self.channels]
+        data = []
+        for name, value in entries:
+            if name in self.channels:
+                data.append((self.channels[name],
+                             self.channels[name].encode([value])))
+        created = []
+        for name, value in entries:
+            if name in new:
+                channel = self._newChannel(name, type_tag(value))
+                data.append((channel, channel.encode([value])))
+                created.append(channel)
+        for channel in created:
+            channel.save()
+            self.channels[channel.name] = channel
+        for channel, values in data:
+            channel.write([t], values)
+        return new
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+
+
+class LogStore(object):
+    """Logs stored under a root directory, by log path."""
+
+    def __init__(self, root, block=BLOCK):
+        self.root = root
+        self.block = block
+        self.logs = {}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def directory(self, path):
+        return os.path.join(self.root, *[filename_encode(p) for p in path])
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.directory(path), LOG_FILE))
+
+    def open(self, path, create=False):
+        """Get the log with the given path, optionally creating it.
+
+        Returns:
+            (Log, bool): The log, and whether it was created.
+        """
+        path = list(path)
+        if not path or '' in path:
+            raise ValueError('Invalid log path {0!r}'.format(path))
+        key = tuple(path)
+        if key in self.logs:
+            return self.logs[key], False
+        created = False
+        if self.exists(path):
+            log = Log(self.directory(path), path, self.block)
+        elif create:
+            log = Log.create(self.directory(path), path, self.block)
+            created = True
+        else:
+            raise LogNotFoundError(path)
+        self.logs[key] = log
+        return log, created
+
+    def list(self, filters=None):
+        """Paths of all logs, optionally matching any of some glob patterns.
+
+        Patterns are matched against the log path joined with '/'.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames
+                                 if not d.endswith(CHANNEL_EXT))
+            if LOG_FILE in filenames:
+                rel = os.path.relpath(dirpath, self.root)
+                paths.append([filename_decode(p) for p in rel.split(os.sep)])
+        if filters:
+            paths = [p for p in paths
+                     if any(fnmatch.fnmatchcase('/'.join(p), f)
+                            for f in filters)]
+        return paths
+
+    def updateRollups(self):
+        """Bring the rollups of all open logs up to date."""
+        for log in self.logs.values():
+            for channel in log.channels.values():
+                channel.updateRollups()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
@@ -1,11 +1,9 @@
 from __future__ import absolute_import
 
-import struct
-
-import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 import labrad.units as U
+import oscilloscope.waveform as waveform
 import oscilloscope.wrappers as wrappers
 
 
@@ -118,7 +116,8 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
             lambda x: format(x['V'], 'E'),
             ':CHAN{:d}:SCAL {}V'.format,
             ':CHAN{:d}:SCAL?'.format,
-            lambda x: float(x) * U.Value(1, 'V'))
+            lambda x: float(x) * U.Value(1, 'V'),
+            invalidates=True)
 
     @inlineCallbacks
     def vert_position(self, channel, position=None):
@@ -126,6 +125,7 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
         if position is not None:
             pos_V = -(position * scale)['V']
             yield self.write(':CHAN{:d}:OFFS {} V'.format(channel, pos_V))
+            self.invalidate_preamble(channel)
         resp = yield self.query(':CHAN{:d}:OFFS?'.format(channel))
         returnValue(-float(resp) / scale['V'])
 
@@ -133,7 +133,8 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
             lambda x: x['s'],
             ':TIM:SCAL {:E}'.format,
             ':TIM:SCAL?'.format,
-            lambda x: float(x) * U.Value(1, 's'))
+            lambda x: float(x) * U.Value(1, 's'),
+            invalidates=True)
 
     @inlineCallbacks
     def horiz_position(self, position=None):
@@ -141,9 +142,17 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
         if position is not None:
             pos = position * horiz_scale
             yield self.write(':TIM:POS {}'.format(-pos['s']))
+            self.invalidate_preamble()
         resp = yield self.query(':TIM:POS?')
         returnValue(-float(resp) * U.Unit('s') / horiz_scale)
 
+    record_length = wrappers.global_method(
+            int,
+            ':ACQ:POIN {:d}'.format,
+            ':ACQ:POIN?'.format,
+            int,
+            invalidates=True)
+
     # TRIGGER
 
     trigger_source = wrappers.global_method(
@@ -195,7 +204,10 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
 
     @inlineCallbacks
     def get_trace(self, channel):
-        """Get a trace.
+        """Get the trace of a channel as it is on screen.
+
+        Unlike get_traces, this makes no new acquisition, so a running scope
+        keeps running, and the preamble is read afresh with the data.
 
         Args:
             channel (int): Which channel to get.
@@ -203,37 +215,51 @@ class DSO91304AWrapper(wrappers.OscilloscopeWrapper):
         Returns: (ValueArray[s]): Time axis.
             (ValueArray[V]): Voltage axis.
         """
-        word_length = 2
-
         channel_on = yield self.channel_on(channel)
         if not channel_on:
             raise RuntimeError('Cannot get trace from channel {} because it '
                                'is not on'.format(channel))
-
-        yield self.write(':WAV:SOUR CHAN{}'.format(channel))
-        yield self.write(':WAV:BYT MSBF')
-        yield self.write(':WAV:FORM WORD')
-
-        preamble_raw = yield self.query(':WAV:PRE?')
-        preamble = parse_preamble(preamble_raw)
-
-        yield self.write(':WAV:DATA?')
-        wave_bin = yield self.read_raw()
-        wave_raw = parse_binary_waveform(wave_bin, word_length=word_length)
-
-        y_incriment = preamble['y_step']
-        y_origin = preamble['y_origin']
-        y_reference = preamble['y_reference']
-        wave = ((wave_raw - y_reference[U.V]) * y_incriment) + y_origin
-
-        x_incriment = preamble['x_step']
-        x_origin = preamble['x_origin']
-        num_points = preamble['num_points']
-        time = np.linspace(
-                x_origin[U.s],
-                x_origin[U.s] + ((num_points-1) * x_incriment[U.s]),
-                num_points) * U.s
-        returnValue((time, wave))
+        ops = [('write', ':WAV:BYT MSBF'), ('write', ':WAV:FORM WORD')]
+        ops.extend(self.preamble_ops(channel))
+        preamble_index = len(ops) - 1
+        ops.extend(self.waveform_ops(channel))
+        resp = yield self.transaction(ops)
+        preamble = self.parse_preamble(resp[preamble_index])
+        returnValue(self.decode_trace(preamble, resp[-1]))
+
+    def acquire_ops(self, channels):
+        sources = ','.join('CHAN{:d}'.format(ch) for ch in sorted(set(channels)))
+        return [('write', ':WAV:BYT MSBF'),
+                ('write', ':WAV:FORM WORD'),
+                ('write', ':DIG {}'.format(sources)),
+                ('query', '*OPC?')]
+
+    def preamble_ops(self, channel):
+        return [('write', ':WAV:SOUR CHAN{:d}'.format(channel)),
+                ('query', ':WAV:PRE?')]
+
+    def waveform_ops(self, channel):
+        return [('write', ':WAV:SOUR CHAN{:d}'.format(channel)),
+                ('write', ':WAV:DATA?'),
+                ('read_raw', '')]
+
+    def parse_preamble(self, preamble):
+        return parse_preamble(preamble)
+
+    def decode_trace(self, preamble, data):
+        wave_raw = parse_binary_waveform(data, word_length=2)
+        wave = waveform.scale(
+                wave_raw,
+                preamble['y_step'][U.V],
+                preamble['y_origin'][U.V],
+                preamble['y_reference'][U.V],
+                unit=U.V)
+        time = waveform.time_axis(
+                preamble['num_points'],
+                preamble['x_step'][U.s],
+                preamble['x_origin'][U.s],
+                unit=U.s)
+        return time, wave
 
 
 def parse_preamble(preamble):
@@ -245,11 +271,7 @@ def parse_preamble(preamble):
     Returns:
         (dict): Mapping field names to their values.
     """
-    results = {}
-    fields = preamble.split(',')
-    for (key, parser), val in zip(PREAMBLE_KEYS, fields):
-        results[key] = parser(val)
-    return results
+    return waveform.parse_preamble(preamble, PREAMBLE_KEYS)
 
 
 def parse_binary_waveform(data, word_length):
@@ -262,18 +284,6 @@ def parse_binary_waveform(data, word_length):
     Returns:
         (ndarray): voltage trace values. The units depend on the scope.
     """
-    format_char = {1: 'B', 2: 'h'}[word_length]
-    if data[0] != '#':
-        raise ValueError("Invalid data. Expected '#' "
-                         "at start, but got {}".format(data[0]))
-    header_len = int(data[1])
-    offset = 2 + header_len
-    wave_len = int(data[2:offset])
-    expected_len = 1 + 1 + header_len + wave_len + 1
-    if len(data) != expected_len:
-        raise ValueError("Data length {} but expected {}".format(
-            expected_len, len(data)))
-    wave_data = data[offset:offset + wave_len]
-    num_words, r = divmod(wave_len, word_length)
-    words = struct.unpack('>' + format_char * num_words, wave_data)
-    return np.array(words)
+    dtype = {1: waveform.sample_dtype(1, signed=False),
+             2: waveform.sample_dtype(2)}[word_length]
+    return waveform.decode_block(data, dtype)
@@ -1,11 +1,9 @@
 from __future__ import absolute_import
 
-import struct
-
-import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 import labrad.units as U
+import oscilloscope.waveform as waveform
 import oscilloscope.wrappers as wrappers
 
 
@@ -50,7 +48,8 @@ class DSOX4104AWrapper(wrappers.OscilloscopeWrapper):
             lambda x: format(x['V'], 'E'),
             ':CHAN{:d}:SCAL {}V'.format,
             ':CHAN{:d}:SCAL?'.format,
-            lambda x: float(x) * U.Value(1, 'V'))
+            lambda x: float(x) * U.Value(1, 'V'),
+            invalidates=True)
 
     @inlineCallbacks
     def vert_position(self, channel, position=None):
@@ -58,6 +57,7 @@ class DSOX4104AWrapper(wrappers.OscilloscopeWrapper):
         if position is not None:
             pos_V = -(position * scale)['V']
             yield self.write(':CHAN{:d}:OFFS {} V'.format(channel, pos_V))
+            self.invalidate_preamble(channel)
         resp = yield self.query(':CHAN{:d}:OFFS?'.format(channel))
         returnValue(-float(resp) / scale['V'])
 
@@ -65,7 +65,8 @@ class DSOX4104AWrapper(wrappers.OscilloscopeWrapper):
             lambda x: x['s'],
             ':TIM:SCAL {}'.format,
             ':TIM:SCAL?'.format,
-            lambda x: float(x) * U.Value(1, 's'))
+            lambda x: float(x) * U.Value(1, 's'),
+            invalidates=True)
 
     @inlineCallbacks
     def horiz_position(self, position=None):
@@ -73,9 +74,17 @@ class DSOX4104AWrapper(wrappers.OscilloscopeWrapper):
         if position is not None:
             pos = position * horiz_scale
             yield self.write(':TIM:POS {}'.format(-pos['s']))
+            self.invalidate_preamble()
         resp = yield self.query(':TIM:POS?')
         returnValue(-float(resp) * U.Unit('s') / horiz_scale)
-        
+
+    record_length = wrappers.global_method(
+            int,
+            ':WAV:POIN {:d}'.format,
+            ':WAV:POIN?'.format,
+            int,
+            invalidates=True)
+
     # TRIGGER
 
     trigger_source = wrappers.global_method(
@@ -97,41 +106,41 @@ class DSOX4104AWrapper(wrappers.OscilloscopeWrapper):
             ':TRIG:EDGE:LEV?'.format,
             lambda x: float(x) * U.Value(1, 'V'))
 
-    @inlineCallbacks
-    def get_trace(self, channel):
-        """Get a trace.
-
-        Args:
-            channel (int): Which channel to get.
-
-        Returns:
-            (ValueArray[s]): Time axis.
-            (ValueArray[V]): Voltage axis.
-        """
-        word_length = 2
-        yield self.write(':WAV:SOUR CHAN{}'.format(channel))
-        yield self.write(':WAV:MSBF')
-        yield self.write(':SING')
-        preamble_raw = yield self.query(':WAV:PRE?')
-        preamble = parse_preamble(preamble_raw)
-        yield self.write(':WAV:FORM WORD')
-        yield self.write(':WAV:DATA?')
-        wave_bin = yield self.read_raw()
-        wave_raw = parse_binary_waveform(wave_bin, word_length=word_length)
-
-        y_incriment = preamble['y_incriment']
-        y_origin = preamble['y_origin']
-        y_reference = preamble['y_reference']
-        wave_volts = ((wave_raw - y_reference) * y_incriment) + y_origin
-
-        x_incriment = preamble['x_incriment']
-        x_origin = preamble['x_origin']
-        num_points = preamble['num_points']
-        time_s = np.linspace(
-                x_origin,
-                x_origin + (num_points-1) * x_incriment,
-                num_points)
-        returnValue((time_s * U.Unit('s'), wave_volts * U.Unit('V')))
+    # ACQUISITION
+
+    def acquire_ops(self, channels):
+        sources = ','.join('CHAN{:d}'.format(ch) for ch in sorted(set(channels)))
+        return [('write', ':WAV:BYT MSBF'),
+                ('write', ':WAV:FORM WORD'),
+                ('write', ':DIG {}'.format(sources)),
+                ('query', '*OPC?')]
+
+    def preamble_ops(self, channel):
+        return [('write', ':WAV:SOUR CHAN{:d}'.format(channel)),
+                ('query', ':WAV:PRE?')]
+
+    def waveform_ops(self, channel):
+        return [('write', ':WAV:SOUR CHAN{:d}'.format(channel)),
+                ('write', ':WAV:DATA?'),
+                ('read_raw', '')]
+
+    def parse_preamble(self, preamble):
+        return parse_preamble(preamble)
+
+    def decode_trace(self, preamble, data):
+        wave_raw = parse_binary_waveform(data, word_length=2)
+        wave_volts = waveform.scale(
+                wave_raw,
+                preamble['y_incriment'],
+                preamble['y_origin'],
+                preamble['y_reference'],
+                unit='V')
+        time_s = waveform.time_axis(
+                preamble['num_points'],
+                preamble['x_incriment'],
+                preamble['x_origin'],
+                unit='s')
+        return time_s, wave_volts
  
 
 def parse_preamble(preamble):
@@ -143,21 +152,14 @@ def parse_preamble(preamble):
     Returns:
         (dict): Mapping field names to their values.
     """
-    fields = preamble.split(',')
-    num_points = int(fields[2])
-    x_incriment = float(fields[4])
-    x_origin = float(fields[5])
-    x_reference = int(fields[6])
-    y_incriment = float(fields[7])
-    y_origin = float(fields[8])
-    y_reference = int(fields[9])
-    return {'num_points': num_points,
-            'x_incriment': x_incriment,
-            'x_origin': x_origin,
-            'x_reference': x_reference,
-            'y_incriment': y_incriment,
-            'y_origin': y_origin,
-            'y_reference': y_reference}
+    fields = waveform.parse_preamble(preamble)
+    return {'num_points': fields['num_points'],
+            'x_incriment': fields['x_step'],
+            'x_origin': fields['x_origin'],
+            'x_reference': int(fields['x_reference']),
+            'y_incriment': fields['y_step'],
+            'y_origin': fields['y_origin'],
+            'y_reference': int(fields['y_reference'])}
 
 
 def parse_binary_waveform(data, word_length):
@@ -170,19 +172,8 @@ def parse_binary_waveform(data, word_length):
     Returns:
         (ndarray): voltage trace values. The units depend on the scope.
     """
-    format_char = {1: 'B', 2: 'H'}[word_length]
-    if data[0] != '#':
-        raise ValueError("Invalid data. Expected '#' "
-                         "at start, but got {}".format(data[0]))
-    header_len = int(data[1])
-    offset = 2 + header_len
-    wave_len = int(data[2:offset])
-    expected_len = 1 + 1 + header_len + wave_len + 1
-    if len(data) != expected_len:
-        raise ValueError("Data length {} but expected {}".format(
-            expected_len, len(data)))
-    wave_data = data[offset:offset + wave_len]
-    num_words, r = divmod(wave_len, word_length)
-    words = struct.unpack('>' + format_char * num_words, wave_data)
-    return np.array(words)
+    if word_length not in (1, 2):
+        raise ValueError("Unsupported word length {}".format(word_length))
+    dtype = waveform.sample_dtype(word_length, signed=False)
+    return waveform.decode_block(data, dtype)
 
@@ -18,12 +18,15 @@ timeout = 20
 
 from __future__ import absolute_import
 
+import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+import labrad.units as U
 from labrad.gpib import GPIBManagedServer
-from labrad.server import setting
+from labrad.server import Signal, setting
 from oscilloscope.agilent.DSOX4104A import DSOX4104AWrapper
 from oscilloscope.agilent.DSO91304A import DSO91304AWrapper
+from oscilloscope.stream import TraceStream
 
 
 class OscilloscopeServer(GPIBManagedServer):
@@ -37,6 +40,14 @@ class OscilloscopeServer(GPIBManagedServer):
             'KEYSIGHT TECHNOLOGIES DSO90804A': DSO91304AWrapper,
     }
 
+    onStreamProgress = Signal(543210, 'signal: stream progress', 'sww')
+    onStreamDropped = Signal(543211, 'signal: stream dropped', 'sw')
+
+    def expireContext(self, c):
+        if 'stream' in c:
+            c['stream'].stop()
+        GPIBManagedServer.expireContext(self, c)
+
     # SYSTEM
 
     @setting(11, returns='')
@@ -162,6 +173,18 @@ class OscilloscopeServer(GPIBManagedServer):
         """
         return self.selectedDevice(c).horiz_position(position)
 
+    @setting(32, length='i', returns='i')
+    def record_length(self, c, length=None):
+        """Set or query the number of points in a trace.
+
+        Args:
+            length (int): Record length. If None (the default), we just query.
+
+        Returns:
+            (int): The record length.
+        """
+        return self.selectedDevice(c).record_length(length)
+
     # TRIGGER
 
     @setting(71, source='s', returns='s')
@@ -251,6 +274,121 @@ class OscilloscopeServer(GPIBManagedServer):
         """
         return self.selectedDevice(c).get_trace(channel)
 
+    @setting(69, channels='*i', returns='*v[s]*2v[V]')
+    def get_traces(self, c, channels):
+        """Get traces for several channels from a single acquisition.
+
+        The acquisition and the data transfer for all channels are done in
+        one bus transaction. Waveform preambles are cached, so they are only
+        transferred again after the channel's scale or position, or the
+        horizontal settings, change.
+
+        Args:
+            channels (list[int]): The channels for which we want traces.
+
+        Returns:
+            (ValueArray[s]): Time axis.
+            (ValueArray[V]): Voltages, one row per channel.
+        """
+        traces = yield self.selectedDevice(c).get_traces(channels)
+        time = traces[0][0]
+        voltages = np.vstack([trace[1][U.V] for trace in traces])
+        returnValue((time, voltages * U.V))
+
+    # STREAMING
+
+    @setting(80, channels='*i', session='*s', dataset='s', shots='w',
+             rate='v[Hz]', batch='w', returns='*ss')
+    def stream_start(self, c, channels, session, dataset, shots=0, rate=None,
+                     batch=10):
+        """Start streaming traces into a new data vault dataset.
+
+        Shots are acquired as with get_traces and added to the dataset in
+        batches, with columns shot, time [ns], and the voltage [V] of each
+        channel. Progress is sent as a stream progress signal (dataset name,
+        saved, acquired) after each batch, and the number of dropped shots as
+        a stream dropped signal (dataset name, dropped).
+
+        Args:
+            channels (list[int]): The channels to stream.
+            session (list[str]): Data vault directory, created if needed.
+            dataset (str): Name of the new dataset.
+            shots (int): Number of shots to save. 0 (the default) streams
+                until stopped.
+            rate (Value[Hz]): Shot rate. Shots that cannot be taken on time,
+                because the scope or the data vault cannot keep up, are
+                dropped. If None (the default), acquire as fast as possible.
+                A slow data vault then slows acquisition down, and no shots
+                are dropped.
+            batch (int): Shots per data vault request.
+
+        Returns:
+            (list[str], str): Path and name of the dataset.
+        """
+        if 'stream' in c and c['stream'].status()[3]:
+            raise RuntimeError('Already streaming in this context')
+        dev = self.selectedDevice(c)
+        dv = self.client.data_vault
+        ctx = self.client.context()
+        yield dv.cd(session, True, context=ctx)
+        dependents = [('voltage', 'channel {}'.format(ch), 'V')
+                      for ch in channels]
+        path, name = yield dv.new(dataset, [('shot', ''), ('time', 'ns')],
+                                  dependents, context=ctx)
+
+        def progress(saved, acquired):
+            self.onStreamProgress((name, saved, acquired))
+
+        def dropped(count):
+            self.onStreamDropped((name, count))
+
+        stream = TraceStream(lambda: dev.get_traces(channels),
+                             lambda rows: dv.add(rows, context=ctx),
+                             shots=shots, rate=rate['Hz'] if rate else 0,
+                             batch=batch, progress=progress, dropped=dropped)
+        c['stream'] = stream
+        stream.start().addErrback(self._streamFailed, name)
+        returnValue((path, name))
+
+    def _streamFailed(self, failure, name):
+        print 'Streaming to {} failed:'.format(name)
+        failure.printTraceback()
+
+    @setting(81, returns='www b')
+    def stream_status(self, c):
+        """Get the state of the stream in this context.
+
+        Returns:
+            (int, int, int, bool): Shots saved, shots acquired, shots dropped,
+                and whether the stream is still running.
+        """
+        if 'stream' not in c:
+            raise RuntimeError('No stream in this context')
+        return c['stream'].status()
+
+    @setting(82, returns='ww')
+    def stream_stop(self, c):
+        """Stop streaming, once the shots already acquired are saved.
+
+        Returns:
+            (int, int): Shots saved and shots dropped.
+        """
+        if 'stream' not in c:
+            raise RuntimeError('No stream in this context')
+        c['stream'].stop()
+        return c['stream'].wait()
+
+    @setting(83, returns='ww')
+    def stream_wait(self, c):
+        """Wait for the stream to save all its shots.
+
+        Returns:
+            (int, int): Shots saved and shots dropped.
+        """
+        if 'stream' not in c:
+            raise RuntimeError('No stream in this context')
+        return c['stream'].wait()
+
 
 if __name__ == '__main__':
     from labrad import util
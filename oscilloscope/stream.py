@@ -0,0 +1,238 @@
+"""Continuous acquisition of scope traces into a data vault dataset.
+
+A TraceStream runs two loops. The acquisition loop triggers the scope and
+fetches traces, and the writer loop sends acquired traces to the data vault
+in batches. Traces waiting to be written are buffered, up to a limit.
+
+When the buffer is full, the acquisition loop waits for the writer, so a
+slow data vault slows down acquisition rather than using unbounded memory.
+If a rate is given, shots are taken on a fixed schedule instead. A shot that
+comes due while the buffer is full, or while the previous shot is still
+being fetched, is dropped and counted, and acquisition continues with the
+next scheduled shot.
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import inlineCallbacks
+
+
+def shot_rows(shot, time, voltages):
+    """Data vault rows for one shot.
+
+    Args:
+        shot (int): Shot number.
+        time (ValueArray[s]): Time axis.
+        voltages (list[ValueArray[V]]): Trace of each channel.
+
+    Returns:
+        (ndarray): One row per point, with columns shot, time in ns and the
+            voltage of each channel in V.
+    """
+    t = time['ns']
+    columns = [np.full(len(t), shot, dtype=float), t]
+    columns.extend(v['V'] for v in voltages)
+    return np.column_stack(columns)
+
+
+class TraceStream(object):
+    """Acquire traces repeatedly and add them to a data vault dataset.
+
+    Args:
+        get_traces (callable): Returns a deferred list of (time, voltage)
+            traces for one shot, e.g. OscilloscopeWrapper.get_traces bound
+            to the channels to stream.
+        add (callable): Adds a 2D array of rows to the dataset, returning a
+            deferred.
+        shots (int): Number of shots to save. 0 means until stopped.
+        rate (float): Shots per second. If 0, acquire as fast as the scope
+            and data vault allow.
+        batch (int): Most shots to send to the data vault at once.
+        buffered (int): Most shots waiting to be written. Defaults to four
+            batches.
+        progress (callable): Called with (saved, acquired) after each batch
+            is written.
+        dropped (callable): Called with the total number of dropped shots
+            whenever a shot is dropped.
+        clock: Provider of callLater, for the rate schedule.
+    """
+
+    def __init__(self, get_traces, add, shots=0, rate=0, batch=10,
+                 buffered=None, progress=None, dropped=None, clock=reactor):
+        if batch < 1:
+            raise ValueError('batch must be at least 1')
+        self.get_traces = get_traces
+        self.add = add
+        self.shots = shots
+        self.rate = rate
+        self.batch = batch
+        self.buffered = max(buffered or 4 * batch, batch)
+        self.progress = progress
+        self.onDropped = dropped
+        self.clock = clock
+
+        self.acquired = 0
+        self.saved = 0
+        self.dropped = 0
+        self.running = False
+        self._buffer = []
+        self._dataWaiter = None
+        self._spaceWaiter = None
+        self._acquiring = False
+        self._started = False
+        self._result = None
+        self._waiters = []
+
+    def start(self):
+        """Start streaming.
+
+        Returns:
+            A deferred like that of wait.
+        """
+        if self._started:
+            raise RuntimeError('Stream already started')
+        self._started = True
+        self.running = True
+        self._acquiring = True
+        writing = self._writeLoop()
+        acquiring = self._acquireLoop()
+        done = defer.DeferredList([acquiring, writing], fireOnOneErrback=True,
+                                  consumeErrors=True)
+        done.addCallbacks(self._finished, self._failed)
+        return self.wait()
+
+    def wait(self):
+        """Wait for streaming to end.
+
+        Streaming ends when all shots are saved, after stop, or on an error.
+        Shots acquired before streaming ends are written first, unless
+        writing failed.
+
+        Returns:
+            A deferred that fires with (saved, dropped).
+        """
+        d = defer.Deferred()
+        if self._result is None:
+            self._waiters.append(d)
+        else:
+            d.callback(self._result)
+        return d
+
+    def stop(self):
+        """Stop acquiring. Buffered shots are still written."""
+        self.running = False
+        self._wake('_spaceWaiter')
+        self._wake('_dataWaiter')
+
+    def status(self):
+        """(saved, acquired, dropped, whether streaming is still going)"""
+        active = self._started and self._result is None
+        return self.saved, self.acquired, self.dropped, active
+
+    def _finished(self, _):
+        self._end((self.saved, self.dropped))
+
+    def _failed(self, failure):
+        # unwrap the FirstError from the DeferredList
+        self.running = False
+        self._end(failure.value.subFailure)
+
+    def _end(self, result):
+        self._result = result
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(result)
+
+    def _wake(self, name):
+        d = getattr(self, name)
+        if d is not None:
+            setattr(self, name, None)
+            d.callback(None)
+
+    def _wait(self, name):
+        d = defer.Deferred()
+        setattr(self, name, d)
+        return d
+
+    def _wanted(self):
+        """Whether another shot should be acquired."""
+        return self.running and (not self.shots or
+                                 self.acquired < self.shots)
+
+    def _drop(self, count=1):
+        self.dropped += count
+        if self.onDropped is not None:
+            self.onDropped(self.dropped)
+
+    @inlineCallbacks
+    def _acquireLoop(self):
+        try:
+            if self.rate:
+                yield self._acquireScheduled()
+            else:
+                yield self._acquireFreeRunning()
+        except Exception:
+            self.running = False
+            raise
+        finally:
+            self._acquiring = False
+            self._wake('_dataWaiter')
+
+    @inlineCallbacks
+    def _acquireFreeRunning(self):
+        while self._wanted():
+            if len(self._buffer) >= self.buffered:
+                yield self._wait('_spaceWaiter')
+                continue
+            yield self._acquire()
+
+    @inlineCallbacks
+    def _acquireScheduled(self):
+        period = 1.0 / self.rate
+        due = self.clock.seconds()
+        while self._wanted():
+            now = self.clock.seconds()
+            if now < due:
+                yield task.deferLater(self.clock, due - now, lambda: None)
+                continue
+            # shots that came due while we were busy
+            missed = int((now - due) / period)
+            if missed:
+                self._drop(missed)
+            due += (missed + 1) * period
+            if len(self._buffer) >= self.buffered:
+                self._drop()
+            else:
+                yield self._acquire()
+
+    @inlineCallbacks
+    def _acquire(self):
+        traces = yield self.get_traces()
+        time = traces[0][0]
+        self._buffer.append(shot_rows(self.acquired, time,
+                                      [v for _, v in traces]))
+        self.acquired += 1
+        if len(self._buffer) >= self.batch:
+            self._wake('_dataWaiter')
+
+    @inlineCallbacks
+    def _writeLoop(self):
+        try:
+            while True:
+                if len(self._buffer) < self.batch and self._acquiring:
+                    yield self._wait('_dataWaiter')
+                    continue
+                if not self._buffer:
+                    break
+                shots = self._buffer[:self.batch]
+                yield self.add(np.vstack(shots))
+                del self._buffer[:len(shots)]
+                self.saved += len(shots)
+                self._wake('_spaceWaiter')
+                if self.progress is not None:
+                    self.progress(self.saved, self.acquired)
+        except Exception:
+            self.stop()
+            raise
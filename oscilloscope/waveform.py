@@ -0,0 +1,203 @@
+"""Decoding of waveform data returned by oscilloscopes.
+
+Scopes send curve data as IEEE 488.2 binary blocks: '#', one digit giving the
+number of length digits, the length in bytes, then the data itself, e.g.
+'#41000<1000 bytes>'. The samples are integers (or floats) that are scaled to
+physical units with parameters from the waveform preamble,
+
+    value = (sample - y_reference) * y_step + y_origin
+    time = (index - x_reference) * x_step + x_origin
+
+The functions here do all of that with numpy, so that a record of millions of
+points is decoded without building a Python object per sample.
+"""
+
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+
+import labrad.units as U
+
+
+# Fields of the :WAV:PRE? preamble common to Agilent/Keysight scopes.
+AGILENT_PREAMBLE_KEYS = [
+        ('format', int),
+        ('type', int),
+        ('num_points', int),
+        ('count', int),
+        ('x_step', float),
+        ('x_origin', float),
+        ('x_reference', float),
+        ('y_step', float),
+        ('y_origin', float),
+        ('y_reference', float),
+]
+
+
+def sample_dtype(word_length, signed=True, msb_first=True, floating=False):
+    """Numpy dtype of binary waveform samples.
+
+    Args:
+        word_length (int): Number of bytes per sample.
+        signed (bool): Whether integer samples are signed.
+        msb_first (bool): Byte order, True for big endian.
+        floating (bool): Whether samples are IEEE floating point numbers.
+
+    Returns:
+        (numpy.dtype): dtype of the samples.
+    """
+    if floating:
+        kind = 'f'
+    else:
+        kind = 'i' if signed else 'u'
+    return np.dtype('{}{}{}'.format('>' if msb_first else '<', kind,
+                                    word_length))
+
+
+def block_range(data, offset=0):
+    """Locate the data of an IEEE 488.2 binary block.
+
+    Args:
+        data (str): Response containing the block.
+        offset (int): Position of the '#' starting the block.
+
+    Returns:
+        (int, int): start and stop index of the block data in data. For an
+            indefinite length block ('#0'), the data runs to the end of the
+            response, less a trailing newline.
+    """
+    if data[offset:offset + 1] != '#':
+        raise ValueError("Invalid block. Expected '#' at start, but got "
+                         "{!r}".format(data[offset:offset + 1]))
+    num_digits = data[offset + 1:offset + 2]
+    if not num_digits.isdigit():
+        raise ValueError("Invalid block header {!r}".format(
+            data[offset:offset + 2]))
+    num_digits = int(num_digits)
+    start = offset + 2 + num_digits
+    if num_digits == 0:
+        stop = len(data)
+        if data.endswith('\n'):
+            stop -= 1
+        return start, stop
+    length = data[offset + 2:start]
+    if len(length) < num_digits or not length.isdigit():
+        raise ValueError("Invalid block header {!r}".format(data[offset:start]))
+    stop = start + int(length)
+    if stop > len(data):
+        raise ValueError("Block has {} bytes, but header says {}".format(
+            len(data) - start, int(length)))
+    return start, stop
+
+
+def decode_samples(data, dtype, start=0, stop=None):
+    """Decode binary samples into an array.
+
+    Args:
+        data (str): Raw binary data.
+        dtype: numpy dtype of the samples, see sample_dtype.
+        start (int): Index of the first byte to decode.
+        stop (int): Index after the last byte to decode. Defaults to the end
+            of data. Trailing bytes that do not make up a whole sample are
+            ignored.
+
+    Returns:
+        (ndarray): The samples. The array shares memory with data, so it is
+            read-only.
+    """
+    dtype = np.dtype(dtype)
+    if stop is None:
+        stop = len(data)
+    count = (stop - start) // dtype.itemsize
+    return np.frombuffer(data, dtype=dtype, count=count, offset=start)
+
+
+def decode_block(data, dtype, offset=0):
+    """Decode the samples in an IEEE 488.2 binary block.
+
+    Args:
+        data (str): Response containing the block.
+        dtype: numpy dtype of the samples, see sample_dtype.
+        offset (int): Position of the '#' starting the block.
+
+    Returns:
+        (ndarray): The samples.
+    """
+    start, stop = block_range(data, offset)
+    return decode_samples(data, dtype, start, stop)
+
+
+def scale(samples, y_step, y_origin=0.0, y_reference=0.0, unit=None):
+    """Convert raw samples to physical values.
+
+    Args:
+        samples (ndarray): Raw samples.
+        y_step: Value of one sample step.
+        y_origin: Value at the reference sample.
+        y_reference: Sample value corresponding to y_origin.
+        unit (str or Unit): Unit of y_step and y_origin. If given, return
+            a ValueArray in this unit.
+
+    Returns:
+        (ndarray or ValueArray): (samples - y_reference) * y_step + y_origin
+    """
+    values = np.asarray(samples, dtype=float)
+    if y_reference:
+        values = values - y_reference
+    values = values * y_step
+    if y_origin:
+        values += y_origin
+    if unit is not None:
+        return U.ValueArray(values, unit)
+    return values
+
+
+def time_axis(num_points, x_step, x_origin=0.0, x_reference=0.0, unit=None):
+    """Times of the points of a record.
+
+    Args:
+        num_points (int): Number of points.
+        x_step: Time between points.
+        x_origin: Time of the reference point.
+        x_reference: Index of the reference point.
+        unit (str or Unit): Unit of x_step and x_origin. If given, return
+            a ValueArray in this unit.
+
+    Returns:
+        (ndarray or ValueArray): (index - x_reference) * x_step + x_origin
+    """
+    return scale(np.arange(num_points), x_step, x_origin, x_reference, unit)
+
+
+def parse_preamble(preamble, keys=AGILENT_PREAMBLE_KEYS, separator=','):
+    """Parse a waveform preamble.
+
+    Args:
+        preamble (str): The preamble as sent by the scope.
+        keys (list): (name, parser) for each field, in the order the scope
+            sends them. Extra fields are ignored.
+        separator (str): Separator between fields.
+
+    Returns:
+        (dict): Mapping field names to their parsed values.
+    """
+    fields = preamble.strip().split(separator)
+    return dict((key, parser(val.strip()))
+                for (key, parser), val in zip(keys, fields))
+
+
+_PER_DIV_NUMBER = re.compile(r'.*?([\d\.]+).*')
+_PER_DIV_UNIT = re.compile(r'.*?([a-zA-z]+)/.*')
+
+
+def parse_per_div(string):
+    """Parse a scale like '100.0mV/div' from a Tektronix waveform ID.
+
+    Returns:
+        (float, str): The number and unit, e.g. (100.0, 'mV').
+    """
+    number = _PER_DIV_NUMBER.sub(r'\1', string)
+    unit = _PER_DIV_UNIT.sub(r'\1', string)
+    return float(number), unit
@@ -4,7 +4,7 @@ import numpy
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad import types as T
-from labrad.gpib import GPIBDeviceWrapper
+from gpib_transaction import GPIBTransactionWrapper
 
 
 def filter_function(*allowed):
@@ -15,28 +15,72 @@ def filter_function(*allowed):
     return func
 
 
-def channel_method(input_parser, write, query, output_parser):
+def channel_method(input_parser, write, query, output_parser,
+                   invalidates=False):
+    """Make a method getting or setting a channel parameter.
+
+    If invalidates is True, setting the parameter invalidates the cached
+    waveform preamble of the channel.
+    """
     @inlineCallbacks
     def func(self, channel, arg=None):
         if arg is not None:
             yield self.write(write(channel, input_parser(arg)))
+            if invalidates:
+                self.invalidate_preamble(channel)
         resp = yield self.query(query(channel))
         returnValue(output_parser(resp))
     return func
 
 
-def global_method(input_parser, write, query, output_parser):
+def global_method(input_parser, write, query, output_parser,
+                  invalidates=False):
+    """Make a method getting or setting a global parameter.
+
+    If invalidates is True, setting the parameter invalidates the cached
+    waveform preambles of all channels.
+    """
     @inlineCallbacks
     def func(self, arg=None):
         if arg is not None:
             yield self.write(write(input_parser(arg)))
+            if invalidates:
+                self.invalidate_preamble()
         resp = yield self.query(query())
         returnValue(output_parser(resp))
     return func
 
 
-class OscilloscopeWrapper(GPIBDeviceWrapper):
-    """Base class for oscilloscope wrappers"""
+class OscilloscopeWrapper(GPIBTransactionWrapper):
+    """Base class for oscilloscope wrappers
+
+    Traces are fetched with get_traces, which uses a few methods that
+    subclasses implement: acquire_ops, preamble_ops, waveform_ops,
+    parse_preamble and decode_trace. Parsed waveform preambles are cached
+    per channel. Methods which change a channel's vertical scale or
+    position, or the horizontal scale, position or record length, must call
+    invalidate_preamble.
+    """
+
+    # Incremented whenever cached preambles are invalidated.
+    _preamble_generation = 0
+
+    @property
+    def preambles(self):
+        """Cached waveform preambles, by channel."""
+        try:
+            return self._preambles
+        except AttributeError:
+            self._preambles = {}
+            return self._preambles
+
+    def invalidate_preamble(self, channel=None):
+        """Forget the cached preamble of a channel, or of all channels."""
+        self._preamble_generation += 1
+        if channel is None:
+            self.preambles.clear()
+        else:
+            self.preambles.pop(channel, None)
 
     @inlineCallbacks
     def reset(self):
@@ -165,6 +209,19 @@ class OscilloscopeWrapper(GPIBDeviceWrapper):
         """
         raise NotImplementedError()
 
+    @inlineCallbacks
+    def record_length(self, length=None):
+        """Get or set the number of points in a trace.
+
+        Args:
+            length (int): The record length. If None (the default) we just
+                query.
+
+        Returns:
+            (int): The record length.
+        """
+        raise NotImplementedError()
+
     # TRIGGER
 
     @inlineCallbacks
@@ -207,5 +264,94 @@ class OscilloscopeWrapper(GPIBDeviceWrapper):
     # ACQUISITION
 
     def get_trace(self, channel):
+        """Get a trace.
+
+        Args:
+            channel (int): Which channel to get.
+
+        Returns:
+            (ValueArray[s]): Time axis.
+            (ValueArray[V]): Voltage axis.
+        """
+        d = self.get_traces([channel])
+        d.addCallback(lambda traces: traces[0])
+        return d
+
+    @inlineCallbacks
+    def get_traces(self, channels):
+        """Acquire once and get the traces of several channels.
+
+        The acquisition, any preambles missing from the cache and the
+        waveform data of all channels are done in one bus transaction.
+
+        Cached preambles are only invalidated by this server's own setters.
+        After a change of scale or offset on the front panel, or by another
+        client, traces are scaled wrongly until a setter is called here.
+
+        Args:
+            channels (list[int]): Which channels to get.
+
+        Returns:
+            (list): (time axis, voltages) for each channel.
+        """
+        if not channels:
+            raise ValueError('No channels requested')
+        generation = self._preamble_generation
+        preambles = dict(self.preambles)
+        ops = list(self.acquire_ops(channels))
+        preamble_index = {}
+        for channel in channels:
+            if channel not in preambles and channel not in preamble_index:
+                ops.extend(self.preamble_ops(channel))
+                preamble_index[channel] = len(ops) - 1
+        data_index = []
+        for channel in channels:
+            ops.extend(self.waveform_ops(channel))
+            data_index.append(len(ops) - 1)
+        resp = yield self.transaction(ops)
+        for channel, i in preamble_index.items():
+            preambles[channel] = self.parse_preamble(resp[i])
+            if generation == self._preamble_generation:
+                self.preambles[channel] = preambles[channel]
+        returnValue([self.decode_trace(preambles[channel], resp[i])
+                     for channel, i in zip(channels, data_index)])
+
+    def acquire_ops(self, channels):
+        """Transaction operations making one acquisition of the channels.
+
+        These must also set up the waveform format, as they are done before
+        preambles are queried.
+        """
+        raise NotImplementedError()
+
+    def preamble_ops(self, channel):
+        """Transaction operations getting a channel's preamble.
+
+        The response to the last operation is the preamble.
+        """
+        raise NotImplementedError()
+
+    def waveform_ops(self, channel):
+        """Transaction operations getting a channel's waveform data.
+
+        The response to the last operation is the data.
+        """
+        raise NotImplementedError()
+
+    def parse_preamble(self, preamble):
+        """Parse a preamble returned by preamble_ops."""
+        raise NotImplementedError()
+
+    def decode_trace(self, preamble, data):
+        """Convert waveform data to a trace.
+
+        Args:
+            preamble: Parsed preamble for the channel.
+            data (str): Data returned by waveform_ops.
+
+        Returns:
+            (ValueArray[s]): Time axis.
+            (ValueArray[V]): Voltage axis.
+        """
         raise NotImplementedError()
 
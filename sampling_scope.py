@@ -30,7 +30,6 @@ timeout = 5
 ### END NODE INFO
 """
 
-import struct
 import re
 
 import numpy as np
@@ -40,6 +39,8 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from oscilloscope import waveform
+
 __QUERY__ = 'ENC WAV:BIN;BYT. LSB;OUT TRA%d;WAV?'
 
 class NotConnectedError(errors.Error):
@@ -322,14 +323,14 @@ _ymult = re.compile('YMULT:(-?\d*.?\d+E?-?\+?\d*),')
 def _parseBinaryData(data):
     """Parse the data coming back from the scope"""
     hdr, dat = data.split(';CURVE')
-    dat = dat[dat.find('%')+3:-1]
-    dat = np.array(struct.unpack('h'*(len(dat)/2), dat))
+    # '%', two byte count, little endian samples and a checksum byte
+    dat = waveform.decode_samples(dat, '<i2', dat.find('%')+3, len(dat)-1)
     xzero = float(_xzero.findall(hdr)[0])
     xincr = float(_xincr.findall(hdr)[0])
     yzero = float(_yzero.findall(hdr)[0])
     ymult = float(_ymult.findall(hdr)[0])
 
-    return xzero, xincr, dat*ymult + yzero
+    return xzero, xincr, waveform.scale(dat, ymult, yzero)
 
 
 __server__ = SamplingScope()
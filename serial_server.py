@@ -36,15 +36,15 @@ timeout = 20
 import collections
 import os
 import os.path
+import re
 import sys
-import time
-from time import sleep
+import threading
 
 from labrad import types as T
 from labrad.errors import Error
 from labrad.server import LabradServer, setting
-from twisted.internet import reactor, threads
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import defer, reactor
+from twisted.internet.defer import returnValue
 from twisted.internet.task import deferLater
 from serial import Serial
 from serial.serialutil import SerialException
@@ -63,6 +63,250 @@ class NoPortsAvailableError(Error):
 
 SerialDevice = collections.namedtuple('SerialDevice', ['name', 'devicepath'])
 
+# Most bytes moved from a port into its receive buffer at once.
+READ_CHUNK = 4096
+# Serial read timeout used by reader threads, which bounds how long closing
+# a port waits for its thread.
+THREAD_READ_TIMEOUT = 0.1
+
+
+def countReader(count):
+    """Read request for count bytes, or whatever arrived at the timeout.
+
+    With count=None the request takes everything in the buffer.
+    """
+    def extract(buf, final):
+        if count is None:
+            return buf, len(buf)
+        if len(buf) >= count or final:
+            return buf[:count], min(count, len(buf))
+    return extract
+
+
+def lineReader(delim, skip=''):
+    """Read request for data up to but not including delim.
+
+    Characters in skip are dropped. At the timeout, we return whatever
+    arrived without a delimiter.
+    """
+    def extract(buf, final):
+        idx = buf.find(delim)
+        if idx >= 0:
+            return _strip(buf[:idx], skip), idx + len(delim)
+        if final:
+            return _strip(buf, skip), len(buf)
+    return extract
+
+
+def linesReader(count, end, delim, skip=''):
+    """Read request for count lines, or lines up to a line equal to end.
+
+    A count of 0 means no limit on the number of lines, and an empty end
+    means no terminating line. The terminating line is consumed but not
+    returned. At the timeout, we return the lines received so far,
+    including a final partial line.
+    """
+    def extract(buf, final):
+        lines = []
+        pos = 0
+        while not count or len(lines) < count:
+            idx = buf.find(delim, pos)
+            if idx < 0:
+                break
+            line = _strip(buf[pos:idx], skip)
+            pos = idx + len(delim)
+            if end and line == end:
+                return lines, pos
+            lines.append(line)
+        else:
+            return lines, pos
+        if final:
+            rest = _strip(buf[pos:], skip)
+            if rest:
+                lines.append(rest)
+            return lines, len(buf)
+    return extract
+
+
+def untilReader(delim):
+    """Read request for data up to and including delim."""
+    def extract(buf, final):
+        idx = buf.find(delim)
+        if idx >= 0:
+            return buf[:idx + len(delim)], idx + len(delim)
+        if final:
+            return buf, len(buf)
+    return extract
+
+
+def regexReader(pattern):
+    """Read request for data up to and including a match of pattern."""
+    regex = re.compile(pattern)
+
+    def extract(buf, final):
+        match = regex.search(buf)
+        if match is not None:
+            return buf[:match.end()], match.end()
+        if final:
+            return buf, len(buf)
+    return extract
+
+
+def _strip(data, skip):
+    for char in skip:
+        data = data.replace(char, '')
+    return data
+
+
+class PortReader(object):
+    """Buffers data arriving on a serial port and serves read requests.
+
+    On POSIX the port's file descriptor is watched by the reactor. Elsewhere,
+    e.g. on windows, a thread per port blocks on reads and hands data to the
+    reactor. Either way data is moved into our receive buffer as soon as it
+    arrives, and pending read requests are answered as soon as they can be.
+
+    A read request is an extract function, see countReader and lineReader,
+    called as extract(buf, final) with the receive buffer. It returns
+    (result, number of bytes consumed), or None if it needs more data.
+    final is True when the request's timeout expires, in which case it must
+    return something. Requests are answered in order.
+    """
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.buffer = ''
+        self.requests = collections.deque()
+        self.error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        if hasattr(self.ser, 'fileno') and not sys.platform.startswith('win'):
+            reactor.addReader(self)
+        else:
+            self.ser.timeout = THREAD_READ_TIMEOUT
+            self.thread = threading.Thread(target=self._readLoop,
+                                           name='serial reader')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.thread is None:
+            reactor.removeReader(self)
+        else:
+            if hasattr(self.ser, 'cancel_read'):
+                self.ser.cancel_read()
+            self.thread.join(2 * THREAD_READ_TIMEOUT)
+            self.ser.timeout = 0
+        self._failAll(Error(msg='Port closed'))
+
+    # reactor interface (POSIX)
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    def logPrefix(self):
+        return 'PortReader'
+
+    def doRead(self):
+        try:
+            data = self.ser.read(READ_CHUNK)
+        except Exception as e:
+            self.readFailed(e)
+        else:
+            self.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.readFailed(reason.value)
+
+    def _readLoop(self):
+        while self.running:
+            try:
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+            except Exception as e:
+                if self.running:
+                    reactor.callFromThread(self.readFailed, e)
+                return
+            if data:
+                reactor.callFromThread(self.dataReceived, data)
+
+    # buffering
+
+    def dataReceived(self, data):
+        self.buffer += data
+        self._serve()
+
+    def readFailed(self, error):
+        print 'Error reading serial port: {}'.format(error)
+        self.error = error
+        if self.running and self.thread is None:
+            reactor.removeReader(self)
+        self.running = False
+        self._failAll(Error(msg='Serial port read failed: {}'.format(error)))
+
+    def _failAll(self, error):
+        requests, self.requests = self.requests, collections.deque()
+        for extract, d, call in requests:
+            if call.active():
+                call.cancel()
+            d.errback(error)
+
+    def read(self, extract, timeout):
+        """Get a deferred answer to a read request.
+
+        With a timeout of 0 the request is answered right away with whatever
+        data has already arrived.
+        """
+        if self.error is not None:
+            return defer.fail(Error(msg='Serial port read failed: {}'
+                                    .format(self.error)))
+        if self.running and self.thread is None:
+            # pick up anything the reactor has not told us about yet
+            self.doRead()
+        if not self.requests:
+            ans = self._extract(extract, timeout <= 0)
+            if ans is not None:
+                return defer.succeed(ans)
+        d = defer.Deferred()
+        req = [extract, d, None]
+        req[2] = reactor.callLater(timeout, self._expire, req)
+        self.requests.append(req)
+        return d
+
+    def _extract(self, extract, final):
+        ans = extract(self.buffer, final)
+        if ans is None:
+            return None
+        result, consumed = ans
+        self.buffer = self.buffer[consumed:]
+        return result
+
+    def _serve(self):
+        while self.requests:
+            extract, d, call = self.requests[0]
+            ans = self._extract(extract, False)
+            if ans is None:
+                return
+            self.requests.popleft()
+            call.cancel()
+            d.callback(ans)
+
+    def _expire(self, req):
+        extract, d, call = req
+        if self.requests[0] is not req:
+            # an earlier request is still waiting, so this one gets nothing
+            self.requests.remove(req)
+            d.callback(extract('', True)[0])
+            return
+        self.requests.popleft()
+        d.callback(self._extract(extract, True))
+        self._serve()
+
 
 class SerialServer(LabradServer):
     """Provides access to a computer's serial (COM) ports."""
@@ -124,8 +368,7 @@ class SerialServer(LabradServer):
                 self.SerialPorts.append(SerialDevice(dev_name, dev_path))
 
     def expireContext(self, c):
-        if 'PortObject' in c:
-            c['PortObject'].close()
+        self._closePort(c)
 
     def getPort(self, c):
         try:
@@ -133,6 +376,26 @@ class SerialServer(LabradServer):
         except:
             raise NoPortSelectedError()
 
+    def getReader(self, c):
+        try:
+            return c['Reader']
+        except KeyError:
+            raise NoPortSelectedError()
+
+    def _openPort(self, c, devicepath):
+        ser = Serial(devicepath, timeout=0)
+        c['PortObject'] = ser
+        c['Reader'] = PortReader(ser)
+        c['Reader'].start()
+
+    def _closePort(self, c):
+        if 'Reader' in c:
+            c['Reader'].stop()
+            del c['Reader']
+        if 'PortObject' in c:
+            c['PortObject'].close()
+            del c['PortObject']
+
     @setting(1, 'List Serial Ports',
              returns=['*s: List of serial ports'])
     def list_serial_ports(self, c):
@@ -163,14 +426,11 @@ class SerialServer(LabradServer):
         on Linux.  For compatibility, always use the same case.
         """
         c['Timeout'] = 0
-        if 'PortObject' in c:
-            c['PortObject'].close()
-            del c['PortObject']
+        self._closePort(c)
         if not port:
             for i in range(len(self.SerialPorts)):
                 try:
-                    c['PortObject'] = Serial(self.SerialPorts[i].devicepath,
-                                             timeout=0)
+                    self._openPort(c, self.SerialPorts[i].devicepath)
                     break
                 except SerialException:
                     pass
@@ -180,7 +440,7 @@ class SerialServer(LabradServer):
             for x in self.SerialPorts:
                 if os.path.normcase(x.name) == os.path.normcase(port):
                     try:
-                        c['PortObject'] = Serial(x.devicepath, timeout=0)
+                        self._openPort(c, x.devicepath)
                         return x.name
                     except SerialException, e:
                         if e.message.find('cannot find') >= 0:
@@ -192,9 +452,7 @@ class SerialServer(LabradServer):
     @setting(11, 'Close', returns=[''])
     def close(self, c):
         """Closes the current serial port."""
-        if 'PortObject' in c:
-            c['PortObject'].close()
-            del c['PortObject']
+        self._closePort(c)
 
     @setting(20, 'Baudrate',
              data=[': List baudrates',
@@ -308,72 +566,11 @@ class SerialServer(LabradServer):
         _ = yield deferLater(reactor, duration['s'], lambda: None)
         return
 
-    @inlineCallbacks
-    def _deferredRead(self, ser, timeout, count=1):
-        stop_time = time.time() + timeout
-
-        def doRead(count):
-            while True:
-                d = ser.read(count)
-                if d:
-                    return d
-                sleep(0.01)
-                if time.time() > stop_time:
-                    return ''
-
-        data = yield threads.deferToThread(doRead, count)
-        returnValue(data)
-
-    @inlineCallbacks
-    def deferredRead(self, ser, timeout, count=1):
-        killit = False
-
-        def doRead(count):
-            d = ''
-            while not killit:
-                d = ser.read(count)
-                if d:
-                    break
-                sleep(0.010)
-            return d
-
-        data = threads.deferToThread(doRead, count)
-        timeout_object = []
-        start_time = time.time()
-        r = yield util.maybeTimeout(data, min(timeout, 300), timeout_object)
-        killit = True
-
-        if r == timeout_object:
-            elapsed = time.time() - start_time
-            print "deferredRead timed out after {} seconds".format(elapsed)
-            r = ''
-        if r == '':
-            r = ser.read(count)
-
-        returnValue(r)
-
-    @inlineCallbacks
     def readSome(self, c, count=0):
-        ser = self.getPort(c)
-
+        reader = self.getReader(c)
         if count == 0:
-            returnValue(ser.read(10000))
-
-        timeout = c['Timeout']
-        if timeout == 0:
-            returnValue(ser.read(count))
-
-        recd = ''
-        while len(recd) < count:
-            r = ser.read(count - len(recd))
-            if r == '':
-                r = yield self.deferredRead(ser, timeout, count - len(recd))
-                if r == '':
-                    ser.close()
-                    ser.open()
-                    break
-            recd += r
-        returnValue(recd)
+            return reader.read(countReader(None), 0)
+        return reader.read(countReader(count), c['Timeout'])
 
     @setting(50, 'Read', count=[': Read all bytes in buffer',
                                 'w: Read this many bytes'],
@@ -405,25 +602,82 @@ class SerialServer(LabradServer):
     def read_line(self, c, data=''):
         """Read data from the port, up to but not including the specified
         delimiter."""
-        ser = self.getPort(c)
-        timeout = c['Timeout']
+        return self.getReader(c).read(lineReader(*_lineDelimiter(data)),
+                                      c['Timeout'])
+
+    @setting(53, 'Read Lines',
+             count='w: Number of lines to read (0: no limit)',
+             end='s: Line that ends the reply (empty: none)',
+             delimiter='s: Line delimiter (empty: LF, ignoring CRs)',
+             returns=['*s: Received lines'])
+    def read_lines(self, c, count=0, end='', delimiter=''):
+        """Read several lines from the port in one request.
+
+        Reads count lines, or lines up to one equal to end, whichever comes
+        first. The end line itself is not returned. If the timeout expires,
+        returns the lines received so far.
+        """
+        if not count and not end:
+            raise Error(msg='Specify a line count or an end line')
+        delim, skip = _lineDelimiter(delimiter)
+        return self.getReader(c).read(linesReader(count, end, delim, skip),
+                                      c['Timeout'])
+
+    @setting(54, 'Read Until',
+             delimiter='s: Delimiter or regular expression ending the reply',
+             regex='b: Treat delimiter as a regular expression',
+             returns=['s: Received data'])
+    def read_until(self, c, delimiter, regex=False):
+        """Read data from the port, up to and including the delimiter.
 
-        if data:
-            delim, skip = data, ''
+        The delimiter can be several characters long, or a regular
+        expression if regex is True. If the timeout expires, returns the
+        data received so far.
+        """
+        if regex:
+            try:
+                extract = regexReader(delimiter)
+            except re.error as e:
+                raise Error(msg='Bad regular expression: {}'.format(e))
         else:
-            delim, skip = '\n', '\r'
-
-        recd = ''
-        while True:
-            r = ser.read(1)
-            if r == '' and timeout > 0:
-                # only try a deferred read if there is a timeout
-                r = yield self.deferredRead(ser, timeout)
-            if r in ('', delim):
-                break
-            if r != skip:
-                recd += r
-        returnValue(recd)
+            if not delimiter:
+                raise Error(msg='Delimiter must not be empty')
+            extract = untilReader(delimiter)
+        return self.getReader(c).read(extract, c['Timeout'])
+
+    @setting(55, 'Query',
+             data='s: Data to send',
+             reply=['w: Read this many bytes',
+                    's: Read up to and including this delimiter'],
+             returns=['s: Received data'])
+    def query(self, c, data, reply=None):
+        """Send data and read the reply in one request.
+
+        By default the reply is a line ending with LF, ignoring CRs. Data is
+        sent as is, so include any line ending the device expects.
+        Data already waiting in the receive buffer is part of the reply, so
+        read or discard stale data first.
+        """
+        ser = self.getPort(c)
+        reader = self.getReader(c)
+        if reply is None:
+            extract = lineReader('\n', '\r')
+        elif isinstance(reply, str):
+            if not reply:
+                raise Error(msg='Delimiter must not be empty')
+            extract = untilReader(reply)
+        else:
+            extract = countReader(reply)
+        ser.write(data)
+        return reader.read(extract, c['Timeout'])
+
+
+def _lineDelimiter(delim):
+    """Line delimiter and characters to skip for line reading settings."""
+    if delim:
+        return delim, ''
+    return '\n', '\r'
+
 
 __server__ = SerialServer()
 
@@ -39,9 +39,9 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad.types import Value
-from struct import unpack
+from oscilloscope import waveform
 
-import numpy, re
+import numpy
 
 BANDWIDTHS = ['TWE', 'ONE', 'FUL']
 COUPLINGS = ['AC', 'DC', 'GND']
@@ -125,6 +125,19 @@ class Tektronix5104BWrapper(GPIBDeviceWrapper):
             yield self.write('MATH%d:DEF %s' %(slot, expression))
         resp = yield self.query('MATH%d:DEF?' %slot)
         returnValue(resp)
+
+    @inlineCallbacks
+    def queryBinary(self, query):
+        """Send a query and read the response as raw bytes.
+
+        Responses to query have whitespace stripped, which may be part of
+        the curve data.
+        """
+        p = self._packet()
+        p.write(query)
+        p.read_raw()
+        resp = yield p.send()
+        returnValue(resp.read_raw)
             
 class Tektronix5104BServer(GPIBManagedServer):
     name = 'TEKTRONIX 5104B OSCILLOSCOPE'
@@ -486,7 +499,7 @@ class Tektronix5104BServer(GPIBManagedServer):
         voltsPerDiv = yield dev.query('CH%d:SCA?' %channel)
         secPerDiv = yield dev.query('HOR:SCA?')        
         #Transfer waveform data
-        binary = yield dev.query('CURV?')
+        binary = yield dev.queryBinary('CURV?')
         #Parse waveform preamble
         #voltsPerDiv, secPerDiv, voltUnits, timeUnits = _parsePreamble(preamble)
         #voltUnits = 1000*m
@@ -499,7 +512,10 @@ class Tektronix5104BServer(GPIBManagedServer):
         #Parse binary
         trace = _parseBinaryData(binary,wordLength = wordLength)
         #Convert from binary to volts
-        traceVolts = (trace * (1/32768.0) * VERT_DIVISIONS/2 * float(voltsPerDiv) - float(position) * float(voltsPerDiv) ) * voltUnitScaler
+        voltsPerDiv = float(voltsPerDiv)
+        traceVolts = waveform.scale(trace,
+                                    (1/32768.0) * VERT_DIVISIONS/2 * voltsPerDiv * voltUnitScaler,
+                                    -float(position) * voltsPerDiv * voltUnitScaler)
         time = numpy.linspace(0, HORZ_DIVISIONS * float(secPerDiv) * timeUnitScaler,len(traceVolts))#recordLength)
 
         returnValue((time, traceVolts))
@@ -508,30 +524,14 @@ def _parsePreamble(preamble):
     ###TODO: parse the rest of the preamble and return the results as a useful dictionary
     preamble = preamble.split(';')
     vertInfo = preamble[5].split(',')
-    
-    def parseString(string):
-        number = re.sub(r'.*?([\d\.]+).*', r'\1', string)
-        units = re.sub(r'.*?([a-zA-z]+)/.*', r'\1', string)
-        return float(number), units
-    
-    voltsPerDiv, voltUnits = parseString(vertInfo[2])
-    secPerDiv, timeUnits = parseString(vertInfo[3])
+    voltsPerDiv, voltUnits = waveform.parse_per_div(vertInfo[2])
+    secPerDiv, timeUnits = waveform.parse_per_div(vertInfo[3])
     return (voltsPerDiv, secPerDiv, voltUnits, timeUnits)
 
 def _parseBinaryData(data, wordLength):
     """Parse binary data packed as string of RIBinary
     """
-    formatChars = {'1':'b','2':'h'}
-    formatChar = formatChars[str(wordLength)]
-
-    #Get rid of header crap
-    dat = data[(int(data[1])+2):]
-    #unpack binary data
-    if wordLength == 1:
-        dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 2:
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))
-    return dat
+    return waveform.decode_block(data, waveform.sample_dtype(wordLength))
 
 __server__ = Tektronix5104BServer()
 
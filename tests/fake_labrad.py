@@ -0,0 +1,237 @@
+"""LabRAD servers in memory, for testing clients without a manager.
+
+A FakeServer answers packets like an asynchronous pylabrad server wrapper.
+A setting is the method of the fake named 'setting_' and the setting name,
+called with the context of the packet, and responses are indexed by key or
+setting name. Each server counts the packets and records it is sent, and
+FakeRegistry also counts the items it moves (keys listed, and elements of
+lists got or set), so that tests can check what a client costs.
+"""
+
+from twisted.internet import defer
+
+from labrad.protocol import MessageContext
+
+MISSING = object()
+
+
+class Response(object):
+    """Results of a packet, as labrad.support.PacketResponse."""
+
+    def __init__(self, results):
+        self.results = {}
+        for name, key, value in results:
+            self.results.setdefault(key or name, []).append(value)
+
+    def __getitem__(self, key):
+        values = self.results[key]
+        return values[0] if len(values) == 1 else values
+
+
+class FakePacket(object):
+    def __init__(self, server, context):
+        self._server = server
+        self._context = context
+        self._records = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._server.settings:
+            raise AttributeError(name)
+
+        def record(*args, **kw):
+            key = kw.pop('key', None)
+            self._records.append((name, args, kw, key))
+            return self
+        return record
+
+    def send(self):
+        server = self._server
+        server.packets += 1
+        server.records += len(self._records)
+        try:
+            results = [(name, key,
+                        getattr(server, 'setting_' + name)(self._context,
+                                                           *args, **kw))
+                       for name, args, kw, key in self._records]
+        except Exception:
+            return defer.fail()
+        return server.respond(Response(results))
+
+
+class FakeServer(object):
+    """A server with the settings named in settings.
+
+    Attributes:
+        packets (int): Packets sent.
+        records (int): Records in them.
+    """
+    name = 'Fake Server'
+    ID = 100
+    settings = ()
+
+    def __init__(self):
+        self.packets = 0
+        self.records = 0
+        self.listeners = []
+        self.contexts = 0
+
+    def context(self):
+        self.contexts += 1
+        return (self.ID, self.contexts)
+
+    def packet(self, context=None, **kw):
+        return FakePacket(self, context)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.settings:
+            raise AttributeError(name)
+
+        def call(*args, **kw):
+            d = getattr(self.packet(context=kw.pop('context', None)),
+                        name)(*args, **kw).send()
+            return d.addCallback(lambda response: response[name])
+        return call
+
+    def respond(self, response):
+        return defer.succeed(response)
+
+    def addListener(self, listener, ID=None, context=None, **kw):
+        self.listeners.append((listener, ID, context))
+
+    def message(self, context, ID, data):
+        """Send a message to the listeners for it."""
+        for listener, lID, lcontext in list(self.listeners):
+            if lID in (ID, None) and lcontext in (context, None):
+                listener(MessageContext(self.ID, context, ID), data)
+
+
+class FakeRegistry(FakeServer):
+    """The registry, with a current directory for each context.
+
+    Attributes:
+        items (int): Keys and directories listed, plus elements of the
+            values got and set, counting a list as its length.
+    """
+    name = 'Registry'
+    ID = 2
+    settings = ('cd', 'dir', 'get', 'set', 'del_', 'notify_on_change')
+
+    def __init__(self):
+        super(FakeRegistry, self).__init__()
+        self.root = ({}, {})  # dirs, keys
+        self.paths = {}
+        self.notify = {}
+        self.items = 0
+        self.changed = []
+
+    def respond(self, response):
+        changed, self.changed = self.changed, []
+        for context, ID, name in changed:
+            self.message(context, ID, (name, False, True))
+        return defer.succeed(response)
+
+    def cost(self):
+        return self.packets, self.records, self.items
+
+    def _find(self, path, create=False):
+        node = self.root
+        for name in path[1:]:
+            if name not in node[0]:
+                if not create:
+                    raise KeyError('Directory %s not found' % name)
+                node[0][name] = ({}, {})
+            node = node[0][name]
+        return node
+
+    def _path(self, c):
+        return self.paths.get(c, [''])
+
+    def write(self, path, key, value):
+        """Set a key without counting it."""
+        self._find(path, True)[1][key] = value
+
+    def read(self, path, key):
+        return self._find(path)[1][key]
+
+    def setting_cd(self, c, path=None, create=False):
+        current = self._path(c)
+        if path is None:
+            return current
+        if isinstance(path, str):
+            path = [path]
+        path = list(path)
+        if path and path[0] == '':
+            new = path
+        else:
+            new = list(current)
+            for name in path:
+                if name == '..':
+                    new.pop()
+                else:
+                    new.append(name)
+        self._find(new, create)
+        self.paths[c] = new
+        return new
+
+    def setting_dir(self, c):
+        dirs, keys = self._find(self._path(c))
+        self.items += len(dirs) + len(keys)
+        return sorted(dirs), sorted(keys)
+
+    def setting_get(self, c, name, set=False, default=MISSING):
+        keys = self._find(self._path(c))[1]
+        if name not in keys:
+            if default is MISSING:
+                raise KeyError('Key %s not found' % name)
+            if not set:
+                return default
+            self.setting_set(c, name, default)
+        value = keys[name]
+        self.items += len(value) if isinstance(value, list) else 1
+        return value
+
+    def setting_set(self, c, name, value):
+        path = self._path(c)
+        self.items += len(value) if isinstance(value, list) else 1
+        self._find(path)[1][name] = list(value) if isinstance(value, list) \
+            else value
+        for context, (npath, ID) in self.notify.items():
+            if npath == path:
+                self.changed.append((context, ID, name))
+
+    def setting_del_(self, c, name):
+        del self._find(self._path(c))[1][name]
+
+    def setting_notify_on_change(self, c, ID, enable):
+        if enable:
+            self.notify[c] = (self._path(c), ID)
+        else:
+            self.notify.pop(c, None)
+
+
+class FakeConnection(dict):
+    """Client connection to fake servers, by python name."""
+
+    def __init__(self, *servers):
+        super(FakeConnection, self).__init__()
+        self.contexts = 0
+        for server in servers:
+            self.add(server)
+
+    def add(self, server):
+        self[server.name] = server
+        self[server.name.lower().replace(' ', '_')] = server
+
+    @property
+    def servers(self):
+        return self
+
+    def context(self):
+        self.contexts += 1
+        return (0, self.contexts)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
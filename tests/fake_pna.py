@@ -0,0 +1,222 @@
+"""Fake PNA for testing the PNA server.
+
+FakePNA answers the subset of SCPI used by PNA/agilentN5242A.py. Each sweep
+(started by ABORT;SENS:SWE:MODE GRO) measures every defined S parameter
+from a model of a resonator, whose response depends on the frequency, the
+power and the number of the sweep.
+"""
+
+import imp
+import os
+import re
+
+import numpy as np
+
+from simulated_scope import SimulatedBus, result
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDR = 'GPIB0::16::INSTR'
+
+pna = imp.load_source('agilentN5242A',
+                      os.path.join(ROOT, 'PNA', 'agilentN5242A.py'))
+
+# commands which only change state we do not model
+IGNORED = [
+    'FORM:DATA REAL,64',
+    'SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON',
+    'OUTP ON',
+    'OUTP OFF',
+    'SENS:SEGM:BWID:CONT ON',
+    'SENS:SEGM:POW:CONT ON',
+    'SENS:AVER ON',
+    'SENS:AVER OFF',
+]
+
+
+def block(values):
+    data = np.asarray(values, dtype='>f8').tostring()
+    length = str(len(data))
+    return '#{}{}{}\n'.format(len(length), length, data)
+
+
+def response(meas, freq, power, sweep):
+    """S parameter of a resonator, which shifts with power and sweep."""
+    f0 = 5e9 + 1e3 * sweep - 1e4 * (power + 30)
+    dip = 0.5 / (1 + 2j * (freq - f0) / 1e6)
+    scale = {'S11': 0.9, 'S12': 0.1, 'S21': 1.0, 'S22': 0.8}[meas]
+    return scale * (1 - dip)
+
+
+class FakePNA(object):
+    def __init__(self):
+        self.start = 4.99e9
+        self.stop = 5.01e9
+        self.points = 201
+        self.power = -30.0
+        self.bandwidth = 1000.0
+        self.sweep_type = 'LIN'
+        self.sweep_time = 0.1
+        self.averages = 1
+        self.segments = []
+        self.pars = {'labrad_S21': 'S21'}
+        self.formats = {}
+        self.selected = None
+        self.sweeps = 0
+        self.data = {}
+        self.stimulus = np.zeros(0)
+        self.commands = []
+        self.output = ''
+
+    def x(self):
+        """Stimulus values of a sweep with the current settings."""
+        if self.sweep_type == 'LIN':
+            return np.linspace(self.start, self.stop, self.points)
+        if self.sweep_type == 'LOG':
+            return np.logspace(np.log10(self.start), np.log10(self.stop),
+                               self.points)
+        if self.sweep_type == 'SEGM':
+            return np.hstack([np.linspace(s['start'], s['stop'], s['points'])
+                              for s in self.segments if s['on']])
+        raise ValueError('Sweep type {} not modelled'.format(self.sweep_type))
+
+    def sweep(self):
+        self.sweeps += 1
+        self.stimulus = self.x()
+        if self.sweep_type == 'SEGM':
+            power = np.hstack([np.full(s['points'], s['power'])
+                               for s in self.segments if s['on']])
+        else:
+            power = self.power
+        self.data = dict((name, response(meas, self.stimulus, power,
+                                         self.sweeps))
+                         for name, meas in self.pars.items())
+
+    def formatted(self, name):
+        data = self.data[name]
+        fmt = self.formats.get(name, 'MLOG')
+        if fmt == 'POL':
+            return np.column_stack((data.real, data.imag)).ravel()
+        if fmt == 'PHAS':
+            return np.angle(data, deg=True)
+        return 20 * np.log10(abs(data))
+
+    def segment(self, n):
+        while len(self.segments) < n:
+            self.segments.append({'start': 0.0, 'stop': 0.0, 'points': 21,
+                                  'bandwidth': self.bandwidth,
+                                  'power': self.power, 'on': False})
+        return self.segments[n - 1]
+
+    def handle(self, cmd):
+        """Run a command, returning the response of queries."""
+        if cmd in IGNORED:
+            return None
+        if cmd == '*OPC?':
+            return '1'
+        if cmd == 'ABORT;SENS:SWE:MODE GRO':
+            self.sweep()
+            return None
+        if cmd == 'SENS:FREQ:STAR?; STOP?':
+            return '{!r};{!r}'.format(self.start, self.stop)
+        m = re.match(r'SENS:FREQ:STAR (\S+); STOP (\S+)$', cmd)
+        if m:
+            self.start, self.stop = float(m.group(1)), float(m.group(2))
+            return None
+        if cmd == 'SENS:SWE:TIME?; POIN?':
+            return '{!r};{}'.format(self.sweep_time, self.points)
+        simple = {
+            'SENS:SWE:POIN': ('points', int),
+            'SENS:SWE:TYPE': ('sweep_type', str),
+            'SOUR:POW': ('power', float),
+            'SENS:BAND': ('bandwidth', float),
+            'SENS:AVER:COUN': ('averages', int),
+        }
+        m = re.match(r'([A-Z:]+)(\?| (.*))$', cmd)
+        if m and m.group(1) in simple:
+            attr, kind = simple[m.group(1)]
+            if m.group(2) == '?':
+                return str(getattr(self, attr))
+            setattr(self, attr, kind(m.group(3)))
+            return None
+        if cmd == 'SENS:SWE:GRO:COUN?':
+            return '1'
+        if cmd.startswith('SENS:SWE:GRO:COUN '):
+            return None
+        if cmd == 'SENS:SEGM:DEL:ALL':
+            self.segments = []
+            return None
+        if cmd == 'SENS:SEGM:COUN?':
+            return str(len(self.segments))
+        m = re.match(r'SENS:SEGM(\d+)(:ADD| ON|:FREQ:STAR|:FREQ:STOP|'
+                     r':SWE:POIN|:BWID|:POW)(\?| (.*))?$', cmd)
+        if m:
+            seg = self.segment(int(m.group(1)))
+            if m.group(2) == ' ON':
+                seg['on'] = True
+                return None
+            if m.group(2) == ':ADD':
+                return None
+            key, kind = {':FREQ:STAR': ('start', float),
+                         ':FREQ:STOP': ('stop', float),
+                         ':SWE:POIN': ('points', int),
+                         ':BWID': ('bandwidth', float),
+                         ':POW': ('power', float)}[m.group(2)]
+            if m.group(3) == '?':
+                return repr(seg[key])
+            seg[key] = kind(m.group(4))
+            return None
+        if cmd == 'CALC:PAR:CAT?':
+            return '"{}"'.format(','.join('{},{}'.format(name, meas)
+                                          for name, meas in
+                                          sorted(self.pars.items())))
+        m = re.match(r"CALC:PAR:DEF '(.*)',(.*)$", cmd)
+        if m:
+            self.pars[m.group(1)] = m.group(2)
+            return None
+        m = re.match(r"CALC:PAR:DEL '(.*)'$", cmd)
+        if m:
+            del self.pars[m.group(1)]
+            return None
+        m = re.match(r"CALC:PAR:SEL '(.*)'$", cmd)
+        if m:
+            self.selected = m.group(1)
+            return None
+        m = re.match(r'CALC:FORM (\w+)$', cmd)
+        if m:
+            self.formats[self.selected] = m.group(1)
+            return None
+        if cmd == 'CALC:DATA? SDATA':
+            data = self.data[self.selected]
+            return block(np.column_stack((data.real, data.imag)).ravel())
+        m = re.match(r'CALC:DATA:MSD\? "(.*)"$', cmd)
+        if m:
+            return block(np.hstack([self.formatted(name)
+                                    for name in m.group(1).split(',')]))
+        if cmd == 'SENS:X?':
+            return block(self.stimulus)
+        raise ValueError('Unknown command {}'.format(cmd))
+
+    def write(self, cmd):
+        self.commands.append(cmd)
+        resp = self.handle(cmd)
+        if resp is not None:
+            self.output = resp if resp.startswith('#') else resp + '\n'
+
+    def read_raw(self):
+        output, self.output = self.output, ''
+        return output
+
+    def query(self, cmd):
+        self.write(cmd)
+        return self.read_raw().strip()
+
+
+def connect(instrument=None):
+    """PNA server and wrapper talking to a fake PNA, and the bus."""
+    bus = SimulatedBus(instrument or FakePNA())
+    dev = pna.PNAWrapper('pna', ADDR)
+    result(dev.connect(bus, ADDR))
+    bus.requests = 0
+    server = pna.AgilentPNAServer()
+    server.selectedDevice = lambda c: dev
+    return server, dev, bus
@@ -0,0 +1,88 @@
+"""Data vault server running in the test process, for testing its clients.
+
+Servers talk to the data vault through self.client.data_vault. Tests can
+set that to a LocalDataVault, which has the same methods, returning
+deferreds, and counts requests like the bus fakes do.
+"""
+
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+from twisted.internet import defer
+
+from datavault import SessionStore
+from datavault import server as dv_server
+
+
+class Context(dict):
+    def __init__(self, ID):
+        self.ID = ID
+
+
+class LocalDataVault(object):
+    """Client side view of a data vault server running in this process."""
+
+    def __init__(self, datadir):
+        self.server = dv_server.DataVault(SessionStore(datadir, mock.MagicMock()))
+        self.server.initServer()
+        self.contexts = {}
+        self.requests = 0
+
+    def context(self, ID=(0, 1)):
+        if ID not in self.contexts:
+            self.contexts[ID] = Context(ID)
+            self.server.initContext(self.contexts[ID])
+        return self.contexts[ID]
+
+    def _call(self, name, *args, **kw):
+        self.requests += 1
+        c = self.context(kw.get('context') or (0, 1))
+        return defer.maybeDeferred(getattr(self.server, name), c, *args)
+
+    def cd(self, path, create=False, context=None):
+        return self._call('cd', path, create, context=context)
+
+    def dir(self, context=None):
+        return self._call('dir', context=context)
+
+    def open(self, name, append=False, context=None):
+        return self._call('open', name, append, context=context)
+
+    def new(self, name, independents, dependents, context=None):
+        return self._call('new', name, independents, dependents,
+                          context=context)
+
+    def add(self, data, context=None):
+        return self._call('add', data, context=context)
+
+    def add_parameter(self, name, data, context=None):
+        return self._call('add_parameter', name, data, context=context)
+
+    def add_comment(self, comment, context=None):
+        return self._call('add_comment', comment, context=context)
+
+    def get(self, limit=None, startOver=True, context=None):
+        return self._call('get', limit, startOver, context=context)
+
+    def get_range(self, start, end, limit=None, context=None):
+        return self._call('get_range', start, end, limit, context=context)
+
+    def parameters(self, context=None):
+        return self._call('parameters', context=context)
+
+    def get_parameter(self, name, context=None):
+        return self._call('get_parameter', name, context=context)
+
+    def variables(self, context=None):
+        return self._call('variables', context=context)
+
+
+@pytest.fixture
+def datavault():
+    datadir = tempfile.mkdtemp(prefix='dvtest_')
+    os.rmdir(datadir)
+    yield LocalDataVault(datadir)
+    shutil.rmtree(datadir, ignore_errors=True)
@@ -0,0 +1,156 @@
+"""Simulated Lakeshore 370 reading the thermometers of a model fridge.
+
+SimulatedLakeshore370 understands the commands used by RuOxWrapper's read
+loop and temperature regulation. The resistance of a channel is that of the
+model fridge's temperature at the time it is read, through a calibration,
+and each reading is logged with the time since the scanner was switched, so
+that tests can check refresh rates and settle times. A ThermalModel stands
+for a regulated stage, which follows the setpoint with a lag. SimulatedRuOx
+is a RuOxWrapper talking to the 370 without a GPIB bus or registry.
+"""
+
+import re
+from datetime import datetime
+
+import numpy as np
+from twisted.internet import defer
+
+import labrad.units as U
+import lakeshore370
+from lakeshore.calibration import DEFAULT
+from lakeshore.scheduler import Scheduler
+
+
+class ModelFridge(object):
+    """Temperatures of the thermometers of a fridge.
+
+    Args:
+        temperatures (dict): Maps channels to a temperature in K, or a
+            function giving the temperature at a time in seconds.
+    """
+
+    def __init__(self, temperatures):
+        self.temperatures = temperatures
+
+    def temperature(self, channel, t):
+        T = self.temperatures[channel]
+        return T(t) if callable(T) else T
+
+
+class ThermalModel(object):
+    """Temperature of a stage regulated by the heater.
+
+    The temperature relaxes exponentially to the setpoint, with time
+    constant tau in seconds.
+    """
+
+    def __init__(self, clock, temperature, tau):
+        self.clock = clock
+        self.T = temperature
+        self.target = temperature
+        self.tau = tau
+        self.updated = clock.seconds()
+
+    def __call__(self, t):
+        dt = t - self.updated
+        if dt > 0:
+            self.T = self.target + (self.T - self.target) * np.exp(-dt / self.tau)
+            self.updated = t
+        return self.T
+
+    def regulate(self, target):
+        self(self.clock.seconds())
+        self.target = target
+
+
+class SimulatedLakeshore370(object):
+    """Instrument model of a 370 with a scanner.
+
+    Attributes:
+        reads (list of (float, int, float)): Time, channel and time since
+            the scanner was switched to the channel, of each reading.
+        setpoints (list of (float, float)): Time and resistance of each
+            setpoint.
+    """
+
+    def __init__(self, clock, fridge, calibration):
+        self.clock = clock
+        self.fridge = fridge
+        self.calibration = calibration
+        self.channel = 1
+        self.switched = clock.seconds()
+        self.reads = []
+        self.setpoints = []
+        self.control = None
+        self.commands = []
+
+    def write(self, cmd):
+        self.commands.append(cmd)
+        m = re.match(r'SCAN (\d+),0$', cmd)
+        if m:
+            self.channel = int(m.group(1))
+            self.switched = self.clock.seconds()
+        m = re.match(r'CSET (\d+),', cmd)
+        if m:
+            self.control = int(m.group(1))
+        m = re.match(r'SETP (.*)$', cmd)
+        if m:
+            r = float(m.group(1))
+            self.setpoints.append((self.clock.seconds(), r))
+            model = self.fridge.temperatures.get(self.control)
+            if isinstance(model, ThermalModel):
+                model.regulate(float(self.calibration.temperature(r)))
+
+    def query(self, cmd):
+        m = re.match(r'RDGR\? (\d+)$', cmd)
+        if not m:
+            raise ValueError('Unknown query {}'.format(cmd))
+        channel = int(m.group(1))
+        assert channel == self.channel, 'reading a channel not scanned'
+        now = self.clock.seconds()
+        self.reads.append((now, channel, now - self.switched))
+        T = self.fridge.temperature(channel, now)
+        return '%.6E' % float(self.calibration.resistance(T))
+
+    def intervals(self, since=0):
+        """Mean time between readings of each channel, after a time."""
+        times = {}
+        for t, channel, _ in self.reads:
+            if t >= since:
+                times.setdefault(channel, []).append(t)
+        return dict((ch, (ts[-1] - ts[0]) / (len(ts) - 1))
+                    for ch, ts in times.items() if len(ts) > 1)
+
+
+class SimulatedRuOx(lakeshore370.RuOxWrapper):
+    def write(self, cmd):
+        return defer.succeed(self.instrument.write(cmd))
+
+    def query(self, cmd):
+        return defer.succeed(self.instrument.query(cmd))
+
+
+def make_device(clock, instrument, readOrder, settleTime=1.0, **options):
+    """A RuOxWrapper on a simulated 370, set up as by loadDeviceInformation.
+
+    All channels use the server's default calibration. Options are passed
+    to the Scheduler.
+    """
+    dev = SimulatedRuOx.__new__(SimulatedRuOx)
+    dev.clock = clock
+    dev.instrument = instrument
+    dev.addr = 'GPIB0::12'
+    dev.alive = True
+    dev.onlyChannel = 0
+    dev.scannedChannel = 0
+    dev.regulatedChannel = 0
+    dev.setpoint = None
+    dev.ramp = None
+    dev.readOrder = readOrder
+    dev.readings = dict((ch, (0 * U.Ohm, datetime.now())) for ch in readOrder)
+    dev.channelNames = ['ch%d' % (i + 1) for i in range(max(readOrder))]
+    dev.calibrations = [[DEFAULT]] * (max(readOrder) + 1)
+    dev.compileCalibrations()
+    dev.settleTime = U.Value(settleTime, 's')
+    dev.scheduler = Scheduler(readOrder, settleTime, **options)
+    return dev
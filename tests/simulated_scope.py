@@ -0,0 +1,215 @@
+"""Simulated DSO-X 4104A and GPIB bus for testing the oscilloscope server.
+
+SimulatedScope understands the SCPI commands used by DSOX4104AWrapper.
+Each acquisition records a sine wave per channel, whose amplitude and phase
+depend on the channel, scaled by the channel settings as a real scope would.
+SimulatedBus stands in for the GPIB bus server, including its Transaction
+setting, and counts requests, i.e. LabRAD round trips.
+"""
+
+import re
+
+import numpy as np
+from twisted.internet import defer
+
+from oscilloscope.agilent.DSOX4104A import DSOX4104AWrapper
+
+ADDR = 'GPIB0::7::INSTR'
+
+
+class SimulatedScope(object):
+    """Instrument model of a four channel scope."""
+
+    channels = (1, 2, 3, 4)
+
+    def __init__(self, points=1000):
+        self.points = points
+        self.scale = dict((ch, 1.0) for ch in self.channels)
+        self.offset = dict((ch, 0.0) for ch in self.channels)
+        self.time_scale = 1e-6
+        self.time_position = 0.0
+        self.display = dict((ch, True) for ch in self.channels)
+        self.source = 1
+        self.acquisitions = 0
+        self.commands = []
+        self.data = dict((ch, np.zeros(points, dtype='u2'))
+                         for ch in self.channels)
+        self.output = ''
+
+    def volts(self, channel):
+        """Signal that an acquisition of a channel records."""
+        t = self.times()
+        phase = 2 * np.pi * self.acquisitions / 7.0
+        return 0.5 * channel * np.sin(2 * np.pi * 3e6 * t + channel + phase)
+
+    def times(self):
+        return self.x_origin() + np.arange(self.points) * self.x_step()
+
+    def x_step(self):
+        return 10 * self.time_scale / self.points
+
+    def x_origin(self):
+        return self.time_position - 5 * self.time_scale
+
+    def y_step(self, channel):
+        return 10 * self.scale[channel] / 65536.0
+
+    def acquire(self, channels):
+        self.acquisitions += 1
+        for ch in channels:
+            raw = (self.volts(ch) - self.offset[ch]) / self.y_step(ch) + 32768
+            self.data[ch] = np.clip(np.round(raw), 0, 65535).astype('u2')
+
+    def preamble(self):
+        ch = self.source
+        fields = [1, 0, self.points, 1, self.x_step(), self.x_origin(), 0,
+                  self.y_step(ch), self.offset[ch], 32768]
+        return ','.join(str(f) for f in fields)
+
+    def write(self, cmd):
+        self.commands.append(cmd)
+        m = re.match(r':CHAN(\d):(SCAL|OFFS)(\?| (.*?) ?V)$', cmd)
+        if m:
+            ch = int(m.group(1))
+            values = self.scale if m.group(2) == 'SCAL' else self.offset
+            if m.group(3) == '?':
+                self.output = str(values[ch])
+            else:
+                values[ch] = float(m.group(4))
+            return
+        m = re.match(r':(TIM:SCAL|TIM:POS|WAV:POIN)(\?| (.*))$', cmd)
+        if m:
+            attr = {'TIM:SCAL': 'time_scale', 'TIM:POS': 'time_position',
+                    'WAV:POIN': 'points'}[m.group(1)]
+            if m.group(2) == '?':
+                self.output = str(getattr(self, attr))
+            else:
+                kind = int if attr == 'points' else float
+                setattr(self, attr, kind(m.group(3)))
+            return
+        m = re.match(r':CHAN(\d):DISP\?$', cmd)
+        if m:
+            self.output = '1' if self.display[int(m.group(1))] else '0'
+            return
+        m = re.match(r':WAV:SOUR CHAN(\d)$', cmd)
+        if m:
+            self.source = int(m.group(1))
+            return
+        m = re.match(r':DIG (.*)$', cmd)
+        if m:
+            self.acquire([int(ch) for ch in re.findall(r'CHAN(\d)', cmd)])
+            return
+        if cmd == '*OPC?':
+            self.output = '1'
+        elif cmd == ':WAV:PRE?':
+            self.output = self.preamble()
+        elif cmd == ':WAV:DATA?':
+            data = self.data[self.source].astype('>u2').tostring()
+            length = str(len(data))
+            self.output = '#{}{}{}\n'.format(len(length), length, data)
+        elif cmd not in (':WAV:BYT MSBF', ':WAV:FORM WORD'):
+            raise ValueError('Unknown command {}'.format(cmd))
+
+    def read_raw(self):
+        output, self.output = self.output, ''
+        return output
+
+    def query(self, cmd):
+        self.write(cmd)
+        return self.read_raw().strip()
+
+
+class SimulatedBus(object):
+    """GPIB bus server with a single simulated instrument."""
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.requests = 0
+
+    def context(self):
+        return (0, 1)
+
+    def packet(self, context=None):
+        return SimulatedPacket(self)
+
+
+class SimulatedPacket(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.calls = []
+
+    def _op(self, name, arg=None):
+        self.calls.append((name, arg))
+        return self
+
+    def address(self, addr):
+        return self._op('address', addr)
+
+    def timeout(self, t):
+        return self._op('timeout', t)
+
+    def write(self, data):
+        return self._op('write', data)
+
+    def query(self, data):
+        return self._op('query', data)
+
+    def read(self, n=None):
+        return self._op('read', n)
+
+    def read_raw(self, n=None):
+        return self._op('read_raw', n)
+
+    def transaction(self, ops):
+        return self._op('transaction', ops)
+
+    def clear(self):
+        return self._op('clear')
+
+    def term_chars(self, chars):
+        return self._op('term_chars', chars)
+
+    def _run(self, op, arg):
+        instr = self.bus.instrument
+        if op == 'write':
+            instr.write(arg)
+        elif op == 'query':
+            return instr.query(arg)
+        elif op == 'read':
+            return instr.read_raw().strip()
+        elif op == 'read_raw':
+            return instr.read_raw()
+        return ''
+
+    def send(self):
+        self.bus.requests += 1
+        resp = Response()
+        for name, arg in self.calls:
+            if name == 'transaction':
+                resp.transaction = [self._run(op, a) for op, a in arg]
+            else:
+                setattr(resp, name, self._run(name, arg))
+        return defer.succeed(resp)
+
+
+class Response(object):
+    pass
+
+
+def result(d):
+    """Result of a deferred which has already fired."""
+    results = []
+    d.addBoth(results.append)
+    assert results
+    if hasattr(results[0], 'raiseException'):
+        results[0].raiseException()
+    return results[0]
+
+
+def connect(instrument=None, wrapper=DSOX4104AWrapper):
+    """Wrapper connected to a simulated scope, and the simulated bus."""
+    bus = SimulatedBus(instrument or SimulatedScope())
+    dev = wrapper('scope', ADDR)
+    result(dev.connect(bus, ADDR))
+    bus.requests = 0
+    return dev, bus
@@ -0,0 +1,245 @@
+"""Tests for binary and ASCII trace transfer of the 8720ES, SR770 and SR780.
+
+Each analyzer is replaced by a loopback instrument which answers both the
+binary and the ASCII data queries from the same trace, so that the two
+transfer paths can be compared.
+"""
+
+import imp
+import os
+import struct
+import time
+
+import numpy as np
+import pytest
+
+import labrad.units as U
+import agilent8720ES
+
+from simulated_scope import SimulatedBus, result
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDR = 'GPIB0::16::INSTR'
+
+sr770 = imp.load_source('sr770', os.path.join(ROOT, 'SR770', 'sr770.py'))
+sr780 = imp.load_source('sr780', os.path.join(ROOT, 'SR780', 'sr780.py'))
+
+
+class LoopbackInstrument(object):
+    """Instrument whose responses to commands are given by handle."""
+
+    def __init__(self):
+        self.output = ''
+        self.sent = 0
+        self.commands = []
+
+    def handle(self, cmd):
+        raise NotImplementedError
+
+    def write(self, cmd):
+        cmd = cmd.strip()
+        self.commands.append(cmd)
+        resp = self.handle(cmd)
+        if resp is not None:
+            self.output = resp
+            self.sent += len(resp)
+
+    def read_raw(self):
+        output, self.output = self.output, ''
+        return output
+
+    def query(self, cmd):
+        self.write(cmd)
+        return self.read_raw().strip()
+
+
+class Fake8720ES(LoopbackInstrument):
+    def __init__(self, points=801):
+        LoopbackInstrument.__init__(self)
+        rng = np.random.RandomState(0)
+        self.trace = rng.normal(size=(points, 2))
+        # binary data may end with bytes that look like whitespace
+        self.trace[-1, 1] = np.frombuffer('\x3f\xf0\x00\x00\x00\x00\x00\x0a',
+                                          '>f8')[0]
+        self.form = 'FORM4'
+
+    def handle(self, cmd):
+        if cmd in agilent8720ES.TRACE_FORMATS:
+            self.form = cmd
+        elif cmd == 'OUTPFORM':
+            if self.form == 'FORM4':
+                return '\n'.join('%.17E, %.17E' % tuple(row)
+                                 for row in self.trace) + '\n'
+            data = self.trace.astype(agilent8720ES.TRACE_FORMATS[self.form])
+            data = data.tostring()
+            return '#A' + struct.pack('>H', len(data)) + data
+        elif cmd == 'STAR?':
+            return '+1.000000000E+09\n'
+        elif cmd == 'STOP?':
+            return '+2.000000000E+09\n'
+        elif cmd == 'POIN?':
+            return '%.6E\n' % len(self.trace)
+
+
+class FakeSR770(LoopbackInstrument):
+    input_range = -20
+    span = 16
+
+    def __init__(self):
+        LoopbackInstrument.__init__(self)
+        rng = np.random.RandomState(1)
+        self.psd = 1e-7 * np.exp(rng.normal(size=sr770.NUM_POINTS))
+        linewidth = sr770.SPANS[self.span] / sr770.NUM_POINTS
+        dbv_pk = 20 * np.log10(self.psd * np.sqrt(2 * linewidth))
+        self.raw = np.round((dbv_pk - self.input_range + 114.3914) *
+                            512 / 3.0103).astype(int)
+
+    def handle(self, cmd):
+        answers = {'DISP?0': '0', 'WNDO?0': '0', 'FFTS?4': '1',
+                   'IRNG?': str(self.input_range), 'SPAN?': str(self.span),
+                   'STRF?': '0.0'}
+        if cmd in answers:
+            return answers[cmd] + '\n'
+        elif cmd == 'SPEB?0':
+            return self.raw.astype('<i2').tostring()
+        elif cmd == 'SPEC?0':
+            return ''.join('%.6e,' % v for v in self.psd) + '\n'
+
+
+class FakeSR780(LoopbackInstrument):
+    def __init__(self, points=800):
+        LoopbackInstrument.__init__(self)
+        rng = np.random.RandomState(2)
+        self.display = (1e-7 * np.exp(rng.normal(size=points))).astype('f4')
+
+    def handle(self, cmd):
+        answers = {'VIEW?0': '0', 'FSPN?0': '12500.0', 'FSTR?0': '0.0',
+                   'FEND?0': '12500.0',
+                   'FAVN? 0': '1', 'NAVG? 0': '1', 'FAVG? 0': '1',
+                   'DSPN? 0': str(len(self.display))}
+        if cmd in answers:
+            return answers[cmd] + '\n'
+        elif cmd == 'DSPB? 0':
+            return self.display.astype('<f4').tostring()
+        elif cmd == 'DSPY? 0':
+            return ','.join(repr(float(v)) for v in self.display) + '\n'
+
+
+def connect(wrapper, instrument):
+    bus = SimulatedBus(instrument)
+    dev = wrapper('analyzer', ADDR)
+    result(dev.connect(bus, ADDR))
+    bus.requests = 0
+    return dev, bus
+
+
+def server_for(server_class, dev):
+    server = server_class()
+    server.selectedDevice = lambda c: dev
+    return server
+
+
+def test_8720ES_formats():
+    fake = Fake8720ES()
+    dev, bus = connect(agilent8720ES.Agilent_8720ES_Wrapper, fake)
+    traces = {}
+    for form in ['FORM2', 'FORM3', 'FORM4']:
+        freqs, traces[form] = result(dev.trace(form))
+        assert np.allclose(freqs, np.linspace(1e9, 2e9, len(fake.trace)))
+    assert bus.requests == 3
+    assert np.array_equal(traces['FORM3'], fake.trace)
+    assert np.array_equal(traces['FORM3'], traces['FORM4'])
+    assert np.allclose(traces['FORM2'], traces['FORM4'], rtol=1e-6)
+    with pytest.raises(ValueError):
+        result(dev.trace('FORM1'))
+
+
+def test_8720ES_get_trace():
+    fake = Fake8720ES(points=11)
+    dev, bus = connect(agilent8720ES.Agilent_8720ES_Wrapper, fake)
+    server = server_for(agilent8720ES.Agilent_8720ES_Server, dev)
+    c = {}
+    binary = result(server.get_trace(c, True))
+    assert fake.form == 'FORM3'
+    assert server.trace_format(c, 'form4') == 'FORM4'
+    ascii = result(server.get_trace(c, True))
+    assert fake.form == 'FORM4'
+    assert np.array_equal(binary, ascii)
+    assert np.allclose(binary[:, 0], np.linspace(1e9, 2e9, 11))
+    assert np.array_equal(binary[:, 1:], fake.trace)
+
+
+def test_8720ES_bad_header():
+    with pytest.raises(ValueError):
+        agilent8720ES.parseBinaryTrace('#B\x00\x08' + '\x00' * 8, '>f4')
+    with pytest.raises(ValueError):
+        agilent8720ES.parseBinaryTrace('#A\x00\x10' + '\x00' * 8, '>f4')
+
+
+def test_sr770_binary_and_ascii():
+    fake = FakeSR770()
+    # the last byte of binary data looks like whitespace
+    last, fake.raw[-1] = fake.raw[-1], 0x200a
+    dev, bus = connect(sr770.SR770Wrapper, fake)
+    server = server_for(sr770.SR770Server, dev)
+    assert np.array_equal(result(server.get_trace({}, 0)), fake.raw)
+
+    fake.raw[-1] = last
+    binary = result(server.power_spectral_amplitude({}, 0))
+    ascii = result(server.power_spectral_amplitude_ASCII({}, 0))
+    assert binary.shape == ascii.shape == (sr770.NUM_POINTS, 2)
+    assert np.array_equal(binary[:, 0], ascii[:, 0])
+    # binary data is quantized to 3.0103 / 512 dB
+    assert np.allclose(binary[:, 1], ascii[:, 1], rtol=1e-3)
+    assert np.allclose(ascii[:, 1], fake.psd, rtol=1e-6)
+
+
+def test_sr780_binary_and_ascii():
+    fake = FakeSR780()
+    fake.display[-1] = np.frombuffer('\x00\x00\x0a\x20', '<f4')[0]
+    dev, bus = connect(sr780.SR780Wrapper, fake)
+    server = server_for(sr780.SR780Server, dev)
+    bus.requests = 0
+    assert np.array_equal(result(dev.displayBinary(0)), fake.display)
+    assert bus.requests == 1
+
+    binary = result(server.power_spectral_amplitude({}, 0))
+    ascii = result(server.power_spectral_amplitude_ASCII({}, 0))
+    assert np.array_equal(binary, ascii)
+    assert np.array_equal(binary[:, 1], fake.display)
+    sweep = result(server.freq_sweep({}))
+    assert len(sweep) == len(fake.display)
+    assert sweep[-1][0] == U.Value(12500.0, 'Hz')
+
+
+def test_sr780_short_data():
+    with pytest.raises(Exception):
+        sr780.unpackBinary('\x00' * 10, 3)
+
+
+def transfer_and_parse_time(fetch, instrument, repeats=20):
+    start_bytes = instrument.sent
+    start = time.time()
+    for _ in range(repeats):
+        data = result(fetch())
+    return data, instrument.sent - start_bytes, time.time() - start
+
+
+def test_binary_faster():
+    fake = FakeSR780()
+    dev, bus = connect(sr780.SR780Wrapper, fake)
+    binary, binary_bytes, binary_time = transfer_and_parse_time(
+        lambda: dev.displayBinary(0), fake)
+    ascii, ascii_bytes, ascii_time = transfer_and_parse_time(
+        lambda: dev.displayASCII(0), fake)
+    assert np.array_equal(binary, ascii)
+    assert binary_bytes < ascii_bytes / 2
+
+    fake = Fake8720ES()
+    dev, bus = connect(agilent8720ES.Agilent_8720ES_Wrapper, fake)
+    _, binary_bytes, binary_time = transfer_and_parse_time(
+        lambda: dev.trace('FORM3'), fake)
+    _, ascii_bytes, ascii_time = transfer_and_parse_time(
+        lambda: dev.trace('FORM4'), fake)
+    assert binary_bytes < ascii_bytes / 2
+    assert binary_time < ascii_time
@@ -0,0 +1,191 @@
+"""Tests for the cryo event log, and moving the registry log into it."""
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from cryolog.events import (ALERT, EXCURSION, FILL, RESET, EventLog,
+                            import_registry, parse_timestamp)
+
+from fake_labrad import FakeRegistry
+from simulated_scope import result
+
+LOG = ['', 'Servers', 'Cryo Notifier', 'Vince', 'log']
+T0 = 1.5e9
+
+
+@pytest.fixture
+def events():
+    events = EventLog(':memory:')
+    yield events
+    events.close()
+
+
+def fill(events, count, t0=T0):
+    for i in range(count):
+        events.append([RESET, FILL][i % 2], ['LN2', 'LHe'][i % 3 % 2],
+                      'entry %d' % i, t=t0 + i // 2)
+
+
+def test_append_and_query(events):
+    event = events.append(EXCURSION, 'Vince:Mix1', 'above 0.1', 0.2, t=T0)
+    assert event.cursor == (T0, event.id)
+    assert events.query(10) == [event]
+    assert events.append(ALERT, 'Vince:Mix1').time == \
+        pytest.approx(time.time(), abs=5)
+    assert len(events) == 2
+    with pytest.raises(ValueError):
+        events.append('leak', 'LN2')
+
+
+def test_pages_of_events(events):
+    fill(events, 100)
+    page = events.query(30)
+    # newest first, and in order of appending at the same time
+    assert [e.message for e in page[:3]] == ['entry 99', 'entry 98',
+                                             'entry 97']
+    assert page[0].time == page[1].time
+    pages = []
+    while page:
+        pages.append(page)
+        page = events.query(30, before=page[-1].cursor)
+    assert [len(p) for p in pages] == [30, 30, 30, 10]
+    assert [e.message for p in pages for e in p] == \
+        ['entry %d' % i for i in reversed(range(100))]
+
+    # and back again
+    newer = events.query(30, after=pages[2][0].cursor)
+    assert newer == pages[1]
+    assert events.query(30, after=pages[0][0].cursor) == []
+    between = events.query(100, before=pages[0][0].cursor,
+                           after=pages[1][-1].cursor)
+    assert between == pages[0][1:] + pages[1][:-1]
+
+
+def test_filters(events):
+    fill(events, 30)
+    events.append(EXCURSION, 'Vince:4K_out', 'above 5', 6.0)
+    events.append(EXCURSION, 'Vince:4Kxout', 'above 5', 6.0)
+    assert all(e.kind == FILL for e in events.query(100, kinds=[FILL]))
+    assert len(events.query(100, kinds=[FILL, RESET])) == 30
+    assert set(e.name for e in events.query(100, name='ln')) == set(['LN2'])
+    # wildcards in names are matched as they are
+    assert [e.name for e in events.query(100, name='4K_')] == ['Vince:4K_out']
+    assert events.query(100, name='%') == []
+    assert events.query(10, kinds=[EXCURSION])[0].value == 6.0
+    assert events.query(10, kinds=[FILL])[0].value is None
+
+
+def test_queries_use_index(events):
+    fill(events, 10)
+    for sql, args in [
+            ('SELECT * FROM events WHERE (time < ? OR (time = ? AND id < ?)) '
+             'ORDER BY time DESC, id DESC LIMIT 10', (T0, T0, 1)),
+            ('SELECT * FROM events WHERE kind IN (?) ORDER BY time DESC, '
+             'id DESC LIMIT 10', (FILL,))]:
+        plan = ' '.join(str(row[-1]) for row in events.db.execute(
+            'EXPLAIN QUERY PLAN ' + sql, args))
+        assert 'USING INDEX' in plan or 'USING COVERING INDEX' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_log_is_kept():
+    root = tempfile.mkdtemp(prefix='cryoevents_')
+    try:
+        path = os.path.join(root, 'events.sqlite')
+        events = EventLog(path)
+        fill(events, 5)
+        events.close()
+        events = EventLog(path)
+        assert len(events) == 5
+        assert events.query(1)[0].message == 'entry 4'
+        events.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def registry_log(legacy, blocks=0):
+    reg = FakeRegistry()
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(legacy):
+        t = start + datetime.timedelta(hours=i)
+        reg.write(LOG, t.isoformat(), ('LN2', 'fill %d' % i))
+    for b in range(blocks):
+        t = start - datetime.timedelta(days=b + 1)
+        reg.write(LOG, 'block%06d' % b, [
+            ((t + datetime.timedelta(minutes=m)).isoformat(), 'LHe',
+             'block %d.%d' % (b, m)) for m in range(3)])
+    return reg
+
+
+def test_import_registry(events):
+    reg = registry_log(2500, blocks=2)
+    assert result(import_registry(reg, LOG, events, batch=1000)) == 2506
+    assert len(events) == 2506
+    assert reg._find(LOG)[1] == {}
+    # gets in one packet, deletes in batches
+    assert reg.packets == 3 + 3
+    page = events.query(3)
+    assert [e.message for e in page] == ['fill 2499', 'fill 2498',
+                                         'fill 2497']
+    assert all(e.kind == RESET for e in page)
+    assert page[0].time == parse_timestamp('2015-04-15T03:00:00')
+    oldest = events.query(2, after=(0, 0))
+    assert [e.message for e in oldest] == ['block 1.1', 'block 1.0']
+
+    # once imported, the keys are gone, and another import adds nothing
+    assert result(import_registry(reg, LOG, events)) == 0
+    assert len(events) == 2506
+
+
+def test_import_registry_keeping_keys(events):
+    reg = registry_log(3)
+    assert result(import_registry(reg, LOG, events, keep=True)) == 3
+    assert len(reg._find(LOG)[1]) == 3
+    # kept keys are noted, so they are not imported twice
+    assert result(import_registry(reg, LOG, events, keep=True)) == 0
+    assert len(events) == 3
+    assert result(import_registry(reg, LOG, events)) == 0
+    assert reg._find(LOG)[1] == {}
+
+
+def test_import_without_log(events):
+    reg = FakeRegistry()
+    reg.write(LOG[:-1], 'timers', [])
+    assert result(import_registry(reg, LOG, events)) == 0
+    assert len(events) == 0
+
+
+def benchmark(count, pages=100):
+    """Time appending events, and paging through the newest of them.
+
+    Returns:
+        (float, float): Seconds per event appended, and per page.
+    """
+    events = EventLog(':memory:')
+    start = time.time()
+    fill(events, count)
+    append_time = (time.time() - start) / count
+    start = time.time()
+    page = events.query(25)
+    for _ in range(pages):
+        page = events.query(25, before=page[-1].cursor)
+    page_time = (time.time() - start) / (pages + 1)
+    events.close()
+    return append_time, page_time
+
+
+def test_benchmark():
+    append_time, page_time = benchmark(20000)
+    assert page_time < 0.01
+
+
+if __name__ == '__main__':
+    count = 1000000
+    append_time, page_time = benchmark(count)
+    print '{} events: {:.1f} us per event appended, {:.2f} ms per ' \
+        'page'.format(count, append_time * 1e6, page_time * 1e3)
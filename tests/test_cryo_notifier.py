@@ -0,0 +1,324 @@
+"""Tests for the status snapshot and event log of the cryo notifier."""
+
+import datetime
+import os
+import urllib
+
+import pytest
+from twisted.internet import task
+from twisted.web.template import flattenString
+
+import labrad.units as U
+import cryo_notifier
+from cryolog.events import EventLog
+from http import cryo_log
+
+from fake_labrad import FakeConnection, FakeRegistry, FakeServer
+from simulated_scope import result
+
+ROOT = ['', 'Servers', 'Cryo Notifier']
+PATH = ROOT + ['Vince']
+LOG = PATH + ['log']
+HTTP = os.path.join(os.path.dirname(__file__), '..', 'http')
+
+
+class Thermometers(FakeServer):
+    """Lakeshore server with devices giving fixed temperatures."""
+    settings = ('list_devices', 'select_device', 'temperatures')
+
+    def __init__(self, name, readings):
+        super(Thermometers, self).__init__()
+        self.name = name
+        self.readings = readings
+        self.selected = {}
+        self.listed = 0
+
+    def setting_list_devices(self, c):
+        self.listed += 1
+        return list(enumerate(sorted(self.readings)))
+
+    def setting_select_device(self, c, name):
+        self.selected[c] = name
+        return name
+
+    def setting_temperatures(self, c):
+        return self.readings[self.selected[c]]
+
+
+class RuOx(Thermometers):
+    settings = Thermometers.settings + ('named_temperatures',)
+
+    def setting_named_temperatures(self, c):
+        now = datetime.datetime.now()
+        return [(name, (T, now)) for name, T in self.readings[self.selected[c]]]
+
+
+class Telecomm(FakeServer):
+    name = 'Telecomm Server'
+    settings = ('send_mail', 'send_sms')
+
+    def __init__(self):
+        super(Telecomm, self).__init__()
+        self.sent = []
+
+    def setting_send_mail(self, c, to, subject, msg):
+        self.sent.append(('mail', msg))
+
+    def setting_send_sms(self, c, subject, msg, user):
+        self.sent.append(('sms', msg))
+
+
+class NotifierServer(FakeServer):
+    """The settings of a CryoNotifier, as a LabRAD server to its clients."""
+    name = 'Cryo Notifier'
+    settings = ('query_timers', 'query_temperatures', 'diode_temperatures',
+                'ruox_temperatures', 'log_entries', 'query_events',
+                'query_counters')
+
+    def __init__(self, notifier):
+        super(NotifierServer, self).__init__()
+        self.notifier = notifier
+
+    def __getattr__(self, name):
+        if name.startswith('setting_'):
+            return getattr(self.notifier, name[8:])
+        return super(NotifierServer, self).__getattr__(name)
+
+
+class Request(object):
+    path = '/'
+
+    def __init__(self, **args):
+        self.args = dict((k, [v]) for k, v in args.items())
+
+
+def make_registry(legacy=0):
+    reg = FakeRegistry()
+    reg.write(ROOT, 'timers_enabled', False)
+    reg.write(PATH, 'temperatures', [('Vince:Mix1', 0.2 * U.K),
+                                     ('Vince:4Kout', 6.0 * U.K)])
+    reg.write(PATH, 'timers', [('LN2', 86400 * U.s), ('LHe', 3 * 86400 * U.s)])
+    reg.write(PATH, 'timers_enabled', True)
+    reg.write(PATH, 'notify_users', ['alice'])
+    reg.write(PATH, 'notify_email', ['alice@example.com'])
+    reg.write(PATH, 'sleepyTime', ((0, 0), (0, 0)))
+    reg.write(PATH, 'LN2_count', 3)
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(legacy):
+        t = start + datetime.timedelta(hours=i)
+        reg.write(LOG, t.isoformat(), ('LN2' if i % 2 else 'LHe', 'fill %d' % i))
+    return reg
+
+
+@pytest.fixture
+def clock():
+    return task.Clock()
+
+
+def make_notifier(clock, reg, ruoxDevices=('Vince GPIB Bus - GPIB0::12',),
+                  events=None):
+    ruox = RuOx('Lakeshore RuOx', dict(
+        (name, [('Mix1', 0.05 * U.K), ('Still', 0.8 * U.K)])
+        for name in ruoxDevices))
+    diodes = Thermometers('Lakeshore Diodes', {
+        'Vince GPIB Bus - GPIB0::3': [50.0 * U.K, 3.5 * U.K, 77.0 * U.K]})
+    server = cryo_notifier.CryoNotifier(events or EventLog(':memory:'))
+    server.clock = clock
+    server.client = FakeConnection(reg, ruox, diodes, Telecomm(),
+                                   FakeServer())
+    server.client['Node Vince'] = FakeServer()
+    result(server.initServer())
+    return server
+
+
+def cost(server):
+    """Requests made by the notifier to other servers so far."""
+    cxn = server.client
+    return (cxn.registry.cost(), cxn.lakeshore_ruox.packets,
+            cxn.lakeshore_diodes.packets)
+
+
+def test_status_is_read_from_snapshot(clock):
+    server = make_notifier(clock, make_registry())
+    assert server.path == PATH
+    before = cost(server)
+    assert dict(server.query_timers(None))['LN2']['s'] == \
+        pytest.approx(86400, abs=60)
+    assert dict(server.query_counters(None)) == {'LN2': 3, 'LHe': -1}
+    assert server.ruox_temperatures(None) == [('Mix1', 0.05 * U.K),
+                                              ('Still', 0.8 * U.K)]
+    assert server.diode_temperatures(None)[1] == 3.5 * U.K
+    temps = dict(server.query_temperatures(None))
+    assert temps['Vince:Mix1'] == 0.05 * U.K
+    assert temps['Vince:4Kout'] == 3.5 * U.K
+    assert server.snapshot.cold
+    assert not server.validate_user(None, 'bob')
+    assert server.validate_user(None, 'Alice')
+    assert server.log_entries(None, 10, '') == []
+    assert cost(server) == before
+
+
+def test_thermometers_of_this_fridge(clock):
+    server = make_notifier(clock, make_registry(), ruoxDevices=[
+        'Other GPIB Bus - GPIB0::12', 'Vince GPIB Bus - GPIB0::12'])
+    ruox = server.client.lakeshore_ruox
+    packets = ruox.packets
+    clock.pump([10.0] * 5)
+    assert ruox.packets == packets + 5
+    assert ruox.listed == 1
+    assert set(ruox.selected.values()) == set(['Vince GPIB Bus - GPIB0::12'])
+
+    # a failed read chooses the device again
+    del ruox.readings['Vince GPIB Bus - GPIB0::12']
+    clock.advance(10)
+    ruox.readings['Vince GPIB Bus - GPIB0::12'] = [('Mix1', 0.3 * U.K)]
+    clock.advance(10)
+    assert ruox.listed == 2
+    assert server.snapshot.temperatures['Vince:Mix1'] == 0.3 * U.K
+
+
+def test_registry_changes_refresh_snapshot(clock):
+    reg = make_registry()
+    server = make_notifier(clock, reg)
+    telecomm = server.client.telecomm_server
+    clock.pump([10.0] * 3)
+    assert telecomm.sent == []
+
+    # another client resets a timer to long ago
+    c = (1, 1)
+    p = reg.packet(context=c)
+    p.cd(PATH)
+    p.set('LN2_reset', datetime.datetime.now() - datetime.timedelta(days=2))
+    result(p.send())
+    packets = reg.packets
+    clock.advance(0)
+    assert reg.packets == packets + 2
+    assert dict(server.query_timers(None))['LN2']['s'] < 0
+
+    clock.pump([10.0] * 3)
+    assert [kind for kind, _ in telecomm.sent] == ['sms', 'mail']
+    assert 'LN2' in telecomm.sent[0][1]
+
+    # a fill resets the timer, and the alert can be sent again
+    result(server.reset_timer(None, 'LN2', 'filled'))
+    clock.advance(0)
+    assert dict(server.query_timers(None))['LN2']['s'] > 0
+    assert dict(server.query_counters(None))['LN2'] == 4
+    assert reg.read(PATH, 'LN2_count') == 4
+    clock.advance(10)
+    assert 'LN2' not in server.sent_notifications
+
+
+def test_registry_log_moves_to_events(clock):
+    reg = make_registry(legacy=5)
+    server = make_notifier(clock, reg)
+    assert len(server.events) == 5
+    assert reg._find(LOG)[1] == {}
+    entries = server.log_entries(None, 3, '')
+    assert [e[2] for e in entries] == ['fill 4', 'fill 3', 'fill 2']
+    assert entries[0][0] == '2015-01-01T04:00:00'
+    assert [e[2] for e in server.log_entries(None, 3, 'ln2')] == \
+        ['fill 3', 'fill 1']
+
+    # each reset appends an event, without writing a log to the registry
+    before = reg.cost()
+    result(server.reset_timer(None, 'LHe', 'filled'))
+    assert reg.cost()[0] == before[0] + 1
+    assert reg._find(LOG)[1] == {}
+    assert server.log_entries(None, 1, '')[0][1:] == ('LHe', 'filled')
+
+    # a restarted notifier keeps its log, and imports nothing again
+    restarted = make_notifier(clock, reg, events=server.events)
+    assert len(restarted.events) == 6
+
+
+def test_excursions_and_alerts_are_events(clock):
+    reg = make_registry()
+    reg.write(PATH, 'temperatures', [('Vince:Mix1', 0.01 * U.K)])
+    server = make_notifier(clock, reg)
+    clock.pump([10.0] * 2)
+    events = server.query_events(None, 10)
+    assert [e[2] for e in events] == ['alert', 'excursion']
+    excursion = events[1]
+    assert excursion[3] == 'Vince:Mix1'
+    assert excursion[5] == pytest.approx(0.05)
+    assert 'Notified' in events[0][4]
+
+    id = server.log_event(None, 'fill', 'LN2', 'topped up')
+    latest = server.query_events(None, 1)[0]
+    assert latest[0] == id
+    assert latest[2:5] == ('fill', 'LN2', 'topped up')
+    # no value
+    assert latest[5] != latest[5]
+    assert [e[2] for e in server.query_events(None, 10, '', ['fill', 'reset'])] \
+        == ['fill']
+    with pytest.raises(ValueError):
+        server.log_event(None, 'leak', 'LN2')
+
+
+def render(server, **args):
+    cxn = FakeConnection(NotifierServer(server))
+    page = cryo_log.CryoStatusPage(cxn, Request(**args))
+    html = result(flattenString(None, page))
+    return html, cxn.cryo_notifier.packets
+
+
+def costs(monkeypatch, clock, entries):
+    """Requests made to other servers to check for alerts, and to render
+    the status page, with a log of a number of entries."""
+    monkeypatch.chdir(HTTP)
+    server = make_notifier(clock, make_registry(legacy=entries))
+    before = cost(server)
+    clock.advance(10)
+    check = [b - a if isinstance(a, int) else
+             tuple(y - x for x, y in zip(a, b))
+             for a, b in zip(before, cost(server))]
+    before = cost(server)
+    html, packets = render(server, cryo='LN2', maxentries='5')
+    assert cost(server) == before
+    assert html.count('<pre>') == 5
+    # the newest LN2 fills, odd numbered
+    assert '<pre>fill %d</pre>' % (entries - 1) in html
+    assert '<pre>fill %d</pre>' % (entries - 9) in html
+    assert '<pre>fill %d</pre>' % (entries - 11) not in html
+    assert 'Newer' not in html
+    return check, packets
+
+
+def test_costs_do_not_grow_with_log(monkeypatch, clock):
+    check, packets = costs(monkeypatch, clock, 12)
+    # the thermometers are read, without the registry
+    assert check == [(0, 0, 0), 1, 1]
+    assert packets == 1
+    assert costs(monkeypatch, clock, 5002) == (check, packets)
+
+
+def test_pages_of_events(monkeypatch, clock):
+    monkeypatch.chdir(HTTP)
+    server = make_notifier(clock, make_registry(legacy=12))
+
+    def fills(html):
+        return [int(line.split('</pre>')[0])
+                for line in html.split('<pre>fill ')[1:]]
+
+    def link(html, label):
+        href = html.split('">%s</a>' % label)[0].rsplit('href="', 1)[1]
+        args = dict(arg.split('=') for arg in href[1:].split('&amp;'))
+        return dict((k, urllib.unquote(v)) for k, v in args.items())
+
+    html, _ = render(server, maxentries='5')
+    assert fills(html) == [11, 10, 9, 8, 7]
+    assert 'Newer' not in html
+    older = link(html, 'Older')
+    html, packets = render(server, **older)
+    assert packets == 1
+    assert fills(html) == [6, 5, 4, 3, 2]
+    html, _ = render(server, **link(html, 'Older'))
+    assert fills(html) == [1, 0]
+    assert 'Older' not in html
+    html, _ = render(server, **link(html, 'Newer'))
+    assert fills(html) == [6, 5, 4, 3, 2]
+    html, _ = render(server, **link(html, 'Newer'))
+    assert fills(html) == [11, 10, 9, 8, 7]
+    assert 'Newer' not in html
+    assert 'Older' in html
@@ -0,0 +1,305 @@
+"""Tests for the DR logger, with fake watched servers and a local data vault.
+
+Time in the logger is driven by a task.Clock, which also stands in for
+time.time(), so that fake servers can answer with a given latency.
+"""
+
+import time
+
+import mock
+import numpy as np
+import pytest
+from twisted.internet import defer, task
+
+import labrad.units as U
+from labrad import types as T
+
+import dr_logger
+
+from local_datavault import datavault
+from simulated_scope import result
+
+MIDNIGHT = time.mktime((2020, 1, 2, 0, 0, 0, 0, 0, -1))
+T0 = MIDNIGHT + 0.5
+
+
+class FakeServer(object):
+    """Watched server which returns its values after a latency."""
+
+    def __init__(self, clock, values, latency=0.0):
+        self.clock = clock
+        self.values = values
+        self.latency = latency
+        self.error = None
+        self.calls = 0
+
+    def reading(self):
+        self.calls += 1
+        if self.error is not None:
+            return defer.fail(T.Error(self.error))
+        values = [v * U.K for v in self.values]
+        if self.latency:
+            return task.deferLater(self.clock, self.latency, lambda: values)
+        return defer.succeed(values)
+
+
+class FakeWatcher(dr_logger.WatchedServer):
+    def _take_point(self):
+        return self.server.reading()
+
+    def get_variables(self):
+        return ['%s %d (Fake) [K]' % (self.name, i)
+                for i in range(len(self.cxn[self.name].values))]
+
+
+WATCHERS = [type('Fake%d' % i, (FakeWatcher,), {'server_name': 'fake_%d' % i})
+            for i in range(3)]
+
+
+class FakeConnection(dict):
+    def context(self):
+        return (0, 7)
+
+
+@pytest.fixture
+def clock():
+    clock = task.Clock()
+    clock.advance(T0)
+    with mock.patch.object(dr_logger, 'WATCHERS', WATCHERS), \
+            mock.patch.object(dr_logger.time, 'time', clock.seconds):
+        yield clock
+
+
+def fake_servers(clock, latencies):
+    """Servers whose i-th has i + 1 values, 10 * i + j."""
+    return [FakeServer(clock, [10.0 * i + j for j in range(i + 1)], latency)
+            for i, latency in enumerate(latencies)]
+
+
+def make_logger(clock, datavault, servers, **kwargs):
+    cxn = FakeConnection(('fake_%d' % i, server)
+                         for i, server in enumerate(servers))
+    cxn['data_vault'] = datavault
+    for i in range(len(servers)):
+        kwargs['fake_%d' % i] = ('fake_%d' % i, 'node')
+    dev = dr_logger.DRLogger('guid', 'Test')
+    dev.clock = clock
+    result(dev.connect(cxn, **kwargs))
+    return dev
+
+
+def saved(datavault):
+    return result(datavault.get(context=(0, 7)))
+
+
+def test_watchers_polled_concurrently(clock, datavault):
+    servers = fake_servers(clock, [0.3, 0.5, 0.2])
+    dev = make_logger(clock, datavault, servers, batchSize=1)
+    clock.advance(0.49)
+    assert len(dev.buffer) == 0
+    clock.advance(0.01)
+    # the first point makes the dataset
+    data = saved(datavault)
+    assert data.shape == (1, 1 + 1 + 2 + 3 + 1)
+    assert np.array_equal(data[0], [T0, 0, 10, 11, 20, 21, 22, 0])
+    indeps, deps = result(datavault.variables(context=(0, 7)))
+    assert deps[-1] == ('Errors', 'Watchers', '')
+    assert result(datavault.get_parameter('watchers', context=(0, 7))) == \
+        ['fake_0', 'fake_1', 'fake_2']
+    clock.pump([0.5] * 4)
+    assert len(saved(datavault)) == 3
+    assert [s.calls for s in servers] == [3, 3, 3]
+
+
+def test_failures_and_timeouts(clock, datavault):
+    servers = fake_servers(clock, [0.0, 5.0, 0.0])
+    servers[2].error = 'lakeshore went away'
+    dev = make_logger(clock, datavault, servers, batchSize=1,
+                      timeout=2 * U.s)
+    clock.advance(2)
+    data = saved(datavault)
+    assert len(data) == 1
+    assert data[0, 1] == 0
+    assert np.all(np.isnan(data[0, 2:7]))
+    assert data[0, -1] == 0b110
+    assert dev.errors == [('fake_1', 'no answer in 2.0 s'),
+                          ('fake_2', 'lakeshore went away')]
+
+    # no new request is made while the slow one is unanswered
+    servers[2].error = None
+    clock.advance(1)
+    assert servers[1].calls == 1
+    assert dev.errors == [('fake_1', 'previous request still unanswered')]
+    assert saved(datavault)[-1, -1] == 0b10
+    clock.pump([1.0] * 4)
+    # the slow server answered at 5 s, and was asked again
+    assert servers[1].calls == 2
+    assert len(saved(datavault)) == 4
+
+
+def test_batched_writes(clock, datavault):
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0, 0.0]),
+                      batchSize=4)
+    # dataset made for the first point
+    requests = datavault.requests
+    clock.pump([1.0] * 3)
+    assert datavault.requests == requests
+    assert len(dev.buffer) == 3
+    clock.advance(1)
+    assert datavault.requests == requests + 1
+    assert not dev.buffer
+    assert len(saved(datavault)) == 5
+
+    # points are kept while the data vault fails
+    add = datavault.add
+    datavault.add = mock.Mock(side_effect=T.Error('data vault is down'))
+    clock.pump([1.0] * 8)
+    assert len(dev.buffer) == 8
+    assert dev.errors[-1] == ('Data Vault', 'data vault is down')
+    datavault.add = add
+    result(dev.logging(False))
+    assert not dev.buffer
+    data = saved(datavault)
+    assert np.array_equal(data[:, 0], T0 + np.arange(13))
+
+
+def test_rollover_keeps_points(clock, datavault):
+    # start a few seconds before the next midnight
+    clock.advance(24 * 60 * 60 - 4)
+    start = clock.seconds()
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0]),
+                      batchSize=100)
+    clock.pump([1.0] * 6)
+    # points before midnight were saved before the rollover
+    assert len(dev.buffer) == 2
+    result(dev.logging(False))
+    names = result(datavault.dir(context=(0, 7)))[1]
+    assert len(names) == 2
+    times = []
+    for name in names:
+        result(datavault.open(name, context=(0, 7)))
+        times.append(saved(datavault)[:, 0])
+    assert np.array_equal(times[0], start + np.arange(4))
+    assert np.array_equal(times[1], start + np.arange(4, 7))
+    assert np.all(times[0] < MIDNIGHT + 24 * 60 * 60)
+    assert np.all(times[1] > MIDNIGHT + 24 * 60 * 60)
+
+    result(dev.new_dataset())
+    assert dev.data_vault is None
+
+
+def test_run_is_one_dataset(clock, datavault):
+    clock.advance(24 * 60 * 60 - 4)
+    start = clock.seconds()
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0, 0.0]),
+                      batchSize=2, run='cooldown 1')
+    clock.pump([1.0] * 7)
+    result(dev.logging(False))
+    # no rollover at midnight
+    names = result(datavault.dir(context=(0, 7)))[1]
+    assert names == ['00001 - Test run cooldown 1']
+    assert np.array_equal(saved(datavault)[:, 0], start + np.arange(8))
+
+    # a restarted logger appends to the run
+    clock.advance(100)
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0, 0.0]),
+                      batchSize=2, run='cooldown 1')
+    clock.pump([1.0] * 3)
+    result(dev.logging(False))
+    assert result(datavault.dir(context=(0, 7)))[1] == names
+    data = saved(datavault)
+    assert len(data) == 12
+    assert np.all(np.diff(data[:, 0]) > 0)
+
+    # rows are read by time
+    rows = result(datavault.get_range(start + 2, start + 5, context=(0, 7)))
+    assert np.array_equal(rows[:, 0], start + np.arange(2, 6))
+    rows = result(datavault.get_range(start + 2.5, start + 1000, 3,
+                                      context=(0, 7)))
+    assert np.array_equal(rows[:, 0], start + np.arange(3, 6))
+    rows = result(datavault.get_range(start + 8.5, start + 9,
+                                      context=(0, 7)))
+    assert len(rows) == 0
+
+    # a run with other watchers gets a new dataset
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0]),
+                      batchSize=1, run='cooldown 1')
+    result(dev.logging(False))
+    assert len(result(datavault.dir(context=(0, 7)))[1]) == 2
+
+    # back to daily datasets
+    result(dev.set_run(''))
+    result(dev.take_point())
+    assert result(datavault.dir(context=(0, 7)))[1][-1].startswith(
+        '00003 - Test log - ')
+
+
+def test_migrate_daily_datasets(clock, datavault):
+    from dr_logger_migrate import migrate
+    ctx = (0, 1)
+    path = ['', 'DR', 'Test']
+    result(datavault.cd(path, True, context=ctx))
+    # an old dataset without the errors variable, and one with
+    old = ['fake_0 0 (Fake) [K]']
+    new = ['fake_0 0 (Fake) [K]', 'fake_1 0 (Fake) [K]',
+           'fake_1 1 (Fake) [K]', dr_logger.ERROR_VARIABLE]
+    result(datavault.new('Test log - day 1', ['time [s]'], old, context=ctx))
+    result(datavault.add([[T0 - 9 + i, i] for i in range(5)], context=ctx))
+    result(datavault.new('Test log - day 2', ['time [s]'], new, context=ctx))
+    result(datavault.add([[T0 - 9 + i, i, 10 + i, 11 + i, 0]
+                          for i in range(5, 9)], context=ctx))
+    sources = result(datavault.dir(context=ctx))[1]
+
+    name, copied = result(migrate(datavault, path, sources, 'Test run 1',
+                                  batch=3))
+    assert copied == 9
+    # migrating again copies nothing
+    assert result(migrate(datavault, path, sources, 'Test run 1')) == (name, 0)
+
+    dev = make_logger(clock, datavault, fake_servers(clock, [0.0, 0.0]),
+                      batchSize=1, run='1')
+    clock.pump([1.0] * 3)
+    result(dev.logging(False))
+    assert result(datavault.dir(context=ctx))[1] == sources + [name]
+    data = saved(datavault)
+    assert data.shape == (9 + 4, 5)
+    assert np.array_equal(data[:9, 0], T0 - 9 + np.arange(9))
+    assert np.array_equal(data[:5, 1], np.arange(5))
+    assert np.all(np.isnan(data[:5, 2:]))
+    assert np.array_equal(data[5:9, 1:],
+                          [[i, 10 + i, 11 + i, 0] for i in range(5, 9)])
+    assert np.array_equal(data[9:, 0], T0 + np.arange(4))
+
+
+def test_migrate_datasets_without_errors(clock, datavault):
+    from dr_logger_migrate import migrate
+    ctx = (0, 1)
+    path = ['', 'DR', 'Test']
+    result(datavault.cd(path, True, context=ctx))
+    variables = ['fake_0 0 (Fake) [K]', 'fake_1 0 (Fake) [K]',
+                 'fake_1 1 (Fake) [K]']
+    for day in range(2):
+        result(datavault.new('Test log - day %d' % day, ['time [s]'],
+                             variables, context=ctx))
+        result(datavault.add([[T0 - 9 + 4 * day + i, i, 10 + i, 11 + i]
+                              for i in range(4)], context=ctx))
+    sources = result(datavault.dir(context=ctx))[1]
+    name, copied = result(migrate(datavault, path, sources, 'Test run 1'))
+    assert copied == 8
+
+    # the logger appends to the migrated dataset
+    servers = fake_servers(clock, [0.0, 0.0])
+    servers[1].error = 'down'
+    dev = make_logger(clock, datavault, servers, batchSize=1, run='1')
+    clock.pump([1.0] * 3)
+    result(dev.logging(False))
+    assert result(datavault.dir(context=ctx))[1] == sources + [name]
+    _, deps = result(datavault.variables(context=(0, 7)))
+    assert [dr_logger.variable_name(d) for d in deps] == \
+        variables + [dr_logger.ERROR_VARIABLE]
+    data = saved(datavault)
+    assert data.shape == (8 + 4, 5)
+    assert np.all(np.isnan(data[:8, 4]))
+    assert np.all(data[8:, 4] == 2)
+    assert result(datavault.get_parameter('watchers', context=(0, 7))) == \
+        ['fake_0', 'fake_1']
@@ -0,0 +1,180 @@
+"""Tests for gpib_server.py, using a fake VISA resource manager."""
+
+import sys
+import threading
+import time
+import types
+
+import mock
+import pytest
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+try:
+    import visa
+except ImportError:
+    # The fake resource manager below stands in for pyvisa.
+    sys.modules['visa'] = types.ModuleType('visa')
+
+import gpib_server
+
+
+class FakeInstrument(object):
+    """Instrument answering queries with a per-call delay."""
+
+    def __init__(self, addr, delay):
+        self.addr = addr
+        self.delay = delay
+        self.written = []
+        self.active = 0
+        self.maxActive = 0
+        self._lock = threading.Lock()
+
+    def _busy(self):
+        with self._lock:
+            self.active += 1
+            self.maxActive = max(self.maxActive, self.active)
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+
+    def clear(self):
+        pass
+
+    def write(self, data):
+        self._busy()
+        self.written.append(data)
+
+    def write_raw(self, data):
+        self.write(data)
+
+    def read_raw(self, n_bytes=None):
+        self._busy()
+        ans = '{}:{}\n'.format(self.addr, self.written[-1])
+        return ans if n_bytes is None else ans[:n_bytes]
+
+
+class FakeResourceManager(object):
+    def __init__(self, instruments):
+        self.instruments = instruments
+
+    def list_resources(self):
+        return tuple(self.instruments)
+
+    def get_instrument(self, addr):
+        return self.instruments[addr]
+
+
+def wait(d, timeout=5.0):
+    """Process thread results in the reactor until d fires."""
+    results = []
+    d.addBoth(results.append)
+    end = time.time() + timeout
+    while not results and time.time() < end:
+        reactor.runUntilCurrent()
+        time.sleep(0.001)
+    assert results, 'timed out'
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+class TestGPIBServer(object):
+    delay = 0.1
+    numDevices = 6
+
+    def setup_method(self, method):
+        self.instruments = dict(
+            ('GPIB0::{}::INSTR'.format(i),
+             FakeInstrument('GPIB0::{}::INSTR'.format(i), self.delay))
+            for i in range(self.numDevices))
+        rm = FakeResourceManager(self.instruments)
+        self.patcher = mock.patch.object(
+            gpib_server, 'visa', mock.Mock(ResourceManager=lambda: rm),
+            create=True)
+        self.patcher.start()
+        self.server = gpib_server.GPIBBusServer()
+        self.server.client = mock.MagicMock()
+        self.server.devices = {}
+        self.server.pool = ThreadPool(maxthreads=gpib_server.VISA_THREADS)
+        self.server.pool.start()
+        wait(self.server.refreshDevices())
+
+    def teardown_method(self, method):
+        self.server.pool.stop()
+        self.patcher.stop()
+
+    def context(self, addr):
+        c = {}
+        self.server.initContext(c)
+        self.server.address(c, addr)
+        return c
+
+    def test_devices_served_concurrently(self):
+        addrs = sorted(self.instruments)
+        assert self.server.list_devices(None) == addrs
+        start = time.time()
+        answers = wait(defer.gatherResults(
+            [self.server.query(self.context(addr), '*IDN?')
+             for addr in addrs]))
+        elapsed = time.time() - start
+        assert answers == ['{}:*IDN?'.format(addr) for addr in addrs]
+        # each query is a write and a read, i.e. two delays
+        assert elapsed < 2 * self.delay * self.numDevices / 2
+
+    def test_same_address_is_ordered(self):
+        addr = 'GPIB0::1::INSTR'
+        c = self.context(addr)
+        calls = [self.server.write(c, 'CMD{}'.format(i)) for i in range(4)]
+        calls.append(self.server.read(c))
+        ans = wait(defer.gatherResults(calls))
+        instr = self.instruments[addr]
+        assert instr.written == ['CMD0', 'CMD1', 'CMD2', 'CMD3']
+        assert instr.maxActive == 1
+        assert ans[-1] == '{}:CMD3'.format(addr)
+        stats = dict((s[0], s[1:]) for s in self.server.queue_stats(c))
+        depth, count, mean, worst = stats[addr]
+        assert (depth, count) == (0, 5)
+        assert worst['s'] >= 4 * self.delay
+        assert stats['GPIB0::2::INSTR'][1] == 0
+
+    def test_read_raw(self):
+        c = self.context('GPIB0::3::INSTR')
+        wait(self.server.write_raw(c, 'AB'))
+        assert wait(self.server.read_raw(c, 5)) == 'GPIB0'
+
+    def test_unknown_address(self):
+        with pytest.raises(Exception):
+            self.server.write(self.context('GPIB0::99::INSTR'), 'CMD')
+
+    def test_transaction(self):
+        addr = 'GPIB0::2::INSTR'
+        c = self.context(addr)
+        ops = [('write', 'FREQ 5GHZ'), ('query', 'FREQ?'), ('write', 'POW 0'),
+               ('read', ''), ('read_raw', '5')]
+        ans = wait(self.server.transaction(c, ops))
+        assert ans == ['', '{}:FREQ?'.format(addr), '',
+                       '{}:POW 0'.format(addr), 'GPIB0']
+        assert self.instruments[addr].written == ['FREQ 5GHZ', 'FREQ?',
+                                                  'POW 0']
+        # five operations, one request to the instrument's worker
+        assert self.server.devices[addr].calls == 1
+
+    def test_transaction_is_atomic(self):
+        addr = 'GPIB0::4::INSTR'
+        c = self.context(addr)
+        first = self.server.transaction(c, [('write', 'A'), ('query', 'B?')])
+        other = self.server.write(c, 'C')
+        second = self.server.transaction(c, [('query', 'D?')])
+        ans = wait(defer.gatherResults([first, other, second]))
+        assert ans == [['', '{}:B?'.format(addr)], None,
+                       ['{}:D?'.format(addr)]]
+        assert self.instruments[addr].written == ['A', 'B?', 'C', 'D?']
+
+    def test_transaction_unknown_operation(self):
+        addr = 'GPIB0::5::INSTR'
+        with pytest.raises(ValueError):
+            self.server.transaction(self.context(addr),
+                                    [('write', 'A'), ('frobnicate', '')])
+        assert self.instruments[addr].written == []
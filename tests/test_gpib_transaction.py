@@ -0,0 +1,121 @@
+"""Tests for gpib_transaction.py, against a fake GPIB bus server."""
+
+import pytest
+from twisted.internet import defer
+
+from gpib_transaction import GPIBTransactionWrapper
+
+
+class FakeBus(object):
+    """Loopback GPIB bus: queries are answered with the query string.
+
+    Counts the requests made, i.e. LabRAD round trips.
+    """
+
+    def __init__(self, transactions=True):
+        self.transactions = transactions
+        self.requests = 0
+        self.written = []
+
+    def context(self):
+        return (0, 1)
+
+    def packet(self, context=None):
+        return FakePacket(self)
+
+
+class FakePacket(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.calls = []
+
+    def _op(self, name, arg=None):
+        self.calls.append((name, arg))
+        return self
+
+    def address(self, addr):
+        return self._op('address', addr)
+
+    def timeout(self, t):
+        return self._op('timeout', t)
+
+    def write(self, data):
+        return self._op('write', data)
+
+    def query(self, data):
+        return self._op('query', data)
+
+    def read(self, n=None):
+        return self._op('read', n)
+
+    def read_raw(self, n=None):
+        return self._op('read_raw', n)
+
+    def __getattr__(self, name):
+        if name == 'transaction' and self.bus.transactions:
+            return lambda ops: self._op('transaction', ops)
+        raise AttributeError(name)
+
+    def _run(self, op, arg):
+        if op in ('write', 'query'):
+            self.bus.written.append(arg)
+        if op == 'query':
+            return 'ans:' + arg
+        if op in ('read', 'read_raw'):
+            return 'ans:' + self.bus.written[-1]
+        return ''
+
+    def send(self):
+        self.bus.requests += 1
+        resp = Response()
+        for name, arg in self.calls:
+            if name == 'transaction':
+                resp.transaction = [self._run(op, a) for op, a in arg]
+            else:
+                setattr(resp, name, self._run(name, arg))
+        return defer.succeed(resp)
+
+
+class Response(object):
+    pass
+
+
+def connect(bus):
+    dev = GPIBTransactionWrapper('dev', 'GPIB0::1::INSTR')
+    results = []
+    dev.connect(bus, 'GPIB0::1::INSTR').addCallback(results.append)
+    assert results
+    bus.requests = 0
+    return dev
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results
+    return results[0]
+
+
+OPS = [('write', 'SENS:SWE:TYPE LIN'), ('query', 'SENS:SWE:POIN?'),
+       ('write', 'OUTP ON'), ('read', ''), ('query', 'SENS:SWE:TIME?')]
+EXPECTED = ['', 'ans:SENS:SWE:POIN?', '', 'ans:OUTP ON', 'ans:SENS:SWE:TIME?']
+
+
+def test_transaction_one_round_trip():
+    bus = FakeBus()
+    dev = connect(bus)
+    assert result(dev.transaction(OPS)) == EXPECTED
+    assert bus.requests == 1
+    assert result(dev.queries('A?', 'B?')) == ['ans:A?', 'ans:B?']
+    assert bus.requests == 2
+
+
+def test_fallback_without_transactions():
+    bus = FakeBus(transactions=False)
+    dev = connect(bus)
+    assert result(dev.transaction(OPS)) == EXPECTED
+    assert bus.requests == len(OPS)
+    assert bus.written == [arg for op, arg in OPS if op != 'read']
+    assert result(dev.transaction([('read_raw', '')])) == ['ans:SENS:SWE:TIME?']
+    with pytest.raises(ValueError):
+        result(dev.transaction([('frobnicate', '')])).raiseException()
@@ -0,0 +1,195 @@
+"""Tests for status pushed to open pages by the HTTP servers."""
+
+import json
+import os
+
+import pytest
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.server import Site
+
+from http import cryo_log, http_server
+
+from fake_labrad import FakeConnection
+from test_cryo_notifier import (HTTP, NotifierServer, make_notifier,
+                                make_registry)
+
+
+class Client(object):
+    """An HTTP/1.0 client, connected to a site in memory, which reads the
+    response as it comes."""
+
+    def __init__(self, site, path):
+        self.transport = StringTransport(
+            peerAddress=IPv4Address('TCP', '127.0.0.1', 50000))
+        self.channel = site.buildProtocol(self.transport.getPeer())
+        self.channel.makeConnection(self.transport)
+        self.channel.dataReceived(
+            'GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' % path)
+
+    @property
+    def headers(self):
+        return self.transport.value().split('\r\n\r\n', 1)[0]
+
+    @property
+    def body(self):
+        return self.transport.value().split('\r\n\r\n', 1)[1]
+
+    @property
+    def events(self):
+        """Server-sent events so far, as (id, event, data)."""
+        events = []
+        for block in self.body.split('\n\n')[:-1]:
+            fields = dict(line.split(': ', 1) for line in block.split('\n'))
+            if 'event' in fields:
+                events.append((int(fields['id']), fields['event'],
+                               json.loads(fields['data'])))
+        return events
+
+    def close(self):
+        self.channel.connectionLost(Failure(ConnectionDone()))
+
+
+@pytest.fixture
+def clock():
+    return task.Clock()
+
+
+@pytest.fixture
+def notifier(monkeypatch, clock):
+    monkeypatch.chdir(HTTP)
+    return make_notifier(clock, make_registry(legacy=3))
+
+
+def make_site(notifier, clock, interval=10):
+    """The site of the standalone cryo status server."""
+    cxn = FakeConnection(NotifierServer(notifier))
+    feed = http_server.StatusFeed(cryo_log.cryo_feed, cxn, interval)
+    feed.clock = clock
+    root = cryo_log.StatusResource(cryo_log.CryoStatusPage, cxn)
+    root.putChild('events', http_server.EventStreamResource(feed))
+    site = Site(root)
+    site.timeOut = None
+    return site, feed, cxn.cryo_notifier
+
+
+def test_viewers_share_one_poll(notifier, clock):
+    site, feed, upstream = make_site(notifier, clock)
+    viewers = [Client(site, '/events')]
+    assert 'text/event-stream' in viewers[0].headers
+    assert upstream.packets == 1
+    viewers += [Client(site, '/events') for _ in range(9)]
+    assert upstream.packets == 1
+    for viewer in viewers:
+        (version, event, status), = viewer.events
+        assert event == 'status'
+        assert sorted(status) == ['Diode', 'RuOx', 'events', 'timers']
+        assert status['RuOx'] == [['Mix1: ', '50.000 mK'],
+                                  ['Still: ', '800.000 mK']]
+        assert [e[3] for e in status['events']] == ['fill 2', 'fill 1',
+                                                    'fill 0']
+
+    # a change is pushed to every viewer, once
+    notifier.log_event(None, 'fill', 'LN2', 'topped up')
+    clock.advance(10)
+    assert upstream.packets == 2
+    for viewer in viewers:
+        assert len(viewer.events) == 2
+        version, event, delta = viewer.events[-1]
+        assert (version, event) == (2, 'delta')
+        assert 'RuOx' not in delta
+        assert delta['events'][0][1:4] == ['fill', 'LN2', 'topped up']
+
+    # nothing is sent while nothing changes, except timers counting down
+    clock.pump([10] * 5)
+    assert upstream.packets == 7
+    for viewer in viewers:
+        assert all(set(delta) <= set(['timers'])
+                   for _, _, delta in viewer.events[2:])
+
+    # the feed stops polling when the last viewer has left
+    for viewer in viewers:
+        viewer.close()
+    clock.pump([10] * 5)
+    assert upstream.packets == 7
+    assert feed.loop is None
+    assert feed.status is None
+
+
+def test_long_poll(notifier, clock):
+    site, feed, upstream = make_site(notifier, clock)
+    first = Client(site, '/events?since=0')
+    assert 'application/json' in first.headers
+    response = json.loads(first.body)
+    assert response['full']
+    assert sorted(response['status']) == ['Diode', 'RuOx', 'events', 'timers']
+    assert feed.loop.running
+
+    # a client which is up to date waits for the next change
+    waiting = Client(site, '/events?since=%d' % response['version'])
+    assert waiting.transport.value() == ''
+    notifier.log_event(None, 'fill', 'LHe', 'topped up')
+    clock.advance(10)
+    response = json.loads(waiting.body)
+    assert not response['full']
+    assert response['status']['events'][0][3] == 'topped up'
+
+    # one which is behind gets the whole status at once
+    behind = Client(site, '/events?since=1')
+    assert json.loads(behind.body)['full']
+    assert upstream.packets == 2
+    clock.pump([10] * 3)
+    assert upstream.packets == 2
+    assert feed.loop is None
+
+
+def test_failed_polls_keep_status(notifier, clock, monkeypatch):
+    site, feed, upstream = make_site(notifier, clock)
+    viewer = Client(site, '/events')
+    monkeypatch.setattr(notifier, 'ruox_temperatures', None)
+    clock.advance(10)
+    _, event, delta = viewer.events[-1]
+    assert event == 'delta'
+    assert 'error' in delta
+    assert feed.status['RuOx']
+    monkeypatch.undo()
+    clock.advance(10)
+    assert viewer.events[-1][2]['error'] is None
+    assert 'error' not in feed.status
+
+
+def test_page_starts_feed(notifier, clock):
+    site, feed, upstream = make_site(notifier, clock)
+    page = Client(site, '/?cryo=LN2&maxentries=2')
+    assert '<table id="timers">' in page.body
+    # with the time and id of the newest event shown
+    assert 'watchStatus("/events", "LN2", 2, [1420074000.0, 2]);' in page.body
+    assert feed.loop is None
+    # the page is served below the root too, with its events next to it
+    page = Client(site, '/cryo/')
+    assert 'watchStatus("/cryo/events", "", 25, [1420077600.0, 3]);' in \
+        page.body
+    (_, event, status), = Client(site, '/cryo/events').events
+    assert event == 'status'
+    # events are sent with the same time and id, to find those not shown
+    assert status['events'][0][3:] == ['fill 2', 1420077600.0, 3]
+    # later pages of the log are not added to
+    page = Client(site, '/?before=1420070400.0_1')
+    assert 'watchStatus("/events", "", 0, null);' in page.body
+
+
+def test_module_pages_have_feeds(notifier, clock, monkeypatch):
+    monkeypatch.syspath_prepend(HTTP)
+    monkeypatch.chdir(os.path.join(HTTP, 'modules'))
+    cxn = FakeConnection(NotifierServer(notifier))
+    site = Site(http_server.RootStatusResource(cxn))
+    site.timeOut = None
+    page = Client(site, '/cryo_log?cryo=LN2')
+    assert 'watchStatus("/cryo_log/events", "LN2", 25, ' in page.body
+    viewer = Client(site, '/cryo_log/events')
+    (_, event, status), = viewer.events
+    assert status['events'][0][3] == 'fill 2'
+    viewer.close()
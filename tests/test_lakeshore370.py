@@ -0,0 +1,214 @@
+"""Tests for the compiled calibrations of the Lakeshore 370 server."""
+
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import labrad.units as U
+import lakeshore370
+from lakeshore.calibration import (DEFAULT, FUNCTION, INTERPOLATION, VRHOPPING,
+                                   Calibrations, compile_calibration,
+                                   compile_expression)
+
+JULES = '((math.log(r) - 6.02) / 1.76) ** (-1/.345)'
+JULES_INVERSE = 'math.exp(1.76*(t**(-0.345)) + 6.02)'
+
+CALIBRATIONS = {
+    'interpolation': [INTERPOLATION,
+                      np.array([1100.0, 1500.0, 3000.0, 9000.0, 60000.0]),
+                      np.array([4.0, 1.0, 0.2, 0.05, 0.01])],
+    'vrhopping': [VRHOPPING, U.Value(520.0, 'Ohm'), U.Value(11.0, 'K')],
+    'function': [FUNCTION, JULES, JULES_INVERSE],
+    'default': [DEFAULT],
+}
+
+
+def legacy_temperature(calibration, r):
+    """Temperature in K as converted by RuOxWrapper.getSingleTemp before
+    calibrations were compiled, for a single resistance in Ohm."""
+    try:
+        if calibration[0] == INTERPOLATION:
+            return float(np.exp(np.interp(np.log(r),
+                                          np.log(np.array(calibration[1])),
+                                          np.log(np.array(calibration[2])))))
+        elif calibration[0] == VRHOPPING:
+            T0 = calibration[2]
+            R0 = calibration[1]
+            return (T0 / (np.log(R0 / (r * U.Ohm)) ** 4))['K']
+        elif calibration[0] == FUNCTION:
+            return eval(calibration[1])
+        else:
+            return ((math.log(r) - 6.02) / 1.76) ** (-1 / .345)
+    except Exception:
+        return 0.0
+
+
+def resistances():
+    return np.concatenate(([0.0, 1000.0, 1100.0, 60000.0, 1e5],
+                           np.logspace(3, 5, 200)))
+
+
+def make_wrapper(calibrations, channels=4):
+    dev = lakeshore370.RuOxWrapper.__new__(lakeshore370.RuOxWrapper)
+    dev.addr = 'GPIB0::12'
+    dev.calibrations = calibrations
+    dev.channelNames = ['ch%d' % (i + 1) for i in range(channels)]
+    dev.readings = dict((i + 1, (0 * U.Ohm, datetime.now()))
+                        for i in range(channels))
+    dev.compileCalibrations()
+    return dev
+
+
+@pytest.mark.parametrize('name', sorted(CALIBRATIONS))
+def test_matches_legacy_conversion(name):
+    calibration = CALIBRATIONS[name]
+    compiled = compile_calibration(calibration)
+    if compiled is None:
+        compiled = Calibrations(None, []).device
+    assert compiled.kind == calibration[0]
+    rs = resistances()
+    expected = [legacy_temperature(calibration, r) for r in rs]
+    assert np.allclose(compiled.temperature(rs), expected, rtol=1e-12)
+    # scalars too
+    assert compiled.temperature(rs[3]) == pytest.approx(expected[3])
+
+    # the inverse goes back to the resistance
+    rs = np.logspace(3.1, 4.5, 20)
+    temps = compiled.temperature(rs)
+    assert np.allclose(compiled.resistance(temps), rs, rtol=1e-6)
+
+
+def test_channels_fall_back_to_device_calibration():
+    dev = make_wrapper([CALIBRATIONS['function'],
+                        CALIBRATIONS['interpolation'], [DEFAULT],
+                        CALIBRATIONS['vrhopping'], [DEFAULT]])
+    for ch, r in enumerate([1500.0, 2000.0, 3000.0, 4000.0]):
+        dev.readings[ch + 1] = (r * U.Ohm, datetime.now())
+    temps = [t['K'] for t, _ in dev.getTemperatures()]
+    assert temps == pytest.approx([
+        legacy_temperature(CALIBRATIONS['interpolation'], 1500.0),
+        legacy_temperature(CALIBRATIONS['function'], 2000.0),
+        legacy_temperature(CALIBRATIONS['vrhopping'], 3000.0),
+        legacy_temperature(CALIBRATIONS['function'], 4000.0)])
+    assert dev.getSingleTemp(2)['K'] == pytest.approx(temps[1])
+    assert [n for n, _ in dev.getNamedTemperatures()] == \
+        ['ch1', 'ch2', 'ch3', 'ch4']
+    assert np.allclose(dev.convertResistances(1, [1500.0, 3000.0]), [1, 0.2])
+
+    # a history of readings on all channels, and some with no calibration
+    rng = np.random.RandomState(0)
+    channels = rng.randint(0, 7, size=500)
+    rs = np.exp(rng.uniform(6, 12, size=500))
+    rs[:5] = 0
+    temps = dev.compiled.temperatures(channels, rs)
+    for ch in set(channels):
+        mask = channels == ch
+        assert np.allclose(temps[mask], dev.compiled[ch].temperature(rs[mask]),
+                           rtol=1e-12)
+
+    # the server default is used without any calibration
+    dev = make_wrapper([[DEFAULT], [DEFAULT]])
+    dev.readings[1] = (2000 * U.Ohm, datetime.now())
+    assert dev.getSingleTemp(1)['K'] == \
+        pytest.approx(legacy_temperature([DEFAULT], 2000.0))
+    assert dev.singleTempToRes(dev.getSingleTemp(1)['K'], 1) == \
+        pytest.approx(2000.0)
+    assert dev.singleTempToRes(-1.0, 1) == 0.0
+
+
+@pytest.mark.parametrize('source', [
+    '__import__("os").system("ls")',
+    'r.__class__',
+    'open("/etc/passwd")',
+    'os.path',
+    'math.log(r, base=2)',
+    '[r for r in range(3)]',
+    'lambda: r',
+    'r if r else 1',
+    'x * 2',
+    'math.log(',
+])
+def test_unsafe_expressions_are_rejected(source):
+    with pytest.raises(ValueError):
+        compile_expression(source, 'r')
+
+
+@pytest.mark.parametrize('source', ['np.polyval([1, 2], r)',
+                                    'min(r, 1000)', '1 if r > 1 else 2'])
+def test_invalid_function_reads_zero(source):
+    dev = make_wrapper([[DEFAULT], [FUNCTION, source, 't'], [DEFAULT]])
+    assert dev.calibrations[1] == [FUNCTION, source, 't']
+    for ch in (1, 2):
+        dev.readings[ch] = (2000 * U.Ohm, datetime.now())
+    assert dev.getSingleTemp(1)['K'] == 0.0
+    assert dev.getSingleTemp(2)['K'] > 0.0
+    assert dev.getTemperatures()[0][0]['K'] == 0.0
+    # so regulating on the channel is refused
+    assert dev.singleTempToRes(0.1, 1) == 0.0
+    assert dev.singleTempToRes(0.1, 2) > 0.0
+
+    # channels without a calibration of their own share the device's
+    dev = make_wrapper([[FUNCTION, source, 't'], [DEFAULT]])
+    dev.readings[3] = (2000 * U.Ohm, datetime.now())
+    assert dev.getSingleTemp(3)['K'] == 0.0
+    assert str(dev.compiled[3]).startswith('INVALID')
+
+
+def test_expressions():
+    f = compile_expression('np.sqrt(r) + pow(r, 2) - math.pi * abs(-r)', 'r')
+    x = np.array([1.0, 4.0])
+    assert np.allclose(f(x), np.sqrt(x) + x ** 2 - np.pi * x)
+
+
+def benchmark(n=100000, channels=16):
+    """Time the conversion of n resistances, by calibration type.
+
+    Returns:
+        dict: Maps each calibration to seconds per resistance one at a
+            time as before, and converting the array at once, and 'all
+            channels' to seconds to read the temperatures of all channels.
+    """
+    rs = np.logspace(3, 5, n)
+    times = {}
+    for name, calibration in sorted(CALIBRATIONS.items()):
+        compiled = compile_calibration(calibration) or \
+            Calibrations(None, []).device
+        few = rs[::max(1, n // 2000)]
+        start = time.time()
+        for r in few:
+            legacy_temperature(calibration, r)
+        legacy = (time.time() - start) / len(few)
+        start = time.time()
+        compiled.temperature(rs)
+        times[name] = legacy, (time.time() - start) / n
+
+    # reading all channels of a device
+    dev = make_wrapper([CALIBRATIONS['function']] +
+                       [CALIBRATIONS['interpolation']] * channels, channels)
+    start = time.time()
+    for _ in range(100):
+        [(legacy_temperature(CALIBRATIONS['interpolation'], 1500.0) * U.K,
+          dev.readings[ch][1]) for ch in range(1, channels + 1)]
+    legacy = (time.time() - start) / 100
+    start = time.time()
+    for _ in range(100):
+        dev.getTemperatures()
+    times['all channels'] = legacy, (time.time() - start) / 100
+    return times
+
+
+def test_benchmark():
+    times = benchmark(20000)
+    for name in CALIBRATIONS:
+        legacy, compiled = times[name]
+        assert compiled < legacy
+
+
+if __name__ == '__main__':
+    for name, (legacy, compiled) in sorted(benchmark().items()):
+        print '{:>14}: {:8.2f} us per call before, {:8.3f} us after, ' \
+            '{:6.1f} times faster'.format(name, legacy * 1e6, compiled * 1e6,
+                                          legacy / compiled)
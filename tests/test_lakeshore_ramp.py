@@ -0,0 +1,172 @@
+"""Tests for inverse calibrations and temperature ramps of the Lakeshore 370."""
+
+import numpy as np
+import pytest
+from twisted.internet import task
+
+import labrad.units as U
+import lakeshore370
+from lakeshore.calibration import (Calibrations, Default, Lookup,
+                                   compile_calibration, compile_expression)
+from lakeshore.ramp import Ramp
+
+from simulated_lakeshore import (ModelFridge, SimulatedLakeshore370,
+                                 ThermalModel, make_device)
+from simulated_scope import result
+from test_lakeshore370 import CALIBRATIONS, JULES_INVERSE
+
+T0 = 1.5e9
+
+
+@pytest.fixture
+def clock():
+    clock = task.Clock()
+    clock.advance(T0)
+    return clock
+
+
+def compiled(name):
+    return compile_calibration(CALIBRATIONS[name]) or \
+        Calibrations(None, []).device
+
+
+@pytest.mark.parametrize('name', sorted(CALIBRATIONS))
+def test_lookup_round_trip(name):
+    calibration = compiled(name)
+    lo, hi = calibration.lookup.range
+    # the temperatures of a fridge, within the table
+    temps = np.exp(np.linspace(np.log(max(lo, 1e-3)), np.log(min(hi, 10.0)),
+                               50))[1:-1]
+    rs = calibration.resistance(temps)
+    assert np.all(rs > 0)
+    assert np.allclose(calibration.temperature(rs), temps, rtol=1e-4)
+    # outside the table there is no resistance
+    assert calibration.resistance(lo / 2) == 0.0
+    assert calibration.resistance(hi * 2) == 0.0
+    assert calibration.resistance(-1.0) == 0.0
+
+
+def test_lookup_matches_inverse_function():
+    inverse = compile_expression(JULES_INVERSE, 't')
+    calibration = compiled('function')
+    temps = np.linspace(0.02, 1.0, 100)
+    assert np.allclose(calibration.resistance(temps), inverse(temps),
+                       rtol=1e-5)
+
+
+def test_lookup_keeps_monotonic_part():
+    rs = [np.nan, 10.0, 100.0, 1000.0, 1e4, 1e5, 1e6, 1e7]
+    ts = [1.0, 5.0, 2.0, 1.0, 1.5, 0.1, 0.01, 0.005]
+    lookup = Lookup(rs, ts)
+    assert lookup.range == pytest.approx((0.005, 1.5))
+    assert lookup(0.1) == pytest.approx(1e5)
+    assert Lookup([1.0], [1.0])(1.0) == 0.0
+
+
+def test_linear_ramp():
+    ramp = Ramp.linear(0.1, 0.05, rate=0.01 / 60, interval=10)
+    assert ramp.duration == pytest.approx(300)
+    assert ramp.target == 0.05
+    assert ramp.setpoint(-1) == 0.1
+    assert ramp.setpoint(150) == pytest.approx(0.075)
+    assert ramp.setpoint(1000) == 0.05
+    schedule = ramp.schedule()
+    assert len(schedule) == 31
+    assert schedule[-1] == pytest.approx(300)
+    with pytest.raises(ValueError):
+        Ramp.linear(0.1, 0.2, rate=0, interval=10)
+    with pytest.raises(ValueError):
+        Ramp([0, 10, 5], [0.1, 0.2, 0.3], 1)
+
+
+def test_steps():
+    ramp = Ramp.steps([0.1, 0.2, 0.3], dwell=60)
+    assert ramp.duration == 120
+    assert ramp.interval == 60
+    assert [ramp.setpoint(t) for t in [0, 59, 60, 119, 120, 500]] == \
+        [0.1, 0.1, 0.2, 0.2, 0.3, 0.3]
+    assert list(ramp.schedule()) == [0, 60, 120]
+
+
+def regulated(clock, tau=20.0):
+    stage = ThermalModel(clock, 0.1, tau)
+    instrument = SimulatedLakeshore370(clock, ModelFridge({1: stage, 2: 0.02}),
+                                       Default())
+    dev = make_device(clock, instrument, [1, 2])
+    instrument.write('CSET 1,0,2,1,1,8,100')
+    dev.regulatedChannel = 1
+    dev.setpoint = 0.1
+    return instrument, dev, stage
+
+
+def test_ramp_on_simulated_device(clock):
+    instrument, dev, stage = regulated(clock)
+    progress = []
+    dev.startRamp(Ramp.linear(0.1, 0.05, rate=1e-4, interval=10),
+                  lambda *args: progress.append(args))
+    assert dev.rampStatus()[0]
+    clock.pump([1.0] * 600)
+
+    times = [t - T0 for t, _ in instrument.setpoints]
+    assert times == range(0, 510, 10)
+    temps = [dev.compiled[1].temperature(r) for _, r in instrument.setpoints]
+    assert np.all(np.diff(temps) < 0)
+    assert temps[0] == pytest.approx(0.1, rel=1e-4)
+    assert temps[-1] == pytest.approx(0.05, rel=1e-4)
+    assert progress[-1] == (1, 0.05, 0.05, 1.0)
+    assert [p[3] for p in progress] == pytest.approx(np.linspace(0, 1, 51))
+    assert dev.rampStatus() == (False, 0.05, 0.05, 1.0)
+    # the stage follows, a time constant behind
+    assert stage(clock.seconds()) == pytest.approx(0.05, rel=1e-3)
+
+
+def test_stop_ramp(clock):
+    instrument, dev, stage = regulated(clock)
+    dev.startRamp(Ramp.steps([0.2, 0.3, 0.4], dwell=100))
+    clock.pump([1.0] * 150)
+    dev.stopRamp()
+    count = len(instrument.setpoints)
+    assert count == 2
+    clock.pump([1.0] * 300)
+    assert len(instrument.setpoints) == count
+    assert dev.rampStatus() == (False, 0.3, 0.4, pytest.approx(0.5))
+    assert stage(clock.seconds()) == pytest.approx(0.3, rel=1e-3)
+
+
+def test_ramp_needs_regulation_and_calibration(clock):
+    instrument, dev, stage = regulated(clock)
+    lo, hi = dev.compiled[1].lookup.range
+    with pytest.raises(Exception):
+        dev.startRamp(Ramp.linear(0.1, hi * 2, rate=1, interval=1))
+    dev.regulatedChannel = 0
+    with pytest.raises(Exception):
+        dev.startRamp(Ramp.linear(0.1, 0.2, rate=1, interval=1))
+    assert instrument.setpoints == []
+
+
+def test_settings_take_values(clock):
+    """Settings get their arguments as Values, as sent by LabRAD."""
+    instrument, dev, stage = regulated(clock)
+    server = lakeshore370.LakeshoreRuOxServer()
+    server.selectedDevice = lambda c: dev
+    progress = []
+    server.onRampProgress = progress.append
+    res = result(server.regulate({}, 1, U.Value(0.1, 'K'),
+                                 U.Value(100, 'Ohm')))
+    assert dev.setpoint == 0.1
+    assert instrument.setpoints == [(clock.seconds(), pytest.approx(res))]
+    assert instrument.commands[-2].startswith('CSET 1,0,2,1,1,8,100.0')
+
+    duration = server.ramp_temperature({}, U.Value(0.05, 'K'),
+                                       U.Value(1e-4, 'K/s'))
+    assert duration['s'] == pytest.approx(500)
+    clock.pump([1.0] * 600)
+    assert len(instrument.setpoints) == 1 + 51
+    assert dev.setpoint == pytest.approx(0.05)
+    assert progress[-1][2]['K'] == pytest.approx(0.05)
+
+    duration = server.ramp_steps({}, U.ValueArray([0.06, 0.07], 'K'),
+                                 U.Value(60, 's'))
+    assert duration['s'] == 60
+    clock.pump([1.0] * 100)
+    assert dev.setpoint == pytest.approx(0.07)
@@ -0,0 +1,160 @@
+"""Tests for the channel scheduling of the Lakeshore 370 read loop."""
+
+import numpy as np
+import pytest
+from twisted.internet import task
+
+import lakeshore370
+from lakeshore.calibration import Default
+from lakeshore.scheduler import Scheduler
+
+from simulated_lakeshore import (ModelFridge, SimulatedLakeshore370,
+                                 make_device)
+
+T0 = 1.5e9
+
+
+@pytest.fixture
+def clock():
+    clock = task.Clock()
+    clock.advance(T0)
+    return clock
+
+
+def run(clock, channels, duration, readOrder=None, temperatures=None,
+        **options):
+    """Run the read loop on a simulated 370 for a while.
+
+    Returns:
+        (SimulatedLakeshore370, RuOxWrapper)
+    """
+    temps = dict((ch, 0.01 * ch) for ch in channels)
+    temps.update(temperatures or {})
+    instrument = SimulatedLakeshore370(clock, ModelFridge(temps), Default())
+    dev = make_device(clock, instrument, readOrder or channels, **options)
+    dev.readLoop()
+    clock.pump([0.25] * int(duration * 4))
+    return instrument, dev
+
+
+def test_equal_channels_are_read_in_turn(clock):
+    channels = range(1, 9)
+    instrument, dev = run(clock, channels, 400)
+    intervals = instrument.intervals()
+    assert sorted(intervals) == channels
+    assert np.allclose(intervals.values(), 8, rtol=0.02)
+    # a switch before every reading, and one waiting to settle
+    scans = [c for c in instrument.commands if c.startswith('SCAN')]
+    assert len(scans) == len(instrument.reads) + 1
+    assert all(settled >= 1.0 for _, _, settled in instrument.reads)
+
+
+def test_read_order_sets_default_intervals(clock):
+    instrument, dev = run(clock, range(1, 6), 400,
+                          readOrder=lakeshore370.READ_ORDER)
+    intervals = instrument.intervals(T0 + 20)
+    assert intervals[1] == pytest.approx(2, rel=0.1)
+    for ch in range(2, 6):
+        assert intervals[ch] == pytest.approx(8, rel=0.1)
+
+
+def test_regulated_channel_is_read_more_often(clock):
+    channels = range(1, 17)
+    instrument, dev = run(clock, channels, 1000)
+    before = instrument.intervals()[1]
+    assert before == pytest.approx(16, rel=0.05)
+
+    dev.scheduler.regulated = 1
+    start = clock.seconds()
+    clock.pump([0.25] * 4000)
+    intervals = instrument.intervals(start)
+    assert intervals[1] < before / 2.5
+    # the others are still read
+    assert max(intervals.values()) < 2 * before
+
+
+def test_fast_changing_channels_are_read_more_often(clock):
+    channels = range(1, 13)
+
+    def warming(t):
+        return 0.2 + (t - T0) / 500.0
+    instrument, dev = run(clock, channels, 400, temperatures={5: warming})
+    intervals = instrument.intervals(T0 + 50)
+    quiet = np.mean([intervals[ch] for ch in channels if ch != 5])
+    assert intervals[5] < quiet / 2
+    assert dev.scheduler.rates[5] > dev.scheduler.fastRate
+    assert dev.scheduler.rates[1] == 0
+
+
+def test_refresh_intervals(clock):
+    channels = range(1, 13)
+    targets = dict((ch, 20.0) for ch in channels)
+    targets[2] = 4.0
+    instrument, dev = run(clock, channels, 1200, intervals=targets)
+    intervals = instrument.intervals(T0 + 100)
+    # the targets leave time to spare, so all are read more often
+    assert intervals[2] <= 4.0
+    for ch in channels:
+        if ch != 2:
+            assert 3.5 * intervals[2] < intervals[ch] <= 20.0
+    assert dev.scheduler.interval(2) == 4.0
+
+
+def test_settle_times(clock):
+    channels = range(1, 13)
+    instrument, dev = run(clock, channels, 600, settleTimes={3: 5.0})
+    for t, ch, settled in instrument.reads:
+        assert settled >= (5.0 if ch == 3 else 1.0)
+    # a cycle now takes 16 s
+    intervals = instrument.intervals(T0 + 100)
+    assert np.allclose(intervals.values(), 16, rtol=0.1)
+
+    staleness = dict(dev.getStaleness())
+    assert sorted(staleness) == channels
+    assert all(0 <= t < 60 for t in staleness.values())
+    for ch in channels:
+        assert dev.readings[ch][0]['Ohm'] > 0
+    assert dev.getTemperatures()[0][0]['K'] == pytest.approx(0.01, rel=1e-5)
+
+
+def test_only_channel(clock):
+    instrument, dev = run(clock, range(1, 5), 10)
+    dev.onlyChannel = 2
+    dev.selectChannel(2)
+    count = len(instrument.reads)
+    clock.pump([0.25] * 40)
+    read = [ch for _, ch, _ in instrument.reads[count:]]
+    assert read == [2] * len(read)
+    assert len(read) >= 9
+
+
+def test_failed_select_is_sent_again(clock):
+    instrument, dev = run(clock, range(1, 5), 10)
+    write = instrument.write
+
+    def fail_once(cmd):
+        instrument.write = write
+        raise IOError('GPIB timeout')
+    instrument.write = fail_once
+    dev.onlyChannel = 2
+    failures = []
+    dev.selectChannel(2).addErrback(failures.append)
+    assert failures
+    count = len(instrument.reads)
+    clock.pump([0.25] * 40)
+    # the channel being read when selecting failed may still be read once
+    read = [ch for _, ch, _ in instrument.reads[count:]][1:]
+    assert read == [2] * len(read)
+    assert len(read) >= 8
+
+
+def test_staleness_before_reading():
+    scheduler = Scheduler([1, 2, 1, 3], 2.0)
+    assert scheduler.staleness(T0) == {1: float('inf'), 2: float('inf'),
+                                       3: float('inf')}
+    assert scheduler.interval(1) == 4.0
+    assert scheduler.interval(2) == 8.0
+    assert scheduler.next(T0) == 1
+    scheduler.record(1, 1000.0, T0)
+    assert scheduler.next(T0 + 1) == 2
+    assert scheduler.staleness(T0 + 1)[1] == 1.0
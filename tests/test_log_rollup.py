@@ -0,0 +1,190 @@
+"""Tests for rollups of log channels, and their use by the Logger server."""
+
+import collections
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import mock
+import numpy as np
+import pytest
+
+import labrad.units as U
+import log_server
+from logstore.rollup import RESOLUTIONS
+from logstore.store import LogStore
+
+T0 = 1.5e9 - 1.5e9 % 86400
+
+
+@pytest.fixture
+def root():
+    root = tempfile.mkdtemp(prefix='logtest_')
+    yield root
+    shutil.rmtree(root, ignore_errors=True)
+
+
+class Context(dict):
+    ID = (0, 1)
+
+
+def expected(times, values, resolution):
+    """Rollup records computed one entry at a time."""
+    buckets = collections.OrderedDict()
+    for t, v in zip(times, values):
+        start = t // resolution * resolution
+        if start not in buckets:
+            buckets[start] = [0, v, v, 0.0]
+        b = buckets[start]
+        b[0] += 1
+        b[1] = min(b[1], v)
+        b[2] = max(b[2], v)
+        b[3] += v
+    return buckets
+
+
+def check(rollup, times, values):
+    records = rollup.query(times[0], times[-1])
+    buckets = expected(times, values, rollup.resolution)
+    assert list(records['t']) == list(buckets)
+    n, low, high, total = np.array(buckets.values()).T
+    assert np.array_equal(records['n'], n)
+    assert np.array_equal(records['min'], low)
+    assert np.array_equal(records['max'], high)
+    assert np.allclose(records['sum'], total)
+
+
+def test_rollups_match_raw_data(root):
+    rng = np.random.RandomState(0)
+    # three days of entries with gaps of up to a few minutes
+    times = T0 + np.cumsum(rng.exponential(20, size=12000))
+    values = rng.normal(size=len(times))
+    store = LogStore(root)
+    log, _ = store.open(['fridge'], True)
+    channel = log.addChannel('T', 'v')
+    splits = sorted(rng.randint(0, len(times), size=20))
+    for i, (lo, hi) in enumerate(zip([0] + splits, splits + [len(times)])):
+        channel.append(times[lo:hi], values[lo:hi])
+        if i % 3 == 0:
+            channel.updateRollups()
+        if i == 10:
+            # the open buckets are rebuilt from the entries on reopening
+            store.close()
+            store = LogStore(root)
+            log, _ = store.open(['fridge'])
+            channel = log['T']
+    channel.updateRollups()
+    assert [r.resolution for r in channel.rollups] == RESOLUTIONS
+    for rollup in channel.rollups:
+        check(rollup, times, values)
+
+    # queries return the buckets overlapping the range
+    day = channel.rollups[-1]
+    assert len(day.query(T0 + 86400 + 10, T0 + 86400 + 20)) == 1
+    assert day.size(T0, T0 + 86400) == 2
+    minutes = channel.rollups[0].query(T0 + 3600.5, T0 + 7200)
+    assert minutes['t'][0] == T0 + 3600
+    assert minutes['t'][-1] <= T0 + 7200
+
+
+def test_integer_channels(root):
+    log, _ = LogStore(root).open(['counts'], True)
+    log.add(T0, [('n', 3)])
+    log.add(T0 + 10, [('n', 5)])
+    log.add(T0 + 70, [('n', 1)])
+    records = log['n'].rollups[0].query(T0, T0 + 100)
+    assert list(records['min']) == [3, 1]
+    assert list(records['max']) == [5, 1]
+    assert list(records['sum'] / records['n']) == [4, 1]
+    log.add(T0 + 71, [('state', 'cold')])
+    assert not log['state'].rollups
+
+
+def test_resolution_choice(root):
+    log, _ = LogStore(root).open(['fridge'], True)
+    channel = log.addChannel('T', 'v[mK]')
+    # two days at one entry per 10 s
+    times = T0 + np.arange(0, 2 * 86400, 10.0)
+    channel.append(times, U.ValueArray(np.arange(len(times)) * 1.0, 'mK'))
+    end = times[-1]
+    assert channel.rollup(T0, end, 5000).resolution == 60
+    assert channel.rollup(T0, end, 1000).resolution == 3600
+    assert channel.rollup(T0, end, 10).resolution == 86400
+    assert channel.rollup(T0, end, 1).resolution == 86400
+
+
+def test_server_uses_rollups(root):
+    server = log_server.Logger(LogStore(root))
+    server.onNewLog = mock.Mock()
+    c = Context()
+    server.initContext(c)
+    server.open_log(c, ['fridge'], True)
+    log = server.getLog(c)
+    channel = log.addChannel('T', 'v[K]')
+    times = T0 + np.arange(0, 86400, 1.0)
+    values = np.sin(times / 1000.0)
+    channel.append(times, U.ValueArray(values, 'K'))
+    start = datetime.fromtimestamp(T0)
+    end = start + timedelta(hours=3, seconds=-1)
+
+    temps, = server.get_data(c, ['T'], (start, end), 200)
+    assert len(temps) == 180
+    assert temps[1][0] - temps[0][0] == timedelta(minutes=1)
+    assert np.allclose([v['K'] for t, v in temps[:3]],
+                       [values[i * 60:(i + 1) * 60].mean() for i in range(3)])
+
+    (resolution, records), = server.get_rollup(c, 'T', (start, end), 10)
+    assert resolution == U.Value(3600, 's')
+    assert len(records) == 3
+    t, n, low, mean, high = records[0]
+    assert t == start
+    assert n == 3600
+    assert low['K'] == values[:3600].min()
+    assert high['K'] == values[:3600].max()
+
+    (resolution, records), = server.get_rollup(
+        c, 'T', (start, start + timedelta(seconds=4)), 10)
+    assert resolution == U.Value(0, 's')
+    assert [r[1] for r in records] == [1] * 5
+    assert [r[3]['K'] for r in records] == list(values[:5])
+
+
+def benchmark(days, limit=1000, queries=20):
+    """Time range queries over many days of 1 Hz data.
+
+    Returns:
+        (float, float): Seconds to build the rollups, and per query of the
+            full range.
+    """
+    root = tempfile.mkdtemp(prefix='logbench_')
+    try:
+        log, _ = LogStore(root).open(['bench'], True)
+        channel = log.addChannel('T', 'v[K]')
+        day = np.arange(86400, dtype=float)
+        for i in range(days):
+            channel.append(T0 + i * 86400 + day, np.sin(day / 1000.0))
+        start = time.time()
+        channel.updateRollups()
+        build_time = time.time() - start
+        start = time.time()
+        for _ in range(queries):
+            rollup = channel.rollup(T0, T0 + days * 86400, limit)
+            records = rollup.query(T0, T0 + days * 86400)
+        query_time = (time.time() - start) / queries
+        assert len(records) <= limit
+        return build_time, query_time
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def test_benchmark():
+    build_time, query_time = benchmark(14)
+    assert query_time < 0.01
+
+
+if __name__ == '__main__':
+    days = 365
+    build_time, query_time = benchmark(days)
+    print '{} days of 1 Hz data: rollups built in {:.1f} s, full range ' \
+        'query {:.2f} ms'.format(days, build_time, query_time * 1e3)
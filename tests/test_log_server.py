@@ -0,0 +1,294 @@
+"""Tests for the Logger server and its log store."""
+
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import mock
+import numpy as np
+import pytest
+
+import labrad.units as U
+import log_server
+from logstore.store import ChannelTypeError, LogNotFoundError, LogStore
+
+T0 = 1.5e9
+
+
+@pytest.fixture
+def root():
+    root = tempfile.mkdtemp(prefix='logtest_')
+    yield root
+    shutil.rmtree(root, ignore_errors=True)
+
+
+class Context(dict):
+    def __init__(self, ID=(0, 1)):
+        self.ID = ID
+
+
+def logger(store):
+    server = log_server.Logger(store)
+    server.onNewLog = mock.Mock()
+    server.onNewVar = mock.Mock()
+    server.onNewData = mock.Mock()
+    return server
+
+
+def context(server, ID=(0, 1)):
+    c = Context(ID)
+    server.initContext(c)
+    return c
+
+
+def test_range_queries_across_blocks(root):
+    store = LogStore(root, block=10)
+    log, created = store.open(['fridge', 'temps'], True)
+    assert created
+    channel = log.addChannel('mix', 'v[K]')
+    times = T0 + np.arange(100) * 0.5
+    channel.append(times, U.ValueArray(np.arange(100) * 10.0, 'mK'))
+    assert len(channel.starts) == 5
+    assert len(channel) == 100
+    assert channel.index(T0 + 10) == 20
+    assert channel.index(T0 + 10, 'right') == 21
+    assert channel.index(T0 + 10.25) == 21
+    assert channel.index(T0 - 1) == 0
+    assert channel.index(T0 + 1000) == 100
+
+    t, v = channel.take(np.arange(channel.index(T0 + 9), channel.index(T0 + 21)))
+    assert np.array_equal(t, times[18:42])
+    assert np.allclose(v, np.arange(18, 42) * 0.01)
+
+    indices = channel.select(0, 100, 7)
+    assert list(indices) == [0, 16, 33, 50, 66, 82, 99]
+    t, v = channel.take(indices)
+    assert np.array_equal(t, times[indices])
+    assert np.array_equal(channel.select(10, 15, 7), np.arange(10, 15))
+
+    with pytest.raises(ValueError):
+        channel.append([T0], [1 * U.K])
+
+
+def test_typed_channels(root):
+    store = LogStore(root)
+    log, _ = store.open(['lab'], True)
+    new = log.add(T0, [('T', U.Value(12, 'mK')), ('state', 'cooling'),
+                       ('valves', [True, False]), ('count', 3)])
+    assert sorted(new) == ['T', 'count', 'state', 'valves']
+    assert log['T'].tag == 'v[mK]'
+    assert log['state'].tag == 's'
+    assert log['valves'].tag == '*b'
+    assert log['count'].tag == 'i'
+    assert log.add(T0 + 1, [('T', U.Value(0.013, 'K')), ('state', 'cold'),
+                            ('valves', [False]), ('count', 4)]) == []
+
+    for bad in [('T', 'hot'), ('T', U.Value(1, 'V')), ('state', 1.0),
+                ('count', 1.5), ('valves', 'open')]:
+        with pytest.raises(ChannelTypeError):
+            log.add(T0 + 2, [('count', 5), bad])
+    # nothing is logged from an entry with a bad value
+    assert len(log['count']) == 2
+
+    t, v = log['T'].take([0, 1])
+    assert np.allclose(v, [12, 13])
+    assert log['state'].take([0, 1])[1] == ['cooling', 'cold']
+    assert [list(x) for x in log['valves'].take([1, 0])[1]] == \
+        [[False], [True, False]]
+
+    store.close()
+    log, created = LogStore(root).open(['lab'])
+    assert not created
+    assert log['state'].take([1])[1] == ['cold']
+    assert log['T'].last == T0 + 1
+    with pytest.raises(LogNotFoundError):
+        LogStore(root).open(['lab', 'missing'])
+
+
+def test_integers_out_of_range(root):
+    store = LogStore(root)
+    log, _ = store.open(['lab'], True)
+    log.add(T0, [('count', 3), ('index', 3L)])
+    assert log['index'].tag == 'w'
+    for bad in [('count', 2**40), ('count', 3000000000), ('index', -1),
+                ('index', 2**32)]:
+        with pytest.raises(ChannelTypeError):
+            log.add(T0 + 1, [bad])
+    # a new channel is not made for a value it can't store
+    for name, bad in [('c5', -5L), ('big', 2**40)]:
+        with pytest.raises(ChannelTypeError):
+            log.add(T0 + 1, [('count', 4), (name, bad)])
+        assert name not in log.channels
+    assert len(log['count']) == 1
+    assert log['count'].take([0])[1][0] == 3
+    store.close()
+    assert sorted(LogStore(root).open(['lab'])[0].channels) == \
+        ['count', 'index']
+
+
+def test_channels_without_entries(root):
+    store = LogStore(root)
+    log, _ = store.open(['lab'], True)
+    log.add(T0, [('T', 1.0)])
+    # the server stopped between making a channel and writing to it, and
+    # while making another
+    log.addChannel('P', 'v')
+    os.makedirs(log._newChannel('Q', 'v').directory + '.new')
+    store.close()
+
+    server = logger(LogStore(root))
+    start, last, channels = server.open_log(context(server), ['lab'])
+    assert [ch[:2] for ch in channels] == [('P', 'v'), ('T', 'v')]
+    assert channels[0][2:] == (start, start)
+    log = server.store.open(['lab'])[0]
+    assert len(log['P']) == 0
+    log.add(T0 + 1, [('P', 2.0), ('Q', 3.0)])
+    assert len(log['P']) == 1
+    assert len(log['Q']) == 1
+
+
+def test_incomplete_entries_are_dropped(root):
+    store = LogStore(root)
+    log, _ = store.open(['lab'], True)
+    for i in range(3):
+        log.add(T0 + i, [('x', float(i)), ('s', 'entry %d' % i)])
+    store.close()
+    x = log['x']
+    s = log['s']
+    # a crash while writing the next entries
+    with open(x._file(x.starts[0], 'v'), 'ab') as f:
+        f.write('\x00' * 8)
+    with open(x._file(x.starts[0], 't'), 'ab') as f:
+        f.write('\x00' * 4)
+    with open(s._file(s.starts[0], 'v'), 'ab') as f:
+        f.write('\x00' * 3)
+
+    log, _ = LogStore(root).open(['lab'])
+    assert len(log['x']) == 3
+    assert len(log['s']) == 3
+    log.add(T0 + 3, [('x', 3.0), ('s', 'entry 3')])
+    assert np.array_equal(log['x'].take(range(4))[1], [0, 1, 2, 3])
+    assert log['s'].take([2, 3])[1] == ['entry 2', 'entry 3']
+
+
+def test_server_log_and_get(root):
+    server = logger(LogStore(root))
+    c = context(server)
+    start, last, channels = server.open_log(c, 'fridge/DR1', True)
+    assert channels == []
+    server.onNewLog.assert_called_once_with(['fridge', 'DR1'])
+    with pytest.raises(LogNotFoundError):
+        server.open_log(context(server), 'fridge/DR2')
+
+    for i in range(5):
+        server.log_data(c, [('T', U.Value(10 + i, 'mK')), ('P', 1e-6 * i),
+                            ('state', 'step %d' % i)])
+    assert server.onNewVar.call_count == 3
+    assert server.get_log_list(c) == ['fridge/DR1']
+    assert server.get_log_list(c, ['*/DR2']) == []
+
+    start, last, channels = server.describe(c, ['fridge', 'DR1'])
+    assert [ch[:2] for ch in channels] == [('P', 'v'), ('T', 'v[mK]'),
+                                           ('state', 's')]
+    assert channels[1][3] == last
+
+    end = datetime.now() + timedelta(seconds=1)
+    temps, pressures = server.get_data(c, ['T', 'P'],
+                                       (start - timedelta(seconds=1), end))
+    assert [v['mK'] for t, v in temps] == [10, 11, 12, 13, 14]
+    assert [v for t, v in pressures] == [1e-6 * i for i in range(5)]
+    assert all(isinstance(t, datetime) for t, v in temps)
+    assert abs(temps[0][0] - start) < timedelta(seconds=5)
+
+    # numeric channels are summarized, others are downsampled
+    temps, states = server.get_data(c, ['T', 'state'],
+                                    (start - timedelta(seconds=1), end), 3)
+    assert len(temps) <= 2
+    assert np.mean([v['mK'] for t, v in temps]) == 12
+    assert [v for t, v in states] == ['step 0', 'step 2', 'step 4']
+
+
+def test_server_streaming(root):
+    server = logger(LogStore(root))
+    writer = context(server)
+    reader = context(server, (0, 2))
+    start, _, _ = server.open_log(writer, ['lab'], True)
+    server.open_log(reader, ['lab'])
+    for i in range(5):
+        server.log_data(writer, [('x', float(i))])
+    assert not server.onNewData.called
+
+    since = start - timedelta(seconds=1)
+    x, = server.get_data(reader, ['x'], since, 3)
+    assert [v for t, v in x] == [0, 1, 2]
+    # more is waiting
+    server.onNewData.assert_called_once_with(None, [(0, 2)])
+    x, = server.get_data(reader, ['x'], since, 3)
+    assert [v for t, v in x] == [3, 4]
+    assert server.onNewData.call_count == 1
+
+    server.log_data(writer, [('x', 5.0)])
+    server.log_data(writer, [('x', 6.0)])
+    # listeners are notified once
+    assert server.onNewData.call_args_list[1:] == \
+        [mock.call(None, set([(0, 2)]))]
+    x, = server.get_data(reader, ['x'], since, 3)
+    assert [v for t, v in x] == [5, 6]
+    server.expireContext(reader)
+    assert not server.getLog(writer).listeners
+
+
+def benchmark(n, batch=1000, queries=100):
+    """Ingest n points into a channel and time random range queries.
+
+    Returns:
+        (float, float, float): Ingest rate in points per second, in batches
+            and one entry at a time, and seconds per range query.
+    """
+    root = tempfile.mkdtemp(prefix='logbench_')
+    try:
+        log, _ = LogStore(root).open(['bench'], True)
+        channel = log.addChannel('T', 'v[K]')
+        times = T0 + np.arange(n, dtype=float)
+        values = U.ValueArray(np.random.RandomState(0).normal(size=n), 'K')
+        start = time.time()
+        for i in range(0, n, batch):
+            channel.append(times[i:i + batch], values[i:i + batch])
+        batch_rate = n / (time.time() - start)
+
+        single = min(n, 10000)
+        other = log.addChannel('P', 'v')
+        start = time.time()
+        for t in times[:single]:
+            log.add(t, [('P', 1.0)])
+        single_rate = single / (time.time() - start)
+
+        rng = np.random.RandomState(1)
+        start = time.time()
+        for _ in range(queries):
+            lo, hi = sorted(rng.uniform(T0, T0 + n, 2))
+            indices = channel.select(channel.index(lo),
+                                     channel.index(hi, 'right'), 1000)
+            t, v = channel.take(indices)
+            assert len(t) <= 1000
+        query_time = (time.time() - start) / queries
+        assert len(other) == single
+        return batch_rate, single_rate, query_time
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def test_benchmark():
+    batch_rate, single_rate, query_time = benchmark(200000, queries=20)
+    assert batch_rate > 1e5
+    assert query_time < 0.05
+
+
+if __name__ == '__main__':
+    n = 5 * 10 ** 6
+    batch_rate, single_rate, query_time = benchmark(n)
+    print '{} points: ingest {:.0f} points/s in batches, {:.0f} entries/s ' \
+        'one at a time, range query with limit 1000 {:.2f} ms'.format(
+            n, batch_rate, single_rate, query_time * 1e3)
@@ -0,0 +1,138 @@
+"""Tests for the oscilloscope server wrappers, using a simulated scope."""
+
+import mock
+import numpy as np
+
+import pytest
+
+import labrad.units as U
+from oscilloscope.agilent.DSO91304A import DSO91304AWrapper
+from oscilloscope.server import OscilloscopeServer
+
+from simulated_scope import SimulatedScope, connect, result
+
+
+def check_trace(scope, channel, trace):
+    time, volts = trace
+    assert np.allclose(time['s'], scope.times())
+    # quantized to one sample step
+    assert np.allclose(volts['V'], scope.volts(channel),
+                       atol=scope.y_step(channel))
+
+
+def test_get_traces_one_round_trip():
+    dev, bus = connect()
+    scope = bus.instrument
+    traces = result(dev.get_traces([1, 2, 3, 4]))
+    assert bus.requests == 1
+    assert scope.acquisitions == 1
+    for channel, trace in zip([1, 2, 3, 4], traces):
+        check_trace(scope, channel, trace)
+    # a single trace also takes one request
+    check_trace(scope, 3, result(dev.get_trace(3)))
+    assert bus.requests == 2
+
+
+def test_round_trips_saved():
+    dev, bus = connect()
+    scope = bus.instrument
+    for channel in [1, 2, 3, 4]:
+        result(dev.get_trace(channel))
+    assert bus.requests == 4
+    assert scope.acquisitions == 4
+    bus.requests = 0
+    result(dev.get_traces([1, 2, 3, 4]))
+    assert bus.requests == 1
+    assert scope.acquisitions == 5
+
+
+def test_preambles_cached():
+    dev, bus = connect()
+    scope = bus.instrument
+    result(dev.get_traces([1, 2]))
+    assert scope.commands.count(':WAV:PRE?') == 2
+    result(dev.get_traces([1, 2]))
+    assert scope.commands.count(':WAV:PRE?') == 2
+    # a new channel needs its preamble
+    result(dev.get_traces([1, 2, 3]))
+    assert scope.commands.count(':WAV:PRE?') == 3
+
+
+def test_preamble_invalidation():
+    dev, bus = connect()
+    scope = bus.instrument
+    result(dev.get_traces([1, 2]))
+    del scope.commands[:]
+
+    result(dev.vert_scale(2, 0.2 * U.V))
+    result(dev.vert_position(1, 1.5))
+    assert scope.scale[2] == 0.2
+    assert scope.offset[1] == -1.5 * scope.scale[1]
+    traces = result(dev.get_traces([1, 2]))
+    assert scope.commands.count(':WAV:PRE?') == 2
+    check_trace(scope, 1, traces[0])
+    check_trace(scope, 2, traces[1])
+
+    # querying does not invalidate
+    del scope.commands[:]
+    result(dev.vert_scale(1))
+    result(dev.get_traces([1, 2]))
+    assert scope.commands.count(':WAV:PRE?') == 0
+
+    # horizontal settings invalidate all channels
+    result(dev.record_length(500))
+    traces = result(dev.get_traces([1, 2]))
+    assert scope.commands.count(':WAV:PRE?') == 2
+    assert len(traces[0][0]) == 500
+    check_trace(scope, 2, traces[1])
+    result(dev.horiz_scale(2e-6 * U.s))
+    check_trace(scope, 1, result(dev.get_trace(1)))
+    assert scope.commands.count(':WAV:PRE?') == 3
+
+
+def test_invalidated_during_fetch():
+    dev, bus = connect()
+    scope = bus.instrument
+    send = bus.packet().__class__.send
+
+    def send_and_change(packet):
+        # the scale changes while the transaction is in flight
+        d = send(packet)
+        dev.invalidate_preamble(1)
+        return d
+
+    with mock.patch.object(bus.packet().__class__, 'send', send_and_change):
+        result(dev.get_traces([1]))
+    assert dev.preambles == {}
+
+
+def test_dso91304a_get_trace_reads_screen():
+    dev, bus = connect(wrapper=DSO91304AWrapper)
+    scope = bus.instrument
+    traces = result(dev.get_traces([1, 2]))
+    assert scope.acquisitions == 1
+    assert np.allclose(traces[1][0]['s'], scope.times())
+    # the trace on screen, without acquiring again
+    trace = result(dev.get_trace(2))
+    assert scope.acquisitions == 1
+    assert np.array_equal(trace[1], traces[1][1])
+    assert not any(cmd.startswith(':DIG') for cmd in scope.commands[-6:])
+    # with its preamble read afresh
+    scope.scale[2] = 2.0
+    trace = result(dev.get_trace(2))
+    assert np.allclose(trace[1]['V'], 2 * traces[1][1]['V'])
+    scope.display[3] = False
+    with pytest.raises(RuntimeError):
+        result(dev.get_trace(3))
+
+
+def test_server_get_traces():
+    dev, bus = connect(SimulatedScope(points=200))
+    server = OscilloscopeServer()
+    server.selectedDevice = lambda c: dev
+    time, volts = result(server.get_traces({}, [2, 4]))
+    assert volts.shape == (2, 200)
+    assert np.allclose(time['s'], bus.instrument.times())
+    assert np.allclose(volts[1]['V'], bus.instrument.volts(4),
+                       atol=bus.instrument.y_step(4))
+    assert bus.requests == 1
@@ -0,0 +1,202 @@
+"""Tests for the PNA server, against a fake PNA."""
+
+import mock
+import numpy as np
+import pytest
+from twisted.internet import defer
+
+import labrad.units as U
+
+from fake_pna import connect, response
+from local_datavault import datavault
+from simulated_scope import result
+
+
+class Context(dict):
+    ID = (0, 1)
+
+
+def context(server):
+    c = Context()
+    server.initContext(c)
+    return c
+
+
+def expected(pna, meas, freq):
+    power = pna.power
+    if pna.sweep_type == 'SEGM':
+        power = np.hstack([np.full(s['points'], s['power'])
+                           for s in pna.segments])
+    return response(meas, freq, power, pna.sweeps)
+
+
+def test_sweep_data_one_request():
+    server, dev, bus = connect()
+    pna = bus.instrument
+    c = context(server)
+    result(server.s_parameters(c, ['S11', 'S21', 'S22']))
+    pna.sweep()
+    bus.requests = 0
+    freq, data = result(dev.sweepData(['S11', 'S21', 'S22']))
+    assert bus.requests == 1
+    assert np.allclose(freq, np.linspace(pna.start, pna.stop, pna.points))
+    assert data.shape == (3, pna.points)
+    for meas, row in zip(['S11', 'S21', 'S22'], data):
+        assert np.allclose(row, expected(pna, meas, freq))
+    assert not [cmd for cmd in pna.commands if 'SDATA' in cmd]
+
+
+def test_freq_sweep():
+    server, dev, bus = connect()
+    pna = bus.instrument
+    c = context(server)
+    result(server.s_parameters(c, ['S21', 'S12']))
+    freq, sparams = result(server.freq_sweep(c))
+    assert pna.sweeps == 1
+    assert np.allclose(freq['Hz'], pna.stimulus)
+    assert sparams.shape == (2, pna.points)
+    assert np.allclose(sparams[0], expected(pna, 'S21', pna.stimulus))
+    assert np.allclose(sparams[1], expected(pna, 'S12', pna.stimulus))
+    assert len([cmd for cmd in pna.commands if cmd.startswith('CALC:DATA')]) == 1
+
+
+def test_segments():
+    server, dev, bus = connect()
+    pna = bus.instrument
+    c = context(server)
+    table = [(4.9 * U.GHz, 4.99 * U.GHz, 11L, 10 * U.kHz, U.Value(-20, 'dBm')),
+             (4.999 * U.GHz, 5.001 * U.GHz, 101L, 100 * U.Hz,
+              U.Value(-40, 'dBm')),
+             (5.01 * U.GHz, 5.1 * U.GHz, 11L, 10 * U.kHz, U.Value(-20, 'dBm'))]
+    bus.requests = 0
+    readback = result(server.segments(c, table))
+    assert bus.requests == 3
+    assert len(readback) == 3
+    for seg, read in zip(table, readback):
+        assert read[0]['Hz'] == seg[0]['Hz']
+        assert read[1]['Hz'] == seg[1]['Hz']
+        assert read[2] == seg[2]
+        assert read[3]['Hz'] == seg[3]['Hz']
+        assert read[4]['dBm'] == seg[4]['dBm']
+    assert pna.segments[1]['bandwidth'] == 100
+    assert len(result(server.segments(c))) == 3
+
+    freq, sparams = result(server.segment_sweep(c))
+    assert pna.sweep_type == 'SEGM'
+    assert len(freq) == 11 + 101 + 11
+    assert np.allclose(freq[11:112]['Hz'], np.linspace(4.999e9, 5.001e9, 101))
+    assert sparams.shape == (1, len(freq))
+    assert np.allclose(sparams[0], expected(pna, 'S21', freq['Hz']))
+
+    # a shorter table replaces the old one
+    result(server.segments(c, table[:1]))
+    assert len(pna.segments) == 1
+
+
+def test_get_trace():
+    server, dev, bus = connect()
+    pna = bus.instrument
+    c = context(server)
+    pna.points = 51
+    pna.sweep()
+    # binary data ending in bytes that look like whitespace
+    name = 'labrad_S21'
+    pna.data[name][-1] = complex(1.0, np.frombuffer('?\xf0\x00\x00\x00\x00\x00 ',
+                                                    '>f8')[0])
+    freq, data = result(server.get_trace(c))
+    assert len(freq) == 51
+    assert np.array_equal(data, pna.data[name])
+
+
+
+def series_server(datavault):
+    server, dev, bus = connect()
+    server.client = mock.MagicMock()
+    server.client.data_vault = datavault
+    return server, dev, bus
+
+
+def test_sweep_series_power(datavault):
+    server, dev, bus = series_server(datavault)
+    pna = bus.instrument
+    pna.points = 51
+    c = context(server)
+    result(server.s_parameters(c, ['S21', 'S11']))
+    powers = [-40.0, -30.0, -20.0]
+    path, name = result(server.sweep_series(c, 'power scan', 'power', powers))
+    assert pna.sweeps == 3
+
+    data = result(datavault.get(context=c.ID))
+    assert data.shape == (3 * 51, 6)
+    freq = np.linspace(pna.start, pna.stop, 51)
+    for i, power in enumerate(powers):
+        rows = data[i * 51:(i + 1) * 51]
+        assert np.all(rows[:, 0] == power)
+        assert np.allclose(rows[:, 1], freq)
+        for j, meas in enumerate(['S21', 'S11']):
+            s = response(meas, freq, power, i + 1)
+            assert np.allclose(rows[:, 2 + j], 20 * np.log10(abs(s)))
+            assert np.allclose(rows[:, 4 + j], np.angle(s))
+    independents, dependents = result(datavault.variables(context=c.ID))
+    assert independents == [('power', 'dBm'), ('frequency', 'Hz')]
+    assert dependents[0] == ('S21', 'log mag', 'dB')
+    assert dependents[3] == ('S11', 'phase', 'rad')
+
+
+def test_sweep_series_overlaps_saving(datavault):
+    server, dev, bus = series_server(datavault)
+    pna = bus.instrument
+    pna.points = 11
+    c = context(server)
+    held = []
+    add = datavault.add
+
+    def slow_add(data, context=None):
+        d = defer.Deferred()
+        held.append(d)
+        d.addCallback(lambda _: add(data, context))
+        return d
+    datavault.add = slow_add
+
+    done = server.sweep_series(c, 'repeats', 'repeat', [0, 1, 2])
+    # the second sweep ran while the first was being saved
+    assert pna.sweeps == 2
+    assert len(held) == 1
+    held[0].callback(None)
+    assert pna.sweeps == 3
+    assert len(held) == 2
+    held[1].callback(None)
+    assert not done.called
+    held[2].callback(None)
+    result(done)
+    data = result(datavault.get(context=c.ID))
+    assert np.array_equal(data[:, 0], np.repeat([0, 1, 2], 11))
+
+
+def test_sweep_series_bias(datavault):
+    server, dev, bus = series_server(datavault)
+    pna = bus.instrument
+    pna.points = 11
+    c = context(server)
+    bias = server.client['dc rack']['voltage']
+    result(server.sweep_series(c, 'bias', 'bias', [0.1, 0.2],
+                               False, ('dc rack', 'voltage')))
+    assert bias.call_args_list == [mock.call(0.1), mock.call(0.2)]
+    assert result(datavault.get_parameter('power', context=c.ID)) == \
+        U.Value(-30, 'dBm')
+    with pytest.raises(ValueError):
+        result(server.sweep_series(c, 'bias', 'bias', [0.1]))
+    with pytest.raises(ValueError):
+        result(server.sweep_series(c, 'flux', 'flux', [0.1]))
+
+
+def test_sweep_series_segmented(datavault):
+    server, dev, bus = series_server(datavault)
+    pna = bus.instrument
+    c = context(server)
+    result(server.segments(c, [(5e9 * U.Hz, 5.001e9 * U.Hz, 5L, 1 * U.kHz,
+                                U.Value(-20, 'dBm'))]))
+    result(server.sweep_series(c, 'segments', 'repeat', [0, 1], True))
+    data = result(datavault.get(context=c.ID))
+    assert np.allclose(data[:5, 1], np.linspace(5e9, 5.001e9, 5))
+    assert len(data) == 10
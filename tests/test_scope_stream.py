@@ -0,0 +1,215 @@
+"""Tests for streaming scope traces into the data vault.
+
+The end to end tests run the oscilloscope server against a simulated scope
+and a local data vault instance.
+"""
+
+import mock
+import numpy as np
+import pytest
+from twisted.internet import defer, task
+
+import labrad.units as U
+from oscilloscope.server import OscilloscopeServer
+from oscilloscope.stream import TraceStream, shot_rows
+
+from local_datavault import datavault
+from simulated_scope import SimulatedScope, connect, result
+
+
+def scope_server(dev, dv):
+    server = OscilloscopeServer()
+    server.selectedDevice = lambda c: dev
+    server.client = mock.Mock()
+    server.client.data_vault = dv
+    server.client.context.return_value = (0, 5)
+    server.onStreamProgress = mock.Mock()
+    server.onStreamDropped = mock.Mock()
+    return server
+
+
+def fake_traces(points=4):
+    """get_traces for a stream, returning a shot counter as the signal."""
+    count = [0]
+
+    def get_traces():
+        count[0] += 1
+        time = np.arange(points) * U.ns
+        return defer.succeed([(time, np.full(points, count[0]) * U.V)])
+    return get_traces
+
+
+def test_shot_rows():
+    time = np.array([1e-9, 2e-9]) * U.s
+    rows = shot_rows(3, time, [np.array([0.1, 0.2]) * U.V,
+                               np.array([5.0, 6.0]) * U.mV])
+    assert np.allclose(rows, [[3, 1, 0.1, 0.005], [3, 2, 0.2, 0.006]])
+
+
+def test_stream_end_to_end(datavault):
+    scope = SimulatedScope(points=100)
+    dev, bus = connect(scope)
+    server = scope_server(dev, datavault)
+    c = {}
+    path, name = result(server.stream_start(c, [1, 3], ['', 'stream'],
+                                            'traces', 25, None, 10))
+    assert path == ['', 'stream']
+    assert result(server.stream_wait(c)) == (25, 0)
+    assert server.stream_status(c) == (25, 25, 0, False)
+    assert scope.acquisitions == 25
+    # one bus request per shot, one data vault request per batch
+    assert bus.requests == 25
+    assert datavault.requests == 2 + 3
+
+    data = result(datavault.get(context=(0, 5)))
+    assert data.shape == (2500, 4)
+    assert np.array_equal(data[:, 0], np.repeat(np.arange(25), 100))
+    assert np.allclose(data[:100, 1], scope.times() * 1e9)
+    last = data[-100:]
+    # the simulated signal depends on the acquisition number
+    assert np.allclose(last[:, 2], scope.volts(1), atol=scope.y_step(1))
+    assert np.allclose(last[:, 3], scope.volts(3), atol=scope.y_step(3))
+
+    progress = [args[0][0] for args in server.onStreamProgress.call_args_list]
+    assert progress == [(name, 10, 10), (name, 20, 20), (name, 25, 25)]
+    assert not server.onStreamDropped.called
+
+
+def test_stream_stop(datavault):
+    dev, bus = connect(SimulatedScope(points=10))
+    server = scope_server(dev, datavault)
+    c = {}
+    add = datavault.add
+    held = defer.Deferred()
+
+    def slow_add(data, context=None):
+        # hold the second batch until the stream is stopped
+        d = add(data, context)
+        if datavault.requests == 4:
+            d.addCallback(lambda _: held)
+        return d
+    datavault.add = slow_add
+
+    result(server.stream_start(c, [1], [''], 'traces', 0, None, 5))
+    saved, acquired, dropped, running = server.stream_status(c)
+    assert running
+    assert saved == 5
+    # acquisition waits while the buffer is full
+    assert acquired == 5 + 4 * 5
+    stopped = server.stream_stop(c)
+    assert not stopped.called
+    held.callback(None)
+    assert result(stopped) == (acquired, 0)
+    assert len(result(datavault.get(context=(0, 5)))) == 10 * acquired
+
+
+def test_already_streaming(datavault):
+    dev, bus = connect(SimulatedScope(points=10))
+    server = scope_server(dev, datavault)
+    datavault.add = lambda data, context=None: defer.Deferred()
+    c = {}
+    result(server.stream_start(c, [1], [''], 'traces', 0, None, 1))
+    with pytest.raises(RuntimeError):
+        result(server.stream_start(c, [1], [''], 'traces', 0, None, 1))
+    server.expireContext(c)
+    assert not c['stream'].running
+
+
+def test_backpressure():
+    writes = []
+
+    def add(rows):
+        writes.append(defer.Deferred())
+        writes[-1].rows = rows
+        return writes[-1]
+
+    stream = TraceStream(fake_traces(), add, shots=100, batch=4, buffered=8)
+    done = stream.start()
+    # one batch being written, and the buffer is full
+    assert len(writes) == 1
+    assert stream.status() == (0, 8, 0, True)
+    writes[0].callback(None)
+    assert stream.status() == (4, 12, 0, True)
+    while not done.called:
+        writes[-1].callback(None)
+    assert result(done) == (100, 0)
+    assert len(writes) == 25
+    shots = np.vstack([w.rows for w in writes])[:, 2]
+    assert np.array_equal(shots, np.repeat(np.arange(1, 101), 4))
+
+
+def test_rate_drops_shots():
+    clock = task.Clock()
+    writes = []
+
+    def add(rows):
+        writes.append(defer.Deferred())
+        return writes[-1]
+
+    dropped = []
+    stream = TraceStream(fake_traces(), add, rate=10, batch=2, buffered=4,
+                         dropped=dropped.append, clock=clock)
+    stream.start()
+    assert stream.acquired == 1
+    clock.advance(0.1)
+    # first batch is being written
+    assert stream.status() == (0, 2, 0, True)
+    clock.pump([0.1] * 4)
+    # buffer filled up after two more shots, then two were dropped
+    assert stream.status() == (0, 4, 2, True)
+    assert dropped == [1, 2]
+    writes[0].callback(None)
+    clock.advance(0.1)
+    assert stream.status() == (2, 5, 2, True)
+
+    # a slow fetch makes us miss shots
+    stream.get_traces = lambda: task.deferLater(clock, 0.35, fake_traces())
+    for d in writes[1:]:
+        d.callback(None)
+    clock.advance(0.1)
+    clock.advance(0.35)
+    # shots came due at 0.7 and 0.8 during the fetch, and the one due at
+    # 0.9 is being fetched late
+    assert stream.dropped == 4
+    assert dropped[-1] == 4
+    assert stream.acquired == 6
+    stream.stop()
+    clock.advance(1)
+    while not writes[-1].called:
+        writes[-1].callback(None)
+    assert result(stream.wait()) == (7, 4)
+
+
+def test_shot_count_with_rate():
+    clock = task.Clock()
+    stream = TraceStream(fake_traces(), lambda rows: defer.succeed(None),
+                         shots=5, rate=100, batch=2, clock=clock)
+    done = stream.start()
+    clock.pump([0.01] * 10)
+    assert result(done) == (5, 0)
+
+
+def test_errors_stop_stream():
+    def get_traces():
+        if stream.acquired == 3:
+            return defer.fail(IOError('scope went away'))
+        return fake_traces()()
+
+    progress = []
+    stream = TraceStream(get_traces, lambda rows: defer.succeed(None),
+                         batch=2, progress=lambda *args: progress.append(args))
+    done = stream.start()
+    with pytest.raises(IOError):
+        result(done)
+    # shots acquired before the error are still saved
+    assert progress == [(2, 2), (3, 3)]
+    assert not stream.status()[3]
+
+    def add(rows):
+        raise ValueError('data vault says no')
+    stream = TraceStream(fake_traces(), add, batch=2)
+    with pytest.raises(ValueError):
+        result(stream.start())
+    assert stream.acquired <= stream.buffered
+    with pytest.raises(ValueError):
+        result(stream.wait())
@@ -0,0 +1,239 @@
+"""Tests for serial_server.py, using a pseudo-terminal as the serial port."""
+
+import os
+import select
+import threading
+import time
+
+import mock
+import pytest
+import tty
+from labrad import types as T
+from twisted.internet import reactor
+from twisted.python import failure
+
+import serial_server
+
+
+def wait(d, timeout=5.0):
+    """Run the reactor until d fires."""
+    results = []
+    d.addBoth(results.append)
+    end = time.time() + timeout
+    while not results and time.time() < end:
+        reactor.iterate(0.001)
+    assert results, 'timed out'
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+class Responder(threading.Thread):
+    """Device at the far end of the port answering each line it receives."""
+
+    def __init__(self, fd, answer):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = fd
+        self.answer = answer
+        self.running = True
+
+    def run(self):
+        buf = ''
+        while self.running:
+            if not select.select([self.fd], [], [], 0.01)[0]:
+                continue
+            buf += os.read(self.fd, 4096)
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                os.write(self.fd, self.answer(line))
+
+
+class TestSerialServer(object):
+
+    def setup_method(self, method):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+        os.close(slave)
+        self.server = serial_server.SerialServer()
+        self.server.client = mock.MagicMock()
+        self.server.SerialPorts = [serial_server.SerialDevice('pty', path)]
+        self.c = {}
+        self.server.initContext(self.c)
+        assert self.server.open(self.c, 'pty') == 'pty'
+
+    def teardown_method(self, method):
+        self.server.close(self.c)
+        os.close(self.master)
+
+    def setTimeout(self, seconds):
+        self.server.timeout(self.c, T.Value(seconds, 's'))
+
+    def send(self, data, delay=0):
+        reactor.callLater(delay, os.write, self.master, data)
+
+    def timed(self, d):
+        start = time.time()
+        ans = wait(d)
+        return ans, time.time() - start
+
+    def test_read_count_wakes_on_data(self):
+        self.setTimeout(5)
+        self.send('abc', 0.05)
+        self.send('defgh', 0.1)
+        ans, elapsed = self.timed(self.server.read(self.c, 6))
+        assert ans == 'abcdef'
+        assert elapsed < 1
+        # the rest stays buffered
+        assert wait(self.server.read(self.c, 2)) == 'gh'
+
+    def test_read_count_partial_on_timeout(self):
+        self.setTimeout(0.2)
+        self.send('ab')
+        ans, elapsed = self.timed(self.server.read(self.c, 5))
+        assert ans == 'ab'
+        assert 0.15 < elapsed < 1
+
+    def test_read_all(self):
+        self.setTimeout(5)
+        assert wait(self.server.read(self.c)) == ''
+        os.write(self.master, 'xyz')
+        time.sleep(0.05)
+        assert wait(self.server.read(self.c)) == 'xyz'
+
+    def test_read_line(self):
+        self.setTimeout(5)
+        self.send('first\r\nsec', 0.05)
+        self.send('ond\r\n', 0.1)
+        ans, elapsed = self.timed(self.server.read_line(self.c))
+        assert ans == 'first'
+        assert elapsed < 1
+        assert wait(self.server.read_line(self.c)) == 'second'
+
+    def test_read_line_delimiter(self):
+        self.setTimeout(5)
+        self.send('1;2;')
+        assert wait(self.server.read_line(self.c, ';')) == '1'
+        assert wait(self.server.read_line(self.c, ';')) == '2'
+
+    def test_read_line_timeout(self):
+        self.setTimeout(0.2)
+        self.send('no end')
+        ans, elapsed = self.timed(self.server.read_line(self.c))
+        assert ans == 'no end'
+        assert elapsed > 0.15
+
+    def test_immediate_read(self):
+        self.setTimeout(0)
+        assert wait(self.server.read_line(self.c)) == ''
+        os.write(self.master, 'ab\n')
+        time.sleep(0.05)
+        assert wait(self.server.read_line(self.c)) == 'ab'
+
+    def test_requests_served_in_order(self):
+        self.setTimeout(5)
+        first = self.server.read(self.c, 3)
+        second = self.server.read_line(self.c)
+        self.send('123line\n', 0.05)
+        assert wait(first) == '123'
+        assert wait(second) == 'line'
+
+    def test_read_as_words(self):
+        self.setTimeout(5)
+        self.send('\x01\xff')
+        assert wait(self.server.read_as_words(self.c, 2)) == [1, 255]
+
+    def test_close_fails_pending(self):
+        self.setTimeout(5)
+        d = self.server.read(self.c, 3)
+        self.server.close(self.c)
+        with pytest.raises(Exception):
+            wait(d)
+        with pytest.raises(serial_server.NoPortSelectedError):
+            self.server.read(self.c, 3)
+
+    def test_read_lines_count(self):
+        self.setTimeout(5)
+        self.send('a\r\nb\r\nc\r\nd\r\n')
+        assert wait(self.server.read_lines(self.c, 3)) == ['a', 'b', 'c']
+        assert wait(self.server.read_line(self.c)) == 'd'
+
+    def test_read_lines_end(self):
+        self.setTimeout(5)
+        self.send('x=1;y=2;', 0.05)
+        self.send('END;z=3;', 0.1)
+        ans = wait(self.server.read_lines(self.c, 0, 'END', ';'))
+        assert ans == ['x=1', 'y=2']
+        assert wait(self.server.read_line(self.c, ';')) == 'z=3'
+        # the count can stop the reply before the end line
+        self.send('1;2;3;END;')
+        assert wait(self.server.read_lines(self.c, 2, 'END', ';')) == ['1', '2']
+
+    def test_read_lines_timeout(self):
+        self.setTimeout(0.2)
+        self.send('one\ntwo\nthr')
+        ans, elapsed = self.timed(self.server.read_lines(self.c, 5))
+        assert ans == ['one', 'two', 'thr']
+        assert elapsed > 0.15
+
+    def test_read_lines_needs_limit(self):
+        with pytest.raises(Exception):
+            self.server.read_lines(self.c)
+
+    def test_read_until(self):
+        self.setTimeout(5)
+        self.send('abc\r\n>', 0.05)
+        self.send('\r\n>def', 0.1)
+        assert wait(self.server.read_until(self.c, '\r\n>\r\n>')) == \
+            'abc\r\n>\r\n>'
+        assert wait(self.server.read(self.c)) == 'def'
+
+    def test_read_until_regex(self):
+        self.setTimeout(5)
+        self.send('#3123\x06rest')
+        ans = wait(self.server.read_until(self.c, '[\x06\x15]', True))
+        assert ans == '#3123\x06'
+        with pytest.raises(Exception):
+            self.server.read_until(self.c, '(', True)
+
+    def test_query(self):
+        self.setTimeout(5)
+        responder = Responder(self.master, lambda line: line.upper() + '\r\n')
+        responder.start()
+        try:
+            assert wait(self.server.query(self.c, 'idn?\n')) == 'IDN?'
+            assert wait(self.server.query(self.c, 'ab\n', 3)) == 'AB\r'
+            assert wait(self.server.query(self.c, 'x\n', '\r\n')) == '\nX\r\n'
+        finally:
+            responder.running = False
+            responder.join()
+
+    def test_query_latency(self):
+        self.setTimeout(5)
+        lines = 20
+        reply = ''.join('line {}\r\n'.format(i) for i in range(lines))
+        responder = Responder(self.master, lambda line: reply + 'END\r\n')
+        responder.start()
+        try:
+            # one request for the whole reply
+            start = time.time()
+            n = 20
+            for _ in range(n):
+                self.server.write_line(self.c, 'LIST?')
+                ans = wait(self.server.read_lines(self.c, 0, 'END'))
+                assert len(ans) == lines
+            batched = (time.time() - start) / n
+            # versus one request per line
+            start = time.time()
+            for _ in range(n):
+                self.server.write_line(self.c, 'LIST?')
+                for _ in range(lines + 1):
+                    wait(self.server.read_line(self.c))
+            single = (time.time() - start) / n
+        finally:
+            responder.running = False
+            responder.join()
+        print 'read lines: {:.2f} ms, read line x {}: {:.2f} ms'.format(
+            batched * 1e3, lines + 1, single * 1e3)
+        assert batched < 0.05
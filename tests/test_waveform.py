@@ -0,0 +1,237 @@
+"""Tests for oscilloscope/waveform.py and the scope drivers using it.
+
+Run this file from the servers directory to benchmark decoding of a 10M point
+record against the struct based decoding the scope drivers used before,
+
+    PYTHONPATH=. python tests/test_waveform.py
+"""
+
+import imp
+import os
+import struct
+import time
+
+import numpy as np
+import pytest
+
+import labrad.units as U
+from oscilloscope import waveform
+from oscilloscope.agilent import DSO91304A, DSOX4104A
+import agilent_DSO7104B
+import agilent_infiniium_scope
+import sampling_scope
+import tektronix5104B
+
+from simulated_scope import connect, result
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+tektronix2014B = imp.load_source(
+    'tektronixTDS2014B', os.path.join(ROOT, 'Tektronix2014B',
+                                      'tektronixTDS2014B.py'))
+tektronix5054B = imp.load_source(
+    'tektronix5054B', os.path.join(ROOT, 'Tektronix5054B',
+                                   'tektronix5054B.py'))
+
+
+def make_block(samples, dtype, terminator='\n'):
+    data = np.asarray(samples).astype(dtype).tostring()
+    length = str(len(data))
+    return '#{}{}{}{}'.format(len(length), length, data, terminator)
+
+
+def struct_decode(data, word_length, fmt):
+    """Decode a block the way the drivers used to."""
+    offset = 2 + int(data[1])
+    wave_len = int(data[2:offset])
+    wave_data = data[offset:offset + wave_len]
+    num_words = wave_len // word_length
+    return np.array(struct.unpack(fmt[0] + fmt[1:] * num_words, wave_data))
+
+
+def random_samples(n, dtype, seed=0):
+    info = np.iinfo(dtype)
+    rng = np.random.RandomState(seed)
+    return rng.randint(info.min, int(info.max) + 1, n).astype(dtype)
+
+
+def test_block_range():
+    assert waveform.block_range('#15abcde\n') == (3, 8)
+    assert waveform.block_range('xx#210' + 'a' * 10, 2) == (6, 16)
+    assert waveform.block_range('#0abc\n') == (2, 5)
+    for bad in ['15abcde', '#x5abcde', '#25abc', '#19abc', '']:
+        with pytest.raises(ValueError):
+            waveform.block_range(bad)
+
+
+@pytest.mark.parametrize('word_length, signed, msb_first, fmt', [
+    (1, True, True, '>b'),
+    (1, False, True, '>B'),
+    (2, True, True, '>h'),
+    (2, False, True, '>H'),
+    (2, True, False, '<h'),
+    (4, True, True, '>i'),
+])
+def test_decode_block(word_length, signed, msb_first, fmt):
+    dtype = waveform.sample_dtype(word_length, signed, msb_first)
+    samples = random_samples(1000, dtype.newbyteorder('='))
+    block = make_block(samples, dtype)
+    decoded = waveform.decode_block(block, dtype)
+    assert np.array_equal(decoded, samples)
+    assert np.array_equal(decoded, struct_decode(block, word_length, fmt))
+
+
+def test_decode_floats():
+    dtype = waveform.sample_dtype(4, floating=True)
+    samples = np.linspace(-1, 1, 101).astype('f4')
+    decoded = waveform.decode_block(make_block(samples, dtype), dtype)
+    assert np.array_equal(decoded, samples)
+
+
+def test_decode_samples_partial_word():
+    assert np.array_equal(waveform.decode_samples('\x00\x01\x00\x02\x00', '>i2'),
+                          [1, 2])
+    assert np.array_equal(
+        waveform.decode_samples('xx\x00\x01\x00\x02\x00', '>i2', 2, 6), [1, 2])
+
+
+def test_scale():
+    raw = np.array([0, 100, 65535], dtype='>u2')
+    # unsigned samples must not wrap around when the reference is subtracted
+    scaled = waveform.scale(raw, 0.5, 1.0, 32768)
+    assert np.allclose(scaled, (raw.astype(float) - 32768) * 0.5 + 1.0)
+    volts = waveform.scale(raw, 2e-3, unit='V')
+    assert volts.unit == U.V
+    assert np.allclose(volts['mV'], raw * 2.0)
+    times = waveform.time_axis(4, 1.0, -2.0, 1, unit=U.ns)
+    assert np.allclose(times['ps'], [-3000, -2000, -1000, 0])
+
+
+def test_parse_preamble():
+    preamble = '0,1,2000,1,2.0E-09,-1.0E-06,0,1.5E-03,0.1,32768,junk\n'
+    fields = waveform.parse_preamble(preamble)
+    assert fields['num_points'] == 2000
+    assert fields['x_step'] == 2e-9
+    assert fields['x_origin'] == -1e-6
+    assert fields['y_reference'] == 32768
+    assert len(fields) == len(waveform.AGILENT_PREAMBLE_KEYS)
+    assert waveform.parse_per_div('100.0mV/div') == (100.0, 'mV')
+
+
+def test_tektronix5104B():
+    samples = random_samples(500, 'i2')
+    block = make_block(samples, '>i2')
+    decoded = tektronix5104B._parseBinaryData(block, wordLength=2)
+    assert np.array_equal(decoded, struct_decode(block, 2, '>h'))
+
+
+def test_infiniium():
+    samples = random_samples(500, 'i2')
+    block = make_block(samples, '>i2')
+    decoded = agilent_infiniium_scope._parseBinaryData(block, word_length=2)
+    assert np.array_equal(decoded, samples)
+    with pytest.raises(ValueError):
+        agilent_infiniium_scope._parseBinaryData(block[:-100], word_length=2)
+
+
+def test_agilent_wrappers():
+    samples = random_samples(500, 'u2')
+    block = make_block(samples, '>u2')
+    assert np.array_equal(DSOX4104A.parse_binary_waveform(block, 2), samples)
+    samples = random_samples(500, 'i2')
+    block = make_block(samples, '>i2')
+    assert np.array_equal(DSO91304A.parse_binary_waveform(block, 2), samples)
+
+
+def test_sampling_scope():
+    samples = random_samples(300, 'i2')
+    data = samples.astype('<i2').tostring()
+    resp = ('WFMPRE XZERO:1.5E-9,XINCR:2.0E-12,YZERO:0.1,YMULT:1.0E-3,'
+            ';CURVE %' + struct.pack('<H', len(data) + 1) + data + '\x7f')
+    xzero, xincr, vals = sampling_scope._parseBinaryData(resp)
+    assert (xzero, xincr) == (1.5e-9, 2e-12)
+    assert np.allclose(vals, samples * 1e-3 + 0.1)
+
+
+class CurveInstrument(object):
+    """Scope sending a binary curve, and fixed answers to other queries."""
+
+    def __init__(self, curve, answers=None):
+        self.curve = curve
+        self.answers = answers or {}
+        self.output = ''
+
+    def write(self, cmd):
+        cmd = cmd.strip()
+        if cmd in ('CURV?', ':WAV:DATA?'):
+            self.output = self.curve
+        elif cmd in self.answers:
+            self.output = self.answers[cmd] + '\n'
+
+    def read_raw(self):
+        output, self.output = self.output, ''
+        return output
+
+    def query(self, cmd):
+        self.write(cmd)
+        return self.read_raw().strip()
+
+
+# the last sample ends with a byte that looks like whitespace
+WHITESPACE_SAMPLES = [5, -3, 7, 10]
+
+
+@pytest.mark.parametrize('module, wrapper, query, dtype', [
+    (tektronix5104B, 'Tektronix5104BWrapper', 'CURV?', '>i2'),
+    (agilent_DSO7104B, 'Agilent7104BWrapper', ':WAV:DATA?', '>u2'),
+    (tektronix2014B, 'Tektronix2014BWrapper', 'CURV?', 'i1'),
+    (tektronix5054B, 'Tektronix5054BWrapper', 'CURV?', '>i2')])
+def test_curve_ending_in_whitespace(module, wrapper, query, dtype):
+    samples = np.array(WHITESPACE_SAMPLES).astype(dtype)
+    block = make_block(samples, dtype)
+    dev, bus = connect(CurveInstrument(block), getattr(module, wrapper))
+    # responses to query are stripped, so the block is cut short
+    with pytest.raises(ValueError):
+        waveform.decode_block(result(dev.query(query)), dtype)
+    data = result(dev.queryBinary(query))
+    assert data == block
+    assert np.array_equal(waveform.decode_block(data, dtype), samples)
+
+
+def test_tektronix2014B_get_trace():
+    block = make_block(WHITESPACE_SAMPLES, 'i1')
+    preamble = ('1;8;BIN;RI;MSB;4;"Ch1, DC coupling, 2.0E0 V/div, '
+                '5.0E-4 s/div, 2500 points, Sample mode";Y;s;2.0E-6;0;0;'
+                'V;8.0E-2;0;0')
+    dev, bus = connect(CurveInstrument(block, {'WFMP?': preamble}),
+                       tektronix2014B.Tektronix2014BWrapper)
+    server = tektronix2014B.Tektronix2014BServer()
+    server.selectedDevice = lambda c: dev
+    times, volts = result(server.get_trace({}, 1, 1, 4))
+    assert len(times) == len(volts) == 4
+    assert np.allclose(volts, np.array(WHITESPACE_SAMPLES) * 10.0 / 127)
+
+
+def compare_speed(n):
+    """Decode and scale an n point record both ways, returning the times."""
+    block = make_block(random_samples(n, 'i2'), '>i2')
+    start = time.time()
+    old = struct_decode(block, 2, '>h') * 1e-3 + 0.1
+    struct_time = time.time() - start
+    start = time.time()
+    new = waveform.scale(waveform.decode_block(block, '>i2'), 1e-3, 0.1)
+    numpy_time = time.time() - start
+    assert np.allclose(old, new)
+    return struct_time, numpy_time
+
+
+def test_faster_than_struct():
+    struct_time, numpy_time = compare_speed(10 ** 5)
+    assert numpy_time < struct_time
+
+
+if __name__ == '__main__':
+    n = 10 ** 7
+    struct_time, numpy_time = compare_speed(n)
+    print '{} points: struct {:.3f} s, numpy {:.3f} s, {:.0f}x faster'.format(
+        n, struct_time, numpy_time, struct_time / numpy_time)